@@ -22,6 +22,7 @@ import getopt
 
 from printrun.printcore import printcore
 from printrun.utils import setup_logging
+from printrun import compressed
 from printrun import gcoder
 
 if __name__ == '__main__':
@@ -85,8 +86,8 @@ if __name__ == '__main__':
     p = printcore(port, baud)
     p.loud = loud
     time.sleep(2)
-    gcode = [i.strip() for i in open(filename)]
-    gcode = gcoder.LightGCode(gcode)
+    # Print the first layers while the rest of the file is parsed
+    gcode = gcoder.LightStreamingGCode(compressed.open_gcode(filename))
     p.startprint(gcode)
 
     try:
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import getopt
+import logging
+import traceback
+
+from printrun.farm import Farm, FarmShell
+from printrun.utils import setup_logging
+
+if __name__ == "__main__":
+    setup_logging(sys.stdout)
+
+    usage = "Usage:\n"+\
+            "  printfarm [OPTIONS]\n\n"+\
+            "Options:\n"+\
+            "  -w, --workers=COUNT\t\tThreads running the event handlers and parsing files. Default value is 4\n"+\
+            "  -c, --cache=DIRECTORY\t\tCache the parsed G-code files in this directory\n"+\
+            "  -e, --execute=COMMAND\t\tExecute a command on startup, e.g. \"add left /dev/ttyUSB0 115200\"; may be repeated\n"+\
+            "  -h, --help\t\t\tPrint this help message and exit\n"
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "w:c:e:h",
+                                   ["workers=", "cache=", "execute=", "help"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        print(usage)
+        sys.exit(2)
+    workers = 4
+    cache_dir = None
+    commands = []
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            print(usage)
+            sys.exit(0)
+        elif o in ('-w', '--workers'):
+            try:
+                workers = int(a)
+            except ValueError:
+                print("Invalid COUNT value '%s'\n" % a)
+                print(usage)
+                sys.exit(2)
+        elif o in ('-c', '--cache'):
+            cache_dir = a
+        elif o in ('-e', '--execute'):
+            commands.append(a)
+
+    interp = FarmShell(Farm(workers, cache_dir))
+    try:
+        for command in commands:
+            interp.onecmd(command)
+        interp.cmdloop()
+    except KeyboardInterrupt:
+        pass
+    except:
+        logging.error("Caught an exception, exiting:\n"
+                      + traceback.format_exc())
+    finally:
+        interp.close()
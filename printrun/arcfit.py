@@ -0,0 +1,374 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Replacement of the polylines of short G1 moves with G2/G3 arcs.
+
+Slicers approximate curved perimeters with many short G1 segments, which
+a printer fed over a serial line may not receive as fast as it prints
+them. `ArcFitter` finds the runs of consecutive extruding G1 moves in the
+XY plane whose points lie on a circle within `tolerance` (the points and
+the middle of the segments) and replaces each run with one G2
+(clockwise) or G3 (counter-clockwise) move to the same end point, with
+the same total extrusion and the same feedrate. A run is only merged
+when its segments extrude evenly along their length, so that the arc
+deposits the filament as the segments did.
+
+Only moves in absolute millimeters are fitted; a move carrying any other
+word than G1 X Y Z E F ends the run, as does a feedrate change. The file
+is read as text, so any parsed `GCode` can be fitted. `ArcFitter.fit`
+returns a new `GCode` parsed from the fitted lines, whose layers and
+indexes are its own, with an `ArcFitReport` of the lines and bytes
+saved.
+"""
+
+import math
+import sys
+
+from . import gcoder
+from . import tokenizer
+
+# Words a fitted segment may carry
+SEGMENT_WORDS = frozenset("gxyzef")
+POSITION_WORDS = frozenset("xyzef")
+tokenize = tokenizer.tokenize
+
+def format_number(value, decimals):
+    """Format `value` with at most `decimals` decimals, without trailing
+    zeros"""
+    text = ("%.*f" % (decimals, value)).rstrip("0").rstrip(".")
+    return "0" if text in ("-0", "") else text
+
+def line_size(line):
+    """Size of `line` in the file, with its newline"""
+    return len(line if line.isascii() else line.encode("utf-8")) + 1
+
+class Segment:
+    """An extruding G1 move of a run"""
+
+    __slots__ = ("raw", "start", "end", "x", "y", "e", "f", "de",
+                 "relative_e", "dx", "dy", "length", "feed_change")
+
+    def __init__(self, raw, start, end, words, de, relative_e,
+                 feed_change):
+        self.raw = raw
+        self.start = start
+        self.end = end
+        self.x = words["x"]
+        self.y = words["y"]
+        self.e = words["e"]
+        self.f = words.get("f")
+        self.de = de
+        self.relative_e = relative_e
+        self.dx = end[0] - start[0]
+        self.dy = end[1] - start[1]
+        self.length = math.hypot(self.dx, self.dy)
+        self.feed_change = feed_change
+
+class ArcFitReport:
+    """Counts of the lines and bytes (with their newline) before and after
+    fitting"""
+
+    def __init__(self):
+        self.lines_before = 0
+        self.lines_after = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.arcs = 0
+        # Number of G1 moves replaced by the arcs
+        self.segments = 0
+
+    @property
+    def lines_saved(self):
+        return self.lines_before - self.lines_after
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_before - self.bytes_after
+
+    def __str__(self):
+        return ("%d arcs replace %d moves: %d lines (%.1f%%) and %d bytes "
+                "(%.1f%%) saved"
+                % (self.arcs, self.segments, self.lines_saved,
+                   100. * self.lines_saved / max(self.lines_before, 1),
+                   self.bytes_saved,
+                   100. * self.bytes_saved / max(self.bytes_before, 1)))
+
+class ArcFitter:
+    """Fit runs of at least `min_segments` G1 moves to arcs.
+
+    `tolerance` (mm) is the largest distance allowed between the arc and
+    the points and segment middles it replaces, `extrusion_tolerance` the
+    largest relative difference between the extrusion per mm of a segment
+    and of the whole arc. Arcs are limited to `max_segments` moves and to
+    `max_radius` (mm), beyond which a run is better left as straight moves.
+    Arc centers are written with `decimals` decimals, relative extrusions
+    with `e_decimals`.
+    """
+
+    def __init__(self, tolerance = 0.01, min_segments = 3,
+                 max_segments = 256, max_radius = 500.,
+                 extrusion_tolerance = 0.05, decimals = 3, e_decimals = 5):
+        self.tolerance = tolerance
+        self.min_segments = max(min_segments, 2)
+        self.max_segments = max_segments
+        self.max_radius = max_radius
+        self.extrusion_tolerance = extrusion_tolerance
+        self.decimals = decimals
+        self.e_decimals = e_decimals
+
+    def fit(self, gcode):
+        """Return the arc fitted copy of `gcode` and its ArcFitReport"""
+        lines, report = self.fit_lines(line.raw for line in gcode.lines)
+        cls = gcoder.LightGCode if gcode.line_class is gcoder.LightLine \
+            else gcoder.GCode
+        fitted = cls(lines, gcode.home_pos,
+                     cutting_as_extrusion = gcode.cutting_as_extrusion)
+        return fitted, report
+
+    def fit_lines(self, lines):
+        """Return the list of the arc fitted G-code `lines` and the
+        ArcFitReport"""
+        report = ArcFitReport()
+        output = []
+        run = []
+        # Position and extrusion in the coordinates of the file and
+        # feedrate, None while unknown
+        position = dict.fromkeys("xyze")
+        feed = None
+        relative = relative_e = imperial = False
+        for raw in lines:
+            raw = raw.strip()
+            if not raw:
+                continue
+            report.lines_before += 1
+            report.bytes_before += line_size(raw)
+            words = {}
+            other = False
+            for letter, value in tokenize(raw):
+                if letter in SEGMENT_WORDS:
+                    if letter not in words:
+                        words[letter] = value
+                elif letter != "(" and letter != ";":
+                    other = True
+                    if letter not in words:
+                        words[letter] = value
+            command = words.get("g")
+            if command is not None:
+                command = "G" + command
+            elif "m" in words:
+                command = "M" + words["m"]
+            values = {}
+            for letter in words:
+                if letter in POSITION_WORDS:
+                    try:
+                        values[letter] = float(words[letter])
+                    except ValueError:
+                        other = True
+            segment = None
+            if command == "G1" and not other and not relative \
+                    and not imperial and "x" in values and "y" in values \
+                    and "e" in values:
+                x, y, e = position["x"], position["y"], position["e"]
+                de = values["e"] if relative_e \
+                    else values["e"] - e if e is not None else None
+                if x is not None and y is not None \
+                        and de is not None and de > 0 \
+                        and values.get("z", position["z"]) == position["z"]:
+                    feed_change = "f" in values and values["f"] != feed
+                    segment = Segment(raw, (x, y),
+                                      (values["x"], values["y"]), words, de,
+                                      relative_e, feed_change)
+            if segment is not None:
+                run.append(segment)
+            else:
+                self._flush(run, output, report)
+                output.append(raw)
+            # Track the state as gcoder does
+            if command in gcoder.move_gcodes:
+                for axis in "xyze":
+                    if axis not in values:
+                        continue
+                    if relative or (axis == "e" and relative_e):
+                        if position[axis] is not None:
+                            position[axis] += values[axis]
+                    else:
+                        position[axis] = values[axis]
+                feed = values.get("f", feed)
+            elif command == "G92":
+                if "f" in values:
+                    del values["f"]
+                position.update(values or dict.fromkeys("xyze", 0.))
+            elif command == "G28":
+                position.update(dict.fromkeys("xyz"))
+            elif command == "G20":
+                imperial = True
+            elif command == "G21":
+                imperial = False
+            elif command == "G90":
+                relative = relative_e = False
+            elif command == "G91":
+                relative = relative_e = True
+            elif command == "M82":
+                relative_e = False
+            elif command == "M83":
+                relative_e = True
+        self._flush(run, output, report)
+        report.lines_after = len(output)
+        report.bytes_after = sum(map(line_size, output))
+        return output, report
+
+    def _flush(self, run, output, report):
+        """Write the segments of `run` as arcs or unchanged, then empty it"""
+        i = 0
+        while i < len(run):
+            end = self._extend(run, i)
+            if end is None:
+                output.append(run[i].raw)
+                i += 1
+            else:
+                output.append(self._arc(run[i:end]))
+                report.arcs += 1
+                report.segments += end - i
+                i = end
+        del run[:]
+
+    def _extend(self, run, start):
+        """Return the end of the longest arc starting at run[start], None if
+        it has less than min_segments moves"""
+        best = None
+        last = min(len(run), start + self.max_segments)
+        turn = 0
+        for end in range(start + 1, last + 1):
+            segment = run[end - 1]
+            if end > start + 1:
+                # Cheap rejection of the moves that don't keep turning the
+                # same way before fitting a circle
+                if segment.feed_change:
+                    break
+                previous = run[end - 2]
+                cross = previous.dx * segment.dy - previous.dy * segment.dx
+                if cross == 0 or (turn and (cross > 0) != (turn > 0)):
+                    break
+                turn = cross
+            if end - start < self.min_segments:
+                continue
+            if self._circle(run[start:end]) is None:
+                break
+            best = end
+        return best
+
+    def _circle(self, segments):
+        """Return the center and direction (True if counter-clockwise) of the
+        arc through the segments, None if they don't fit one"""
+        points = [segments[0].start] + [segment.end for segment in segments]
+        # Least squares circle (Kasa fit), in coordinates centered on the
+        # mean point for accuracy
+        n = len(points)
+        mx = sum(px for px, py in points) / n
+        my = sum(py for px, py in points) / n
+        suu = suv = svv = suuu = svvv = suvv = svuu = 0.
+        for px, py in points:
+            u = px - mx
+            v = py - my
+            uu = u * u
+            vv = v * v
+            suu += uu
+            svv += vv
+            suv += u * v
+            suuu += uu * u
+            svvv += vv * v
+            suvv += u * vv
+            svuu += v * uu
+        det = suu * svv - suv * suv
+        if abs(det) < 1e-12:
+            return None
+        bu = (suuu + suvv) / 2
+        bv = (svvv + svuu) / 2
+        ox = mx + (bu * svv - bv * suv) / det
+        oy = my + (bv * suu - bu * suv) / det
+        # Center rounded as written in the I and J words, the firmware
+        # draws the arc at its distance from the start point
+        (sx, sy), (tx, ty) = points[0], points[1]
+        scale = 10 ** self.decimals
+        ox = sx + round((ox - sx) * scale) / scale
+        oy = sy + round((oy - sy) * scale) / scale
+        r = math.hypot(sx - ox, sy - oy)
+        if r > self.max_radius:
+            return None
+        tolerance = self.tolerance
+        for px, py in points:
+            if abs(math.hypot(px - ox, py - oy) - r) > tolerance:
+                return None
+        ccw = (sx - ox) * (ty - oy) - (sy - oy) * (tx - ox) > 0
+        sweep = 0.
+        total_e = sum(segment.de for segment in segments)
+        total_length = sum(segment.length for segment in segments)
+        if total_length <= 0:
+            return None
+        rate = total_e / total_length
+        for segment in segments:
+            (sx, sy), (tx, ty) = segment.start, segment.end
+            if segment.length <= 0:
+                return None
+            # Segment middle, at r * cos(angle / 2) from the center
+            if r - math.hypot((sx + tx) / 2 - ox, (sy + ty) / 2 - oy) \
+                    > tolerance:
+                return None
+            cross = (sx - ox) * (ty - oy) - (sy - oy) * (tx - ox)
+            if (cross > 0) != ccw:
+                return None
+            sweep += 2 * math.asin(min(segment.length / (2 * r), 1.))
+            if abs(segment.de / segment.length - rate) \
+                    > self.extrusion_tolerance * rate:
+                return None
+        # A full circle would be read as a zero length arc
+        if sweep >= 2 * math.pi - 1e-3:
+            return None
+        return ox, oy, ccw
+
+    def _arc(self, segments):
+        """Return the G2/G3 line replacing `segments`"""
+        ox, oy, ccw = self._circle(segments)
+        sx, sy = segments[0].start
+        last = segments[-1]
+        words = ["G3" if ccw else "G2", "X" + last.x, "Y" + last.y,
+                 "I" + format_number(ox - sx, self.decimals),
+                 "J" + format_number(oy - sy, self.decimals)]
+        if last.relative_e:
+            words.append("E" + format_number(
+                sum(segment.de for segment in segments), self.e_decimals))
+        else:
+            words.append("E" + last.e)
+        if segments[0].f is not None:
+            words.append("F" + segments[0].f)
+        return " ".join(words)
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: %s input.gcode [output.gcode] [tolerance]"
+              % sys.argv[0])
+        return
+    fitter = ArcFitter()
+    if len(sys.argv) > 3:
+        fitter.tolerance = float(sys.argv[3])
+    with open(sys.argv[1], "r", encoding = "utf-8") as f:
+        lines, report = fitter.fit_lines(f)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w", encoding = "utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    print(report, file = sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,669 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Printer host running on an asyncio event loop.
+
+`AsyncPrintcore` speaks to the printer like `printrun.printcore.printcore`
+but from two tasks of the running event loop instead of threads: one reads
+the replies, the other sends the next line when the printer is clear. A
+single loop can drive many printers.
+
+Serial ports are read through the event loop on POSIX systems; Windows
+hosts can reach their printers through TCP serial bridges.
+
+Both hosts number, checksum, shorten and resend the lines of a print and
+run its host commands with `printrun.hostprotocol`. These features of
+printcore are not supported:
+
+- the send window: each line waits for the "ok" of the previous one;
+- Grbl streaming and realtime commands;
+- MeatPack packing of the sent lines;
+- `tcp_streaming_mode`: lines sent over TCP wait for their "ok" too;
+- the legacy callbacks such as `tempcb` or `preprintsendcb`, only the
+  event handlers are called;
+- `send_latencies`, `runSmallScript` and the ADVANCED_OK replies.
+"""
+
+import asyncio
+import logging
+import os
+import traceback
+from collections import deque
+from printrun import device
+from printrun import gcoder
+from printrun import hostprotocol
+from printrun import transcoder
+from .utils import install_locale, parse_temperature_report
+install_locale('pronterface')
+from printrun.plugins import PRINTCORE_HANDLER
+
+# Seconds of silence before asking a printer that isn't online yet again
+ONLINE_RETRY = 3.75
+# Items kept for each iterator of the received lines or temperatures
+# lagging behind, the oldest are dropped
+ITERATOR_BUFFER = 1000
+
+class AsyncPrintcore():
+    """3D printer host for asyncio event loops.
+
+    All the methods but `addEventHandler` must be called from the event
+    loop the printer was connected from. See the module documentation for
+    the features of printcore it lacks.
+
+    Parameters
+    ----------
+    port : str, optional
+        Either a device name, such as '/dev/ttyUSB0', or an URL with port,
+        such as '192.168.0.10:80'.
+    baud : int, optional
+        Communication speed in bit/s, such as 115200 or 250000.
+    dtr : bool, optional
+        On serial connections, enable/disable hardware DTR flow control.
+
+    Attributes
+    ----------
+    analyzer : GCode
+        A `printrun.gcoder.GCode` object containing all the G-code commands
+        sent to the printer.
+    event_handler : list of PrinterEventHandler
+        See `printrun.printcore.printcore`, the handlers are called from the
+        event loop.
+    mainqueue : GCode
+        The G-code printed, see `startprint`.
+    online : bool
+        True if the printer has responded to the initial command and is
+        active.
+    paused : bool
+        True if there is a print currently on pause.
+    printing : bool
+        True if there is a print currently running.
+
+    """
+
+    def __init__(self, port = None, baud = None, dtr = None):
+        self.port = port
+        self.baud = baud
+        self.dtr = dtr
+        self.analyzer = gcoder.GCode()
+        self.event_handler = list(PRINTCORE_HANDLER)
+        self.greetings = ['start', 'Grbl ']
+        self.loud = False  # emit sent and received lines to terminal
+        self.online = False
+        self.printing = False
+        self.paused = False
+        self.clear = False
+        self.mainqueue = None
+        self.queueindex = 0
+        self.lineno = 0
+        self.resendfrom = -1
+        # The printer state may differ from the one the precomputed wire
+        # lines of the main queue rely on
+        self._wire_resync = False
+        self.sentlines = {}
+        self.writefailures = 0
+        self.xy_feedrate = None
+        self.z_feedrate = None
+        # (command, future resolved by its reply or None) sent before the
+        # lines of the print
+        self._priqueue = deque()
+        # Future of the last command sent from the priority queue
+        self._pending = None
+        self._reader = None
+        self._writer = None
+        self._read_transport = None
+        self._device = None
+        self._tcp = False
+        self._tasks = []
+        # asyncio primitives, created by connect in the running loop
+        self._wakeup = None
+        self._online = None
+        self._print_done = None
+        # Queues of the running iterators of lines and temperatures
+        self._line_queues = set()
+        self._temp_queues = set()
+        for handler in self.event_handler:
+            try: handler.on_init()
+            except: logging.error(traceback.format_exc())
+
+    def addEventHandler(self, handler):
+        '''
+        Adds an event handler.
+
+        @param handler: The handler to be added.
+        '''
+        self.event_handler.append(handler)
+
+    def logError(self, error):
+        for handler in self.event_handler:
+            try: handler.on_error(error)
+            except: logging.error(traceback.format_exc())
+        logging.error(error)
+
+    def _notify(self, event, *args):
+        for handler in self.event_handler:
+            try: getattr(handler, event)(*args)
+            except: logging.error(traceback.format_exc())
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def connect(self, port = None, baud = None, dtr = None,
+                      timeout = None):
+        """Set port and baudrate if given, connect to the printer and wait
+        until it answers.
+
+        Raises
+        ------
+        DeviceError
+            If the connection could not be made or was closed before the
+            printer answered.
+        asyncio.TimeoutError
+            If the printer didn't answer within `timeout` seconds.
+
+        """
+        if self._writer is not None:
+            await self.disconnect()
+        if port is not None:
+            self.port = port
+        if baud is not None:
+            self.baud = baud
+        if dtr is not None:
+            self.dtr = dtr
+        if self.port is None:
+            raise device.DeviceError("No port or URL specified")
+        self._wakeup = asyncio.Event()
+        self._online = asyncio.Event()
+        self._print_done = asyncio.Event()
+        self._print_done.set()
+        self.writefailures = 0
+        self.clear = False
+        self._reader, self._writer = await self._open()
+        self._notify("on_connect")
+        listener = asyncio.ensure_future(self._listen())
+        self._tasks = [listener, asyncio.ensure_future(self._sender())]
+        online = asyncio.ensure_future(self._online.wait())
+        try:
+            await asyncio.wait((online, listener), timeout = timeout,
+                               return_when = asyncio.FIRST_COMPLETED)
+        finally:
+            online.cancel()
+        if not self.online:
+            if listener.done():
+                raise device.DeviceError(
+                    "Connection to %s closed before the printer answered"
+                    % self.port)
+            await self.disconnect()
+            raise asyncio.TimeoutError(
+                "%s didn't answer in %s s" % (self.port, timeout))
+
+    async def _open(self):
+        address = device.parse_url(self.port)
+        self._tcp = address is not None
+        if address is not None:
+            try:
+                return await asyncio.open_connection(*address)
+            except OSError as e:
+                msg = "Could not connect to {}:{}".format(*address)
+                raise device.DeviceError(msg, e) from e
+        if os.name == "nt":
+            raise device.DeviceError(
+                "Serial ports can't be read from asyncio on Windows, "
+                "connect to a TCP serial bridge instead")
+        if self.baud is None:
+            raise device.DeviceError("No baudrate specified")
+        loop = asyncio.get_running_loop()
+        printer = device.Device(self.port, self.baud, force_dtr = self.dtr)
+        # stty and opening the port may block
+        await loop.run_in_executor(None, printer.connect)
+        try:
+            fd = printer.fileno()
+            reader = asyncio.StreamReader()
+            self._read_transport, _ = await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader),
+                os.fdopen(os.dup(fd), "rb", buffering = 0))
+            transport, protocol = await loop.connect_write_pipe(
+                asyncio.streams.FlowControlMixin,
+                os.fdopen(os.dup(fd), "wb", buffering = 0))
+        except OSError as e:
+            if self._read_transport is not None:
+                self._read_transport.close()
+                self._read_transport = None
+            printer.disconnect()
+            msg = "Could not connect to serial port '{}'".format(self.port)
+            raise device.DeviceError(msg, e) from e
+        self._device = printer
+        return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    async def disconnect(self):
+        """Disconnect from the printer, the current print is stopped"""
+        if self._writer is None:
+            return
+        current = asyncio.current_task()
+        tasks = [task for task in self._tasks if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        self._tasks = []
+        self._writer.close()
+        if self._read_transport is not None:
+            self._read_transport.close()
+        if self._device is not None:
+            try:
+                self._device.disconnect()
+            except device.DeviceError:
+                self.logError(traceback.format_exc())
+        self._reader = self._writer = None
+        self._read_transport = self._device = None
+        error = device.DeviceError("Disconnected from printer")
+        futures = [future for command, future in self._priqueue]
+        futures.append(self._pending)
+        for future in futures:
+            if future is not None and not future.done():
+                future.set_exception(error)
+        self._priqueue.clear()
+        self._pending = None
+        # End the iterators
+        self._publish(self._line_queues | self._temp_queues, None)
+        self._line_queues.clear()
+        self._temp_queues.clear()
+        self.online = False
+        self.clear = False
+        if self.printing:
+            self._stop_printing()
+        self._notify("on_disconnect")
+
+    async def reset(self):
+        """Attempt to reset a serial connection by toggling DTR"""
+        if self._device is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._device.reset)
+
+    def _publish(self, queues, item):
+        for queue in queues:
+            if queue.full():
+                # The consumer lags behind, drop the oldest item
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    async def _iterate(self, queues, queue):
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            queues.discard(queue)
+
+    def _subscribe(self, queues):
+        queue = asyncio.Queue(ITERATOR_BUFFER)
+        if self._writer is None:
+            queue.put_nowait(None)
+        else:
+            queues.add(queue)
+        return self._iterate(queues, queue)
+
+    def lines(self):
+        """Asynchronous iterator of the lines received from the printer from
+        now on, without their end of line, until it disconnects"""
+        return self._subscribe(self._line_queues)
+
+    def temperatures(self):
+        """Asynchronous iterator of the temperature reports of the printer
+        from now on, parsed by `printrun.utils.parse_temperature_report`,
+        until it disconnects"""
+        return self._subscribe(self._temp_queues)
+
+    async def _readline(self):
+        try:
+            line_bytes = await self._reader.readline()
+        except OSError as e:
+            self.logError("Can't read from printer (disconnected?) {0}"
+                          .format(e))
+            return None
+        except ValueError as e:
+            # Line longer than the buffer of the reader
+            self.logError("Got a too long line from printer: {0}".format(e))
+            return ""
+        if not line_bytes:
+            self.logError("Can't read from printer (disconnected?).")
+            return None
+        try:
+            line = line_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            self.logError(("Got rubbish reply from {0} at baudrate {1}:\n"
+                           "Maybe a bad baudrate?").format(self.port,
+                                                            self.baud))
+            return ""
+        if len(line) > 1:
+            self._notify("on_recv", line)
+            if self.loud: logging.info("RECV: %s" % line.rstrip())
+            self._publish(self._line_queues, line.rstrip("\r\n"))
+        return line
+
+    async def _listen_until_online(self):
+        while not self.online:
+            await self._send("M105")
+            if self.writefailures >= 4:
+                self.logError(_("Aborting connection attempt after 4 failed writes."))
+                return False
+            try:
+                while True:
+                    line = await asyncio.wait_for(self._readline(),
+                                                  ONLINE_RETRY)
+                    if line is None:
+                        return False
+                    if line.startswith(tuple(self.greetings)) \
+                       or line.startswith('ok') or "T:" in line:
+                        break
+            except asyncio.TimeoutError:
+                # M105 may be sent before the printer is ready
+                continue
+            self.online = True
+            self.clear = True
+            self._online.set()
+            self._notify("on_online")
+            self._wake()
+        return True
+
+    async def _listen(self):
+        try:
+            if await self._listen_until_online():
+                while True:
+                    line = await self._readline()
+                    if line is None:
+                        break
+                    self._process_line(line)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logError(_("Read task died due to the following error:") +
+                          "\n" + traceback.format_exc())
+        await self.disconnect()
+
+    def _process_line(self, line):
+        if line.startswith('DEBUG_'):
+            return
+        if line.startswith(tuple(self.greetings)) or line.startswith('ok'):
+            self.clear = True
+            future, self._pending = self._pending, None
+            if future is not None and not future.done():
+                future.set_result(line.rstrip("\r\n"))
+            self._wake()
+        if "T:" in line and (line.startswith('ok')
+                             or line.lstrip().startswith('T:')):
+            self._notify("on_temp", line)
+            self._publish(self._temp_queues, parse_temperature_report(line))
+        elif line.startswith('Error'):
+            self.logError(line)
+        if hostprotocol.is_resend(line):
+            toresend = hostprotocol.resend_number(line)
+            if toresend is not None:
+                self.resendfrom = toresend
+            self.clear = True
+            self._wake()
+
+    def _has_work(self):
+        return -1 < self.resendfrom < self.lineno or bool(self._priqueue) \
+            or self.printing
+
+    async def _sender(self):
+        try:
+            while True:
+                if not (self.clear and self._has_work()):
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                await self._sendnext()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logError(_("Send task died due to the following error:") +
+                          "\n" + traceback.format_exc())
+
+    async def _sendnext(self):
+        self.clear = False
+        if -1 < self.resendfrom < self.lineno:
+            command = self.sentlines.get(self.resendfrom)
+            self.resendfrom += 1
+            if command is None:
+                self.clear = True
+            else:
+                await self._send(command)
+            return
+        self.resendfrom = -1
+        if self._priqueue:
+            command, future = self._priqueue.popleft()
+            if not transcoder.keeps_state(command):
+                # The next shortened lines may rely on a position or
+                # feedrate the command changed
+                self._wire_resync = True
+            self._pending = future
+            if not await self._send(command) and future is not None:
+                self._pending = None
+                future.set_exception(device.DeviceError(
+                    "Can't write to printer"))
+            return
+        if self.printing:
+            await self._sendprintline()
+        else:
+            self.clear = True
+
+    async def _has_index(self, index):
+        queue = self.mainqueue
+        if isinstance(queue, gcoder.StreamingGCode) \
+                and not queue.has_index(index, 0):
+            # Wait for the parser thread without blocking the loop
+            return await asyncio.get_running_loop().run_in_executor(
+                None, queue.has_index, index)
+        return queue.has_index(index)
+
+    async def _sendprintline(self):
+        queue = self.mainqueue
+        ready = await self._has_index(self.queueindex)
+        if not self.printing or queue is not self.mainqueue:
+            # Paused or cancelled while waiting for the line
+            self.clear = True
+            return
+        if not ready:
+            self.queueindex = 0
+            self.lineno = 0
+            self.sentlines = {}
+            await self._send("M110 N-1")
+            self._stop_printing()
+            return
+        (layer, line) = queue.idxs(self.queueindex)
+        gline = queue.all_layers[layer][line]
+        if self.queueindex > 0:
+            (prev_layer, prev_line) = queue.idxs(self.queueindex - 1)
+            if prev_layer != layer:
+                self._notify("on_layerchange", layer)
+        exclusion = queue.exclusion
+        if exclusion is not None and self.queueindex < len(exclusion.mask) \
+                and exclusion.mask[self.queueindex]:
+            # Move of an excluded object, the fixups restore the state the
+            # next lines expect
+            for command in exclusion.fixups.get(self.queueindex, ()):
+                self._priqueue.append((command, None))
+            self._wire_resync = True
+            self.queueindex += 1
+            self.clear = True
+            return
+        self._notify("on_preprintsend", gline, self.queueindex, queue)
+        tline = gline.raw
+        if hostprotocol.is_host_command(tline):
+            self.queueindex += 1
+            self.clear = True
+            await self.process_host_command(tline)
+            return
+        tline, checksum, self._wire_resync = hostprotocol.wire_line(
+            queue, self.queueindex, tline, self._wire_resync)
+        if tline:
+            await self._send(tline, self.lineno, True, checksum)
+            self.lineno += 1
+            self._notify("on_printsend", gline)
+        else:
+            self.clear = True
+        self.queueindex += 1
+
+    async def _send(self, command, lineno = 0, calcchecksum = False,
+                    checksum = None):
+        # Only add checksums over serial, tcp does the flow control itself
+        if calcchecksum and not self._tcp:
+            command = hostprotocol.numbered(command, lineno, checksum)
+            if "M110" not in command:
+                self.sentlines[lineno] = command
+        gline = None
+        try:
+            gline = self.analyzer.append(command, store = False)
+        except:
+            logging.warning(_("Could not analyze command %s:") % command +
+                            "\n" + traceback.format_exc())
+        if self.loud:
+            logging.info("SENT: %s" % command)
+        self._notify("on_send", command, gline)
+        try:
+            self._writer.write((command + "\n").encode('ascii', 'replace'))
+            await self._writer.drain()
+        except OSError as e:
+            self.logError("Can't write to printer (disconnected?)"
+                          "{0}".format(e))
+            self.writefailures += 1
+            return False
+        self.writefailures = 0
+        return True
+
+    async def send_now(self, command):
+        """Send `command` ahead of the lines of the print.
+
+        Returns
+        -------
+        str
+            The reply of the printer to the command, such as "ok", None if
+            not connected.
+
+        Raises
+        ------
+        DeviceError
+            If the printer disconnected before replying.
+
+        """
+        if not self.online:
+            self.logError(_("Not connected to printer."))
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._priqueue.append((command, future))
+        self._wake()
+        return await future
+
+    async def send(self, command):
+        """Append `command` to the print, or send it like `send_now` and
+        return its reply if not printing."""
+        if self.online and self.printing:
+            self.mainqueue.append(command)
+            self._wake()
+            return None
+        return await self.send_now(command)
+
+    async def startprint(self, gcode, startindex = 0, startcommands = None):
+        """Start printing `gcode` from its `startindex`-th line, after the
+        `startcommands`, and return at once, see
+        `printrun.printcore.printcore.startprint`.
+
+        Returns
+        -------
+        bool
+            True on successful print start, False if already printing or
+            offline.
+
+        """
+        if self.printing or not self.online:
+            return False
+        self.queueindex = startindex
+        self.mainqueue = gcode
+        self.lineno = 0
+        self.resendfrom = -1
+        self._wire_resync = startindex != 0
+        self.sentlines = {}
+        self._priqueue.appendleft(("M110 N-1", None))
+        for command in startcommands or ():
+            self._priqueue.append((command, None))
+        self._start_printing(startindex != 0)
+        return True
+
+    def _start_printing(self, resuming):
+        self.printing = True
+        self._print_done.clear()
+        self._notify("on_start", resuming)
+        self._wake()
+
+    def _stop_printing(self):
+        self.printing = False
+        self._print_done.set()
+        self._notify("on_end")
+
+    async def wait_print(self):
+        """Wait until the print ends, is paused or cancelled"""
+        if self.printing:
+            await self._print_done.wait()
+
+    async def cancelprint(self):
+        """Cancel an ongoing print."""
+        await self.pause()
+        self.paused = False
+        self.mainqueue = None
+
+    async def pause(self):
+        """Pause an ongoing print after the line being sent, saving the
+        position to go back to when resuming.
+
+        Returns
+        -------
+        bool
+            False if not printing.
+
+        """
+        if not self.printing:
+            return False
+        self.paused = True
+        self._stop_printing()
+        hostprotocol.save_pause(self)
+        return True
+
+    async def resume(self):
+        """Go back to the position of the paused print and resume it.
+
+        Returns
+        -------
+        bool
+            False if print not paused.
+
+        """
+        if not self.paused or not self.online:
+            return False
+        commands = hostprotocol.resume_commands(self)
+        self._priqueue.extend((command, None) for command in commands)
+        self.paused = False
+        self._wire_resync = True
+        self._start_printing(True)
+        return True
+
+    async def process_host_command(self, command):
+        """only ;@pause command is implemented as a host command, but hosts
+        are free to reimplement this method"""
+        command = command.lstrip()
+        if command.startswith(";@pause"):
+            await self.pause()
@@ -0,0 +1,669 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reading and writing of binary G-code files (.bgcode).
+
+The binary G-code format of PrusaSlicer is a file header ("GCDE", format
+version and checksum type) followed by blocks. Each block has a header
+(type, compression, uncompressed size and, when compressed, compressed
+size), parameters (the encoding of metadata and G-code blocks, the
+format and size of thumbnails), its data and, when the file has
+checksums, the CRC32 of all of these. Metadata blocks (file, printer,
+print and slicer metadata) are "key=value" lines and come before the
+thumbnails and the G-code blocks. G-code blocks are compressed with
+deflate or heatshrink, and their text may be MeatPack packed, in which
+case the spaces before the parameters of G commands are left out.
+
+`Decoder` is an incremental decompressor in the sense of `compressed`,
+returning the text of the G-code blocks of the bytes it is given, so that
+.bgcode files are loaded, mapped and cached like compressed text files.
+`read_metadata` only reads the blocks before the G-code, from which
+`Metadata.apply` fills the filament length, duration and dimensions of a
+`gcoder.GCode` without parsing it. `Writer` writes a .bgcode file from
+G-code text.
+
+Heatshrink is decoded and encoded with the `heatshrink2` module when it
+is installed, in pure Python otherwise.
+"""
+
+import collections
+import datetime
+import json
+import re
+import struct
+import zlib
+
+try:
+    import heatshrink2
+except ImportError:
+    heatshrink2 = None
+
+from . import meatpack
+
+MAGIC = b"GCDE"
+VERSION = 1
+
+# Checksum types
+CHECKSUM_NONE = 0
+CHECKSUM_CRC32 = 1
+
+# Block types
+FILE_METADATA = 0
+GCODE = 1
+SLICER_METADATA = 2
+PRINTER_METADATA = 3
+PRINT_METADATA = 4
+THUMBNAIL = 5
+
+# Compressions
+COMPRESSION_NONE = 0
+DEFLATE = 1
+HEATSHRINK_11_4 = 2
+HEATSHRINK_12_4 = 3
+# Window and lookahead sizes (log2) of the heatshrink compressions
+HEATSHRINK_PARAMETERS = {HEATSHRINK_11_4: (11, 4), HEATSHRINK_12_4: (12, 4)}
+
+# Encodings of the G-code blocks (metadata blocks are always INI)
+ENCODING_NONE = 0
+MEATPACK = 1
+MEATPACK_COMMENTS = 2
+
+# Thumbnail formats
+PNG = 0
+JPG = 1
+QOI = 2
+
+file_header = struct.Struct("<4sIH")
+block_header = struct.Struct("<HHI")
+compressed_size = struct.Struct("<I")
+encoding_parameters = struct.Struct("<H")
+thumbnail_parameters = struct.Struct("<HHH")
+crc = struct.Struct("<I")
+
+# Size of the G-code text of the blocks written
+BLOCK_SIZE = 64 * 1024
+
+# Parameters of G commands, before which MeatPack leaves out the spaces
+space_exp = re.compile(rb"(?<=[^ ])(?=[XYZEFIJRPWHCA])")
+spaced_exp = re.compile(rb"(?<=[^ ]) (?=[XYZEFIJRPWHCA])")
+duration_exp = re.compile(r"(\d+)\s*([dhms])")
+
+FILAMENT_KEY = "filament used [mm]"
+DURATION_KEY = "estimated printing time (normal mode)"
+MAX_Z_KEY = "max_layer_z"
+OBJECTS_KEY = "objects_info"
+
+Thumbnail = collections.namedtuple("Thumbnail", "format width height data")
+
+def heatshrink_decompress(data, window_bits, lookahead_bits):
+    """Return the heatshrink decompressed bytes of `data`"""
+    if heatshrink2 is not None:
+        return heatshrink2.decompress(bytes(data), window_sz2 = window_bits,
+                                      lookahead_sz2 = lookahead_bits)
+    # The window starts filled with zeros
+    window = 1 << window_bits
+    out = bytearray(window)
+    bits = 0
+    count = 0
+    index_mask = window - 1
+    backref_bits = window_bits + lookahead_bits
+    count_mask = (1 << lookahead_bits) - 1
+    for byte in data:
+        bits = bits << 8 | byte
+        count += 8
+        while True:
+            if count < 1:
+                break
+            if bits >> (count - 1) & 1:
+                if count < 9:
+                    break
+                count -= 9
+                out.append(bits >> count & 0xFF)
+            else:
+                if count < 1 + backref_bits:
+                    break
+                count -= 1 + backref_bits
+                value = bits >> count
+                offset = (value >> lookahead_bits & index_mask) + 1
+                length = (value & count_mask) + 1
+                start = len(out) - offset
+                if offset >= length:
+                    out += out[start:start + length]
+                else:
+                    for i in range(start, start + length):
+                        out.append(out[i])
+            bits &= (1 << count) - 1
+    # Trailing bits too few for a whole item are padding
+    del out[:window]
+    return bytes(out)
+
+def heatshrink_compress(data, window_bits, lookahead_bits):
+    """Return `data` compressed with heatshrink"""
+    if heatshrink2 is not None:
+        return heatshrink2.compress(bytes(data), window_sz2 = window_bits,
+                                    lookahead_sz2 = lookahead_bits)
+    window = 1 << window_bits
+    max_length = 1 << lookahead_bits
+    # Shorter matches cost about as many bits as literals
+    min_length = 3
+    out = bytearray()
+    bits = 0
+    count = 0
+    positions = {}
+    size = len(data)
+    i = 0
+    while i < size:
+        best_length = 0
+        best_offset = 0
+        key = data[i:i + min_length]
+        candidates = positions.get(key)
+        if candidates is not None and len(key) == min_length:
+            for j in reversed(candidates):
+                if i - j > window:
+                    break
+                length = min_length
+                limit = min(max_length, size - i)
+                while length < limit and data[j + length] == data[i + length]:
+                    length += 1
+                if length > best_length:
+                    best_length = length
+                    best_offset = i - j
+                    if length == limit:
+                        break
+        if best_length:
+            bits = bits << (1 + window_bits + lookahead_bits) \
+                | (best_offset - 1) << lookahead_bits | (best_length - 1)
+            count += 1 + window_bits + lookahead_bits
+            step = best_length
+        else:
+            bits = bits << 9 | 0x100 | data[i]
+            count += 9
+            step = 1
+        for k in range(i, min(i + step, size - min_length + 1)):
+            candidates = positions.setdefault(data[k:k + min_length], [])
+            candidates.append(k)
+            if len(candidates) > 16:
+                del candidates[:8]
+        i += step
+        while count >= 8:
+            count -= 8
+            out.append(bits >> count & 0xFF)
+        bits &= (1 << count) - 1
+    if count:
+        # The last byte is padded with zeros
+        out.append(bits << (8 - count) & 0xFF)
+    return bytes(out)
+
+def decompress(compression, data, size):
+    """Return the `size` bytes of the block data `data`"""
+    if compression == COMPRESSION_NONE:
+        out = bytes(data)
+    elif compression == DEFLATE:
+        out = zlib.decompress(data)
+    elif compression in HEATSHRINK_PARAMETERS:
+        out = heatshrink_decompress(data,
+                                    *HEATSHRINK_PARAMETERS[compression])
+    else:
+        raise ValueError("unknown binary G-code compression %d"
+                         % compression)
+    if len(out) != size:
+        raise ValueError("corrupted binary G-code block")
+    return out
+
+def compress(compression, data):
+    """Return `data` compressed with `compression`"""
+    if compression == COMPRESSION_NONE:
+        return bytes(data)
+    if compression == DEFLATE:
+        return zlib.compress(data)
+    if compression in HEATSHRINK_PARAMETERS:
+        return heatshrink_compress(data, *HEATSHRINK_PARAMETERS[compression])
+    raise ValueError("unknown binary G-code compression %d" % compression)
+
+def parse_ini(data):
+    """Return the dict of the "key=value" lines of a metadata block"""
+    values = {}
+    for line in data.decode("utf-8", "replace").splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            values[key.strip()] = value.strip()
+    return values
+
+def format_ini(values):
+    return "".join("%s=%s\n" % item for item in values.items()).encode()
+
+def insert_spaces(text):
+    """Put back the spaces left out by MeatPack before the parameters of
+    the G commands of the complete lines `text`"""
+    lines = text.split(b"\n")
+    for i, line in enumerate(lines):
+        if line[:1] == b"G":
+            code, sep, comment = line.partition(b";")
+            lines[i] = space_exp.sub(b" ", code) + sep + comment
+    return b"\n".join(lines)
+
+def remove_spaces(text):
+    """Leave out the spaces put back by `insert_spaces`"""
+    lines = text.split(b"\n")
+    for i, line in enumerate(lines):
+        if line[:1] == b"G":
+            code, sep, comment = line.partition(b";")
+            lines[i] = spaced_exp.sub(b"", code) + sep + comment
+    return b"\n".join(lines)
+
+def parse_duration(value):
+    """Return the timedelta of a duration such as "1d 2h 3m 4s", None if
+    it has no duration"""
+    seconds = 0
+    found = False
+    for number, unit in duration_exp.findall(value):
+        seconds += int(number) * {"d": 86400, "h": 3600, "m": 60, "s": 1}[unit]
+        found = True
+    return datetime.timedelta(seconds = seconds) if found else None
+
+def format_duration(duration):
+    """Format the timedelta `duration` as PrusaSlicer does"""
+    seconds = int(duration.total_seconds())
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    parts = [(days, "d"), (hours, "h"), (minutes, "m")]
+    while parts and not parts[0][0]:
+        parts.pop(0)
+    return " ".join("%d%s" % part for part in parts + [(seconds, "s")])
+
+def print_metadata(filament_lengths, duration = None, zmax = None):
+    """Return the print metadata of a print using `filament_lengths`
+    millimeters of filament per extruder, lasting the timedelta `duration`
+    and up to the height `zmax`"""
+    values = {FILAMENT_KEY: ", ".join("%.2f" % length
+                                      for length in filament_lengths)}
+    if duration is not None:
+        values[DURATION_KEY] = format_duration(duration)
+    if zmax is not None:
+        values[MAX_Z_KEY] = "%.2f" % zmax
+    return values
+
+def gcode_metadata(gcode):
+    """Return the print metadata of the parsed `gcode`"""
+    return print_metadata([gcode.filament_length or 0], gcode.duration,
+                          gcode.zmax)
+
+class Metadata:
+    """Metadata blocks and thumbnails of a binary G-code file"""
+
+    def __init__(self):
+        self.file = {}
+        self.printer = {}
+        self.print = {}
+        self.slicer = {}
+        self.thumbnails = []
+
+    def add(self, block_type, data, parameters = None):
+        """Add the block of `block_type` with the decompressed `data`"""
+        if block_type == THUMBNAIL:
+            self.thumbnails.append(Thumbnail(*parameters, data))
+            return
+        values = {FILE_METADATA: self.file, PRINTER_METADATA: self.printer,
+                  PRINT_METADATA: self.print,
+                  SLICER_METADATA: self.slicer}[block_type]
+        values.update(parse_ini(data))
+
+    def get(self, key, default = None):
+        """Return the value of `key` in the first metadata block having it"""
+        for values in (self.print, self.printer, self.slicer, self.file):
+            if key in values:
+                return values[key]
+        return default
+
+    @property
+    def filament_lengths(self):
+        """Filament used by each extruder, in millimeters"""
+        try:
+            return [float(value)
+                    for value in self.get(FILAMENT_KEY, "").split(",")
+                    if value.strip()]
+        except ValueError:
+            return []
+
+    @property
+    def filament_length(self):
+        lengths = self.filament_lengths
+        return sum(lengths) if lengths else None
+
+    @property
+    def duration(self):
+        value = self.get(DURATION_KEY)
+        return parse_duration(value) if value is not None else None
+
+    @property
+    def objects(self):
+        """Printed objects, as dicts with their "name" and outline
+        ("polygon")"""
+        try:
+            objects = json.loads(self.get(OBJECTS_KEY, "{}"))["objects"]
+        except (ValueError, KeyError, TypeError):
+            return []
+        return [obj for obj in objects if isinstance(obj, dict)]
+
+    @property
+    def bounds(self):
+        """(xmin, xmax, ymin, ymax, zmin, zmax) of the printed objects, from
+        their outlines and the height of their last layer, with None for
+        the unknown ones"""
+        xmin = xmax = ymin = ymax = zmin = zmax = None
+        try:
+            zmax = float(self.get(MAX_Z_KEY))
+            zmin = 0.0
+        except (TypeError, ValueError):
+            pass
+        try:
+            points = [point for obj in self.objects
+                      for point in obj["polygon"]]
+        except (KeyError, TypeError):
+            points = []
+        if points:
+            xs = [point[0] for point in points]
+            ys = [point[1] for point in points]
+            xmin, xmax, ymin, ymax = min(xs), max(xs), min(ys), max(ys)
+        return xmin, xmax, ymin, ymax, zmin, zmax
+
+    def apply(self, gcode):
+        """Set the filament length, duration and dimensions of `gcode` known
+        from the metadata"""
+        lengths = self.filament_lengths
+        if lengths:
+            gcode.filament_length = sum(lengths)
+            gcode.filament_length_multi = lengths
+        duration = self.duration
+        if duration is not None:
+            gcode.duration = duration
+        xmin, xmax, ymin, ymax, zmin, zmax = self.bounds
+        if xmin is not None:
+            gcode.xmin, gcode.xmax = xmin, xmax
+            gcode.ymin, gcode.ymax = ymin, ymax
+            gcode.width = xmax - xmin
+            gcode.depth = ymax - ymin
+        if zmax is not None:
+            gcode.zmin, gcode.zmax = zmin, zmax
+            gcode.height = zmax - zmin
+
+def parse_file_header(data):
+    """Return the checksum type of the file starting with `data`"""
+    if len(data) < file_header.size or not data.startswith(MAGIC):
+        raise ValueError("not a binary G-code file")
+    _magic, version, checksum_type = file_header.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("unsupported binary G-code version %d" % version)
+    if checksum_type not in (CHECKSUM_NONE, CHECKSUM_CRC32):
+        raise ValueError("unknown binary G-code checksum type %d"
+                         % checksum_type)
+    return checksum_type
+
+def parameters_size(block_type):
+    return thumbnail_parameters.size if block_type == THUMBNAIL \
+        else encoding_parameters.size
+
+def parse_block_header(data, offset = 0):
+    """Return the type, compression, uncompressed size and stored size of
+    the block whose header is at `offset` of `data`, and the size of its
+    header, None if `data` doesn't hold the whole header"""
+    if len(data) - offset < block_header.size:
+        return None
+    block_type, compression, size = block_header.unpack_from(data, offset)
+    if block_type > THUMBNAIL:
+        raise ValueError("unknown binary G-code block type %d" % block_type)
+    if compression == COMPRESSION_NONE:
+        return block_type, compression, size, size, block_header.size
+    if len(data) - offset < block_header.size + compressed_size.size:
+        return None
+    stored, = compressed_size.unpack_from(data, offset + block_header.size)
+    return (block_type, compression, size, stored,
+            block_header.size + compressed_size.size)
+
+def check_block(block, checksum_type):
+    """Raise ValueError if the checksum ending the whole `block` is wrong"""
+    if checksum_type == CHECKSUM_CRC32:
+        expected, = crc.unpack_from(block, len(block) - crc.size)
+        if zlib.crc32(block[:-crc.size]) != expected:
+            raise ValueError("binary G-code block checksum mismatch")
+
+class Decoder:
+    """Incremental decompressor of binary G-code files, returning the text
+    of their G-code blocks and collecting their metadata"""
+
+    # The format has no end marker
+    eof = False
+    unused_data = b""
+
+    def __init__(self):
+        self.metadata = Metadata()
+        self._buffer = bytearray()
+        self._checksum_type = None
+        self._meatpack = None
+        # Incomplete line of MeatPack encoded blocks
+        self._line = b""
+
+    def decompress(self, data):
+        """Return the G-code text of the blocks completed by `data`"""
+        buffer = self._buffer
+        buffer += data
+        if self._checksum_type is None:
+            if len(buffer) < file_header.size:
+                return b""
+            self._checksum_type = parse_file_header(buffer)
+            del buffer[:file_header.size]
+        checksum_size = crc.size if self._checksum_type else 0
+        out = []
+        offset = 0
+        while True:
+            header = parse_block_header(buffer, offset)
+            if header is None:
+                break
+            block_type, compression, size, stored, header_size = header
+            params_size = parameters_size(block_type)
+            end = offset + header_size + params_size + stored + checksum_size
+            if len(buffer) < end:
+                break
+            block = bytes(buffer[offset:end])
+            check_block(block, self._checksum_type)
+            params = block[header_size:header_size + params_size]
+            text = decompress(compression,
+                              block[header_size + params_size:
+                                    header_size + params_size + stored],
+                              size)
+            if block_type == GCODE:
+                encoding, = encoding_parameters.unpack(params)
+                out.append(self._decode_gcode(encoding, text))
+            elif block_type == THUMBNAIL:
+                self.metadata.add(block_type, text,
+                                  thumbnail_parameters.unpack(params))
+            else:
+                self.metadata.add(block_type, text)
+            offset = end
+        del buffer[:offset]
+        return b"".join(out)
+
+    def _decode_gcode(self, encoding, data):
+        if encoding == ENCODING_NONE:
+            return data
+        if encoding not in (MEATPACK, MEATPACK_COMMENTS):
+            raise ValueError("unknown binary G-code encoding %d" % encoding)
+        if self._meatpack is None:
+            self._meatpack = meatpack.Decoder()
+        text = self._line + self._meatpack.decode(data)
+        end = text.rfind(b"\n") + 1
+        self._line = text[end:]
+        return insert_spaces(text[:end])
+
+    def flush(self):
+        """Return the rest of the text once the whole file was given"""
+        if self._buffer or self._checksum_type is None:
+            raise ValueError("truncated binary G-code file")
+        line = self._line
+        self._line = b""
+        return insert_spaces(line)
+
+def read_metadata(filename):
+    """Return the Metadata of the binary G-code file `filename`, reading
+    the file up to its first G-code block"""
+    metadata = Metadata()
+    with open(filename, "rb") as f:
+        checksum_type = parse_file_header(f.read(file_header.size))
+        checksum_size = crc.size if checksum_type else 0
+        while True:
+            head = f.read(block_header.size + compressed_size.size)
+            header = parse_block_header(head)
+            if header is None:
+                break
+            block_type, compression, size, stored, header_size = header
+            if block_type == GCODE:
+                break
+            params_size = parameters_size(block_type)
+            rest = header_size + params_size + stored + checksum_size \
+                - len(head)
+            block = head + f.read(rest)
+            if len(block) < len(head) + rest:
+                raise ValueError("truncated binary G-code file")
+            check_block(block, checksum_type)
+            params = block[header_size:header_size + params_size]
+            data = decompress(compression, block[header_size + params_size:
+                                                 header_size + params_size
+                                                 + stored], size)
+            if block_type == THUMBNAIL:
+                metadata.add(block_type, data,
+                             thumbnail_parameters.unpack(params))
+            else:
+                metadata.add(block_type, data)
+    return metadata
+
+class Writer:
+    """Text stream writing a binary G-code file to `file`, a file name or
+    an open binary file, when closed.
+
+    `metadata` maps the metadata block types to their dicts, the printer,
+    print and slicer metadata blocks are required by the format and are
+    written empty if not given. `thumbnails` are Thumbnail tuples.
+    """
+
+    def __init__(self, file, metadata = None, thumbnails = (),
+                 compression = HEATSHRINK_12_4, encoding = MEATPACK_COMMENTS,
+                 checksum_type = CHECKSUM_CRC32):
+        if encoding not in (ENCODING_NONE, MEATPACK, MEATPACK_COMMENTS):
+            raise ValueError("unknown binary G-code encoding %d" % encoding)
+        self._own_file = isinstance(file, str)
+        self.f = open(file, "wb") if self._own_file else file
+        self.metadata = {FILE_METADATA: {"Producer": "Printrun"},
+                         PRINTER_METADATA: {}, PRINT_METADATA: {},
+                         SLICER_METADATA: {}}
+        self.metadata.update(metadata or {})
+        self.thumbnails = list(thumbnails)
+        self.compression = compression
+        self.encoding = encoding
+        self.checksum_type = checksum_type
+        self.closed = False
+        self._text = []
+        self._text_size = 0
+        self._blocks = []
+
+    def write(self, text):
+        self._text.append(text)
+        self._text_size += len(text)
+        if self._text_size >= BLOCK_SIZE:
+            data = "".join(self._text).encode("utf-8")
+            end = data.rfind(b"\n") + 1
+            if end:
+                self._add_gcode(data[:end])
+                rest = data[end:].decode("utf-8")
+                self._text = [rest]
+                self._text_size = len(rest)
+        return len(text)
+
+    def _add_gcode(self, data):
+        if self.encoding != ENCODING_NONE:
+            # MeatPack only packs whole lines
+            if not data.endswith(b"\n"):
+                data += b"\n"
+            lines = data.split(b"\n")
+            if self.encoding == MEATPACK:
+                lines = [line.split(b";", 1)[0].rstrip() for line in lines]
+                lines = [line for line in lines if line] + [b""]
+            encoder = meatpack.Encoder(no_spaces = True)
+            data = meatpack.command(meatpack.ENABLE_PACKING) \
+                + meatpack.command(meatpack.ENABLE_NO_SPACES) \
+                + encoder.encode(remove_spaces(b"\n".join(lines)))
+        self._blocks.append(self._block(GCODE, data,
+                                        encoding_parameters.pack(
+                                            self.encoding)))
+
+    def _block(self, block_type, data, params, compression = None):
+        if compression is None:
+            compression = self.compression
+        stored = compress(compression, data)
+        header = block_header.pack(block_type, compression, len(data))
+        if compression != COMPRESSION_NONE:
+            header += compressed_size.pack(len(stored))
+        block = header + params + stored
+        if self.checksum_type == CHECKSUM_CRC32:
+            block += crc.pack(zlib.crc32(block))
+        return block
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._text_size:
+            self._add_gcode("".join(self._text).encode("utf-8"))
+        self._text = []
+        f = self.f
+        f.write(file_header.pack(MAGIC, VERSION, self.checksum_type))
+        ini = encoding_parameters.pack(0)
+        # Metadata is small and read before the G-code, keep it plain
+        for block_type in (FILE_METADATA, PRINTER_METADATA):
+            f.write(self._block(block_type,
+                                format_ini(self.metadata[block_type]), ini,
+                                COMPRESSION_NONE))
+        for thumbnail in self.thumbnails:
+            f.write(self._block(THUMBNAIL, thumbnail.data,
+                                thumbnail_parameters.pack(*thumbnail[:3]),
+                                COMPRESSION_NONE))
+        for block_type in (PRINT_METADATA, SLICER_METADATA):
+            f.write(self._block(block_type,
+                                format_ini(self.metadata[block_type]), ini,
+                                COMPRESSION_NONE))
+        for block in self._blocks:
+            f.write(block)
+        self._blocks = []
+        if self._own_file:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._own_file:
+            self.f.close()
+
+def export(gcode, filename, **kwargs):
+    """Write the parsed `gcode` to the binary G-code file `filename`,
+    `kwargs` are passed to Writer"""
+    metadata = gcode_metadata(gcode)
+    kwargs.setdefault("metadata", {PRINTER_METADATA: metadata,
+                                   PRINT_METADATA: metadata})
+    with Writer(filename, **kwargs) as writer:
+        for line in gcode.lines:
+            writer.write(line.raw + "\n")
@@ -0,0 +1,245 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reading of compressed G-code files.
+
+G-code files compressed with gzip (.gcode.gz), xz (.gcode.xz) or Zstandard
+(.gcode.zst, requires the `zstandard` module) are recognized by their first
+bytes whatever their name. `open_gcode` returns a text stream decompressing
+the file in chunks as it is read, so that neither a temporary file nor a
+decompressed copy of the whole file is needed to parse it. Binary G-code
+files (.bgcode) are read the same way, as the text of their G-code
+blocks (see `bgcode`).
+
+`SeekableReader` gives random access to the decompressed bytes for
+`mappedgcode.MappedGCode`, which reads the lines at the offsets found by
+the parse (or restored from `gcodecache`). It records a checkpoint of the
+decompressor state at regular intervals of the decompressed data, from
+which later reads resume instead of decompressing the file from its start.
+"""
+
+import bisect
+import io
+import lzma
+import threading
+import zlib
+
+from . import bgcode
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# First bytes of the files of each format
+MAGIC = {
+    "gzip": b"\x1f\x8b",
+    "xz": b"\xfd7zXZ\x00",
+    "zstd": b"\x28\xb5\x2f\xfd",
+    "bgcode": bgcode.MAGIC,
+}
+EXTENSIONS = (".gz", ".xz", ".zst", ".bgcode")
+# Size of the compressed blocks read at once
+CHUNK_SIZE = 64 * 1024
+
+def detect(f):
+    """Return the compression format of the open binary file `f`, None if
+    it is not compressed. The position of `f` is kept."""
+    position = f.tell()
+    head = f.read(max(len(magic) for magic in MAGIC.values()))
+    f.seek(position)
+    for name, magic in MAGIC.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+def compression(filename):
+    """Return the compression format of the file `filename`, or None"""
+    with open(filename, "rb") as f:
+        return detect(f)
+
+def decompressor(name):
+    """Return a new incremental decompressor for the format `name`"""
+    if name == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if name == "xz":
+        return lzma.LZMADecompressor()
+    if name == "zstd":
+        if zstandard is None:
+            raise OSError("Reading Zstandard files requires the zstandard "
+                          "module")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if name == "bgcode":
+        return bgcode.Decoder()
+    raise ValueError("unknown compression format %r" % name)
+
+def flush(decomp):
+    """Return the data left in the decompressor `decomp` at the end of the
+    file"""
+    if hasattr(decomp, "flush"):
+        return decomp.flush()
+    return b""
+
+class DecompressingReader(io.RawIOBase):
+    """Binary stream of the decompressed content of an open compressed file.
+
+    Concatenated members (gzip), streams (xz) or frames (zstd) are read
+    one after the other, as the command line tools do.
+    """
+
+    def __init__(self, raw, name):
+        self.raw = raw
+        self.format = name
+        self._decompressor = decompressor(name)
+        self._pending = memoryview(b"")
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _decompress_chunk(self):
+        """Return the next block of decompressed data, b"" at the end"""
+        while not self._eof:
+            data = b""
+            if getattr(self._decompressor, "eof", False):
+                # Next member of a concatenated file
+                data = self._decompressor.unused_data
+                self._decompressor = decompressor(self.format)
+            if not data:
+                data = self.raw.read(CHUNK_SIZE)
+                if not data:
+                    self._eof = True
+                    return flush(self._decompressor)
+            out = self._decompressor.decompress(data)
+            if out:
+                return out
+        return b""
+
+    def readinto(self, buffer):
+        if not self._pending:
+            self._pending = memoryview(self._decompress_chunk())
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+def open_binary(filename):
+    """Open `filename` for reading its decompressed bytes"""
+    f = open(filename, "rb")
+    try:
+        name = detect(f)
+        if name is None:
+            return f
+        return io.BufferedReader(DecompressingReader(f, name), CHUNK_SIZE)
+    except BaseException:
+        f.close()
+        raise
+
+def open_gcode(filename, encoding = "utf-8"):
+    """Open the G-code file `filename`, compressed or not, as text"""
+    return io.TextIOWrapper(open_binary(filename), encoding = encoding)
+
+class SeekableReader:
+    """Random access to the decompressed bytes of a compressed file.
+
+    Slicing reads the decompressed bytes between two offsets. Reads going
+    forward continue the decompression, reads going backward resume from
+    the closest checkpoint before them. Checkpoints are copies of the
+    decompressor state taken every `checkpoint_interval` decompressed
+    bytes, for the formats whose decompressor can be copied (gzip), the
+    other formats restart from the start of the file.
+    """
+
+    def __init__(self, filename, checkpoint_interval = 4 * 1024 * 1024):
+        self.filename = filename
+        self.checkpoint_interval = checkpoint_interval
+        self._lock = threading.Lock()
+        self._raw = open(filename, "rb")
+        self.format = detect(self._raw)
+        if self.format is None:
+            self._raw.close()
+            raise ValueError("%s is not compressed" % filename)
+        # Decompressed offset, compressed offset and decompressor state,
+        # None for the start of the file
+        self._checkpoints = [(0, 0, None)]
+        self._checkpoint_offsets = [0]
+        self._resume(0)
+
+    def _resume(self, index):
+        offset, raw_offset, state = self._checkpoints[index]
+        self._raw.seek(raw_offset)
+        if state is None:
+            self._decompressor = decompressor(self.format)
+        else:
+            self._decompressor = state.copy()
+        self._buffer = bytearray()
+        self._buffer_start = offset
+        self._eof = False
+
+    def _decompress_chunk(self):
+        decomp = self._decompressor
+        if getattr(decomp, "eof", False):
+            data = decomp.unused_data
+            decomp = self._decompressor = decompressor(self.format)
+        else:
+            data = b""
+        if not data:
+            data = self._raw.read(CHUNK_SIZE)
+            if not data:
+                self._eof = True
+                self._buffer += flush(decomp)
+                return
+        self._buffer += decomp.decompress(data)
+        end = self._buffer_start + len(self._buffer)
+        if hasattr(decomp, "copy") and not decomp.eof \
+                and end >= self._checkpoint_offsets[-1] \
+                + self.checkpoint_interval:
+            self._checkpoints.append((end, self._raw.tell(), decomp.copy()))
+            self._checkpoint_offsets.append(end)
+
+    def read_at(self, start, size):
+        """Read `size` decompressed bytes from the offset `start`"""
+        end = start + size
+        with self._lock:
+            if start < self._buffer_start:
+                self._resume(bisect.bisect_right(self._checkpoint_offsets,
+                                                 start) - 1)
+            while self._buffer_start + len(self._buffer) < end \
+                    and not self._eof:
+                if start > self._buffer_start:
+                    # Only keep the data from the start of the read
+                    drop = min(start - self._buffer_start, len(self._buffer))
+                    del self._buffer[:drop]
+                    self._buffer_start += drop
+                self._decompress_chunk()
+            first = max(start - self._buffer_start, 0)
+            return bytes(self._buffer[first:end - self._buffer_start])
+
+    def __getitem__(self, i):
+        if not isinstance(i, slice) or i.step not in (None, 1) \
+                or i.start is None or i.stop is None:
+            raise TypeError("SeekableReader only supports [start:stop]")
+        return self.read_at(i.start, max(i.stop - i.start, 0))
+
+    def close(self):
+        with self._lock:
+            self._checkpoints = self._checkpoint_offsets = None
+            self._buffer = None
+            self._raw.close()
@@ -19,17 +19,39 @@ import platform
 import re
 import selectors
 import socket
+import threading
 import time
 
 # Third-party libraries
 import serial
 
+# Custom libraries
+from printrun import meatpack
+
 READ_EMPTY = b''
 """Constant to represent empty or no data"""
 
 READ_EOF = None
 """Constant to represent an end-of-file"""
 
+# TODO: Rearrange to avoid long line
+host_regexp = re.compile(r"^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$|^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
+
+
+def parse_url(text):
+    """Return the (hostname, port number) of a `text` such as
+    '192.168.0.10:80', None if it is not an URL but a device name."""
+    if ':' in text:
+        bits = text.split(":")
+        if len(bits) == 2:
+            try:
+                port_number = int(bits[1])
+            except ValueError:
+                return None
+            if host_regexp.match(bits[0]) and 1 <= port_number <= 65535:
+                return bits[0], port_number
+    return None
+
 
 class Device():
     """Handler for serial and web socket connections.
@@ -59,6 +81,9 @@ class Device():
     ----------
     is_connected
     has_flow_control
+    meatpack : printrun.meatpack.Encoder or None
+        Packs the written data while MeatPack packing is enabled on the
+        peer, see `meatpack_command`.
 
     """
 
@@ -68,6 +93,7 @@ class Device():
         self.baudrate = baudrate
         self.force_dtr = force_dtr
         self.parity_workaround = parity_workaround
+        self.meatpack = None
 
         # Private
         self._device = None
@@ -79,6 +105,8 @@ class Device():
         self._selector = None
         self._timeout = 0.25
         self._type = None
+        self._meatpack_no_spaces = False
+        self._write_lock = threading.Lock()
 
         if port is not None:
             self._parse_type()
@@ -108,6 +136,8 @@ class Device():
 
         if self.port is not None:
             self._parse_type()
+            self.meatpack = None
+            self._meatpack_no_spaces = False
             getattr(self, "_connect_" + self._type)()
         else:
             raise DeviceError("No port or URL specified")
@@ -162,6 +192,20 @@ class Device():
             return getattr(self, "_readline_" + self._type)()
         raise DeviceError("Attempted to read when disconnected")
 
+    def fileno(self):
+        """Return the file descriptor of the connection, to wait for data
+        with `selectors` or an event loop.
+
+        Raises
+        ------
+        DeviceError
+            If not connected.
+
+        """
+        if self._device is not None:
+            return self._device.fileno()
+        raise DeviceError("Attempted to use the connection when disconnected")
+
     def reset(self):
         """Attempt to reset the connection to the device.
 
@@ -193,10 +237,50 @@ class Device():
 
         """
         if self._device is not None:
-            getattr(self, "_write_" + self._type)(data)
+            with self._write_lock:
+                if self.meatpack is not None:
+                    data = self.meatpack.encode(data)
+                getattr(self, "_write_" + self._type)(data)
         else:
             raise DeviceError("Attempted to write when disconnected")
 
+    def meatpack_command(self, code):
+        """Send a MeatPack command to the connected peer.
+
+        The data written afterwards is packed as the peer expects it once it
+        has run the command.
+
+        Parameters
+        ----------
+        code: int
+            One of the command codes of `printrun.meatpack`, such as
+            `meatpack.ENABLE_PACKING`.
+
+        Raises
+        ------
+        DeviceError
+            If connected peer is unreachable.
+
+        """
+        if self._device is None:
+            raise DeviceError("Attempted to write when disconnected")
+        with self._write_lock:
+            getattr(self, "_write_" + self._type)(meatpack.command(code))
+            if code in (meatpack.ENABLE_NO_SPACES,
+                        meatpack.DISABLE_NO_SPACES):
+                self._meatpack_no_spaces = \
+                    code == meatpack.ENABLE_NO_SPACES
+                if self.meatpack is not None:
+                    self.meatpack.no_spaces = self._meatpack_no_spaces
+            elif code == meatpack.ENABLE_PACKING:
+                if self.meatpack is None:
+                    self.meatpack = meatpack.Encoder(self._meatpack_no_spaces)
+            elif code == meatpack.DISABLE_PACKING:
+                self.meatpack = None
+            elif code == meatpack.RESET_ALL:
+                self.meatpack = None
+                self._meatpack_no_spaces = False
+
     def _parse_type(self):
         # Guess which type of connection is being used
         if self._is_url(self.port):
@@ -205,21 +289,11 @@ class Device():
             self._type = 'serial'
 
     def _is_url(self, text):
-        # TODO: Rearrange to avoid long line
-        host_regexp = re.compile("^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$|^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
-        if ':' in text:
-            bits = text.split(":")
-            if len(bits) == 2:
-                self._hostname = bits[0]
-                try:
-                    self._port_number = int(bits[1])
-                    if (host_regexp.match(self._hostname) and
-                            1 <= self._port_number <= 65535):
-                        return True
-                except:
-                    # TODO: avoid catch-all clauses
-                    pass
-        return False
+        address = parse_url(text)
+        if address is None:
+            return False
+        self._hostname, self._port_number = address
+        return True
 
     # ------------------------------------------------------------------------
     # Serial Functions
@@ -0,0 +1,563 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Host many printers from one process.
+
+`Farm` drives named printers through `printrun.asyncprintcore` on a single
+asyncio event loop, whose selector waits for the data of all their
+connections. The hooks of the event handlers of each printer run in order
+on a bounded pool of threads shared by all printers, so that slow handlers
+don't hold up the loop. Printers printing the same file share one parsed
+`GCode`.
+
+`FarmShell` controls a farm with pronsole-style commands addressed by
+printer name, or by comma-separated names:
+
+    add left /dev/ttyUSB0 115200
+    add right 192.168.0.20:23
+    connect all
+    print left,right part.gcode
+    status
+"""
+
+import asyncio
+import cmd
+import concurrent.futures
+import logging
+import os
+import threading
+import traceback
+from collections import deque
+
+from printrun import compressed
+from printrun import gcoder
+from printrun.asyncprintcore import AsyncPrintcore
+from printrun.eventhandler import PrinterEventHandler
+from printrun.gcodecache import GCodeCache
+from .utils import install_locale, parse_temperature_report
+install_locale('pronterface')
+
+# Calls of a printer run by a worker before it lets the other printers in
+CALL_BATCH = 100
+
+class CallQueue:
+    """Calls of one printer, run in order by a shared pool of threads"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.calls = deque()
+        self.lock = threading.Lock()
+        self.running = False
+
+    def submit(self, function, *args):
+        with self.lock:
+            self.calls.append((function, args))
+            if self.running:
+                return
+            self.running = True
+        try:
+            self.executor.submit(self._run)
+        except RuntimeError:
+            # Pool shut down
+            with self.lock:
+                self.calls.clear()
+                self.running = False
+
+    def _run(self):
+        while True:
+            for i in range(CALL_BATCH):
+                with self.lock:
+                    if not self.calls:
+                        self.running = False
+                        return
+                    function, args = self.calls.popleft()
+                try:
+                    function(*args)
+                except:
+                    logging.error(traceback.format_exc())
+            try:
+                self.executor.submit(self._run)
+                return
+            except RuntimeError:
+                # Pool shutting down, run the remaining calls here
+                pass
+
+class PooledHandler:
+    """Event handler passing the hooks called from the event loop on to
+    `handler` through the `calls` of its printer"""
+
+    def __init__(self, handler, calls):
+        self.handler = handler
+        self.calls = calls
+
+    def __getattr__(self, name):
+        hook = getattr(self.handler, name)
+        if not name.startswith("on_"):
+            return hook
+        return lambda *args: self.calls.submit(hook, *args)
+
+class _TemperatureRecorder(PrinterEventHandler):
+
+    def __init__(self, printer):
+        self.printer = printer
+
+    def on_temp(self, line):
+        self.printer.temperatures = parse_temperature_report(line)
+
+class FarmPrinter:
+    """A printer of a farm.
+
+    Attributes
+    ----------
+    core : AsyncPrintcore
+        The connection to the printer.
+    filename : str
+        The file printed last, None if none.
+    temperatures : dict
+        The last temperature report, see
+        `printrun.utils.parse_temperature_report`.
+
+    """
+
+    def __init__(self, name, port, baud, executor):
+        self.name = name
+        self.core = AsyncPrintcore(port, baud)
+        self.calls = CallQueue(executor)
+        self.filename = None
+        self.temperatures = {}
+        self.connecting = False
+        # Task asking for the temperatures
+        self.poller = None
+        self.core.addEventHandler(_TemperatureRecorder(self))
+
+    @property
+    def state(self):
+        if self.core.printing:
+            return "printing"
+        if self.core.paused:
+            return "paused"
+        if self.core.online:
+            return "online"
+        if self.connecting:
+            return "connecting"
+        return "offline"
+
+    @property
+    def progress(self):
+        """Fraction of the lines of the file sent, None if no file"""
+        queue = self.core.mainqueue
+        if queue is None or not len(queue):
+            return None
+        return min(1.0, self.core.queueindex / len(queue))
+
+class Farm:
+    """Printers hosted by one event loop.
+
+    The coroutines must be called from the same event loop.
+
+    Parameters
+    ----------
+    workers : int
+        Threads running the hooks of the event handlers and parsing files.
+    cache_dir : str, optional
+        Directory of the `printrun.gcodecache.GCodeCache` of the parsed
+        files, not cached if None.
+    poll_interval : float
+        Seconds between two temperature requests to the online printers, 0
+        to disable.
+    connect_timeout : float
+        Seconds to wait for a printer to answer when connecting.
+
+    """
+
+    def __init__(self, workers = 4, cache_dir = None, poll_interval = 5,
+                 connect_timeout = 30):
+        self.printers = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix = "farm worker")
+        self.cache = GCodeCache(cache_dir) if cache_dir else None
+        self.poll_interval = poll_interval
+        self.connect_timeout = connect_timeout
+        # Parsing or parsed files by (path, size, modification time)
+        self._jobs = {}
+
+    def add(self, name, port, baud = None):
+        """Add the printer `name` connected to `port`"""
+        if not name or name == "all" or "," in name:
+            raise ValueError(_("Invalid printer name: %s") % name)
+        if name in self.printers:
+            raise ValueError(_("Printer %s already exists") % name)
+        printer = FarmPrinter(name, port, baud, self.executor)
+        self.printers[name] = printer
+        return printer
+
+    def select(self, names):
+        """Return the printers named in the list `names`, all of them for
+        "all". Raises KeyError for an unknown name."""
+        if "all" in names:
+            return list(self.printers.values())
+        return [self.printers[name] for name in names]
+
+    def addEventHandler(self, name, handler):
+        """Add a `PrinterEventHandler` to the printer `name`, its hooks are
+        called from the worker threads"""
+        printer = self.printers[name]
+        printer.core.addEventHandler(PooledHandler(handler, printer.calls))
+
+    async def remove(self, name):
+        printer = self.printers.pop(name)
+        await self.disconnect(printer)
+
+    async def connect(self, printer):
+        printer.connecting = True
+        try:
+            await printer.core.connect(timeout = self.connect_timeout)
+        finally:
+            printer.connecting = False
+        if self.poll_interval and printer.poller is None:
+            printer.poller = asyncio.ensure_future(self._poll(printer))
+
+    async def disconnect(self, printer):
+        if printer.poller is not None:
+            printer.poller.cancel()
+            await asyncio.gather(printer.poller, return_exceptions = True)
+            printer.poller = None
+        await printer.core.disconnect()
+
+    async def _poll(self, printer):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not printer.core.online:
+                continue
+            try:
+                # Printers not answering are not asked again meanwhile
+                await printer.core.send_now("M105")
+            except Exception as e:
+                logging.debug("Temperature request failed: %s" % e)
+
+    async def load(self, filename):
+        """Return the parsed `GCode` of `filename`, parsed in a worker
+        thread unless a printer prints it already"""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        job = self._jobs.get(key)
+        if job is None:
+            self._forget_jobs()
+            job = asyncio.get_running_loop().run_in_executor(
+                self.executor, self._parse, path)
+            self._jobs[key] = job
+        try:
+            return await asyncio.shield(job)
+        except Exception:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
+            raise
+
+    def _forget_jobs(self):
+        printed = set(id(printer.core.mainqueue)
+                      for printer in self.printers.values())
+        for key, job in list(self._jobs.items()):
+            if job.done() and (job.exception() is not None
+                               or id(job.result()) not in printed):
+                del self._jobs[key]
+
+    def _parse(self, path):
+        gcode = gcoder.LightGCode(deferred = True)
+        if self.cache is None or not self.cache.load(path, gcode):
+            with compressed.open_gcode(path) as f:
+                gcode.prepare(f)
+            gcode.estimate_duration()
+            if self.cache is not None:
+                self.cache.store(path, gcode)
+        return gcode
+
+    async def startprint(self, printer, filename):
+        """Print `filename`, return False if offline or already printing"""
+        gcode = await self.load(filename)
+        if not await printer.core.startprint(gcode):
+            return False
+        printer.filename = filename
+        return True
+
+    async def pause(self, printer):
+        return await printer.core.pause()
+
+    async def resume(self, printer):
+        return await printer.core.resume()
+
+    async def cancel(self, printer):
+        await printer.core.cancelprint()
+
+    async def send(self, printer, command):
+        """Send `command` ahead of the print and return the reply.
+
+        Never appended to the print, whose `GCode` may be shared."""
+        return await printer.core.send_now(command)
+
+    async def close(self):
+        """Disconnect all the printers and stop the workers"""
+        await asyncio.gather(*(self.disconnect(printer)
+                               for printer in self.printers.values()))
+        self.executor.shutdown(wait = False)
+
+class _ShellHandler(PrinterEventHandler):
+
+    def __init__(self, shell, name):
+        self.shell = shell
+        self.name = name
+
+    def on_end(self):
+        self.shell.log(_("[%s] Print stopped.") % self.name)
+
+    def on_disconnect(self):
+        self.shell.log(_("[%s] Disconnected.") % self.name)
+
+class FarmShell(cmd.Cmd):
+    """Commands controlling a `Farm` run by an event loop in a thread of
+    its own"""
+
+    prompt = "farm> "
+
+    def __init__(self, farm = None):
+        super().__init__()
+        self.farm = farm if farm is not None else Farm()
+        self.loop = asyncio.new_event_loop()
+        self.io_thread = threading.Thread(target = self.loop.run_forever,
+                                          name = "farm I/O", daemon = True)
+        self.io_thread.start()
+
+    def log(self, *msg):
+        msg = "".join(str(i) for i in msg)
+        logging.info(msg)
+
+    def logError(self, *msg):
+        msg = "".join(str(i) for i in msg)
+        logging.error(msg)
+
+    def call(self, function, *args):
+        """Run `function` in the I/O thread, awaiting it if it is a
+        coroutine function, and return its result"""
+        async def run():
+            result = function(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.call(self.farm.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.io_thread.join()
+        self.loop.close()
+
+    def targets(self, l):
+        """Return the printers addressed by the first word of `l` and the
+        rest of `l`, None if a name is unknown"""
+        names, _sep, rest = l.strip().partition(" ")
+        if not names:
+            self.logError(_("No printer given."))
+            return None, rest
+        try:
+            printers = self.call(self.farm.select, names.split(","))
+        except KeyError as e:
+            self.logError(_("Unknown printer: %s") % e.args[0])
+            return None, rest
+        return printers, rest.strip()
+
+    def each(self, printers, method, *args):
+        """Call the coroutine `method` of the farm for each printer at
+        once, log the errors and return the results by printer name"""
+        async def run():
+            return await asyncio.gather(
+                *(method(printer, *args) for printer in printers),
+                return_exceptions = True)
+        results = self.call(run)
+        for printer, result in zip(printers, results):
+            if isinstance(result, Exception):
+                self.logError("[%s] %s" % (printer.name,
+                                           str(result) or type(result).__name__))
+        return dict((printer.name, result)
+                    for printer, result in zip(printers, results))
+
+    def emptyline(self):
+        pass
+
+    def do_add(self, l):
+        args = l.split()
+        if len(args) not in (2, 3):
+            self.help_add()
+            return
+        baud = None
+        if len(args) == 3:
+            try:
+                baud = int(args[2])
+            except ValueError:
+                self.logError(_("Bad baud value '%s'") % args[2])
+                return
+        try:
+            self.call(self.farm.add, args[0], args[1], baud)
+        except ValueError as e:
+            self.logError(str(e))
+            return
+        self.call(self.farm.addEventHandler, args[0],
+                  _ShellHandler(self, args[0]))
+
+    def help_add(self):
+        self.log(_("Add a printer to the farm"))
+        self.log(_("add <name> <port> [baudrate]"))
+
+    def do_remove(self, l):
+        printers, rest = self.targets(l)
+        if printers is None:
+            return
+        for printer in printers:
+            self.call(self.farm.remove, printer.name)
+
+    def help_remove(self):
+        self.log(_("Disconnect printers and remove them from the farm"))
+        self.log(_("remove <names>"))
+
+    def do_connect(self, l):
+        printers, rest = self.targets(l)
+        if printers is None:
+            return
+        for name, result in self.each(printers, self.farm.connect).items():
+            if result is None:
+                self.log(_("[%s] Printer is now online.") % name)
+
+    def help_connect(self):
+        self.log(_("Connect to printers and wait until they answer"))
+        self.log(_("connect <names>"))
+
+    def do_disconnect(self, l):
+        printers, rest = self.targets(l)
+        if printers is not None:
+            self.each(printers, self.farm.disconnect)
+
+    def help_disconnect(self):
+        self.log(_("Disconnect from printers"))
+        self.log(_("disconnect <names>"))
+
+    def do_print(self, l):
+        printers, filename = self.targets(l)
+        if printers is None:
+            return
+        if not filename:
+            self.logError(_("No file name given."))
+            return
+        try:
+            self.call(self.farm.load, filename)
+        except Exception as e:
+            self.logError(_("Could not load %s: %s") % (filename, e))
+            return
+        for name, started in self.each(printers, self.farm.startprint,
+                                       filename).items():
+            if started is True:
+                self.log(_("[%s] Printing %s") % (name, filename))
+            elif started is False:
+                self.logError(_("[%s] Not connected or already printing.")
+                              % name)
+
+    def help_print(self):
+        self.log(_("Print a file on printers, which share its parsed lines"))
+        self.log(_("print <names> <file>"))
+
+    def do_pause(self, l):
+        printers, rest = self.targets(l)
+        if printers is None:
+            return
+        for name, paused in self.each(printers, self.farm.pause).items():
+            if paused is False:
+                self.logError(_("[%s] Not printing, cannot pause.") % name)
+
+    def help_pause(self):
+        self.log(_("Pause running prints"))
+        self.log(_("pause <names>"))
+
+    def do_resume(self, l):
+        printers, rest = self.targets(l)
+        if printers is None:
+            return
+        for name, resumed in self.each(printers, self.farm.resume).items():
+            if resumed is False:
+                self.logError(_("[%s] Not paused, unable to resume.") % name)
+
+    def help_resume(self):
+        self.log(_("Resume paused prints"))
+        self.log(_("resume <names>"))
+
+    def do_cancel(self, l):
+        printers, rest = self.targets(l)
+        if printers is not None:
+            self.each(printers, self.farm.cancel)
+
+    def help_cancel(self):
+        self.log(_("Cancel prints"))
+        self.log(_("cancel <names>"))
+
+    def do_send(self, l):
+        printers, command = self.targets(l)
+        if printers is None:
+            return
+        if not command:
+            self.logError(_("No command given."))
+            return
+        printers = [printer for printer in printers if printer.core.online]
+        for name, reply in self.each(printers, self.farm.send,
+                                     command).items():
+            if isinstance(reply, str):
+                self.log("[%s] %s" % (name, reply))
+
+    def help_send(self):
+        self.log(_("Send a command to printers and show their replies"))
+        self.log(_("send <names> <command>"))
+
+    def status_lines(self):
+        lines = []
+        for printer in self.call(lambda: list(self.farm.printers.values())):
+            parts = [printer.name, printer.core.port, printer.state]
+            progress = printer.progress
+            if printer.state in ("printing", "paused") \
+                    and progress is not None:
+                parts.append("%s %.1f%%" % (os.path.basename(printer.filename),
+                                            progress * 100))
+            parts.extend("%s:%s/%s" % (sensor, current, target)
+                         for sensor, (current, target)
+                         in sorted(printer.temperatures.items()))
+            lines.append(" ".join(parts))
+        return lines
+
+    def do_status(self, l):
+        lines = self.status_lines()
+        if not lines:
+            self.log(_("No printers, add them with the add command."))
+        for line in lines:
+            self.log(line)
+
+    def help_status(self):
+        self.log(_("Show the state, print progress and temperatures of all printers"))
+
+    def do_exit(self, l):
+        self.close()
+        return True
+
+    def help_exit(self):
+        self.log(_("Disconnect from all printers and exit"))
+
+    def do_EOF(self, l):
+        return self.do_exit(l)
@@ -0,0 +1,293 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Information on G-code files read from the comments of their slicer.
+
+Slicers write the estimated print time, the filament used and their
+settings in comments at the start (Cura, ideaMaker, OrcaSlicer) or at the
+end (PrusaSlicer, SuperSlicer, Simplify3D) of the files, along with
+thumbnails and the labels of the printed objects. `probe` only reads the
+first and last `PROBE_SIZE` bytes of a file to find them, which takes
+milliseconds whatever the size of the file, so that a file can be
+described without parsing it with `gcoder`.
+
+The end of files compressed as a whole (gzip, xz, Zstandard) can't be
+read without decompressing them, only their start is probed. Binary
+G-code files (.bgcode) are described by their metadata blocks.
+"""
+
+import base64
+import datetime
+import os
+import re
+
+from . import bgcode
+from . import compressed
+
+# Size of the start and end of the files read
+PROBE_SIZE = 64 * 1024
+# Most bytes read at the start of a file to get its thumbnails whole
+MAX_HEAD_SIZE = 4 * 1024 * 1024
+
+THUMBNAIL_FORMATS = {"": bgcode.PNG, "PNG": bgcode.PNG, "JPG": bgcode.JPG,
+                     "QOI": bgcode.QOI}
+
+number = r"([-+]?[0-9]*\.?[0-9]+)"
+slicer_exp = re.compile(r";\s*(?:g-code )?(?:generated (?:by|with)|sliced by)"
+                        r"\s+(.+?)(?:\s+on\s+\d.*)?$", re.I)
+# Durations as "1d 2h 3m 4s" or in seconds
+duration_exps = (
+    re.compile(r";\s*estimated printing time \(normal mode\)\s*=\s*(.+)"),
+    re.compile(r";\s*total estimated time\s*:\s*(.+)"),
+)
+seconds_exps = (
+    re.compile(r";TIME:\s*%s" % number),
+    re.compile(r";\s*Print Time:\s*%s" % number),
+)
+build_time_exp = re.compile(r";\s*Build time:\s*(?:(\d+) hours?)?\s*"
+                            r"(?:(\d+) minutes?)?")
+filament_mm_exp = re.compile(r";\s*filament used \[mm\]\s*=\s*(.+)")
+filament_m_exp = re.compile(r";Filament used:\s*(.+)")
+filament_length_exp = re.compile(r";\s*Filament length:\s*%s\s*mm" % number)
+material_exp = re.compile(r";\s*Material#(\d+) Used:\s*%s" % number)
+layer_height_exps = (
+    re.compile(r";\s*layer_height\s*=\s*%s" % number),
+    re.compile(r";\s*Layer height:\s*%s" % number),
+    re.compile(r";\s*layerHeight,\s*%s" % number),
+)
+layer_count_exps = (
+    re.compile(r";\s*total layers? (?:count|number)\s*[=:]\s*(\d+)"),
+    re.compile(r";LAYER_COUNT:\s*(\d+)"),
+    re.compile(r";\s*Layer Count:\s*(\d+)"),
+)
+height_exps = (
+    re.compile(r";\s*max_layer_z\s*=\s*%s" % number),
+    re.compile(r";MAXZ:\s*%s" % number),
+)
+object_exps = (
+    re.compile(r"EXCLUDE_OBJECT_DEFINE\s+NAME=(\S+)", re.I),
+    re.compile(r"M486\s+(?:S-?\d+\s+)?A(.+)"),
+    re.compile(r";\s*printing object\s+(.+?)(?:\s+id:\d+\s+copy\s+\d+)?$"),
+    re.compile(r";MESH:(.+)"),
+)
+thumbnail_begin_exp = re.compile(r";\s*thumbnail(?:_(\w+))? begin\s+(\d+)x(\d+)"
+                                 r"(?:\s+(\d+))?")
+thumbnail_end_exp = re.compile(r";\s*thumbnail(?:_\w+)? end")
+thumbnail_begins_exp = re.compile(rb"; ?thumbnail(?:_\w+)? begin \d+x\d+ (\d+)")
+thumbnail_ends_exp = re.compile(rb"; ?thumbnail(?:_\w+)? end")
+
+class FileInfo:
+    """What a slicer tells of a G-code file, None for what is unknown"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.slicer = None
+        self.duration = None
+        # Millimeters of filament used by each tool
+        self.filament_lengths = []
+        self.layer_height = None
+        self.layer_count = None
+        self.height = None
+        self.objects = []
+        self.thumbnails = []
+
+    @property
+    def filament_length(self):
+        return sum(self.filament_lengths) if self.filament_lengths else None
+
+    def apply(self, gcode):
+        """Set the filament length and duration of `gcode` known from the
+        slicer"""
+        if self.filament_lengths:
+            gcode.filament_length = self.filament_length
+            gcode.filament_length_multi = list(self.filament_lengths)
+        if self.duration is not None:
+            gcode.duration = self.duration
+
+    def _add_object(self, name):
+        name = name.strip().strip('"')
+        if name and name != "NONMESH" and name not in self.objects:
+            self.objects.append(name)
+
+    def _parse_line(self, line):
+        if self.slicer is None:
+            match = slicer_exp.match(line)
+            if match:
+                self.slicer = match.group(1).strip()
+                return
+        for exp in object_exps:
+            match = exp.match(line)
+            if match:
+                self._add_object(match.group(1))
+                return
+        if not line.startswith(";"):
+            return
+        if self.duration is None:
+            for exp in duration_exps:
+                match = exp.match(line)
+                if match:
+                    self.duration = bgcode.parse_duration(match.group(1))
+                    return
+            for exp in seconds_exps:
+                match = exp.match(line)
+                if match:
+                    self.duration = datetime.timedelta(
+                        seconds = int(float(match.group(1))))
+                    return
+            match = build_time_exp.match(line)
+            if match and any(match.groups()):
+                hours, minutes = (int(value or 0) for value in match.groups())
+                self.duration = datetime.timedelta(hours = hours,
+                                                   minutes = minutes)
+                return
+        if not self.filament_lengths:
+            match = filament_mm_exp.match(line)
+            if match:
+                self.filament_lengths = parse_lengths(match.group(1))
+                return
+            match = filament_m_exp.match(line)
+            if match:
+                self.filament_lengths = [
+                    length * 1000
+                    for length in parse_lengths(match.group(1), "m")]
+                return
+            match = filament_length_exp.match(line)
+            if match:
+                self.filament_lengths = [float(match.group(1))]
+                return
+        match = material_exp.match(line)
+        if match:
+            tool = int(match.group(1)) - 1
+            lengths = self.filament_lengths
+            lengths.extend([0.0] * (tool + 1 - len(lengths)))
+            lengths[tool] = float(match.group(2))
+            return
+        for name, exps, kind in (("layer_height", layer_height_exps, float),
+                                 ("layer_count", layer_count_exps, int),
+                                 ("height", height_exps, float)):
+            if getattr(self, name) is None:
+                for exp in exps:
+                    match = exp.match(line)
+                    if match:
+                        setattr(self, name, kind(match.group(1)))
+                        return
+
+    def parse(self, text):
+        """Read the information of the complete lines `text`"""
+        thumbnail = None
+        for line in text.splitlines():
+            line = line.strip()
+            if thumbnail is not None:
+                if thumbnail_end_exp.match(line):
+                    self._add_thumbnail(*thumbnail)
+                    thumbnail = None
+                else:
+                    thumbnail[3].append(line.lstrip(";").strip())
+                continue
+            match = thumbnail_begin_exp.match(line)
+            if match:
+                kind, width, height, _length = match.groups()
+                thumbnail = (kind or "", int(width), int(height), [])
+                continue
+            if line:
+                self._parse_line(line)
+
+    def _add_thumbnail(self, kind, width, height, lines):
+        try:
+            data = base64.b64decode("".join(lines), validate = True)
+        except ValueError:
+            return
+        self.thumbnails.append(bgcode.Thumbnail(
+            THUMBNAIL_FORMATS.get(kind.upper(), bgcode.PNG), width, height,
+            data))
+
+def parse_lengths(value, unit = ""):
+    """Return the numbers of the comma separated lengths `value`"""
+    lengths = []
+    for length in value.split(","):
+        length = length.strip()
+        if unit and length.endswith(unit):
+            length = length[:-len(unit)]
+        try:
+            lengths.append(float(length))
+        except ValueError:
+            return []
+    return lengths
+
+def read_head(f, size = PROBE_SIZE):
+    """Read the start of the binary file `f`, up to the end of the
+    thumbnails it starts"""
+    data = f.read(size)
+    while len(data) < MAX_HEAD_SIZE:
+        begins = list(thumbnail_begins_exp.finditer(data))
+        if not begins or thumbnail_ends_exp.search(data, begins[-1].end()):
+            break
+        # Base64 lines of 78 characters behind "; "
+        end = begins[-1].end() + int(begins[-1].group(1)) * 82 // 78 + 256
+        more = f.read(min(end, MAX_HEAD_SIZE) - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def probe_metadata(filename):
+    """Return the FileInfo of the binary G-code file `filename`"""
+    metadata = bgcode.read_metadata(filename)
+    info = FileInfo(filename)
+    info.slicer = metadata.get("Producer")
+    info.duration = metadata.duration
+    info.filament_lengths = metadata.filament_lengths
+    for name in ("layer_height", "max_layer_z"):
+        try:
+            value = float(metadata.get(name))
+        except (TypeError, ValueError):
+            continue
+        if name == "layer_height":
+            info.layer_height = value
+        else:
+            info.height = value
+    for obj in metadata.objects:
+        info._add_object(str(obj.get("name", "")))
+    info.thumbnails = list(metadata.thumbnails)
+    return info
+
+def probe(filename, size = PROBE_SIZE):
+    """Return the FileInfo of the G-code file `filename`, reading its first
+    and last `size` bytes"""
+    with open(filename, "rb") as f:
+        kind = compressed.detect(f)
+        if kind == "bgcode":
+            return probe_metadata(filename)
+        info = FileInfo(filename)
+        tail = b""
+        if kind is not None:
+            with compressed.open_binary(filename) as data:
+                head = read_head(data, size)
+            # The last line may be cut
+            head = head[:head.rfind(b"\n") + 1]
+        else:
+            head = read_head(f, size)
+            file_size = os.fstat(f.fileno()).st_size
+            if file_size <= len(head) + size:
+                head += f.read()
+            else:
+                head = head[:head.rfind(b"\n") + 1]
+                f.seek(file_size - size)
+                tail = f.read()
+                # Skip the line cut by the start of the read
+                tail = tail[tail.find(b"\n") + 1:]
+    info.parse(head.decode("utf-8", "replace"))
+    info.parse(tail.decode("utf-8", "replace"))
+    return info
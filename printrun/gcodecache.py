@@ -0,0 +1,452 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent on-disk cache of parsed G-code files.
+
+Parsing a G-code file with `gcoder` means splitting every line and running
+`GCode._preprocess` over the whole file. `GCodeCache` stores the result of
+that work next to the other Printrun caches so that reloading an unchanged
+file only has to read it back:
+
+- the byte offset and length of every non-empty line of the file,
+- the layer table (`layer_idxs`, `line_idxs`, z and duration of each layer),
+- the estimated time at the end of each line (`elapsed`),
+- the bounding box, filament lengths per tool and estimated duration,
+- the parser state at the end of the file, so that `GCode.append` keeps
+  working on a restored object.
+
+Compressed files (see `compressed`) are indexed by the offsets of their
+lines in the decompressed data.
+
+Entries are keyed by the absolute path of the file and validated against
+its size, modification time and a hash of its first and last blocks, as
+well as the home position and `cutting_as_extrusion` flag that the parse
+depends on. Entries are binary files read through `mmap`; the least
+recently used ones are removed once the cache grows over `max_size`.
+"""
+
+import datetime
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from . import compressed
+from . import gcoder
+
+MAGIC = b"PRGC"
+VERSION = 2
+# Size of the blocks hashed at the start and at the end of the file
+HASH_BLOCK = 64 * 1024
+ENTRY_SUFFIX = ".gcc"
+
+# magic, version, byte order, file size, mtime, hash, home position,
+# cutting_as_extrusion, path length, line count, layer count, tool count,
+# bounding box, filament length, duration, final position/extrusion state,
+# current tool and modal flags
+HEADER = struct.Struct("<4sHcxQq16s3d?3xIQQQ6ddd11dI4?")
+
+STATE_FIELDS = ("current_x", "current_y", "current_z",
+                "offset_x", "offset_y", "offset_z",
+                "current_e", "offset_e", "total_e", "max_e", "current_f")
+FLAG_FIELDS = ("imperial", "relative", "relative_e", "cutting")
+MULTI_FIELDS = ("current_e_multi", "offset_e_multi", "total_e_multi",
+                "max_e_multi", "filament_length_multi")
+BYTE_ORDER = sys.byteorder[0].encode()
+
+def file_hash(f, size):
+    """Hash the first and last `HASH_BLOCK` bytes of an open binary file"""
+    digest = hashlib.blake2b(digest_size = 16)
+    f.seek(0)
+    digest.update(f.read(HASH_BLOCK))
+    if size > HASH_BLOCK:
+        f.seek(max(HASH_BLOCK, size - HASH_BLOCK))
+        digest.update(f.read(HASH_BLOCK))
+    return digest.digest()
+
+def iter_lines(f, starts, lengths):
+    """Iterate over the stripped non-empty lines of the binary file `f`,
+    as kept by `GCode.prepare`, recording their byte offsets and lengths in
+    the `starts` and `lengths` arrays"""
+    offset = 0
+    # Iterating splits on \n only, splitlines() also handles \r newlines
+    for block in f:
+        for line in block.splitlines(True):
+            stripped = line.strip()
+            if stripped:
+                starts.append(offset + len(line) - len(line.lstrip()))
+                lengths.append(len(stripped))
+                yield stripped
+            offset += len(line)
+
+def line_offsets(f):
+    """Return the byte offsets and lengths of the lines of the binary file
+    `f` kept by `GCode.prepare`"""
+    starts = array('Q')
+    lengths = array('I')
+    for line in iter_lines(f, starts, lengths):
+        pass
+    return starts, lengths
+
+def _read_array(typecode, buffer, offset, count):
+    values = array(typecode)
+    end = offset + count * values.itemsize
+    values.frombytes(buffer[offset:end])
+    return values, end
+
+def _map_array(typecode, buffer, offset, count):
+    end = offset + count * array(typecode).itemsize
+    return memoryview(buffer)[offset:end].cast(typecode), end
+
+class CacheEntry:
+    """Parsed data of a G-code file as read back from the cache.
+
+    With `copy = False` the arrays are read-only views over `buffer`, which
+    must then stay open until `close()` is called.
+    """
+
+    def __init__(self, buffer, copy = True):
+        self.buffer = None if copy else buffer
+        read_array = _read_array if copy else _map_array
+        header = HEADER.unpack_from(buffer, 0)
+        (magic, version, byte_order, self.size, self.mtime, self.hash,
+         home_x, home_y, home_z, self.cutting_as_extrusion, path_length,
+         nlines, nlayers, ntools) = header[:14]
+        if magic != MAGIC or version != VERSION or byte_order != BYTE_ORDER:
+            raise ValueError("incompatible G-code cache entry")
+        self.home_pos = (home_x, home_y, home_z)
+        (self.xmin, self.xmax, self.ymin, self.ymax, self.zmin,
+         self.zmax) = header[14:20]
+        self.filament_length, self.duration = header[20:22]
+        self.state = dict(zip(STATE_FIELDS, header[22:33]))
+        self.state["current_tool"] = header[33]
+        self.state.update(zip(FLAG_FIELDS, header[34:38]))
+
+        offset = HEADER.size
+        self.path = bytes(buffer[offset:offset + path_length]).decode()
+        offset += path_length
+        self.line_starts, offset = read_array('Q', buffer, offset, nlines)
+        self.line_lengths, offset = read_array('I', buffer, offset, nlines)
+        self.layer_idxs, offset = read_array('I', buffer, offset, nlines)
+        self.line_idxs, offset = read_array('I', buffer, offset, nlines)
+        self.elapsed, offset = read_array('d', buffer, offset, nlines)
+        self.layer_ends, offset = read_array('I', buffer, offset, nlayers)
+        self.layer_z, offset = read_array('d', buffer, offset, nlayers)
+        self.layer_duration, offset = read_array('d', buffer, offset,
+                                                 nlayers)
+        self.multi = {}
+        for name in MULTI_FIELDS:
+            self.multi[name], offset = _read_array('d', buffer, offset,
+                                                   ntools)
+        if offset != len(buffer):
+            raise ValueError("truncated G-code cache entry")
+
+    def __len__(self):
+        return len(self.line_starts)
+
+    def close(self):
+        """Release the views and the buffer of a mapped entry"""
+        if self.buffer is None:
+            return
+        for name in ("line_starts", "line_lengths", "layer_idxs",
+                     "line_idxs", "elapsed", "layer_ends", "layer_z",
+                     "layer_duration"):
+            getattr(self, name).release()
+        self.buffer.close()
+        self.buffer = None
+
+    def restore(self, gcode, make_layer, layer_callback = None):
+        """Fill `gcode` as `GCode.prepare` would have, except for its
+        `lines`. `make_layer(start, end, z)` must return the layer made of
+        the lines `start` to `end` of the file."""
+        all_layers = gcode.all_layers = []
+        start = 0
+        for layer, end in enumerate(self.layer_ends):
+            z = self.layer_z[layer]
+            new_layer = make_layer(start, end, None if math.isnan(z) else z)
+            new_layer.duration = self.layer_duration[layer]
+            all_layers.append(new_layer)
+            start = end
+        gcode.all_zs = {layer.z for layer in all_layers}
+        gcode.append_layer_id = len(all_layers)
+        gcode.append_layer = gcoder.Layer([])
+        all_layers.append(gcode.append_layer)
+        gcode.layer_idxs = self.layer_idxs
+        gcode.line_idxs = self.line_idxs
+        gcode.elapsed = self.elapsed
+
+        for name, value in self.state.items():
+            setattr(gcode, name, value)
+        for name, values in self.multi.items():
+            setattr(gcode, name, list(values))
+        gcode.xmin, gcode.xmax = self.xmin, self.xmax
+        gcode.ymin, gcode.ymax = self.ymin, self.ymax
+        gcode.zmin, gcode.zmax = self.zmin, self.zmax
+        gcode.width = gcode.xmax - gcode.xmin
+        gcode.depth = gcode.ymax - gcode.ymin
+        gcode.height = gcode.zmax - gcode.zmin
+        gcode.filament_length = self.filament_length
+        gcode.duration = datetime.timedelta(seconds = int(self.duration))
+        if layer_callback:
+            for layer in range(len(all_layers) - 1):
+                layer_callback(gcode, layer)
+
+def layer_ends(gcode):
+    """Index past the last line of each layer of `gcode`"""
+    ends = []
+    end = 0
+    for layer in gcode.all_layers[:-1]:
+        end += len(layer)
+        ends.append(end)
+    return ends
+
+def serialize(gcode, size, mtime, digest, path, starts, lengths):
+    """Build the chunks of the cache entry of a parsed `gcode`"""
+    home_pos = tuple(float(v) for v in gcode.home_pos)
+    layers = gcode.all_layers[:-1]
+    ntools = len(gcode.max_e_multi)
+    header = HEADER.pack(
+        MAGIC, VERSION, BYTE_ORDER, size, mtime, digest,
+        *home_pos, bool(gcode.cutting_as_extrusion), len(path),
+        len(starts), len(layers), ntools,
+        gcode.xmin, gcode.xmax, gcode.ymin, gcode.ymax,
+        gcode.zmin, gcode.zmax,
+        gcode.filament_length, gcode.duration.total_seconds(),
+        *(float(getattr(gcode, name)) for name in STATE_FIELDS),
+        gcode.current_tool,
+        *(bool(getattr(gcode, name)) for name in FLAG_FIELDS))
+    chunks = [header, path, starts, lengths,
+              array('I', gcode.layer_idxs).tobytes(),
+              array('I', gcode.line_idxs).tobytes(),
+              array('d', gcode.elapsed).tobytes(),
+              array('I', layer_ends(gcode)).tobytes(),
+              array('d', [float("nan") if layer.z is None else layer.z
+                          for layer in layers]).tobytes(),
+              array('d', [layer.duration for layer in layers]).tobytes()]
+    for name in MULTI_FIELDS:
+        values = list(getattr(gcode, name))[:ntools]
+        values += [0] * (ntools - len(values))
+        chunks.append(array('d', values).tobytes())
+    return chunks
+
+class GCodeCache:
+    """Cache of parsed G-code files stored in `cache_dir`"""
+
+    def __init__(self, cache_dir, max_size = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def entry_path(self, filename):
+        """Path of the cache entry of `filename`"""
+        key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+    def _open_entry(self, filename, f, home_pos, cutting_as_extrusion,
+                    copy = True):
+        """Return the valid `CacheEntry` of an open G-code file, if any"""
+        buffer = None
+        try:
+            with open(self.entry_path(filename), "rb") as entry_file:
+                buffer = mmap.mmap(entry_file.fileno(), 0,
+                                   access = mmap.ACCESS_READ)
+            entry = CacheEntry(buffer, copy)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError, struct.error) as e:
+            logging.debug("Ignoring G-code cache entry of %s: %s",
+                          filename, e)
+            if buffer is not None:
+                buffer.close()
+            return None
+        if copy:
+            buffer.close()
+        stat = os.fstat(f.fileno())
+        home_pos = tuple(float(v) for v in home_pos or (0, 0, 0))
+        if entry.path != os.path.abspath(filename) \
+                or entry.size != stat.st_size \
+                or entry.mtime != stat.st_mtime_ns \
+                or entry.home_pos != home_pos \
+                or entry.cutting_as_extrusion != bool(cutting_as_extrusion) \
+                or entry.hash != file_hash(f, stat.st_size):
+            entry.close()
+            return None
+        try:
+            os.utime(self.entry_path(filename))
+        except OSError:
+            pass
+        return entry
+
+    def lookup(self, filename, home_pos = None,
+               cutting_as_extrusion = False, copy = True):
+        """Return the valid `CacheEntry` of `filename`, or None.
+
+        With `copy = False` the entry is mapped instead of being read into
+        memory and must be closed by the caller.
+        """
+        try:
+            with open(filename, "rb") as f:
+                return self._open_entry(filename, f, home_pos,
+                                        cutting_as_extrusion, copy)
+        except OSError:
+            return None
+
+    @staticmethod
+    def restorable(gcode):
+        """Whether `gcode` can be filled by `load`: objects storing light
+        lines (`gcoder.LightGCode`, `gcoder.LightStreamingGCode`), as the
+        per-line parsed values of the other line classes are not cached.
+        `mappedgcode.MappedGCode` uses the cache from its `prepare`."""
+        from .mappedgcode import MappedGCode
+        return gcode.line_class is gcoder.LightLine \
+            and not isinstance(gcode, MappedGCode)
+
+    def load(self, filename, gcode, home_pos = None, layer_callback = None):
+        """Fill `gcode` from the cache entry of `filename`.
+
+        The lines are created in bulk from the bytes of the file and the
+        cached offsets, the compiled lines pointing into those bytes.
+        Compressed files are split into lines again while decompressing.
+
+        Returns
+        -------
+        bool
+            True if `gcode` was restored, False if it must be parsed.
+
+        Raises
+        ------
+        TypeError
+            If `gcode` can not be restored, see `restorable`.
+        """
+        if not self.restorable(gcode):
+            raise TypeError("%s objects can not be restored from the G-code "
+                            "cache" % type(gcode).__name__)
+        line_class = gcode.line_class
+        try:
+            with open(filename, "rb") as f:
+                entry = self._open_entry(filename, f, home_pos,
+                                         gcode.cutting_as_extrusion)
+                if entry is None:
+                    return False
+                f.seek(0)
+                if compressed.detect(f):
+                    # Split the lines again while decompressing rather than
+                    # decompressing the whole file in memory
+                    with compressed.open_binary(filename) as data:
+                        lines = gcoder.lines_from_strings(
+                            (line.decode("utf-8") for line in
+                             iter_lines(data, array('Q'), array('I'))),
+                            line_class)
+                else:
+                    lines = gcoder.lines_from_offsets(
+                        f.read(), entry.line_starts, entry.line_lengths,
+                        line_class)
+        except (OSError, ValueError) as e:
+            logging.debug("Could not load %s from the G-code cache: %s",
+                          filename, e)
+            return False
+        if len(lines) != len(entry):
+            logging.debug("Could not load %s from the G-code cache: "
+                          "different lines", filename)
+            return False
+        gcode.home_pos = home_pos
+        entry.restore(gcode,
+                      lambda start, end, z: gcoder.Layer(lines[start:end], z),
+                      layer_callback)
+        gcode.lines = gcoder.LayeredLines(gcode)
+        return True
+
+    def store(self, filename, gcode, offsets = None):
+        """Store a `gcode` freshly parsed from `filename` in the cache.
+
+        `offsets` are the line offsets and lengths given by `line_offsets`,
+        computed here if not provided.
+
+        Returns
+        -------
+        bool
+            True if an entry was written.
+        """
+        if self.max_size <= 0 or gcode.duration is None:
+            return False
+        try:
+            with open(filename, "rb") as f:
+                stat = os.fstat(f.fileno())
+                digest = file_hash(f, stat.st_size)
+                f.seek(0)
+                if offsets is None and compressed.detect(f):
+                    with compressed.open_binary(filename) as data:
+                        offsets = line_offsets(data)
+                starts, lengths = offsets or line_offsets(f)
+            if len(starts) != len(gcode.layer_idxs):
+                # Lines were split differently than by the text reader
+                return False
+            if gcode.elapsed is None or len(gcode.elapsed) != len(starts):
+                return False
+            path = os.path.abspath(filename).encode()
+            chunks = serialize(gcode, stat.st_size, stat.st_mtime_ns, digest,
+                               path, starts, lengths)
+            if sum(len(chunk) for chunk in chunks) > self.max_size:
+                return False
+            os.makedirs(self.cache_dir, exist_ok = True)
+            entry_path = self.entry_path(filename)
+            tmp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+            with open(tmp_path, "wb") as entry_file:
+                for chunk in chunks:
+                    entry_file.write(chunk)
+            os.replace(tmp_path, entry_path)
+        except (OSError, struct.error) as e:
+            logging.warning("Could not store %s in the G-code cache: %s",
+                            filename, e)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        `max_size`"""
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """Remove every entry of the cache"""
+        max_size, self.max_size = self.max_size, 0
+        self.evict()
+        self.max_size = max_size
@@ -17,6 +17,7 @@
 
 import wx
 import sys
+import datetime
 import os
 import time
 import types
@@ -24,6 +25,7 @@ import re
 import math
 import logging
 
+from printrun import bgcode
 from printrun import gcoder
 from printrun.objectplater import make_plater, PlaterPanel
 from printrun.gl.libtatlin import actors
@@ -76,7 +78,7 @@ def rewrite_gline(centeroffset, gline, cosr, sinr):
 
 class GcodePlaterPanel(PlaterPanel):
 
-    load_wildcard = _("GCODE files") + " (*.gcode;*.GCODE;*.g)|*.gcode;*.gco;*.g"
+    load_wildcard = _("GCODE files") + " (*.gcode;*.GCODE;*.g;*.bgcode)|*.gcode;*.gco;*.g;*.bgcode"
     save_wildcard = load_wildcard
 
     def prepare_ui(self, filenames = [], callback = None,
@@ -148,6 +150,20 @@ class GcodePlaterPanel(PlaterPanel):
     def export_to(self, name):
         return self.export_combined(name)
 
+    def open_export(self, name, models):
+        """Open the file `name` for writing the G-code of `models`, as
+        binary G-code if its extension is .bgcode"""
+        if not name.lower().endswith(".bgcode"):
+            return open(name, "w")
+        lengths = [model.gcode.filament_length or 0 for model in models]
+        duration = sum((model.gcode.duration for model in models
+                        if model.gcode.duration), datetime.timedelta())
+        zmax = max((model.gcode.zmax + model.offsets[2] for model in models),
+                   default = 0)
+        metadata = bgcode.print_metadata([sum(lengths)], duration, zmax)
+        return bgcode.Writer(name, metadata = {bgcode.PRINTER_METADATA: metadata,
+                                               bgcode.PRINT_METADATA: metadata})
+
     def export_combined(self, name):
         models = list(self.models.values())
         last_real_position = None
@@ -167,7 +183,7 @@ class GcodePlaterPanel(PlaterPanel):
         laste = [0] * len(models)
         lasttool = [0] * len(models)
         lastrelative = [False] * len(models)
-        with open(name, "w") as f:
+        with self.open_export(name, models) as f:
             analyzer = gcoder.GCode(None, get_home_pos(self.build_dimensions))
             analyzer.write = types.MethodType(lambda self, line: gcoder_write(self, f, line), analyzer)
             for (layer_z, model_i, layer_i) in alllayers:
@@ -215,7 +231,7 @@ class GcodePlaterPanel(PlaterPanel):
         last_real_position = None
         # Sort models by Z max to print smaller objects first
         models.sort(key = lambda x: x.dims[-1])
-        with open(name, "w") as f:
+        with self.open_export(name, models) as f:
             for model_i, model in enumerate(models):
                 r = math.radians(model.rot)
                 o = model.offsets
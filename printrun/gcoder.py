@@ -18,10 +18,16 @@
 import sys
 import re
 import math
+import bisect
 import datetime
+import itertools
 import logging
+import threading
 from array import array
 
+from . import compressed
+from . import tokenizer
+
 gcode_parsed_args = ["x", "y", "e", "f", "z", "i", "j"]
 gcode_parsed_nonargs = 'gtmnd'
 to_parse = "".join(gcode_parsed_args) + gcode_parsed_nonargs
@@ -62,14 +68,79 @@ try:
     LightLine = gcoder_line.GLightLine
 except Exception as e:
     logging.warning("Memory-efficient GCoder implementation unavailable: %s" % e)
+    gcoder_line = None
     Line = PyLine
     LightLine = PyLightLine
 
+try:
+    from . import gcoder_preprocess
+except Exception as e:
+    logging.debug("Compiled G-code preprocessing unavailable: %s" % e)
+    gcoder_preprocess = None
+
+# Characters stripped around the lines of a bytes buffer: the ASCII
+# characters str.strip removes
+buffer_strip = b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+buffer_newline_exp = re.compile(rb"\r\n|\r|\n")
+
+def is_buffer(data):
+    """Whether `data` is a bytes-like object (bytes, bytearray, memoryview,
+    mmap...) rather than an iterable of str lines"""
+    try:
+        memoryview(data).release()
+    except TypeError:
+        return False
+    return True
+
+def lines_from_buffer(buffer, line_class = Line):
+    """Return the stripped non-empty lines of the UTF-8 bytes-like `buffer`
+    as `line_class` objects. Lines end as in files read in text mode.
+
+    The compiled lines keep a pointer into the buffer and decode their raw
+    line only when it is read, other lines are decoded one by one.
+    """
+    if gcoder_line is not None and line_class is gcoder_line.GLine:
+        return gcoder_line.lines_from_buffer(buffer)
+    if gcoder_line is not None and line_class is gcoder_line.GLightLine:
+        return gcoder_line.lines_from_buffer(buffer, light = True)
+    return [line_class(l2.decode("utf-8", "replace")) for l2 in
+            (l.strip(buffer_strip) for l in
+             buffer_newline_exp.split(memoryview(buffer).tobytes()))
+            if l2]
+
+def lines_from_offsets(buffer, starts, lengths, line_class = Line):
+    """Return the lines of the UTF-8 bytes-like `buffer` at the byte offsets
+    `starts` (array('Q')) with the byte lengths `lengths` (array('I')), such
+    as the ones recorded by `gcodecache.line_offsets`, as `line_class`
+    objects. The compiled lines point into the buffer as with
+    `lines_from_buffer`."""
+    if gcoder_line is not None and line_class is gcoder_line.GLine:
+        return gcoder_line.lines_from_offsets(buffer, starts, lengths)
+    if gcoder_line is not None and line_class is gcoder_line.GLightLine:
+        return gcoder_line.lines_from_offsets(buffer, starts, lengths,
+                                              light = True)
+    data = memoryview(buffer)
+    return [line_class(data[start:start + length].tobytes()
+                       .decode("utf-8", "replace"))
+            for start, length in zip(starts, lengths)]
+
+def lines_from_strings(strings, line_class = Line):
+    """Return the stripped non-empty lines of the iterable of str lines
+    `strings` as `line_class` objects. The compiled lines are packed in one
+    buffer instead of allocating each raw line."""
+    if gcoder_line is not None and line_class is gcoder_line.GLine:
+        return gcoder_line.lines_from_strings(strings)
+    if gcoder_line is not None and line_class is gcoder_line.GLightLine:
+        return gcoder_line.lines_from_strings(strings, light = True)
+    return [line_class(l2) for l2 in (l.strip() for l in strings) if l2]
+
 def find_specific_code(line, code):
-    exp = specific_exp % code
-    bits = [bit for bit in re.findall(exp, line.raw) if bit]
-    if not bits: return None
-    else: return float(bits[0][1:])
+    value = tokenizer.find_code(line.raw, code)
+    if not value: return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
 
 def S(line):
     return find_specific_code(line, "S")
@@ -78,7 +149,7 @@ def P(line):
     return find_specific_code(line, "P")
 
 def split(line):
-    split_raw = gcode_exp.findall(line.raw.lower())
+    split_raw = tokenizer.split(line.raw, to_parse)
     if split_raw and split_raw[0][0] == "n":
         del split_raw[0]
     if not split_raw:
@@ -87,7 +158,8 @@ def split(line):
         logging.warning("raw G-Code line \"%s\" could not be parsed" % line.raw)
         return [line.raw]
     command = split_raw[0]
-    line.command = command[0].upper() + command[1]
+    # Share the command strings between lines
+    line.command = sys.intern(command[0].upper() + command[1])
     line.is_move = line.command in move_gcodes
     return split_raw
 
@@ -110,15 +182,54 @@ class Layer(list):
         self.z = z
         self.duration = 0
 
+class LayeredLines:
+    """Sequence of the lines of a `GCode` in print order, read from its
+    layers. The layers are the only store of the lines, so that editing a
+    layer does not move the lines of the other ones."""
+
+    __slots__ = ("gcode",)
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+
+    def __len__(self):
+        return len(self.gcode)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("line index out of range")
+        layer, line = self.gcode.idxs(i)
+        return self.gcode.all_layers[layer][line]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.gcode.all_layers)
+
 class GCode:
 
     line_class = Line
+    # Run _preprocess with the gcoder_preprocess extension when it is built
+    compiled_preprocess = True
+    # prepare also accepts the bytes of the file
+    buffer_input = True
 
     lines = None
     layers = None
     all_layers = None
-    layer_idxs = None
-    line_idxs = None
+    _layer_idxs = None
+    _line_idxs = None
+    _layer_offsets = None
+    _offsets_layers = None
+    # Estimated time in seconds at the end of each line, in print order
+    elapsed = None
+    # Lines to send precomputed by printrun.transcoder, dropped on edits
+    wire_lines = None
+    # Moves of excluded objects skipped when printing, see exclude_objects
+    exclusion = None
+    _object_index = None
     append_layer = None
     append_layer_id = None
 
@@ -227,89 +338,154 @@ class GCode:
             self.prepare(data, home_pos, layer_callback)
 
     def prepare(self, data = None, home_pos = None, layer_callback = None):
+        """Parse `data`, an iterable of str lines (e.g. a file opened in text
+        mode) or, when `buffer_input` is set, the bytes of a UTF-8 file
+        (bytes or mmap)"""
         self.home_pos = home_pos
+        self.wire_lines = None
+        self.exclusion = None
+        self._object_index = None
         if data:
             line_class = self.line_class
-            self.lines = [line_class(l2) for l2 in
-                          (l.strip() for l in data)
-                          if l2]
+            if self.buffer_input and is_buffer(data):
+                self.lines = lines_from_buffer(data, line_class)
+            else:
+                self.lines = lines_from_strings(data, line_class)
             self._preprocess(build_layers = True,
                              layer_callback = layer_callback)
         else:
-            self.lines = []
             self.append_layer_id = 0
             self.append_layer = Layer([])
             self.all_layers = [self.append_layer]
             self.all_zs = set()
             self.layers = {}
-            self.layer_idxs = array('I', [])
-            self.line_idxs = array('I', [])
+            self._layers_edited()
+            self.elapsed = array('d', [])
+        # The layers hold the lines from now on
+        self.lines = LayeredLines(self)
+
+    def _get_layer_offsets(self):
+        # Rebuilt when the layers were replaced or edited
+        if self._offsets_layers is not self.all_layers:
+            self._layer_offsets = array('Q', itertools.accumulate(
+                map(len, self.all_layers or ()), initial = 0))
+            self._offsets_layers = self.all_layers
+        return self._layer_offsets
+    # Index of the first line of each layer in print order, followed by the
+    # number of lines: layer k holds the lines layer_offsets[k] to
+    # layer_offsets[k + 1] - 1
+    layer_offsets = property(_get_layer_offsets)
+
+    def _build_idxs(self):
+        layer_idxs = array('I')
+        line_idxs = array('I')
+        lengths = [len(layer) for layer in self.all_layers or ()]
+        counting = array('I', range(max(lengths, default = 0)))
+        for layer_idx, length in enumerate(lengths):
+            layer_idxs.extend(array('I', [layer_idx]) * length)
+            line_idxs.extend(counting[:length])
+        self._layer_idxs = layer_idxs
+        self._line_idxs = line_idxs
+
+    def _get_layer_idxs(self):
+        if self._layer_idxs is None:
+            self._build_idxs()
+        return self._layer_idxs
+
+    def _set_layer_idxs(self, layer_idxs):
+        self._layer_idxs = layer_idxs
+
+    def _get_line_idxs(self):
+        if self._line_idxs is None:
+            self._build_idxs()
+        return self._line_idxs
+
+    def _set_line_idxs(self, line_idxs):
+        self._line_idxs = line_idxs
+
+    # Layer and line in the layer of each line in print order, built from
+    # the layers when first used
+    layer_idxs = property(_get_layer_idxs, _set_layer_idxs)
+    line_idxs = property(_get_line_idxs, _set_line_idxs)
+
+    def _layers_edited(self):
+        """Drop the indexes built from the layers after editing them"""
+        self._offsets_layers = None
+        self._layer_idxs = None
+        self._line_idxs = None
+        self.wire_lines = None
+        self.exclusion = None
+        self._object_index = None
+
+    @property
+    def object_index(self):
+        """ObjectIndex of the objects labelled by the slicer, built when
+        first used"""
+        if self._object_index is not None:
+            return self._object_index
+        index = ObjectIndex(self)
+        # Lines are still added while parsing
+        if not getattr(self, "parsing", False):
+            self._object_index = index
+        return index
+
+    def exclude_objects(self, names, start = 0):
+        """Skip the moves of the labelled objects `names` when printing the
+        lines from `start` on, or skip nothing if `names` is empty"""
+        if names:
+            self.exclusion = self.object_index.exclusion(self, names, start)
+        else:
+            self.exclusion = None
+        return self.exclusion
 
     def has_index(self, i):
         return i < len(self)
     def __len__(self):
-        return len(self.line_idxs)
+        return self.layer_offsets[-1]
 
     def __iter__(self):
         return self.lines.__iter__()
 
-    def prepend_to_layer(self, commands, layer_idx):
-        # Prepend commands in reverse order
-        commands = [c.strip() for c in commands[::-1] if c.strip()]
-        layer = self.all_layers[layer_idx]
-        # Find start index to append lines
-        # and end index to append new indices
-        start_index = self.layer_idxs.index(layer_idx)
-        for i in range(start_index, len(self.layer_idxs)):
-            if self.layer_idxs[i] != layer_idx:
-                end_index = i
-                break
-        else:
-            end_index = i + 1
-        end_line = self.line_idxs[end_index - 1]
-        for i, command in enumerate(commands):
+    def _new_lines(self, commands):
+        glines = []
+        for command in commands:
             gline = Line(command)
             # Split to get command
             split(gline)
             # Force is_move to False
             gline.is_move = False
-            # Insert gline at beginning of layer
-            layer.insert(0, gline)
-            # Insert gline at beginning of list
-            self.lines.insert(start_index, gline)
-            # Update indices arrays & global gcodes list
-            self.layer_idxs.insert(end_index + i, layer_idx)
-            self.line_idxs.insert(end_index + i, end_line + i + 1)
-        return commands[::-1]
+            glines.append(gline)
+        return glines
+
+    def prepend_to_layer(self, commands, layer_idx):
+        commands = [c.strip() for c in commands if c.strip()]
+        layer = self.all_layers[layer_idx]
+        start_index = self.layer_offsets[layer_idx]
+        # Only this layer moves, the offsets are rebuilt from the layer
+        # lengths when next needed
+        layer[0:0] = self._new_lines(commands)
+        self._layers_edited()
+        if self.elapsed is not None:
+            # Injected lines are not timed
+            start_time = self.elapsed_time(start_index)
+            self.elapsed[start_index:start_index] = \
+                array('d', [start_time]) * len(commands)
+        return commands
 
     def rewrite_layer(self, commands, layer_idx):
-        # Prepend commands in reverse order
-        commands = [c.strip() for c in commands[::-1] if c.strip()]
+        commands = [c.strip() for c in commands if c.strip()]
         layer = self.all_layers[layer_idx]
-        # Find start index to append lines
-        # and end index to append new indices
-        start_index = self.layer_idxs.index(layer_idx)
-        for i in range(start_index, len(self.layer_idxs)):
-            if self.layer_idxs[i] != layer_idx:
-                end_index = i
-                break
-        else:
-            end_index = i + 1
-        self.layer_idxs = self.layer_idxs[:start_index] + array('I', len(commands) * [layer_idx]) + self.layer_idxs[end_index:]
-        self.line_idxs = self.line_idxs[:start_index] + array('I', range(len(commands))) + self.line_idxs[end_index:]
-        del self.lines[start_index:end_index]
-        del layer[:]
-        for i, command in enumerate(commands):
-            gline = Line(command)
-            # Split to get command
-            split(gline)
-            # Force is_move to False
-            gline.is_move = False
-            # Insert gline at beginning of layer
-            layer.insert(0, gline)
-            # Insert gline at beginning of list
-            self.lines.insert(start_index, gline)
-        return commands[::-1]
+        start_index = self.layer_offsets[layer_idx]
+        end_index = self.layer_offsets[layer_idx + 1]
+        layer[:] = self._new_lines(commands)
+        self._layers_edited()
+        if self.elapsed is not None:
+            # Rewritten lines are not timed, the layer keeps its estimated
+            # duration
+            start_time = self.elapsed_time(start_index)
+            self.elapsed[start_index:end_index] = \
+                array('d', [start_time]) * len(commands)
+        return commands
 
     def append(self, command, store = True):
         '''Add a G-code command to the list
@@ -337,15 +513,23 @@ class GCode:
         gline = Line(command)
         self._preprocess([gline])
         if store:
-            self.lines.append(gline)
             self.append_layer.append(gline)
-            self.layer_idxs.append(self.append_layer_id)
-            self.line_idxs.append(len(self.append_layer)-1)
+            # The append layer is the last one
+            if self._offsets_layers is self.all_layers:
+                self._layer_offsets[-1] += 1
+            if self._layer_idxs is not None:
+                self._layer_idxs.append(self.append_layer_id)
+                self._line_idxs.append(len(self.append_layer)-1)
+            if self.elapsed is not None:
+                self.elapsed.append(self.elapsed_time(len(self.elapsed)))
         return gline
 
     def _preprocess(self, lines = None, build_layers = False,
                     layer_callback = None):
         """Checks for imperial/relativeness settings and tool changes"""
+        if self.compiled_preprocess and gcoder_preprocess is not None:
+            return gcoder_preprocess.preprocess(self, lines, build_layers,
+                                                layer_callback)
         if not lines:
             lines = self.lines
         imperial = self.imperial
@@ -408,8 +592,7 @@ class GCode:
             # Initialize layers
             all_layers = self.all_layers = []
             all_zs = self.all_zs = set()
-            layer_idxs = self.layer_idxs = []
-            line_idxs = self.line_idxs = []
+            elapsed = array('d')
 
 
             last_layer_z = None
@@ -432,11 +615,7 @@ class GCode:
                     layer = all_layers[-1]
                     finished_layer = None
                 layer_id = len(all_layers)-1
-                layer_line = len(layer)
-                for i, ln in enumerate(lines):
-                    layer.append(ln)
-                    layer_idxs.append(layer_id)
-                    line_idxs.append(layer_line+i)
+                layer.extend(lines)
                 layer.duration += totalduration - layerbeginduration
                 layerbeginduration = totalduration
                 if layer_callback:
@@ -679,6 +858,7 @@ class GCode:
 
             if build_layers:
                 cur_lines.append(true_line)
+                elapsed.append(totalduration)
                 prev_z = cur_z
             # ## Loop done
 
@@ -708,55 +888,633 @@ class GCode:
         if build_layers:
             if cur_lines:
                 append_lines(cur_lines, True)
-
-            self.append_layer_id = len(all_layers)
-            self.append_layer = Layer([])
-            self.append_layer.duration = 0
-            all_layers.append(self.append_layer)
-            self.layer_idxs = array('I', layer_idxs)
-            self.line_idxs = array('I', line_idxs)
-
-            # Compute bounding box
-            all_zs = self.all_zs.union({zmin}).difference({None})
-            zmin = min(all_zs)
-            zmax = max(all_zs)
-
-            self.filament_length = self.max_e
-            while len(self.filament_length_multi)<len(self.max_e_multi):
-                    self.filament_length_multi+=[0]
-            for i in enumerate(self.max_e_multi):
-                self.filament_length_multi[i[0]]=i[1]
-
-
-            if self.filament_length > 0:
-                self.xmin = xmin_e if not math.isinf(xmin_e) else 0
-                self.xmax = xmax_e if not math.isinf(xmax_e) else 0
-                self.ymin = ymin_e if not math.isinf(ymin_e) else 0
-                self.ymax = ymax_e if not math.isinf(ymax_e) else 0
-            else:
-                self.xmin = xmin if not math.isinf(xmin) else 0
-                self.xmax = xmax if not math.isinf(xmax) else 0
-                self.ymin = ymin if not math.isinf(ymin) else 0
-                self.ymax = ymax if not math.isinf(ymax) else 0
-            self.zmin = zmin if not math.isinf(zmin) else 0
-            self.zmax = zmax if not math.isinf(zmax) else 0
-            self.width = self.xmax - self.xmin
-            self.depth = self.ymax - self.ymin
-            self.height = self.zmax - self.zmin
-
-            # Finalize duration
-            totaltime = datetime.timedelta(seconds = int(totalduration))
-            self.duration = totaltime
+            self._finalize_layers((xmin, xmax, ymin, ymax, zmin),
+                                  (xmin_e, xmax_e, ymin_e, ymax_e),
+                                  totalduration, elapsed)
+
+    def _finalize_layers(self, bounds, bounds_e, totalduration, elapsed):
+        """Add the append layer and compute the bounding box and duration
+        once all lines went through _preprocess. `elapsed` holds the
+        estimated time at the end of each line."""
+        xmin, xmax, ymin, ymax, zmin = bounds
+        xmin_e, xmax_e, ymin_e, ymax_e = bounds_e
+        self.append_layer_id = len(self.all_layers)
+        self.append_layer = Layer([])
+        self.append_layer.duration = 0
+        self.all_layers.append(self.append_layer)
+        self._layers_edited()
+        self.elapsed = elapsed
+
+        # Compute bounding box
+        all_zs = self.all_zs.union({zmin}).difference({None})
+        zmin = min(all_zs)
+        zmax = max(all_zs)
+
+        self.filament_length = self.max_e
+        while len(self.filament_length_multi)<len(self.max_e_multi):
+                self.filament_length_multi+=[0]
+        for i in enumerate(self.max_e_multi):
+            self.filament_length_multi[i[0]]=i[1]
+
+
+        if self.filament_length > 0:
+            self.xmin = xmin_e if not math.isinf(xmin_e) else 0
+            self.xmax = xmax_e if not math.isinf(xmax_e) else 0
+            self.ymin = ymin_e if not math.isinf(ymin_e) else 0
+            self.ymax = ymax_e if not math.isinf(ymax_e) else 0
+        else:
+            self.xmin = xmin if not math.isinf(xmin) else 0
+            self.xmax = xmax if not math.isinf(xmax) else 0
+            self.ymin = ymin if not math.isinf(ymin) else 0
+            self.ymax = ymax if not math.isinf(ymax) else 0
+        self.zmin = zmin if not math.isinf(zmin) else 0
+        self.zmax = zmax if not math.isinf(zmax) else 0
+        self.width = self.xmax - self.xmin
+        self.depth = self.ymax - self.ymin
+        self.height = self.zmax - self.zmin
+
+        # Finalize duration
+        totaltime = datetime.timedelta(seconds = int(totalduration))
+        self.duration = totaltime
 
     def idxs(self, i):
-        return self.layer_idxs[i], self.line_idxs[i]
+        offsets = self.layer_offsets
+        layer = bisect.bisect_right(offsets, i) - 1
+        return layer, i - offsets[layer]
 
     def estimate_duration(self):
         return self.layers_count, self.duration
 
+    def elapsed_time(self, i):
+        """Estimated time in seconds to print the lines before the `i`-th
+        one, 0 if no estimate is available"""
+        elapsed = self.elapsed
+        if elapsed is None or not len(elapsed) or i <= 0:
+            return 0.
+        return elapsed[min(i, len(elapsed)) - 1]
+
+    def layer_start(self, layer_idx):
+        """Index of the first line of the layer `layer_idx`"""
+        return self.layer_offsets[layer_idx]
+
+    def index_at_time(self, seconds):
+        """Index of the line estimated to be printing `seconds` after the
+        start of the print, len(self) past the end of the print"""
+        elapsed = self.elapsed
+        if seconds <= 0:
+            return 0
+        if elapsed is None or not len(elapsed):
+            return len(self)
+        return bisect.bisect_right(elapsed, seconds)
+
+    def index_at_z(self, z):
+        """Index of the first line of the first layer at or above `z`,
+        len(self) if there is none"""
+        # Layers may go down (e.g. sequential printing): search the first
+        # layer reaching z in the running maximum of the layer heights
+        heights = []
+        top = float("-inf")
+        for layer in self.all_layers:
+            if layer.z is not None and layer.z > top:
+                top = layer.z
+            heights.append(top)
+        layer_idx = bisect.bisect_left(heights, z - 1e-6)
+        if layer_idx >= len(heights):
+            return len(self)
+        return self.layer_start(layer_idx)
+
 class LightGCode(GCode):
     line_class = LightLine
 
+class StreamingGCode(GCode):
+    """G-code parsed by a background thread while it is being printed
+
+    prepare() starts the parser thread and returns at once. The lines of a
+    layer become available when the parser finishes the layer, or as soon
+    as they are read if `split_layers` is False, which keeps all lines in
+    one layer for slow sources such as the output of a script. has_index()
+    blocks until the parser reaches the line or the end of the data, so
+    that printcore can print the lines parsed so far; idxs() and
+    all_layers are only valid for the lines has_index() reported. Layer
+    callbacks are called from the parser thread, `data` is closed once
+    parsed. Commands appended while parsing are added after the parsed
+    lines.
+    """
+
+    # Lines are read from a stream
+    buffer_input = False
+    parsing = False
+    # Exception raised by the parser thread, raised again by wait()
+    parse_error = None
+    # Number of lines at the end of each parsed layer while parsing
+    _ready_offsets = None
+
+    def __init__(self, data = None, home_pos = None,
+                 layer_callback = None, deferred = False,
+                 cutting_as_extrusion = False, split_layers = True):
+        self.split_layers = split_layers
+        self._ready = threading.Condition()
+        self._appended = []
+        super().__init__(data, home_pos, layer_callback, deferred,
+                         cutting_as_extrusion)
+
+    def prepare(self, data = None, home_pos = None, layer_callback = None):
+        if not data:
+            return super().prepare(data, home_pos, layer_callback)
+        self.home_pos = home_pos
+        self.all_layers = []
+        self.all_zs = set()
+        self.layers = {}
+        self.lines = LayeredLines(self)
+        self._ready_offsets = array('Q', [0])
+        self.parse_error = None
+        self.parsing = True
+        self.parser_thread = threading.Thread(target = self._parse,
+                                              name = 'gcode parser thread',
+                                              args = (data, layer_callback))
+        self.parser_thread.daemon = True
+        self.parser_thread.start()
+
+    def _parse(self, data, layer_callback):
+        line_class = self.line_class
+        lines = (line_class(l2) for l2 in (l.strip() for l in data) if l2)
+        try:
+            if self.split_layers:
+                def parsed(gcode, layer_idx):
+                    with self._ready:
+                        offsets = self._ready_offsets
+                        offsets.append(offsets[-1] + len(self.all_layers[layer_idx]))
+                        self._ready.notify_all()
+                    if layer_callback:
+                        layer_callback(gcode, layer_idx)
+                self._preprocess(lines, build_layers = True,
+                                 layer_callback = parsed)
+            else:
+                GCode.prepare(self, None, self.home_pos)
+                self._ready_offsets.append(0)
+                for line in lines:
+                    GCode.append(self, line.raw)
+                    with self._ready:
+                        self._ready_offsets[-1] += 1
+                        self._ready.notify_all()
+        except BaseException as e:
+            logging.error("Failed to parse G-code: %s" % e)
+            self.parse_error = e
+        finally:
+            close = getattr(data, "close", None)
+            if close is not None:
+                close()
+            with self._ready:
+                if self.parse_error is None:
+                    for command in self._appended:
+                        GCode.append(self, command)
+                    self._ready_offsets = None
+                self._appended = []
+                self.parsing = False
+                self._ready.notify_all()
+
+    def wait(self, timeout = None):
+        """Wait for the end of the parsing, return False on timeout and
+        raise the exception of the parser thread if it failed"""
+        with self._ready:
+            if not self._ready.wait_for(lambda: not self.parsing, timeout):
+                return False
+        if self.parse_error is not None:
+            raise self.parse_error
+        return True
+
+    def has_index(self, i, timeout = None):
+        """True once the `i`-th line is parsed, False if the data has no
+        such line, or if it is not parsed after `timeout` seconds"""
+        if i < len(self):
+            return True
+        with self._ready:
+            self._ready.wait_for(lambda: i < len(self) or not self.parsing,
+                                 timeout)
+            return i < len(self)
+
+    def __len__(self):
+        offsets = self._ready_offsets
+        if offsets is not None:
+            return offsets[-1]
+        return super().__len__()
+
+    def __bool__(self):
+        return self.parsing or len(self) > 0
+
+    def idxs(self, i):
+        offsets = self._ready_offsets
+        if offsets is None:
+            return super().idxs(i)
+        layer = bisect.bisect_right(offsets, i) - 1
+        return layer, i - offsets[layer]
+
+    def append(self, command, store = True):
+        with self._ready:
+            if self.parsing:
+                command = command.strip()
+                if command and store:
+                    self._appended.append(command)
+                return Line(command) if command else None
+        return super().append(command, store)
+
+class LightStreamingGCode(StreamingGCode):
+    line_class = LightLine
+
+def _number(value):
+    return ("%.5f" % value).rstrip("0").rstrip(".")
+
+def resume_commands(lines, xy_feedrate = 3000, z_feedrate = 100,
+                    z_lift = 1):
+    """Return the commands bringing a homed printer into the state left by
+    the raw `lines`, so that printing can start at the following line.
+
+    Temperatures, fan, units, tool, positioning modes, position, extruder
+    position and feedrate are restored. The head goes up `z_lift` mm above
+    the position, travels to it and goes back down. Feedrates are in
+    mm/min.
+    """
+    hotends = {}
+    bed = None
+    fan = None
+    tool = None
+    imperial = relative = relative_e = False
+    position = dict.fromkeys("xyze")
+    feedrate = None
+    for raw in lines:
+        words = [word for word in tokenizer.split(raw, "gmtxyzefsr")
+                 if word[0]]
+        if not words:
+            continue
+        command = words[0][0].upper() + words[0][1]
+        args = dict(words[1:])
+        if command in move_gcodes:
+            for axis in "xyze":
+                if not args.get(axis):
+                    continue
+                value = float(args[axis])
+                axis_relative = relative_e if axis == "e" else relative
+                if axis_relative:
+                    value += position[axis] or 0
+                position[axis] = value
+            if args.get("f"):
+                feedrate = float(args["f"])
+        elif command == "G92":
+            for axis in [axis for axis in "xyze" if axis in args] or "xyze":
+                position[axis] = float(args.get(axis) or 0)
+        elif command == "G28":
+            for axis in [axis for axis in "xyz" if axis in args] or "xyz":
+                position[axis] = 0.
+        elif command == "G20":
+            imperial = True
+        elif command == "G21":
+            imperial = False
+        elif command == "G90":
+            relative = relative_e = False
+        elif command == "G91":
+            relative = relative_e = True
+        elif command == "M82":
+            relative_e = False
+        elif command == "M83":
+            relative_e = True
+        elif command[0] == "T":
+            try:
+                tool = int(command[1:])
+            except ValueError:
+                pass
+        elif command in ("M104", "M109"):
+            target = args.get("s") or args.get("r")
+            if target:
+                hotend = int(args.get("t") or tool or 0)
+                hotends[hotend] = float(target)
+        elif command in ("M140", "M190"):
+            target = args.get("s") or args.get("r")
+            if target:
+                bed = float(target)
+        elif command == "M106":
+            fan = float(args.get("s") or 255)
+        elif command == "M107":
+            fan = 0
+
+    # Lengths of the commands are in the units of the file
+    scale = 1 / 25.4 if imperial else 1
+    commands = []
+    if bed:
+        commands.append("M140 S" + _number(bed))
+    for hotend, target in sorted(hotends.items()):
+        commands.append("M104 T%d S%s" % (hotend, _number(target)))
+    if bed:
+        commands.append("M190 S" + _number(bed))
+    for hotend, target in sorted(hotends.items()):
+        if target:
+            commands.append("M109 T%d S%s" % (hotend, _number(target)))
+    commands.append("G20" if imperial else "G21")
+    if tool is not None:
+        commands.append("T%d" % tool)
+    commands.append("G90")
+    z = position["z"]
+    if z is not None:
+        commands.append("G1 Z%s F%s" % (_number(z + z_lift * scale),
+                                        _number(z_feedrate * scale)))
+    xy = ["%s%s" % (axis.upper(), _number(position[axis]))
+          for axis in "xy" if position[axis] is not None]
+    if xy:
+        commands.append("G1 %s F%s" % (" ".join(xy),
+                                       _number(xy_feedrate * scale)))
+    if z is not None:
+        commands.append("G1 Z%s F%s" % (_number(z),
+                                        _number(z_feedrate * scale)))
+    if position["e"] is not None:
+        commands.append("G92 E" + _number(position["e"]))
+    commands.append("M83" if relative_e else "M82")
+    if relative:
+        commands.append("G91")
+    if fan is not None:
+        commands.append("M106 S%s" % _number(fan) if fan else "M107")
+    if feedrate:
+        commands.append("G1 F" + _number(feedrate))
+    return commands
+
+m_label_exp = re.compile(r"[Mm](82|83|486)(?!\d)\s*(.*)")
+m486_words_exp = re.compile(r"([STPUstpu])\s*(-?\d+)")
+m486_name_exp = re.compile(r"(?:^|\s)[Aa](.+)")
+klipper_label_exp = re.compile(r"EXCLUDE_OBJECT_(DEFINE|START|END)"
+                               r"(?:.*?\bNAME=(\"[^\"]*\"|\S+))?", re.I)
+comment_label_exp = re.compile(r";\s*(stop )?printing object\s+(.+)")
+
+class _Labels:
+    """Line ranges of the objects labelled one way"""
+
+    def __init__(self):
+        self.keys = []
+        self.ranges = {}
+        self.current = None
+        self.start = 0
+        self.moves = 0
+
+    def define(self, key):
+        if key not in self.ranges:
+            self.keys.append(key)
+            self.ranges[key] = []
+
+    def open(self, key, index, moves):
+        self.close(index, moves)
+        self.define(key)
+        self.current = key
+        self.start = index + 1
+        self.moves = moves
+
+    def close(self, index, moves):
+        # Ranges without moves, such as definitions, are left out
+        if self.current is not None and moves > self.moves:
+            self.ranges[self.current].append((self.start, index))
+        self.current = None
+
+class ObjectIndex:
+    """Lines of the objects labelled by the slicer in a GCode, read in one
+    pass over its raw lines.
+
+    Objects are labelled by M486 S<id> and M486 A<name> (Marlin,
+    PrusaSlicer), "; printing object" and "; stop printing object"
+    comments (PrusaSlicer, SuperSlicer), EXCLUDE_OBJECT_START and
+    EXCLUDE_OBJECT_END (Klipper) or ;MESH: comments (Cura). `names` lists
+    the objects in order of appearance and `ranges` maps each of them to
+    the (start, end) indexes of its lines in print order, end excluded.
+    Files labelling their objects several ways are indexed from the first
+    kind of labels of that list found in them.
+    """
+
+    def __init__(self, gcode):
+        m486 = _Labels()
+        comments = _Labels()
+        klipper = _Labels()
+        meshes = _Labels()
+        m486_names = {}
+        # Positioning modes at the start of each range
+        self._modes = {}
+        relative = relative_e = False
+        moves = 0
+        for i, line in enumerate(gcode):
+            raw = line.raw.lstrip()
+            c = raw[:1]
+            if c in "Gg":
+                moves += 1
+                if raw[1:3] in ("90", "91") and not raw[3:4].isdigit():
+                    relative = relative_e = raw[2] == "1"
+                continue
+            labels = None
+            if c == ";":
+                if raw.startswith(";MESH:"):
+                    name = raw[6:].strip()
+                    if name == "NONMESH":
+                        meshes.close(i, moves)
+                    elif name:
+                        labels = meshes
+                        meshes.open(name, i, moves)
+                elif raw.startswith(";LAYER:"):
+                    meshes.close(i, moves)
+                elif "printing object" in raw:
+                    match = comment_label_exp.match(raw)
+                    if match:
+                        if match.group(1):
+                            comments.close(i, moves)
+                        else:
+                            labels = comments
+                            comments.open(match.group(2).strip(), i, moves)
+            elif c in "Mm":
+                match = m_label_exp.match(raw)
+                if match is None:
+                    continue
+                if match.group(1) == "82":
+                    relative_e = False
+                elif match.group(1) == "83":
+                    relative_e = True
+                else:
+                    args = match.group(2)
+                    name = m486_name_exp.search(args)
+                    if name:
+                        args = args[:name.start()]
+                    words = dict((letter.upper(), int(value)) for letter, value
+                                 in m486_words_exp.findall(
+                                     tokenizer.strip_comments(args)))
+                    if "S" in words:
+                        if words["S"] < 0:
+                            m486.close(i, moves)
+                        else:
+                            labels = m486
+                            m486.open(words["S"], i, moves)
+                    if name and m486.current is not None:
+                        m486_names[m486.current] = \
+                            name.group(1).strip().strip('"')
+            elif c in "Ee":
+                match = klipper_label_exp.match(raw)
+                if match is None:
+                    continue
+                kind, name = match.groups()
+                name = name.strip('"') if name else None
+                if kind.upper() == "END":
+                    klipper.close(i, moves)
+                elif name and kind.upper() == "START":
+                    labels = klipper
+                    klipper.open(name, i, moves)
+                elif name:
+                    klipper.define(name)
+            if labels is not None:
+                self._modes[i + 1] = (relative, relative_e)
+        end = len(gcode)
+        for labels in (klipper, m486, comments, meshes):
+            labels.close(end, moves)
+        chosen = next((labels for labels in (klipper, m486, comments, meshes)
+                       if any(labels.ranges.values())),
+                      next((labels for labels in (klipper, m486, comments,
+                                                  meshes) if labels.keys),
+                           meshes))
+        if chosen is m486:
+            keys = [m486_names.get(key, str(key)) for key in m486.keys]
+        else:
+            keys = chosen.keys
+        self.names = []
+        self.ranges = {}
+        for key, name in zip(chosen.keys, keys):
+            if name not in self.ranges:
+                self.names.append(name)
+                self.ranges[name] = []
+            self.ranges[name] += chosen.ranges[key]
+
+    def __len__(self):
+        return len(self.names)
+
+    def exclusion(self, gcode, names, start = 0):
+        """Return the Exclusion skipping the moves of the objects `names` of
+        `gcode` from the line `start` on"""
+        mask = bytearray(len(gcode))
+        fixups = {}
+        for name in names:
+            if name not in self.ranges:
+                raise ValueError("unknown object %r" % name)
+            for range_start, range_end in self.ranges[name]:
+                if range_end <= start:
+                    continue
+                relative, relative_e = self._modes[range_start]
+                skipped, commands = skip_moves(
+                    gcode.lines, range_start, range_end, start, relative,
+                    relative_e)
+                for i in skipped:
+                    mask[i] = 1
+                if skipped and commands:
+                    fixups[skipped[-1]] = commands
+        return Exclusion(names, mask, fixups)
+
+class Exclusion:
+    """Moves skipped to exclude objects from a print: `mask` has a 1 for
+    each line to skip in print order, and `fixups` maps the last line of
+    each skipped range to the commands to send after it, restoring the
+    extruder position, Z height and feedrate the next lines expect"""
+
+    def __init__(self, names, mask, fixups):
+        self.names = frozenset(names)
+        self.mask = mask
+        self.fixups = fixups
+
+    def lines(self, gcode):
+        """Return the raw lines of `gcode` without the excluded moves"""
+        lines = []
+        mask = self.mask
+        for i, line in enumerate(gcode):
+            if i >= len(mask) or not mask[i]:
+                lines.append(line.raw)
+            elif i in self.fixups:
+                lines.extend(self.fixups[i])
+        return lines
+
+def _mode_move(words, move_relative, relative, relative_e):
+    """Return the commands of a move of `words` in relative or absolute
+    positioning, restoring the modes `relative` and `relative_e`"""
+    move = "G1 " + " ".join(words)
+    if move_relative == relative:
+        return [move]
+    commands = ["G91" if move_relative else "G90", move,
+                "G91" if relative else "G90"]
+    # G90 and G91 also set the extruder mode
+    if relative_e != relative:
+        commands.append("M83" if relative_e else "M82")
+    return commands
+
+def skip_moves(lines, start, end, first, relative = False,
+               relative_e = False):
+    """Return the indexes of the moves among the lines `start` to `end` of
+    `lines` (raw lines read from `first` on) to skip, and the commands to
+    send after the last one so that the following lines print as if the
+    moves had been done. `relative` and `relative_e` are the positioning
+    modes at `start`."""
+    parsed = []
+    last = None
+    for i in range(start, end):
+        words = [word for word in tokenizer.split(lines[i].raw, "gmxyzef")
+                 if word[0]]
+        command = words[0][0].upper() + words[0][1] if words else ""
+        parsed.append((command, dict(words[1:])))
+        if i >= first and command in move_gcodes:
+            last = i
+    if last is None:
+        return [], []
+    skipped = []
+    e = z = feedrate = None
+    # Relative moves skipped since the last absolute position
+    offsets = dict.fromkeys("xyz", 0.)
+    for i in range(start, last + 1):
+        command, args = parsed[i - start]
+        if command in move_gcodes:
+            if i < first:
+                continue
+            skipped.append(i)
+            for axis in "xyz":
+                if not args.get(axis):
+                    continue
+                value = float(args[axis])
+                if not relative:
+                    offsets[axis] = 0.
+                    if axis == "z":
+                        z = value
+                elif axis == "z" and z is not None:
+                    z += value
+                else:
+                    offsets[axis] += value
+            if args.get("e") and not relative_e:
+                e = float(args["e"])
+            if args.get("f"):
+                feedrate = float(args["f"])
+        elif command == "G92":
+            # Sent anyway, the printer agrees on the axes it sets
+            for axis in [axis for axis in "xyze" if axis in args] or "xyze":
+                if axis == "e":
+                    e = None
+                else:
+                    offsets[axis] = 0.
+                    if axis == "z":
+                        z = None
+        elif command == "G90":
+            relative = relative_e = False
+        elif command == "G91":
+            relative = relative_e = True
+        elif command == "M82":
+            relative_e = False
+        elif command == "M83":
+            relative_e = True
+    commands = []
+    if e is not None and not relative_e:
+        commands.append("G92 E" + _number(e))
+    if z is not None:
+        commands += _mode_move(["Z" + _number(z)], False, relative,
+                               relative_e)
+    words = ["%s%s" % (axis.upper(), _number(offsets[axis]))
+             for axis in "xyz" if offsets[axis]]
+    if words:
+        commands += _mode_move(words, True, relative, relative_e)
+    if feedrate is not None:
+        commands.append("G1 F" + _number(feedrate))
+    return skipped, commands
+
 def main():
     if len(sys.argv) < 2:
         print("usage: %s filename.gcode" % sys.argv[0])
@@ -764,7 +1522,15 @@ def main():
 
     print("Line object size:", sys.getsizeof(Line("G0 X0")))
     print("Light line object size:", sys.getsizeof(LightLine("G0 X0")))
-    gcode = GCode(open(sys.argv[1], "rU"))
+    with compressed.open_binary(sys.argv[1]) as f:
+        gcode = GCode(f.read())
+    if len(gcode):
+        # Compiled lines count their raw line in their size, the commands
+        # are shared by all lines
+        size = sum(sys.getsizeof(line) for line in gcode.lines)
+        if Line is PyLine:
+            size += sum(sys.getsizeof(line.raw) for line in gcode.lines)
+        print("Memory per line: %0.01f bytes" % (size / len(gcode)))
 
     print("Dimensions:")
     xdims = (gcode.xmin, gcode.xmax, gcode.width)
@@ -0,0 +1,911 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar (struct-of-arrays) parse engine for G-code files.
+
+`ColumnarGCode` parses a file straight into NumPy arrays instead of
+creating one `gcoder.Line` object per line and running the per-line
+`GCode._preprocess` state machine. Modal state, positions, extrusion,
+bounding box and duration are then computed with vectorized cumulative
+operations over the whole file.
+
+`lines`, `all_layers`, `layer_idxs`, `line_idxs` and `idxs()` behave as on
+`gcoder.GCode`, the lines and layers being lightweight views over the
+arrays, so `printcore` and the viewers can use a `ColumnarGCode` wherever
+they use a `GCode`.
+"""
+
+import datetime
+import io
+import logging
+import math
+import os
+import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from . import compressed
+from . import gcoder
+
+coord_codes = gcoder.gcode_parsed_args
+move_commands = frozenset(gcoder.move_gcodes)
+
+class GCodeColumns:
+    """Per-line arrays of a `ColumnarGCode`.
+
+    Coordinates are float32 with NaN meaning the word was absent, as GLine
+    stores them. `opcodes` index into `commands`, the table of distinct
+    command strings of the file.
+    """
+
+    __slots__ = ("raw", "commands", "opcodes", "active", "is_move",
+                 "x", "y", "z", "e", "f", "i", "j",
+                 "current_x", "current_y", "current_z",
+                 "relative", "relative_e", "tool", "extruding",
+                 "end_vertex")
+
+    def __init__(self, n = 0):
+        self.raw = []
+        self.commands = []
+        self.opcodes = numpy.zeros(n, dtype = numpy.uint16)
+        self.active = numpy.zeros(n, dtype = bool)
+        self.is_move = numpy.zeros(n, dtype = bool)
+        for code in coord_codes:
+            setattr(self, code, numpy.full(n, numpy.nan, dtype = numpy.float32))
+        for name in ("current_x", "current_y", "current_z"):
+            setattr(self, name, numpy.full(n, numpy.nan, dtype = numpy.float32))
+        self.relative = numpy.zeros(n, dtype = bool)
+        self.relative_e = numpy.zeros(n, dtype = bool)
+        self.tool = numpy.zeros(n, dtype = numpy.uint8)
+        # -1: unset, 0: False, 1: True
+        self.extruding = numpy.full(n, -1, dtype = numpy.int8)
+        self.end_vertex = None
+
+    def __len__(self):
+        return len(self.raw)
+
+def _optional(value):
+    return None if value != value else float(value)
+
+class ColumnarLine:
+    """Read-only `gcoder.Line` lookalike for one row of `GCodeColumns`."""
+
+    __slots__ = ("_columns", "_i")
+
+    def __init__(self, columns, i):
+        self._columns = columns
+        self._i = i
+
+    @property
+    def raw(self):
+        return self._columns.raw[self._i]
+
+    @property
+    def command(self):
+        c = self._columns
+        return c.commands[c.opcodes[self._i]]
+
+    @property
+    def is_move(self):
+        return bool(self._columns.is_move[self._i])
+
+    @property
+    def x(self):
+        return _optional(self._columns.x[self._i])
+
+    @property
+    def y(self):
+        return _optional(self._columns.y[self._i])
+
+    @property
+    def z(self):
+        return _optional(self._columns.z[self._i])
+
+    @property
+    def e(self):
+        return _optional(self._columns.e[self._i])
+
+    @property
+    def f(self):
+        return _optional(self._columns.f[self._i])
+
+    @property
+    def i(self):
+        return _optional(self._columns.i[self._i])
+
+    @property
+    def j(self):
+        return _optional(self._columns.j[self._i])
+
+    @property
+    def current_x(self):
+        return _optional(self._columns.current_x[self._i])
+
+    @property
+    def current_y(self):
+        return _optional(self._columns.current_y[self._i])
+
+    @property
+    def current_z(self):
+        return _optional(self._columns.current_z[self._i])
+
+    @property
+    def relative(self):
+        if not self._columns.is_move[self._i]: return None
+        return bool(self._columns.relative[self._i])
+
+    @property
+    def relative_e(self):
+        if not self._columns.is_move[self._i]: return None
+        return bool(self._columns.relative_e[self._i])
+
+    @property
+    def current_tool(self):
+        if not self._columns.is_move[self._i]: return None
+        return int(self._columns.tool[self._i])
+
+    @property
+    def extruding(self):
+        value = self._columns.extruding[self._i]
+        return None if value < 0 else bool(value)
+
+    def _get_gcview_end_vertex(self):
+        end_vertex = self._columns.end_vertex
+        if end_vertex is None or end_vertex[self._i] < 0:
+            return None
+        return int(end_vertex[self._i])
+
+    def _set_gcview_end_vertex(self, value):
+        c = self._columns
+        if c.end_vertex is None:
+            c.end_vertex = numpy.full(len(c.opcodes), -1, dtype = numpy.int64)
+        c.end_vertex[self._i] = value
+    gcview_end_vertex = property(_get_gcview_end_vertex, _set_gcview_end_vertex)
+
+class ColumnarLines:
+    """Sequence of `ColumnarLine` views over a whole file.
+
+    Lines added afterwards through `GCode.append` are real `gcoder.Line`
+    objects kept after the parsed rows.
+    """
+
+    def __init__(self, columns):
+        self._columns = columns
+        self._extra = []
+
+    def __len__(self):
+        return len(self._columns) + len(self._extra)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        n = len(self._columns)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("line index out of range")
+        if i >= n:
+            return self._extra[i - n]
+        return ColumnarLine(self._columns, i)
+
+    def __iter__(self):
+        columns = self._columns
+        for i in range(len(columns)):
+            yield ColumnarLine(columns, i)
+        yield from self._extra
+
+    def append(self, line):
+        self._extra.append(line)
+
+class ColumnarLayer:
+    """Contiguous range of rows forming one layer, see `gcoder.Layer`."""
+
+    __slots__ = ("_columns", "start", "end", "duration", "z")
+
+    def __init__(self, columns, start, end, z = None):
+        self._columns = columns
+        self.start = start
+        self.end = end
+        self.z = z
+        self.duration = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __bool__(self):
+        return self.end > self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("layer line index out of range")
+        return ColumnarLine(self._columns, self.start + i)
+
+    def __iter__(self):
+        columns = self._columns
+        for i in range(self.start, self.end):
+            yield ColumnarLine(columns, i)
+
+def ffill_index(mask):
+    """Index of the last True entry of `mask` at or before each position,
+    -1 where there is none"""
+    idx = numpy.where(mask, numpy.arange(len(mask)), -1)
+    return numpy.maximum.accumulate(idx) if len(idx) else idx
+
+def ffill(mask, values, initial):
+    """Carry `values` forward from the rows where `mask` is set"""
+    last = ffill_index(mask)
+    return numpy.where(last >= 0, values[numpy.maximum(last, 0)], initial)
+
+def anchored_cumsum(anchors, anchor_values, deltas, initial):
+    """Running value which is set to `anchor_values` on `anchors` rows and
+    incremented by `deltas` on the other rows.
+
+    This is how modal coordinates evolve: absolute moves and G92 set the
+    position, relative moves add to it.
+    """
+    deltas = numpy.where(anchors, 0., deltas)
+    cumulated = numpy.cumsum(deltas)
+    last = ffill_index(anchors)
+    safe_last = numpy.maximum(last, 0)
+    base = numpy.where(last >= 0, anchor_values[safe_last], initial)
+    base_cumulated = numpy.where(last >= 0, cumulated[safe_last], 0.)
+    return base + cumulated - base_cumulated
+
+def shifted(values, initial):
+    """`values` delayed by one row, starting with `initial`"""
+    if not len(values):
+        return values
+    return numpy.concatenate(([initial], values[:-1]))
+
+def nan_equal(a, b):
+    return (a == b) | (numpy.isnan(a) & numpy.isnan(b))
+
+# gcoder.gcode_exp applied to the whole file at once: words are captured
+# with their letter, and newlines are captured to tell lines apart
+file_exp = re.compile(r"\([^\(\)\n]*\)|;.*|([%s][^\S\n]*[-+]?[0-9]*\.?[0-9]*|\n)"
+                      % gcoder.to_parse)
+
+def tokenize(raw_lines):
+    """Split raw lines into `GCodeColumns`, without interpreting them.
+
+    This gives the same command and coordinates as `gcoder.split` and
+    `gcoder.parse_coordinates`, but runs a single regular expression over
+    the whole file and does the per-line bookkeeping with array operations.
+    """
+    columns = GCodeColumns(0)
+    columns.raw = raw_lines
+    n = len(raw_lines)
+    tokens = numpy.array(file_exp.findall("\n".join(raw_lines).lower() + "\n")
+                         if n else [], dtype = str)
+    newline = tokens == "\n"
+    token_rows = numpy.cumsum(newline) - newline
+    tokens = tokens[~newline]
+    token_rows = token_rows[~newline]
+    width = max(tokens.dtype.itemsize // 4, 1)
+    chars = tokens.view(numpy.uint32).reshape(-1, width) if len(tokens) else \
+        numpy.zeros((0, width), dtype = numpy.uint32)
+    letters = chars[:, 0]
+
+    # Locate the command word of each line, skipping the line number
+    counts = numpy.bincount(token_rows, minlength = n)
+    first = numpy.cumsum(counts) - counts
+    has_tokens = counts > 0
+    first = numpy.where(has_tokens, first, 0)
+    skip_n = has_tokens & (letters[first] == ord("n") if len(tokens)
+                           else has_tokens)
+    command_pos = first + skip_n
+    valid = counts > skip_n
+
+    commands = columns.commands
+    command_ids = {}
+    opcodes = numpy.zeros(n, dtype = numpy.uint16)
+    words, inverse = numpy.unique(tokens[command_pos[valid]],
+                                  return_inverse = True)
+    word_opcodes = numpy.zeros(len(words), dtype = numpy.uint16)
+    for k, word in enumerate(words):
+        command = word[:1].upper() + word[1:].strip()
+        if command not in command_ids:
+            command_ids[command] = len(commands)
+            commands.append(command)
+        word_opcodes[k] = command_ids[command]
+    opcodes[valid] = word_opcodes[inverse.ravel()]
+    for k in numpy.flatnonzero(~valid):
+        raw = raw_lines[k]
+        logging.warning("raw G-Code line \"%s\" could not be parsed" % raw)
+        if raw not in command_ids:
+            command_ids[raw] = len(commands)
+            commands.append(raw)
+        opcodes[k] = command_ids[raw]
+    columns.opcodes = opcodes
+
+    # Coordinates are only parsed on G-lines
+    g_line = valid & (letters[command_pos] == ord("g") if len(tokens)
+                      else valid)
+    coords = numpy.isin(letters, [ord(code) for code in coord_codes])
+    coords &= g_line[token_rows]
+    values = chars[coords, 1:].copy().view("<U%d" % (width - 1)).ravel() \
+        if width > 1 else numpy.zeros(0, dtype = str)
+    if values.size and (values.view(numpy.uint32).reshape(len(values), -1)[:, 0]
+                        <= ord(" ")).any():
+        values = numpy.char.strip(values)
+    rows = token_rows[coords]
+    coord_letters = letters[coords]
+    present = values != ""
+    for code in coord_codes:
+        column = numpy.full(n, numpy.nan, dtype = numpy.float64)
+        mask = present & (coord_letters == ord(code))
+        column[rows[mask]] = values[mask].astype(numpy.float64)
+        setattr(columns, code, column)
+    return columns
+
+def concatenate(parts):
+    """Join the `GCodeColumns` of consecutive chunks of a file"""
+    columns = GCodeColumns(0)
+    command_ids = {}
+    opcodes = []
+    for part in parts:
+        columns.raw.extend(part.raw)
+        remap = numpy.zeros(max(len(part.commands), 1), dtype = numpy.uint16)
+        for k, command in enumerate(part.commands):
+            if command not in command_ids:
+                command_ids[command] = len(columns.commands)
+                columns.commands.append(command)
+            remap[k] = command_ids[command]
+        opcodes.append(remap[part.opcodes])
+    columns.opcodes = numpy.concatenate(opcodes) if opcodes else \
+        numpy.zeros(0, dtype = numpy.uint16)
+    for code in coord_codes:
+        setattr(columns, code,
+                numpy.concatenate([getattr(part, code) for part in parts])
+                if parts else numpy.zeros(0, dtype = numpy.float64))
+    return columns
+
+def file_chunks(filename, count):
+    """Split a file in up to `count` byte ranges starting on line starts"""
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, "rb") as f:
+        for k in range(1, count):
+            position = size * k // count
+            if position <= bounds[-1]:
+                continue
+            f.seek(position - 1)
+            f.readline()
+            position = f.tell()
+            if bounds[-1] < position < size:
+                bounds.append(position)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def tokenize_file_chunk(filename, start, end, encoding = "utf-8"):
+    """Tokenize the lines between the byte offsets `start` and `end` of a
+    file, reading them as `open(filename, encoding = encoding)` would"""
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    text = io.StringIO(data.decode(encoding), newline = None)
+    return tokenize([l2 for l2 in (l.strip() for l in text) if l2])
+
+class ColumnarGCode(gcoder.GCode):
+    """`gcoder.GCode` storing its lines as `GCodeColumns`.
+
+    Parsing produces the same positions, layers, filament lengths, bounding
+    box and duration as `GCode`. Lines can be appended as usual; injecting
+    into or rewriting a layer first converts the whole file back to regular
+    `gcoder.Line` objects (see `materialize`).
+    """
+
+    columns = None
+    # prepare takes lines, not the bytes of the file
+    buffer_input = False
+
+    def prepare(self, data = None, home_pos = None, layer_callback = None):
+        if not data:
+            self.columns = None
+            return super().prepare(data, home_pos, layer_callback)
+        self.home_pos = home_pos
+        raw_lines = [l2 for l2 in (l.strip() for l in data) if l2]
+        self._prepare_columns(tokenize(raw_lines), layer_callback)
+
+    def _prepare_columns(self, columns, layer_callback = None):
+        self.columns = columns
+        self.lines = ColumnarLines(columns)
+        self._compute_state(columns)
+        self._build_layers(columns, layer_callback)
+
+    def _opcode_mask(self, columns, *commands):
+        ids = [columns.commands.index(c) for c in commands
+               if c in columns.commands]
+        return numpy.isin(columns.opcodes, ids)
+
+    def _compute_state(self, columns):
+        """Vectorized counterpart of `GCode._preprocess`"""
+        n = len(columns)
+        cmd = self._opcode_mask
+        commands = columns.commands
+        active = numpy.array([bool(c) for c in commands], dtype = bool)
+        columns.active = active = active[columns.opcodes] if n else \
+            numpy.zeros(0, dtype = bool)
+        is_move = columns.is_move = cmd(columns, *move_commands)
+        g92 = cmd(columns, "G92")
+        g28 = cmd(columns, "G28")
+
+        # Modal state
+        g90 = cmd(columns, "G90")
+        g91 = cmd(columns, "G91")
+        m82 = cmd(columns, "M82")
+        m83 = cmd(columns, "M83")
+        relative = ffill(g90 | g91, g91, self.relative)
+        relative_e = ffill(g90 | g91 | m82 | m83, g91 | m83, self.relative_e)
+        g20 = cmd(columns, "G20")
+        imperial = ffill(g20 | cmd(columns, "G21"), g20, self.imperial)
+        cutting_on = cmd(columns, "M3", "M4")
+        cutting = ffill(cutting_on | cmd(columns, "M5"), cutting_on,
+                        self.cutting)
+
+        tool_ids = numpy.full(len(commands), -1, dtype = numpy.int64)
+        for opcode, command in enumerate(commands):
+            if command[:1] == "T":
+                try:
+                    tool_ids[opcode] = int(command[1:])
+                except ValueError:
+                    pass  # handle T? by treating it as no tool change
+        row_tool = tool_ids[columns.opcodes] if n else \
+            numpy.zeros(0, dtype = numpy.int64)
+        tool = ffill(row_tool >= 0, row_tool, self.current_tool)
+        ntools = max(int(tool.max()) + 1 if n else 0,
+                     len(self.current_e_multi))
+        for name in ("current_e_multi", "offset_e_multi",
+                     "total_e_multi", "max_e_multi"):
+            setattr(self, name,
+                    list(getattr(self, name)) +
+                    [0] * (ntools - len(getattr(self, name))))
+
+        # Coordinates, scaled on G-lines when in imperial mode
+        unit = numpy.where(imperial, 25.4, 1.)
+        for code in coord_codes:
+            setattr(columns, code,
+                    (getattr(columns, code) * unit).astype(numpy.float32))
+        # Use float32 rounded values for computations, as GLine does
+        coords = {code: getattr(columns, code).astype(numpy.float64)
+                  for code in coord_codes}
+        has = {code: ~numpy.isnan(coords[code]) for code in coord_codes}
+        zeroed = {code: numpy.nan_to_num(coords[code]) for code in coord_codes}
+
+        absolute_move = is_move & ~relative
+        relative_move = is_move & relative
+        home_all = g28 & ~(zeroed["x"].astype(bool) |
+                           zeroed["y"].astype(bool) |
+                           zeroed["z"].astype(bool))
+        # Positions: logical coordinate (in the G92-shifted system) plus
+        # the offset between machine origin and that system
+        for axis, home in (("x", self.home_x), ("y", self.home_y),
+                           ("z", self.home_z)):
+            current0 = getattr(self, "current_" + axis)
+            offset0 = getattr(self, "offset_" + axis)
+            homed = home_all | (g28 & has[axis])
+            set_here = g92 & has[axis]
+            logical = anchored_cumsum(
+                (absolute_move & has[axis]) | set_here | homed,
+                numpy.where(homed, home, zeroed[axis]),
+                numpy.where(relative_move, zeroed[axis], 0.),
+                current0 - offset0)
+            logical_before = shifted(logical, current0 - offset0)
+            offset = anchored_cumsum(
+                homed, numpy.zeros(n),
+                numpy.where(set_here, logical_before - zeroed[axis], 0.),
+                offset0)
+            current = logical + offset
+            column = current.astype(numpy.float32)
+            column[~active] = numpy.nan
+            setattr(columns, "current_" + axis, column)
+            if n:
+                setattr(self, "current_" + axis, float(current[-1]))
+                setattr(self, "offset_" + axis, float(offset[-1]))
+
+        # Extrusion
+        e_move = is_move & has["e"]
+        e_set = g92 & has["e"]
+        e_rows = e_move | e_set
+        delta = self._extrusion_deltas(
+            e_move, e_set, relative_e, zeroed["e"],
+            self.current_e - self.offset_e)
+        total_e = self.total_e + numpy.cumsum(delta)
+        running_max = numpy.maximum.accumulate(
+            numpy.where(e_move, total_e, -numpy.inf)) if n else total_e
+        running_max = numpy.maximum(running_max, self.max_e)
+        if n:
+            logical_e = anchored_cumsum(
+                (e_move & ~relative_e) | e_set, zeroed["e"],
+                numpy.where(e_move & relative_e, zeroed["e"], 0.),
+                self.current_e - self.offset_e)
+            self.current_e += float(delta.sum())
+            self.offset_e = self.current_e - float(logical_e[-1])
+            self.total_e = float(total_e[-1])
+            self.max_e = float(running_max[-1])
+        for t in range(ntools):
+            mask = e_rows & (tool == t)
+            if not mask.any():
+                continue
+            sub_move = e_move[mask]
+            sub_set = e_set[mask]
+            sub_rel = relative_e[mask]
+            sub_e = zeroed["e"][mask]
+            logical0 = self.current_e_multi[t] - self.offset_e_multi[t]
+            sub_delta = self._extrusion_deltas(sub_move, sub_set, sub_rel,
+                                               sub_e, logical0)
+            sub_total = self.total_e_multi[t] + numpy.cumsum(sub_delta)
+            sub_logical = anchored_cumsum(
+                (sub_move & ~sub_rel) | sub_set, sub_e,
+                numpy.where(sub_move & sub_rel, sub_e, 0.), logical0)
+            self.current_e_multi[t] += float(sub_delta.sum())
+            self.offset_e_multi[t] = self.current_e_multi[t] - float(sub_logical[-1])
+            if sub_move.any():
+                self.max_e_multi[t] = max(self.max_e_multi[t],
+                                          float(sub_total[sub_move].max()))
+            self.total_e_multi[t] = float(sub_total[-1])
+
+        extruding = numpy.full(n, -1, dtype = numpy.int8)
+        extruding[e_move] = delta[e_move] > 0
+        if self.cutting_as_extrusion:
+            extruding[active & cutting] = 1
+        columns.extruding = extruding
+        columns.relative = relative
+        columns.relative_e = relative_e
+        columns.tool = tool.astype(numpy.uint8)
+
+        if n:
+            self.imperial = bool(imperial[-1])
+            self.relative = bool(relative[-1])
+            self.relative_e = bool(relative_e[-1])
+            self.cutting = bool(cutting[-1])
+            self.current_tool = int(tool[-1])
+            f_moves = is_move & has["f"]
+            if f_moves.any():
+                self.current_f = float(coords["f"][f_moves][-1])
+
+        # Rows contributing extrusion to the layer detection
+        self._layer_extrusion = e_move & (delta > 0) & (has["x"] | has["y"])
+        self._running_max_e = running_max
+        self._coords = coords
+        self._has = has
+
+    @staticmethod
+    def _extrusion_deltas(e_move, e_set, relative_e, e, logical0):
+        """Filament pushed by each row, see the extrusion part of
+        `GCode._preprocess`"""
+        logical = anchored_cumsum((e_move & ~relative_e) | e_set, e,
+                                  numpy.where(e_move & relative_e, e, 0.),
+                                  logical0)
+        logical_before = shifted(logical, logical0)
+        return numpy.where(e_move, logical - logical_before, 0.)
+
+    def _durations(self, columns):
+        """Duration of each row using the same acceleration model as
+        `GCode._preprocess`"""
+        n = len(columns)
+        coords = self._coords
+        has = self._has
+        durations = numpy.zeros(n)
+        moves = self._opcode_mask(columns, "G0", "G1")
+        rows = numpy.flatnonzero(moves)
+        if len(rows):
+            def carried(code, scale = 1.):
+                # Value of the word, or of the last G0/G1 which had it
+                values = coords[code][rows] * scale
+                present = has[code][rows]
+                return ffill(present, values, 0.)
+            x = carried("x")
+            y = carried("y")
+            z = carried("z")
+            e = carried("e")
+            f = carried("f", 1 / 60.)
+            lastx = shifted(x, 0.)
+            lasty = shifted(y, 0.)
+            lastz = shifted(z, 0.)
+            laste = shifted(e, 0.)
+            lastf = shifted(f, 0.)
+            dx = x - lastx
+            dy = y - lasty
+            lastdx = shifted(dx, 0.)
+            lastdy = shifted(dy, 0.)
+            lastf = numpy.where(dx * lastdx + dy * lastdy <= 0, 0., lastf)
+
+            travel = numpy.hypot(dx, dy)
+            raw_z = numpy.nan_to_num(coords["z"][rows])
+            raw_e = numpy.nan_to_num(coords["e"][rows])
+            ztravel = numpy.where(columns.relative[rows], numpy.abs(raw_z),
+                                  numpy.abs(raw_z - lastz))
+            etravel = numpy.where(columns.relative_e[rows], numpy.abs(raw_e),
+                                  numpy.abs(raw_e - laste))
+            travel = numpy.where(travel == 0,
+                                 numpy.where(has["z"][rows], ztravel,
+                                             numpy.where(has["e"][rows],
+                                                         etravel, 0.)),
+                                 travel)
+            acceleration = 2000.0  # mm/s^2
+            with numpy.errstate(divide = "ignore", invalid = "ignore"):
+                constant = numpy.where(f != 0, travel / f, 0.)
+                distance = 2 * numpy.abs(((lastf + f) * (f - lastf) * 0.5) / acceleration)
+                full_speed = (distance <= travel) & (lastf + f != 0) & (f != 0)
+                accelerated = numpy.where(
+                    full_speed,
+                    2 * distance / (lastf + f) + (travel - distance) / f,
+                    2 * travel / (lastf + f))
+                durations[rows] = numpy.where(f == lastf, constant,
+                                              accelerated)
+        for row in numpy.flatnonzero(self._opcode_mask(columns, "G4")):
+            duration = gcoder.P(ColumnarLine(columns, row))
+            if duration:
+                durations[row] = duration / 1000.0
+        return durations
+
+    def _layer_z(self, columns):
+        """Z of the layer each row belongs to, as tracked by
+        `GCode._preprocess` (NaN until a Z is known)"""
+        coords = self._coords
+        has_z = self._has["z"]
+        g92 = self._opcode_mask(columns, "G92")
+        z_rows = has_z & (g92 | columns.is_move)
+        first = numpy.zeros(len(columns), dtype = bool)
+        if z_rows.any():
+            first[numpy.argmax(z_rows)] = True
+        relative = columns.is_move & columns.relative & has_z & ~first
+        anchors = z_rows & ~relative
+        z = numpy.nan_to_num(coords["z"])
+        cur_z = anchored_cumsum(anchors, z, numpy.where(relative, z, 0.),
+                                numpy.nan)
+        return cur_z
+
+    def _build_layers(self, columns, layer_callback = None):
+        n = len(columns)
+        durations = self._durations(columns)
+        total_duration = numpy.cumsum(durations)
+        cur_z = self._layer_z(columns)
+        extrusion = numpy.cumsum(self._layer_extrusion)
+
+        def z_value(value):
+            return None if math.isnan(value) else float(value)
+
+        # Rows where the tracked Z changes are the candidate layer breaks
+        candidates = numpy.flatnonzero(~nan_equal(cur_z, shifted(cur_z, numpy.nan)))
+        layers = []  # [start, end, z, duration]
+        callbacks = []
+        last_split = -1
+        start = 0
+        begin_duration = 0.
+        last_layer_z = None
+
+        def append_lines(end, z, extruded, duration_row, is_end):
+            nonlocal begin_duration, last_layer_z, start
+            if extruded and z != last_layer_z or not layers:
+                finished = len(layers) - 1 if layers else None
+                layers.append([start, end, z, 0.])
+                last_layer_z = z
+            else:
+                layers[-1][1] = end
+                finished = None
+            duration = float(total_duration[duration_row]) if n else 0.
+            layers[-1][3] += duration - begin_duration
+            begin_duration = duration
+            start = end
+            if finished is not None:
+                callbacks.append(finished)
+            if is_end:
+                callbacks.append(len(layers) - 1)
+
+        def has_extrusion(k):
+            # Extruding rows since the previous layer break
+            before = extrusion[last_split] if last_split >= 0 else 0
+            return extrusion[k] - before > 0
+
+        for k in candidates:
+            if not has_extrusion(k):
+                continue
+            append_lines(k, z_value(cur_z[k - 1]) if k else None, True, k,
+                         False)
+            last_split = k
+        if start < n:
+            append_lines(n, z_value(cur_z[-1]), has_extrusion(n - 1), n - 1,
+                         True)
+
+        all_layers = self.all_layers = []
+        self.all_zs = set()
+        layer_ids = numpy.zeros(n, dtype = numpy.uint32)
+        line_ids = numpy.zeros(n, dtype = numpy.uint32)
+        for layer_id, (start, end, z, duration) in enumerate(layers):
+            layer = ColumnarLayer(columns, start, end, z)
+            layer.duration = duration
+            all_layers.append(layer)
+            self.all_zs.add(z)
+            layer_ids[start:end] = layer_id
+            line_ids[start:end] = numpy.arange(end - start, dtype = numpy.uint32)
+        self.layer_idxs = array('I', layer_ids.tobytes())
+        self.line_idxs = array('I', line_ids.tobytes())
+        self.append_layer_id = len(all_layers)
+        self.append_layer = gcoder.Layer([])
+        self.append_layer.duration = 0
+        all_layers.append(self.append_layer)
+
+        self._compute_bounding_box(columns)
+        self.duration = datetime.timedelta(
+            seconds = int(total_duration[-1]) if n else 0)
+        self._durations_per_line = durations
+        self.elapsed = array('d', total_duration.tobytes())
+
+        if layer_callback:
+            for layer_id in callbacks:
+                layer_callback(self, layer_id)
+
+    def _compute_bounding_box(self, columns):
+        is_move = columns.is_move
+        extruding = is_move & (columns.extruding == 1)
+        current_x = columns.current_x.astype(numpy.float64)
+        current_y = columns.current_y.astype(numpy.float64)
+
+        # Extruding moves also include the previous G0/G1 point, as
+        # G0 X10 ; G1 X20 E5 results in 10..20 even as G0 is not extruding
+        moves = self._opcode_mask(columns, "G0", "G1")
+        seen = shifted(numpy.maximum.accumulate(moves), False)
+
+        def last_g0g1(code):
+            # Coordinate of the previous G0/G1 as tracked by the duration
+            # estimation, NaN before the first G0/G1
+            value = ffill(moves & self._has[code], self._coords[code], 0.)
+            return numpy.where(seen, shifted(value, 0.), numpy.nan)
+
+        lastx = last_g0g1("x")
+        lasty = last_g0g1("y")
+
+        def bounds(values):
+            values = values[~numpy.isnan(values)]
+            if not len(values):
+                return float("inf"), float("-inf")
+            return float(values.min()), float(values.max())
+
+        xmin_e, xmax_e = bounds(numpy.concatenate((current_x[extruding],
+                                                   lastx[extruding])))
+        ymin_e, ymax_e = bounds(numpy.concatenate((current_y[extruding],
+                                                   lasty[extruding])))
+        travel = is_move & (self._running_max_e <= 0)
+        xmin, xmax = bounds(current_x[travel])
+        ymin, ymax = bounds(current_y[travel])
+
+        all_zs = self.all_zs.union({0}).difference({None})
+        zmin = min(all_zs)
+        zmax = max(all_zs)
+
+        self.filament_length = self.max_e
+        self.filament_length_multi = list(self.max_e_multi)
+        if self.filament_length > 0:
+            self.xmin = xmin_e if not math.isinf(xmin_e) else 0
+            self.xmax = xmax_e if not math.isinf(xmax_e) else 0
+            self.ymin = ymin_e if not math.isinf(ymin_e) else 0
+            self.ymax = ymax_e if not math.isinf(ymax_e) else 0
+        else:
+            self.xmin = xmin if not math.isinf(xmin) else 0
+            self.xmax = xmax if not math.isinf(xmax) else 0
+            self.ymin = ymin if not math.isinf(ymin) else 0
+            self.ymax = ymax if not math.isinf(ymax) else 0
+        self.zmin = zmin if not math.isinf(zmin) else 0
+        self.zmax = zmax if not math.isinf(zmax) else 0
+        self.width = self.xmax - self.xmin
+        self.depth = self.ymax - self.ymin
+        self.height = self.zmax - self.zmin
+
+    def materialize(self):
+        """Convert the views into regular `gcoder.Line` objects and layers,
+        after which this object behaves exactly like a `GCode`"""
+        if self.columns is None:
+            return
+        columns = self.columns
+        attributes = ("command", "is_move", "x", "y", "z", "e", "f", "i", "j",
+                      "current_x", "current_y", "current_z", "relative",
+                      "relative_e", "current_tool", "extruding",
+                      "gcview_end_vertex")
+        lines = []
+        for view in ColumnarLines(columns):
+            line = gcoder.Line(view.raw)
+            for name in attributes:
+                value = getattr(view, name)
+                if value is not None:
+                    setattr(line, name, value)
+            lines.append(line)
+        all_layers = []
+        for layer in self.all_layers[:-1]:
+            new_layer = gcoder.Layer(lines[layer.start:layer.end], layer.z)
+            new_layer.duration = layer.duration
+            all_layers.append(new_layer)
+        all_layers.append(self.append_layer)
+        self.all_layers = all_layers
+        self.lines = gcoder.LayeredLines(self)
+        self.columns = None
+
+    def append(self, command, store = True):
+        gline = super().append(command, store)
+        if store and gline is not None and self.columns is not None:
+            self.lines.append(gline)
+        return gline
+
+    def prepend_to_layer(self, commands, layer_idx):
+        self.materialize()
+        return super().prepend_to_layer(commands, layer_idx)
+
+    def rewrite_layer(self, commands, layer_idx):
+        self.materialize()
+        return super().rewrite_layer(commands, layer_idx)
+
+class ParallelGCode(ColumnarGCode):
+    """`ColumnarGCode` tokenizing chunks of the file in worker processes.
+
+    Tokenizing does not depend on any parser state, so the file is split
+    in byte ranges that are tokenized in parallel. The modal state (G90/G91,
+    M82/M83, G20/G21, G92 offsets, tool, position) is then carried across
+    the whole file by the vectorized pass of `ColumnarGCode`, which gives
+    the same results as a sequential parse.
+
+    `prepare` reads the byte ranges directly from the file when given a file
+    object opened on a named file (as pronsole and Pronterface do), and
+    sends chunks of lines to the workers otherwise.
+    """
+
+    # Below this many bytes or lines per worker, tokenize in-process
+    min_chunk_size = 1 << 20
+    min_chunk_lines = 20000
+
+    def __init__(self, data = None, home_pos = None,
+                 layer_callback = None, deferred = False,
+                 cutting_as_extrusion = False, workers = None):
+        self.workers = workers or os.cpu_count() or 1
+        super().__init__(data, home_pos, layer_callback, deferred,
+                         cutting_as_extrusion)
+
+    def prepare(self, data = None, home_pos = None, layer_callback = None):
+        filename = getattr(data, "name", None)
+        if not data or not isinstance(filename, str) \
+                or not os.path.isfile(filename) \
+                or compressed.compression(filename):
+            if data and not isinstance(data, list):
+                data = list(data)
+            if not data or self.workers < 2 \
+                    or len(data) < 2 * self.min_chunk_lines:
+                return super().prepare(data, home_pos, layer_callback)
+            raw_lines = [l2 for l2 in (l.strip() for l in data) if l2]
+            step = -(-len(raw_lines) // self.workers)
+            chunks = [raw_lines[k:k + step]
+                      for k in range(0, len(raw_lines), step)]
+            with ProcessPoolExecutor(len(chunks)) as pool:
+                parts = list(pool.map(tokenize, chunks))
+        else:
+            count = min(self.workers, os.path.getsize(filename)
+                        // max(self.min_chunk_size, 1))
+            chunks = file_chunks(filename, max(count, 1))
+            encoding = getattr(data, "encoding", None) or "utf-8"
+            if len(chunks) < 2:
+                parts = [tokenize_file_chunk(filename, *chunks[0], encoding)]
+            else:
+                with ProcessPoolExecutor(len(chunks)) as pool:
+                    parts = list(pool.map(tokenize_file_chunk,
+                                          *zip(*((filename, start, end,
+                                                  encoding)
+                                                 for start, end in chunks))))
+        self.home_pos = home_pos
+        self._prepare_columns(concatenate(parts), layer_callback)
@@ -0,0 +1,81 @@
+#cython: language_level=3
+#
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Declarations shared with the other compiled modules (gcoder_preprocess),
+# which access the fields of GLine directly
+
+from libc.stdint cimport uint32_t
+
+cdef char* copy_string(object value)
+cdef uint32_t command_opcode(unicode command) except? 0xffffffff
+
+cdef enum BitPos:
+    pos_raw =               1 << 0
+    pos_command =           1 << 1
+    pos_is_move =           1 << 2
+    pos_x =                 1 << 3
+    pos_y =                 1 << 4
+    pos_z =                 1 << 5
+    pos_e =                 1 << 6
+    pos_f =                 1 << 7
+    pos_i =                 1 << 8
+    pos_j =                 1 << 9
+    pos_relative =          1 << 10
+    pos_relative_e =        1 << 11
+    pos_extruding =         1 << 12
+    pos_current_x =         1 << 13
+    pos_current_y =         1 << 14
+    pos_current_z =         1 << 15
+    pos_current_tool =      1 << 16
+    pos_gcview_end_vertex = 1 << 17
+    # _raw points into the buffer held by _raw_owner instead of being
+    # allocated by the line
+    pos_raw_borrowed =      1 << 18
+    # WARNING: don't use bits 24 to 31 as we store current_tool there
+
+cdef inline uint32_t has_var(uint32_t status, uint32_t pos):
+    return status & pos
+
+cdef inline uint32_t set_has_var(uint32_t status, uint32_t pos):
+    return status | pos
+
+cdef inline uint32_t unset_has_var(uint32_t status, uint32_t pos):
+    return status & ~pos
+
+cdef class GLine:
+
+    cdef char* _raw
+    # Index of the command in the opcode table
+    cdef uint32_t _command
+    cdef object _raw_owner
+    cdef uint32_t _raw_len
+    cdef float _x, _y, _z, _e, _f, _i, _j
+    cdef float _current_x, _current_y, _current_z
+    cdef uint32_t _gcview_end_vertex
+    cdef uint32_t _status
+
+cdef class GLightLine:
+
+    cdef char* _raw
+    # Index of the command in the opcode table
+    cdef uint32_t _command
+    cdef object _raw_owner
+    cdef uint32_t _raw_len
+    cdef uint32_t _status
+
+cdef GLine borrowed_line(object owner, char* raw, uint32_t length)
+cdef GLightLine borrowed_light_line(object owner, char* raw, uint32_t length)
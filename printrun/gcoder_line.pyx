@@ -15,12 +15,14 @@
 # You should have received a copy of the GNU General Public License
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
+cimport cython
+from cpython.object cimport Py_TYPE
 from libc.stdlib cimport malloc, free
-from libc.stdint cimport uint8_t, uint32_t
 from libc.string cimport strlen, strncpy
 
 cdef char* copy_string(object value):
-    value = value.encode('utf-8')
+    if isinstance(value, unicode):
+        value = (<unicode>value).encode('utf-8')
     cdef char* orig = value
     str_len = len(orig)
     cdef char* array = <char *>malloc(str_len + 1)
@@ -28,58 +30,219 @@ cdef char* copy_string(object value):
     array[str_len] = 0;
     return array
 
-cdef enum BitPos:
-    pos_raw =               1 << 0
-    pos_command =           1 << 1
-    pos_is_move =           1 << 2
-    pos_x =                 1 << 3
-    pos_y =                 1 << 4
-    pos_z =                 1 << 5
-    pos_e =                 1 << 6
-    pos_f =                 1 << 7
-    pos_i =                 1 << 8
-    pos_j =                 1 << 9
-    pos_relative =          1 << 10
-    pos_relative_e =        1 << 11
-    pos_extruding =         1 << 12
-    pos_current_x =         1 << 13
-    pos_current_y =         1 << 14
-    pos_current_z =         1 << 15
-    pos_current_tool =      1 << 16
-    pos_gcview_end_vertex = 1 << 17
-    # WARNING: don't use bits 24 to 31 as we store current_tool there
+# G, M and T commands are interned in an opcode table shared by all lines,
+# which only store the opcode: a file uses a few dozen distinct commands.
+# The table is never freed, so the commands of unparsed or unusual lines,
+# which can be anything, get the unknown opcode and are read again from
+# the raw line instead.
+cdef uint32_t UNKNOWN_OPCODE = 0
+cdef list command_names = [None]
+cdef dict command_opcodes = {}
+# Longest interned command, such as "M1234.5"
+cdef Py_ssize_t MAX_COMMAND_LENGTH = 8
+cdef unicode TO_PARSE = u"xyefzijgtmnd"
 
-cdef inline uint32_t has_var(uint32_t status, uint32_t pos):
-    return status & pos
+cdef bint is_command_word(unicode command):
+    """Whether `command` is a G, M or T command, such as G1 or G29.1"""
+    cdef Py_ssize_t n = len(command), i
+    cdef bint dot = False
+    if n < 2 or n > MAX_COMMAND_LENGTH or command[0] not in u"GMT":
+        return False
+    for i in range(1, n):
+        if command[i] == u".":
+            if dot or i == 1 or i == n - 1:
+                return False
+            dot = True
+        elif not u"0" <= command[i] <= u"9":
+            return False
+    return True
 
-cdef inline uint32_t set_has_var(uint32_t status, uint32_t pos):
-    return status | pos
+cdef unicode unknown_command(unicode raw):
+    """The command gcoder.split finds in the line `raw`, or the line itself
+    if it can not be parsed"""
+    from printrun.tokenizer import split as tokenizer_split
+    split_raw = tokenizer_split(raw, TO_PARSE)
+    if split_raw and split_raw[0][0] == u"n":
+        del split_raw[0]
+    if not split_raw:
+        return raw
+    return split_raw[0][0].upper() + split_raw[0][1]
 
-cdef inline uint32_t unset_has_var(uint32_t status, uint32_t pos):
-    return status & ~pos
+cdef uint32_t intern_opcode(unicode command) except? 0xffffffff:
+    opcode = command_opcodes.get(command)
+    if opcode is None:
+        opcode = command_opcodes[command] = len(command_names)
+        command_names.append(command)
+    return opcode
 
+cdef uint32_t command_opcode(unicode command) except? 0xffffffff:
+    """Return the opcode of `command` found in a line by gcoder.split,
+    adding it to the table if needed, or the unknown opcode if it is not a
+    G, M or T command"""
+    if not is_command_word(command):
+        return UNKNOWN_OPCODE
+    return intern_opcode(command)
+
+cdef uint32_t set_command_opcode(unicode command, object raw) except? 0xffffffff:
+    """Opcode of `command` set as the command of the line `raw`"""
+    opcode = command_opcode(command)
+    if opcode == UNKNOWN_OPCODE and (raw is None
+                                     or command != unknown_command(raw)):
+        # Not the command of the line, it can only be kept in the table
+        opcode = intern_opcode(command)
+    return opcode
+
+def opcode_table():
+    """Return the commands of the opcode table, by opcode, None standing
+    for the unknown opcode"""
+    return tuple(command_names)
+
+# The fields of GLine and GLightLine are declared in gcoder_line.pxd
+
+cdef GLine borrowed_line(object owner, char* raw, uint32_t length):
+    """GLine whose raw line is the `length` bytes at `raw`, kept valid by
+    `owner`"""
+    cdef GLine line = GLine.__new__(GLine)
+    line._raw = raw
+    line._raw_len = length
+    line._raw_owner = owner
+    line._status = pos_raw | pos_raw_borrowed
+    return line
+
+cdef GLightLine borrowed_light_line(object owner, char* raw, uint32_t length):
+    """GLightLine whose raw line is the `length` bytes at `raw`, kept valid
+    by `owner`"""
+    cdef GLightLine line = GLightLine.__new__(GLightLine)
+    line._raw = raw
+    line._raw_len = length
+    line._raw_owner = owner
+    line._status = pos_raw | pos_raw_borrowed
+    return line
+
+cdef inline bint is_strip_space(unsigned char c) noexcept:
+    # The ASCII characters removed by str.strip()
+    return c == 32 or (c >= 9 and c <= 13) or (c >= 28 and c <= 31)
+
+def lines_from_buffer(buffer, bint light = False):
+    """Return the stripped non-empty lines of the bytes-like `buffer` (e.g.
+    bytes or mmap) as GLine, or GLightLine if `light`, objects whose raw
+    line points into the buffer instead of being a copy. Lines end with
+    \\n, \\r or \\r\\n as in files read in text mode. The raw lines are
+    only decoded when read, invalid UTF-8 reads as replacement characters.
+    """
+    # The memoryview keeps a bytearray from being resized
+    owner = buffer if type(buffer) is bytes else memoryview(buffer)
+    cdef const unsigned char[::1] view = owner
+    cdef Py_ssize_t n = view.shape[0]
+    cdef list lines = []
+    if n == 0:
+        return lines
+    cdef char* data = <char*>&view[0]
+    cdef Py_ssize_t i = 0, start, end
+    while i < n:
+        start = i
+        while i < n and data[i] != b'\n' and data[i] != b'\r':
+            i += 1
+        end = i
+        if i < n:
+            if data[i] == b'\r' and i + 1 < n and data[i + 1] == b'\n':
+                i += 1
+            i += 1
+        while start < end and is_strip_space(data[start]):
+            start += 1
+        while end > start and is_strip_space(data[end - 1]):
+            end -= 1
+        if end > start:
+            if light:
+                lines.append(borrowed_light_line(owner, data + start,
+                                                 end - start))
+            else:
+                lines.append(borrowed_line(owner, data + start, end - start))
+    return lines
+
+def lines_from_offsets(buffer, starts, lengths, bint light = False):
+    """Return the lines of the bytes-like `buffer` starting at the byte
+    offsets of the array('Q') `starts`, with the byte lengths of the
+    array('I') `lengths`, as lines_from_buffer does but without splitting
+    the buffer again.
+    """
+    owner = buffer if type(buffer) is bytes else memoryview(buffer)
+    cdef const unsigned char[::1] view = owner
+    cdef const unsigned long long[::1] start_view = starts
+    cdef const unsigned int[::1] length_view = lengths
+    cdef Py_ssize_t n = view.shape[0]
+    cdef Py_ssize_t count = start_view.shape[0], i
+    if length_view.shape[0] != count:
+        raise ValueError("as many line starts as lengths are needed")
+    cdef list lines = []
+    if count == 0:
+        return lines
+    for i in range(count):
+        if start_view[i] + length_view[i] > <unsigned long long>n:
+            raise ValueError("line %d ends past the buffer" % i)
+    cdef char* data = <char*>&view[0]
+    for i in range(count):
+        if light:
+            lines.append(borrowed_light_line(owner, data + start_view[i],
+                                             length_view[i]))
+        else:
+            lines.append(borrowed_line(owner, data + start_view[i],
+                                       length_view[i]))
+    return lines
+
+def lines_from_strings(strings, bint light = False):
+    """Return the stripped non-empty lines of the iterable of str lines
+    `strings` (e.g. a file opened in text mode) as lines_from_buffer does.
+    The lines are packed one after the other in a single buffer, which is
+    freed at once with the last line.
+    """
+    cdef bytearray arena = bytearray()
+    cdef list lengths = []
+    cdef bytes encoded
+    for line in strings:
+        line = line.strip()
+        if line:
+            encoded = (<unicode?>line).encode('utf-8')
+            arena += encoded
+            lengths.append(len(encoded))
+    cdef list lines = []
+    if not lengths:
+        return lines
+    owner = memoryview(arena)
+    cdef char* data = arena
+    cdef Py_ssize_t start = 0, length
+    for length in lengths:
+        if light:
+            lines.append(borrowed_light_line(owner, data + start, length))
+        else:
+            lines.append(borrowed_line(owner, data + start, length))
+        start += length
+    return lines
+
+# _raw_owner is a buffer or another line, which can't form reference cycles:
+# keep the lines out of the garbage collector as when they had no object field
+@cython.no_gc
 cdef class GLine:
-    
-    cdef char* _raw
-    cdef char* _command
-    cdef float _x, _y, _z, _e, _f, _i, _j
-    cdef float _current_x, _current_y, _current_z
-    cdef uint32_t _gcview_end_vertex
-    cdef uint32_t _status
 
     __slots__ = ()
 
     def __cinit__(self):
         self._status = 0
         self._raw = NULL
-        self._command = NULL
+        self._raw_len = 0
 
     def __init__(self, line):
         self.raw = line
 
     def __dealloc__(self):
-        if self._raw != NULL: free(self._raw)
-        if self._command != NULL: free(self._command)
+        if self._raw != NULL and not has_var(self._status, pos_raw_borrowed):
+            free(self._raw)
+
+    def __sizeof__(self):
+        # With the raw line, allocated by the line or its share of the buffer
+        if self._raw == NULL:
+            return Py_TYPE(self).tp_basicsize
+        return Py_TYPE(self).tp_basicsize + self._raw_len + 1
 
     property x:
         def __get__(self):
@@ -195,60 +358,69 @@ cdef class GLine:
             self._status = set_has_var(self._status, pos_gcview_end_vertex)
     property raw:
         def __get__(self):
-            if has_var(self._status, pos_raw): return self._raw.decode('utf-8')
+            if has_var(self._status, pos_raw):
+                return self._raw[:self._raw_len].decode('utf-8', 'replace')
             else: return None
         def __set__(self, value):
             # WARNING: memory leak could happen here, as we don't do the following :
             # if self._raw != NULL: free(self._raw)
             self._raw = copy_string(value)
+            self._raw_len = strlen(self._raw)
+            self._raw_owner = None
+            self._status = unset_has_var(self._status, pos_raw_borrowed)
             self._status = set_has_var(self._status, pos_raw)
     property command:
         def __get__(self):
-            if has_var(self._status, pos_command): return self._command.decode('utf-8')
-            else: return None
+            if not has_var(self._status, pos_command): return None
+            if self._command == UNKNOWN_OPCODE: return unknown_command(self.raw)
+            return command_names[self._command]
         def __set__(self, value):
-            # WARNING: memory leak could happen here, as we don't do the following :
-            # if self._command != NULL: free(self._command)
-            self._command = copy_string(value)
+            self._command = set_command_opcode(value, self.raw)
             self._status = set_has_var(self._status, pos_command)
 
+@cython.no_gc
 cdef class GLightLine:
 
-    cdef char* _raw
-    cdef char* _command
-    cdef uint8_t _status
-
     __slots__ = ()
 
     def __cinit__(self):
         self._status = 0
         self._raw = NULL
-        self._command = NULL
+        self._raw_len = 0
 
     def __init__(self, line):
         self.raw = line
 
     def __dealloc__(self):
-        if self._raw != NULL: free(self._raw)
-        if self._command != NULL: free(self._command)
+        if self._raw != NULL and not has_var(self._status, pos_raw_borrowed):
+            free(self._raw)
+
+    def __sizeof__(self):
+        # With the raw line, allocated by the line or its share of the buffer
+        if self._raw == NULL:
+            return Py_TYPE(self).tp_basicsize
+        return Py_TYPE(self).tp_basicsize + self._raw_len + 1
 
     property raw:
         def __get__(self):
-            if has_var(self._status, pos_raw): return self._raw.decode('utf-8')
+            if has_var(self._status, pos_raw):
+                return self._raw[:self._raw_len].decode('utf-8', 'replace')
             else: return None
         def __set__(self, value):
             # WARNING: memory leak could happen here, as we don't do the following :
             # if self._raw != NULL: free(self._raw)
             self._raw = copy_string(value)
+            self._raw_len = strlen(self._raw)
+            self._raw_owner = None
+            self._status = unset_has_var(self._status, pos_raw_borrowed)
             self._status = set_has_var(self._status, pos_raw)
     property command:
         def __get__(self):
-            if has_var(self._status, pos_command): return self._command.decode('utf-8')
-            else: return None
+            if not has_var(self._status, pos_command): return None
+            if self._command == UNKNOWN_OPCODE: return unknown_command(self.raw)
+            return command_names[self._command]
         def __set__(self, value):
-            # WARNING: memory leak could happen here, as we don't do the following :
-            # if self._command != NULL: free(self._command)
-            self._command = copy_string(value)
+            self._command = set_command_opcode(value, self.raw)
             self._status = set_has_var(self._status, pos_command)
     property is_move:
         def __get__(self):
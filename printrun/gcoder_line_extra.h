@@ -10,10 +10,10 @@ typedef struct {
 
 int gline_size(struct __pyx_obj_8printrun_11gcoder_line_GLine *gline) {
   int size = __pyx_type_8printrun_11gcoder_line_GLine.tp_basicsize;
-  if (gline->_raw != NULL)
-    size += strlen(gline->_raw) + 1;
-  if (gline->_command != NULL)
-    size += strlen(gline->_command) + 1;
+  /* Raw lines borrowed from a buffer (pos_raw_borrowed) are not owned */
+  if (gline->_raw != NULL && !(gline->_status & (1 << 18)))
+    size += gline->_raw_len + 1;
+  /* _command is an index in the shared opcode table */
   return size;
 }
 
@@ -0,0 +1,556 @@
+#cython: language_level=3
+#
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compiled implementation of GCode._preprocess. It follows the Python code
+# of printrun/gcoder.py statement by statement (keep them in sync) but keeps
+# the modal state in C variables and reads and writes the fields of GLine
+# directly. Values stored in GLine are single precision floats and are read
+# back from the line, as the Python code does, so that both give the same
+# results.
+
+import logging
+import math
+from array import array
+
+from libc.math cimport INFINITY
+from libc.stdint cimport uint32_t
+
+from printrun.gcoder_line cimport GLine, GLightLine, borrowed_line, \
+    command_opcode, has_var, set_has_var, unset_has_var, pos_command, \
+    pos_is_move, pos_x, pos_y, pos_z, pos_e, pos_f, pos_i, pos_j, \
+    pos_relative, pos_relative_e, pos_extruding, pos_current_x, \
+    pos_current_y, pos_current_z, pos_current_tool
+from printrun.tokenizer import split as tokenizer_split, find_code
+
+cdef unicode TO_PARSE = u"xyefzijgtmnd"
+cdef object hypot = math.hypot
+
+# Letters of TO_PARSE as one-character lowercase strings, None for the other
+# ASCII characters
+cdef list PARSED_LETTERS = [chr(c).lower() if chr(c).lower() in TO_PARSE
+                            else None for c in range(128)]
+cdef tuple EMPTY_PAIR = (u"", u"")
+
+cdef inline bint is_set(GLine line, uint32_t pos):
+    return has_var(line._status, pos) != 0
+
+cdef inline void set_flag(GLine line, uint32_t pos, bint value):
+    if value:
+        line._status = set_has_var(line._status, pos)
+    else:
+        line._status = unset_has_var(line._status, pos)
+
+cdef inline bint is_space(char c) noexcept:
+    # Py_UNICODE_ISSPACE for ASCII characters, as in gcoder_tokenizer
+    return c == b' ' or (c >= 9 and c <= 13) or (c >= 28 and c <= 31)
+
+cdef inline bint is_digit(char c) noexcept:
+    return c >= b'0' and c <= b'9'
+
+cdef list split_ascii(char* line, Py_ssize_t n):
+    """tokenizer.split(line, TO_PARSE) reading the ASCII bytes of the line"""
+    cdef list words = []
+    cdef Py_ssize_t i = 0, start, end
+    cdef unsigned char c
+    while i < n:
+        c = line[i]
+        if c < 128 and PARSED_LETTERS[c] is not None:
+            start = i + 1
+            while start < n and is_space(line[start]):
+                start += 1
+            end = start
+            if end < n and (line[end] == b'-' or line[end] == b'+'):
+                end += 1
+            while end < n and is_digit(line[end]):
+                end += 1
+            if end < n and line[end] == b'.':
+                end += 1
+            while end < n and is_digit(line[end]):
+                end += 1
+            words.append((PARSED_LETTERS[c],
+                          line[start:end].decode('ascii')))
+            i = end
+        elif c == b'(':
+            end = i + 1
+            while end < n and line[end] != b')' and line[end] != b'(':
+                end += 1
+            if end < n and line[end] == b')':
+                words.append(EMPTY_PAIR)
+                i = end + 1
+            else:
+                i += 1
+        elif c == b';':
+            words.append(EMPTY_PAIR)
+            break
+        else:
+            i += 1
+    return words
+
+cdef inline bint is_ascii(char* line, Py_ssize_t n) noexcept:
+    cdef Py_ssize_t i
+    for i in range(n):
+        if <unsigned char>line[i] >= 128:
+            return False
+    return True
+
+cdef list split(GLine line):
+    """gcoder.split working on the C fields. ASCII lines are split from
+    their raw bytes without decoding them."""
+    cdef list split_raw
+    cdef tuple command
+    cdef unicode name, raw
+    if is_ascii(line._raw, line._raw_len):
+        split_raw = split_ascii(line._raw, line._raw_len)
+    else:
+        split_raw = tokenizer_split(line.raw, TO_PARSE)
+    if split_raw and split_raw[0][0] == u"n":
+        del split_raw[0]
+    if not split_raw:
+        raw = line.raw
+        name = raw
+        logging.warning("raw G-Code line \"%s\" could not be parsed" % raw)
+        split_raw = [raw]
+    else:
+        command = split_raw[0]
+        name = command[0].upper() + command[1]
+    line._command = command_opcode(name)
+    line._status = set_has_var(line._status, pos_command)
+    set_flag(line, pos_is_move, name == u"G0" or name == u"G1"
+             or name == u"G2" or name == u"G3")
+    return split_raw
+
+cdef void parse_coordinates(GLine line, list split_raw, double unit_factor) except *:
+    """gcoder.parse_coordinates working on the C fields"""
+    cdef unicode code
+    for bit in split_raw:
+        code = bit[0]
+        if len(code) != 1 or not bit[1]:
+            continue
+        if code == u"x":
+            line._x = unit_factor * float(bit[1])
+            line._status = set_has_var(line._status, pos_x)
+        elif code == u"y":
+            line._y = unit_factor * float(bit[1])
+            line._status = set_has_var(line._status, pos_y)
+        elif code == u"z":
+            line._z = unit_factor * float(bit[1])
+            line._status = set_has_var(line._status, pos_z)
+        elif code == u"e":
+            line._e = unit_factor * float(bit[1])
+            line._status = set_has_var(line._status, pos_e)
+        elif code == u"f":
+            line._f = unit_factor * float(bit[1])
+            line._status = set_has_var(line._status, pos_f)
+        elif code == u"i":
+            line._i = unit_factor * float(bit[1])
+            line._status = set_has_var(line._status, pos_i)
+        elif code == u"j":
+            line._j = unit_factor * float(bit[1])
+            line._status = set_has_var(line._status, pos_j)
+
+cdef object P(unicode raw):
+    """gcoder.P on a raw line"""
+    value = find_code(raw, u"P")
+    if not value: return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+cdef class LayerBuilder:
+    """State of the layer splitting, the append_lines closure of
+    GCode._preprocess"""
+
+    cdef object gcode, layer_callback, Layer
+    cdef list all_layers
+    cdef set all_zs
+    cdef double layerbeginduration
+    cdef bint has_last_layer_z
+    cdef double last_layer_z
+
+    def __init__(self, gcode, layer_callback, Layer):
+        self.gcode = gcode
+        self.layer_callback = layer_callback
+        self.Layer = Layer
+        self.all_layers = gcode.all_layers = []
+        self.all_zs = gcode.all_zs = set()
+        self.layerbeginduration = 0.0
+        self.has_last_layer_z = False
+        self.last_layer_z = 0.0
+
+    cdef append_lines(self, list lines, bint isEnd, bint cur_layer_has_extrusion,
+                      bint has_prev_z, double prev_z, double totalduration):
+        cdef Py_ssize_t layer_id
+        cdef list all_layers = self.all_layers
+        if cur_layer_has_extrusion and (has_prev_z != self.has_last_layer_z
+                                        or (has_prev_z and prev_z != self.last_layer_z)) \
+                or not all_layers:
+            z = prev_z if has_prev_z else None
+            layer = self.Layer([], z)
+            self.has_last_layer_z = has_prev_z
+            self.last_layer_z = prev_z
+            finished_layer = len(all_layers)-1 if all_layers else None
+            all_layers.append(layer)
+            self.all_zs.add(z)
+        else:
+            layer = all_layers[-1]
+            finished_layer = None
+        layer_id = len(all_layers)-1
+        layer.extend(lines)
+        layer.duration += totalduration - self.layerbeginduration
+        self.layerbeginduration = totalduration
+        if self.layer_callback:
+            # we finish a layer when inserting the next
+            if finished_layer is not None:
+                self.layer_callback(self.gcode, finished_layer)
+            # notify about end layer, there will not be next
+            if isEnd:
+                self.layer_callback(self.gcode, layer_id)
+
+def preprocess(gcode, lines = None, bint build_layers = False,
+               layer_callback = None):
+    """GCode._preprocess(lines, build_layers, layer_callback) for `gcode`"""
+    from printrun.gcoder import Layer
+
+    if not lines:
+        lines = gcode.lines
+    cdef bint imperial = gcode.imperial
+    cdef bint relative = gcode.relative
+    cdef bint relative_e = gcode.relative_e
+    current_tool = gcode.current_tool
+    cdef double current_x = gcode.current_x
+    cdef double current_y = gcode.current_y
+    cdef double current_z = gcode.current_z
+    cdef double offset_x = gcode.offset_x
+    cdef double offset_y = gcode.offset_y
+    cdef double offset_z = gcode.offset_z
+    cdef double home_x = gcode.home_x
+    cdef double home_y = gcode.home_y
+    cdef double home_z = gcode.home_z
+
+    # Extrusion computation
+    cdef double current_e = gcode.current_e
+    cdef double offset_e = gcode.offset_e
+    cdef double total_e = gcode.total_e
+    cdef double max_e = gcode.max_e
+    cdef bint cutting = gcode.cutting
+    cdef bint cutting_as_extrusion = gcode.cutting_as_extrusion
+
+    cdef list current_e_list = gcode.current_e_multi
+    cdef list offset_e_list = gcode.offset_e_multi
+    cdef list total_e_list = gcode.total_e_multi
+    cdef list max_e_list = gcode.max_e_multi
+    cdef double current_e_multi = current_e_list[current_tool]
+    cdef double offset_e_multi = offset_e_list[current_tool]
+    cdef double total_e_multi = total_e_list[current_tool]
+    cdef double max_e_multi = max_e_list[current_tool]
+    cdef double new_e, new_e_multi
+    cdef uint32_t tool_bits = 0
+    cdef bint tool_bits_valid = False
+
+    cdef bint has_current_f = False
+    cdef double current_f = 0
+
+    cdef bint cur_layer_has_extrusion = False
+
+    # Bounding box computation
+    cdef double xmin = INFINITY, ymin = INFINITY
+    cdef double xmax = -INFINITY, ymax = -INFINITY
+    cdef double xmin_e = INFINITY, ymin_e = INFINITY
+    cdef double xmax_e = -INFINITY, ymax_e = -INFINITY
+
+    # Duration estimation
+    cdef bint has_last = False
+    cdef double lastx = 0, lasty = 0, lastz = 0, laste = 0, lastf = 0
+    cdef double lastdx = 0, lastdy = 0
+    cdef double x, y, z, e, f, dx, dy, distance
+    cdef double currenttravel = 0.0
+    cdef double moveduration = 0.0
+    cdef double totalduration = 0.0
+    cdef double acceleration = 2000.0  # mm/s^2
+
+    # Layers
+    cdef LayerBuilder builder = None
+    cdef bint has_cur_z = False, has_prev_z = False
+    cdef double cur_z = 0, prev_z = 0
+    cdef list cur_lines = []
+    cdef object elapsed = array('d')
+    if build_layers:
+        builder = LayerBuilder(gcode, layer_callback, Layer)
+
+    cdef bint heavy = gcode.line_class is GLine
+    cdef GLine line
+    cdef GLightLine light_line
+    cdef unicode command
+    cdef list split_raw
+    cdef bint home_all
+    for true_line in lines:
+        # # Parse line
+        # Use a heavy copy of the light line to preprocess, sharing its raw
+        # line
+        if heavy:
+            line = <GLine?>true_line
+        elif type(true_line) is GLightLine:
+            light_line = <GLightLine>true_line
+            line = borrowed_line(light_line, light_line._raw,
+                                 light_line._raw_len)
+        else:
+            line = GLine(true_line.raw)
+        split_raw = split(line)
+        command = line.command
+        if command:
+            # Update properties
+            if is_set(line, pos_is_move):
+                set_flag(line, pos_relative, relative)
+                set_flag(line, pos_relative_e, relative_e)
+                if not tool_bits_valid:
+                    # Same conversion and overflow as GLine.current_tool
+                    tool_bits = current_tool << 24
+                    tool_bits_valid = True
+                line._status = (line._status & ((1 << 24) - 1)) | tool_bits
+                line._status = set_has_var(line._status, pos_current_tool)
+            elif command == u"G20":
+                imperial = True
+            elif command == u"G21":
+                imperial = False
+            elif command == u"G90":
+                relative = False
+                relative_e = False
+            elif command == u"G91":
+                relative = True
+                relative_e = True
+            elif command == u"M82":
+                relative_e = False
+            elif command == u"M83":
+                relative_e = True
+            elif command[0] == u"T":
+                current_e_list[current_tool] = current_e_multi
+                offset_e_list[current_tool] = offset_e_multi
+                total_e_list[current_tool] = total_e_multi
+                max_e_list[current_tool] = max_e_multi
+                try:
+                    current_tool = int(command[1:])
+                except:
+                    pass #handle T? by treating it as no tool change
+                tool_bits_valid = False
+                while current_tool+1 > len(current_e_list):
+                    current_e_list.append(0)
+                    offset_e_list.append(0)
+                    total_e_list.append(0)
+                    max_e_list.append(0)
+                current_e_multi = current_e_list[current_tool]
+                offset_e_multi = offset_e_list[current_tool]
+                total_e_multi = total_e_list[current_tool]
+                max_e_multi = max_e_list[current_tool]
+            elif command == u"M3" or command == u"M4":
+                cutting = True
+            elif command == u"M5":
+                cutting = False
+
+            if command[0] == u"G":
+                parse_coordinates(line, split_raw, 25.4 if imperial else 1)
+
+            # Compute current position
+            if is_set(line, pos_is_move):
+                if is_set(line, pos_f):
+                    current_f = line._f
+                    has_current_f = True
+
+                if is_set(line, pos_relative):
+                    if is_set(line, pos_x): current_x = current_x + line._x
+                    if is_set(line, pos_y): current_y = current_y + line._y
+                    if is_set(line, pos_z): current_z = current_z + line._z
+                else:
+                    if is_set(line, pos_x): current_x = line._x + offset_x
+                    if is_set(line, pos_y): current_y = line._y + offset_y
+                    if is_set(line, pos_z): current_z = line._z + offset_z
+
+            elif command == u"G28":
+                home_all = not ((is_set(line, pos_x) and line._x != 0)
+                                or (is_set(line, pos_y) and line._y != 0)
+                                or (is_set(line, pos_z) and line._z != 0))
+                if home_all or is_set(line, pos_x):
+                    offset_x = 0
+                    current_x = home_x
+                if home_all or is_set(line, pos_y):
+                    offset_y = 0
+                    current_y = home_y
+                if home_all or is_set(line, pos_z):
+                    offset_z = 0
+                    current_z = home_z
+
+            elif command == u"G92":
+                if is_set(line, pos_x): offset_x = current_x - line._x
+                if is_set(line, pos_y): offset_y = current_y - line._y
+                if is_set(line, pos_z): offset_z = current_z - line._z
+
+            line._current_x = current_x
+            line._current_y = current_y
+            line._current_z = current_z
+            line._status = set_has_var(line._status, pos_current_x
+                                       | pos_current_y | pos_current_z)
+
+            # # Process extrusion
+            if is_set(line, pos_e):
+                if is_set(line, pos_is_move):
+                    if is_set(line, pos_relative_e):
+                        set_flag(line, pos_extruding, line._e > 0)
+                        total_e += line._e
+                        current_e += line._e
+                        total_e_multi += line._e
+                        current_e_multi += line._e
+                    else:
+                        new_e = line._e + offset_e
+                        set_flag(line, pos_extruding, new_e > current_e)
+                        total_e += new_e - current_e
+                        current_e = new_e
+                        new_e_multi = line._e + offset_e_multi
+                        total_e_multi += new_e_multi - current_e_multi
+                        current_e_multi = new_e_multi
+
+                    max_e = max(max_e, total_e)
+                    max_e_multi = max(max_e_multi, total_e_multi)
+                    cur_layer_has_extrusion |= is_set(line, pos_extruding) and (
+                        is_set(line, pos_x) or is_set(line, pos_y))
+                elif command == u"G92":
+                    offset_e = current_e - line._e
+                    offset_e_multi = current_e_multi - line._e
+            if cutting and cutting_as_extrusion:
+                line._status = set_has_var(line._status, pos_extruding)
+
+            # # Create layers and perform global computations
+            if build_layers:
+                # Update bounding box
+                if is_set(line, pos_is_move):
+                    if is_set(line, pos_extruding):
+                        # G0 X10 ; G1 X20 E5 results in 10..20 even as G0 is not extruding
+                        xmin_e = min(xmin_e, line._current_x, lastx if has_last else xmin_e)
+                        xmax_e = max(xmax_e, line._current_x, lastx if has_last else xmax_e)
+                        ymin_e = min(ymin_e, line._current_y, lasty if has_last else ymin_e)
+                        ymax_e = max(ymax_e, line._current_y, lasty if has_last else ymax_e)
+                    if max_e <= 0:
+                        xmin = min(xmin, line._current_x)
+                        xmax = max(xmax, line._current_x)
+                        ymin = min(ymin, line._current_y)
+                        ymax = max(ymax, line._current_y)
+
+                # Compute duration
+                if command == u"G0" or command == u"G1":
+                    x = line._x if is_set(line, pos_x) else lastx
+                    y = line._y if is_set(line, pos_y) else lasty
+                    z = line._z if is_set(line, pos_z) else lastz
+                    e = line._e if is_set(line, pos_e) else laste
+                    # mm/s vs mm/m => divide by 60
+                    f = line._f / 60.0 if is_set(line, pos_f) else lastf
+
+                    # See GCode._preprocess for the limits of this estimation
+                    dx = x - lastx
+                    dy = y - lasty
+                    if dx * lastdx + dy * lastdy <= 0:
+                        lastf = 0
+
+                    # math.hypot is not always rounded like the C hypot
+                    currenttravel = hypot(dx, dy)
+                    if currenttravel == 0:
+                        if is_set(line, pos_z):
+                            currenttravel = abs(line._z) if is_set(line, pos_relative) else abs(line._z - lastz)
+                        elif is_set(line, pos_e):
+                            currenttravel = abs(line._e) if is_set(line, pos_relative_e) else abs(line._e - laste)
+                    # Feedrate hasn't changed, no acceleration/decceleration planned
+                    if f == lastf:
+                        moveduration = currenttravel / f if f != 0 else 0.
+                    else:
+                        distance = 2 * abs(((lastf + f) * (f - lastf) * 0.5) / acceleration)  # multiply by 2 because we have to accelerate and decelerate
+                        if distance <= currenttravel and lastf + f != 0 and f != 0:
+                            moveduration = 2 * distance / (lastf + f)  # This is distance / mean(lastf, f)
+                            moveduration += (currenttravel - distance) / f
+                        else:
+                            moveduration = 2 * currenttravel / (lastf + f)  # This is currenttravel / mean(lastf, f)
+
+                    lastdx = dx
+                    lastdy = dy
+
+                    totalduration += moveduration
+
+                    lastx = x
+                    lasty = y
+                    lastz = z
+                    laste = e
+                    lastf = f
+                    has_last = True
+                elif command == u"G4":
+                    dwell = P(line.raw)
+                    if dwell:
+                        moveduration = dwell / 1000.0
+                        totalduration += moveduration
+
+                if is_set(line, pos_z):
+                    if command == u"G92":
+                        cur_z = line._z
+                        has_cur_z = True
+                    elif is_set(line, pos_is_move):
+                        if is_set(line, pos_relative) and has_cur_z:
+                            cur_z += line._z
+                        else:
+                            cur_z = line._z
+                            has_cur_z = True
+
+                if (has_cur_z != has_prev_z or (has_cur_z and cur_z != prev_z)) \
+                        and cur_layer_has_extrusion:
+                    builder.append_lines(cur_lines, False, cur_layer_has_extrusion,
+                                         has_prev_z, prev_z, totalduration)
+                    cur_lines = []
+                    cur_layer_has_extrusion = False
+
+        if build_layers:
+            cur_lines.append(true_line)
+            elapsed.append(totalduration)
+            has_prev_z = has_cur_z
+            prev_z = cur_z
+        # ## Loop done
+
+    # Store current status
+    gcode.imperial = imperial
+    gcode.relative = relative
+    gcode.relative_e = relative_e
+    gcode.current_tool = current_tool
+    gcode.current_x = current_x
+    gcode.current_y = current_y
+    gcode.current_z = current_z
+    gcode.offset_x = offset_x
+    gcode.offset_y = offset_y
+    gcode.offset_z = offset_z
+    gcode.current_e = current_e
+    gcode.offset_e = offset_e
+    gcode.max_e = max_e
+    gcode.total_e = total_e
+    current_e_list[current_tool] = current_e_multi
+    offset_e_list[current_tool] = offset_e_multi
+    max_e_list[current_tool] = max_e_multi
+    total_e_list[current_tool] = total_e_multi
+    gcode.cutting = cutting
+    if has_current_f:
+        gcode.current_f = current_f
+
+    # Finalize layers
+    if build_layers:
+        if cur_lines:
+            builder.append_lines(cur_lines, True, cur_layer_has_extrusion,
+                                 has_prev_z, prev_z, totalduration)
+        gcode._finalize_layers((xmin, xmax, ymin, ymax, 0),
+                               (xmin_e, xmax_e, ymin_e, ymax_e),
+                               totalduration, elapsed)
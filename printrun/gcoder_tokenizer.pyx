@@ -0,0 +1,194 @@
+#cython: language_level=3
+#
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compiled implementation of printrun/tokenizer.py, see there for the
+# token syntax. Each function scans the line once, character by character.
+
+from cpython.unicode cimport Py_UNICODE_ISSPACE
+
+# One-character lowercase strings of the ASCII letters, to avoid allocating
+# a new string per word
+cdef list LOWER = [chr(c).lower() for c in range(128)]
+cdef tuple EMPTY_PAIR = ("", "")
+
+cdef inline bint is_letter(Py_UCS4 c):
+    return (c >= u'a' and c <= u'z') or (c >= u'A' and c <= u'Z')
+
+cdef inline bint is_digit(Py_UCS4 c):
+    return c >= u'0' and c <= u'9'
+
+cdef inline Py_ssize_t skip_spaces(unicode line, Py_ssize_t i, Py_ssize_t n):
+    while i < n and Py_UNICODE_ISSPACE(line[i]):
+        i += 1
+    return i
+
+cdef inline Py_ssize_t scan_number(unicode line, Py_ssize_t i, Py_ssize_t n):
+    cdef Py_UCS4 c
+    if i < n:
+        c = line[i]
+        if c == u'-' or c == u'+':
+            i += 1
+    while i < n and is_digit(line[i]):
+        i += 1
+    if i < n and line[i] == u'.':
+        i += 1
+    while i < n and is_digit(line[i]):
+        i += 1
+    return i
+
+cdef inline Py_ssize_t paren_end(unicode line, Py_ssize_t i, Py_ssize_t n):
+    """Index of the ) closing the ( at i, or -1 if it is not a comment"""
+    cdef Py_UCS4 c
+    i += 1
+    while i < n:
+        c = line[i]
+        if c == u')':
+            return i
+        if c == u'(':
+            return -1
+        i += 1
+    return -1
+
+def tokenize(unicode line):
+    cdef list tokens = []
+    cdef Py_ssize_t n = len(line)
+    cdef Py_ssize_t i = 0, start, end
+    cdef Py_UCS4 c
+    while i < n:
+        c = line[i]
+        if is_letter(c):
+            start = skip_spaces(line, i + 1, n)
+            end = scan_number(line, start, n)
+            tokens.append((LOWER[<Py_ssize_t>c], line[start:end]))
+            i = end
+        elif c == u'(':
+            end = paren_end(line, i, n)
+            if end < 0:
+                i += 1
+            else:
+                tokens.append((u"(", line[i + 1:end]))
+                i = end + 1
+        elif c == u';':
+            tokens.append((u";", line[i + 1:]))
+            break
+        elif c == u'*' and i + 1 < n and is_digit(line[i + 1]):
+            end = i + 1
+            while end < n and is_digit(line[end]):
+                end += 1
+            tokens.append((u"*", line[i + 1:end]))
+            i = end
+        else:
+            i += 1
+    return tokens
+
+def split(unicode line, unicode letters):
+    cdef bint keep[128]
+    cdef list words = []
+    cdef Py_ssize_t n = len(line)
+    cdef Py_ssize_t i = 0, start, end
+    cdef Py_UCS4 c
+    for i in range(128):
+        keep[i] = False
+    for c in letters:
+        if is_letter(c):
+            keep[(<Py_ssize_t>c) | 0x20] = True
+    i = 0
+    while i < n:
+        c = line[i]
+        if is_letter(c) and keep[(<Py_ssize_t>c) | 0x20]:
+            start = skip_spaces(line, i + 1, n)
+            end = scan_number(line, start, n)
+            words.append((LOWER[<Py_ssize_t>c], line[start:end]))
+            i = end
+        elif c == u'(':
+            end = paren_end(line, i, n)
+            if end < 0:
+                i += 1
+            else:
+                words.append(EMPTY_PAIR)
+                i = end + 1
+        elif c == u';':
+            words.append(EMPTY_PAIR)
+            break
+        else:
+            i += 1
+    return words
+
+def find_code(unicode line, unicode letter):
+    cdef Py_ssize_t n = len(line)
+    cdef Py_ssize_t i = 0, start, end
+    cdef Py_UCS4 c
+    cdef Py_UCS4 lower = letter.lower()[0]
+    cdef Py_UCS4 upper = letter.upper()[0]
+    while i < n:
+        c = line[i]
+        if c == lower or c == upper:
+            start = skip_spaces(line, i + 1, n)
+            end = scan_number(line, start, n)
+            return line[start:end]
+        elif c == u'(':
+            end = paren_end(line, i, n)
+            i = i + 1 if end < 0 else end + 1
+        elif c == u';':
+            break
+        else:
+            i += 1
+    return None
+
+def report_words(unicode line, unicode letters):
+    cdef list words = []
+    cdef Py_ssize_t n = len(line)
+    cdef Py_ssize_t i = 0, start, end
+    cdef Py_UCS4 c
+    while i < n:
+        c = line[i]
+        if c == u'(':
+            end = paren_end(line, i, n)
+            i = i + 1 if end < 0 else end + 1
+        elif c in letters:
+            start = i + 1
+            if start < n and line[start] == u':':
+                start += 1
+            end = scan_number(line, start, n)
+            words.append((line[i:i + 1], line[start:end]))
+            i = end
+        else:
+            i += 1
+    return words
+
+def strip_comments(unicode line):
+    cdef list parts = []
+    cdef Py_ssize_t n = len(line)
+    cdef Py_ssize_t i = 0, kept = 0, end
+    cdef Py_UCS4 c
+    while i < n:
+        c = line[i]
+        if c == u'(':
+            end = paren_end(line, i, n)
+            if end < 0:
+                i += 1
+            else:
+                parts.append(line[kept:i])
+                i = kept = end + 1
+        elif c == u';':
+            break
+        else:
+            i += 1
+    if kept == 0 and i == n:
+        return line
+    parts.append(line[kept:i])
+    return u"".join(parts)
@@ -0,0 +1,227 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming protocol of Grbl CNC and laser controllers.
+
+Grbl answers each line with "ok" or "error:N" once it is parsed, without
+line numbers or checksums. Hosts stream by counting the characters of the
+lines not answered yet and sending the next line as long as it fits in
+the 127 bytes of the serial receive buffer of Grbl.
+
+Realtime commands are single bytes that Grbl picks out of the stream as
+soon as they arrive, whatever the state of the buffer: "?" asks for a
+status report such as "<Idle|MPos:0.000,0.000,0.000|FS:0,0>", "!"
+holds the feed, "~" resumes it and bytes above 0x80 (Grbl 1.1) override
+the feed, rapid and spindle speeds. An "ALARM:N" line reports that Grbl
+stopped and flushed its buffers.
+"""
+
+import collections
+import re
+
+RX_BUFFER_SIZE = 127
+
+STATUS_REPORT = b"?"
+CYCLE_START = b"~"
+FEED_HOLD = b"!"
+SOFT_RESET = b"\x18"
+SAFETY_DOOR = b"\x84"
+JOG_CANCEL = b"\x85"
+FEED_OVERRIDE_RESET = b"\x90"
+FEED_OVERRIDE_PLUS_10 = b"\x91"
+FEED_OVERRIDE_MINUS_10 = b"\x92"
+FEED_OVERRIDE_PLUS_1 = b"\x93"
+FEED_OVERRIDE_MINUS_1 = b"\x94"
+RAPID_OVERRIDE_RESET = b"\x95"
+RAPID_OVERRIDE_50 = b"\x96"
+RAPID_OVERRIDE_25 = b"\x97"
+SPINDLE_OVERRIDE_RESET = b"\x99"
+SPINDLE_OVERRIDE_PLUS_10 = b"\x9a"
+SPINDLE_OVERRIDE_MINUS_10 = b"\x9b"
+SPINDLE_OVERRIDE_PLUS_1 = b"\x9c"
+SPINDLE_OVERRIDE_MINUS_1 = b"\x9d"
+SPINDLE_STOP = b"\x9e"
+FLOOD_COOLANT = b"\xa0"
+MIST_COOLANT = b"\xa1"
+
+REALTIME = frozenset((
+    STATUS_REPORT, CYCLE_START, FEED_HOLD, SOFT_RESET, SAFETY_DOOR,
+    JOG_CANCEL, FEED_OVERRIDE_RESET, FEED_OVERRIDE_PLUS_10,
+    FEED_OVERRIDE_MINUS_10, FEED_OVERRIDE_PLUS_1, FEED_OVERRIDE_MINUS_1,
+    RAPID_OVERRIDE_RESET, RAPID_OVERRIDE_50, RAPID_OVERRIDE_25,
+    SPINDLE_OVERRIDE_RESET, SPINDLE_OVERRIDE_PLUS_10,
+    SPINDLE_OVERRIDE_MINUS_10, SPINDLE_OVERRIDE_PLUS_1,
+    SPINDLE_OVERRIDE_MINUS_1, SPINDLE_STOP, FLOOD_COOLANT, MIST_COOLANT))
+# Realtime commands users can type as a line of their own
+TYPED_REALTIME = {"?": STATUS_REPORT, "~": CYCLE_START, "!": FEED_HOLD}
+
+ERRORS = {
+    1: "Expected command letter",
+    2: "Bad number format",
+    3: "Invalid statement",
+    4: "Value < 0",
+    5: "Setting disabled",
+    6: "Value < 3 usec",
+    7: "EEPROM read fail. Using defaults",
+    8: "Not idle",
+    9: "G-code lock",
+    10: "Homing not enabled",
+    11: "Line overflow",
+    12: "Step rate > 30kHz",
+    13: "Check Door",
+    14: "Line length exceeded",
+    15: "Travel exceeded",
+    16: "Invalid jog command",
+    17: "Setting disabled",
+    20: "Unsupported command",
+    21: "Modal group violation",
+    22: "Undefined feed rate",
+    23: "Integer value required",
+    24: "Axis command conflict",
+    25: "Repeated word",
+    26: "No axis words",
+    27: "Invalid line number",
+    28: "Missing P or L value",
+    29: "Unsupported coordinate system",
+    30: "G53 requires G0 or G1",
+    31: "Unused axis words",
+    32: "No axis words in the arc plane",
+    33: "Invalid motion target",
+    34: "Arc radius error",
+    35: "No offsets in the arc plane",
+    36: "Unused words",
+    37: "Tool length offset on another axis",
+    38: "Tool number too large",
+}
+
+ALARMS = {
+    1: "Hard limit",
+    2: "Soft limit",
+    3: "Abort during cycle",
+    4: "Probe fail",
+    5: "Probe fail",
+    6: "Homing fail",
+    7: "Homing fail",
+    8: "Homing fail",
+    9: "Homing fail",
+}
+
+Status = collections.namedtuple(
+    "Status", "state mpos wpos wco feed spindle planner_free rx_free line "
+    "fields")
+Status.__doc__ = """Status report of Grbl, positions are tuples of floats,
+None when not reported. `fields` holds all the fields of the report as
+strings."""
+
+reply_exp = re.compile(r"(error|ALARM):\s*(\d+)?")
+# Grbl 0.9 separates the fields of its reports with commas too
+old_field_exp = re.compile(r"([A-Za-z]+):([^A-Za-z]*?)(?:,(?=[A-Za-z])|$)")
+
+def is_reply(line):
+    """Return whether `line` answers a line sent ("ok" or "error")"""
+    return line.startswith(("ok", "error"))
+
+def describe(line):
+    """Return the "error:N" or "ALARM:N" `line` with the meaning of its
+    code, Grbl 0.9 tells it itself"""
+    line = line.strip()
+    match = reply_exp.match(line)
+    if match is None or match.group(2) is None:
+        return line
+    messages = ERRORS if match.group(1) == "error" else ALARMS
+    message = messages.get(int(match.group(2)))
+    return "%s (%s)" % (line, message) if message else line
+
+def _floats(value):
+    try:
+        return tuple(float(number) for number in value.split(","))
+    except ValueError:
+        return None
+
+def parse_status(line, wco = None):
+    """Return the Status of the report `line`, None if it is not a status
+    report. Grbl 1.1 reports the work coordinate offset only now and then,
+    `wco` is the last one reported."""
+    line = line.strip()
+    if not (line.startswith("<") and line.endswith(">")):
+        return None
+    body = line[1:-1]
+    if "|" in body:
+        state, *fields = body.split("|")
+        fields = dict(field.partition(":")[::2] for field in fields)
+    else:
+        state, _, rest = body.partition(",")
+        fields = dict(old_field_exp.findall(rest))
+    # Substates such as "Hold:0"
+    state = state.partition(":")[0]
+    mpos = _floats(fields["MPos"]) if "MPos" in fields else None
+    wpos = _floats(fields["WPos"]) if "WPos" in fields else None
+    if "WCO" in fields:
+        wco = _floats(fields["WCO"])
+    if wco is not None:
+        if wpos is None and mpos is not None:
+            wpos = tuple(m - o for m, o in zip(mpos, wco))
+        elif mpos is None and wpos is not None:
+            mpos = tuple(w + o for w, o in zip(wpos, wco))
+    feed = spindle = None
+    if "FS" in fields:
+        speeds = _floats(fields["FS"]) or (None,)
+        feed = speeds[0]
+        spindle = speeds[1] if len(speeds) > 1 else None
+    elif "F" in fields:
+        feed = (_floats(fields["F"]) or (None,))[0]
+    planner_free = rx_free = None
+    if "Bf" in fields:
+        buffers = _floats(fields["Bf"])
+        if buffers is not None and len(buffers) == 2:
+            planner_free, rx_free = (int(free) for free in buffers)
+    line_number = int(fields["Ln"]) if fields.get("Ln", "").isdigit() \
+        else None
+    return Status(state, mpos, wpos, wco, feed, spindle, planner_free,
+                  rx_free, line_number, fields)
+
+class CharacterCounter:
+    """Lines sent to Grbl not answered yet and the bytes they hold in its
+    serial receive buffer of `size` bytes"""
+
+    def __init__(self, size = RX_BUFFER_SIZE):
+        self.size = size
+        self.lines = collections.deque()
+        self.used = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def fits(self, command):
+        """Return whether the line `command` fits in the buffer, a line too
+        long for it is sent when the buffer is empty"""
+        return not self.lines or self.used + len(command) + 1 <= self.size
+
+    def sent(self, command):
+        self.lines.append(command)
+        self.used += len(command) + 1
+
+    def answered(self):
+        """Forget the oldest line, answered by Grbl, and return it, None if
+        no line was in the buffer"""
+        if not self.lines:
+            return None
+        command = self.lines.popleft()
+        self.used -= len(command) + 1
+        return command
+
+    def clear(self):
+        self.lines.clear()
+        self.used = 0
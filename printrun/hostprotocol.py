@@ -0,0 +1,114 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Line protocol of the printer hosts.
+
+`printrun.printcore.printcore` and `printrun.asyncprintcore.AsyncPrintcore`
+both send the lines of a print with these functions: numbered lines with
+their checksums, the lines precomputed by `printrun.transcoder` when the
+printer state allows it, the resend requests of the firmware, the host
+commands of the file and the commands restoring the state of a paused
+print.
+"""
+
+from printrun import tokenizer
+from printrun import transcoder
+
+def is_host_command(raw):
+    """Whether the raw line `raw` of a file is a host command, such as
+    ";@pause", run by the host instead of being sent"""
+    return raw.lstrip().startswith(";@")
+
+def is_resend(line):
+    """Whether the firmware asks with `line` to resend the lines from a
+    line number"""
+    return line.lower().startswith("resend") or line.startswith("rs")
+
+def resend_number(line):
+    """Return the line number of the resend request `line`, None if it has
+    none"""
+    # Teststrings for resend parsing       # Firmware     exp. result
+    # line="rs N2 Expected checksum 67"    # Teacup       2
+    for haystack in ["N:", "N", ":"]:
+        line = line.replace(haystack, " ")
+    for word in line.split():
+        try:
+            return int(word)
+        except ValueError:
+            pass
+    return None
+
+def numbered(command, lineno, checksum = None):
+    """Return `command` with the line number `lineno` and its checksum.
+
+    `checksum` is the checksum of `command` when it is precomputed, such as
+    the ones of `printrun.transcoder.WireLines`.
+    """
+    prefix = "N" + str(lineno) + " "
+    if checksum is None:
+        checksum = transcoder.checksum(prefix + command)
+    else:
+        checksum ^= transcoder.checksum(prefix)
+    return prefix + command + "*" + str(checksum)
+
+def wire_line(queue, index, raw, resync):
+    """Return the line to send for the line `index` of `queue`, `raw`
+    being its raw text, its checksum or None and whether the lines after
+    it must still be sent without relying on the printer state.
+
+    The precomputed `wire_lines` of `queue` are sent unless `resync` tells
+    that the printer state may differ from the one they rely on, up to the
+    next line that relies on nothing before it.
+    """
+    wire = queue.wire_lines
+    if wire is None or index >= len(wire):
+        return tokenizer.strip_comments(raw).strip(), None, resync
+    if wire.syncs[index]:
+        resync = False
+    if resync:
+        line, checksum = wire.trimmed(raw)
+    else:
+        line, checksum = wire[index]
+    return line, checksum, resync
+
+def save_pause(host):
+    """Save the position and modes of the analyzer of `host` in its pause
+    attributes to go back to them when resuming"""
+    analyzer = host.analyzer
+    host.pauseX = analyzer.abs_x
+    host.pauseY = analyzer.abs_y
+    host.pauseZ = analyzer.abs_z
+    host.pauseE = analyzer.abs_e
+    host.pauseF = analyzer.current_f
+    host.pauseRelative = analyzer.relative
+    host.pauseRelativeE = analyzer.relative_e
+
+def resume_commands(host):
+    """Return the commands going back to the state saved by `save_pause`,
+    at the `xy_feedrate` and `z_feedrate` of `host`"""
+    xyFeed = '' if host.xy_feedrate is None else ' F' + str(host.xy_feedrate)
+    zFeed = '' if host.z_feedrate is None else ' F' + str(host.z_feedrate)
+    commands = ["G90",  # go to absolute coordinates
+                "G1 X%s Y%s%s" % (host.pauseX, host.pauseY, xyFeed),
+                "G1 Z" + str(host.pauseZ) + zFeed,
+                "G92 E" + str(host.pauseE)]
+    # go back to relative if needed
+    if host.pauseRelative:
+        commands.append("G91")
+    if host.pauseRelativeE:
+        commands.append("M83")
+    # reset old feed rate
+    commands.append("G1 F" + str(host.pauseF))
+    return commands
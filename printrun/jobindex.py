@@ -0,0 +1,311 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Index of the G-code files of job directories.
+
+`JobIndex` keeps in an SQLite database what `fileinfo.probe` tells of
+each G-code file of a directory: estimated duration, filament, height,
+number of tools, ... so that the jobs can be listed and sorted without
+reading them. Entries are refreshed when the size or modification time
+of their file changes and removed with their file.
+
+Files can also be parsed with `gcoder` to fill what their slicer doesn't
+tell. `JobIndexer` is a thread keeping the index of a directory up to
+date, polling the directory and parsing the files one at a time with
+pauses in between, at the lowest scheduling priority where supported,
+so as not to slow down printing.
+"""
+
+import collections
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from . import compressed
+from . import fileinfo
+from . import gcoder
+from . import tokenizer
+from .transcoder import MOVES
+from .utils import install_locale
+install_locale('pronterface')
+
+SCHEMA_VERSION = 1
+GCODE_EXTENSIONS = (".gcode", ".gco", ".g", ".bgcode") \
+    + tuple(".gcode" + extension for extension in compressed.EXTENSIONS
+            if extension != ".bgcode")
+# Columns the jobs can be sorted by
+SORT_KEYS = ("name", "duration", "filament", "height", "tools", "size",
+             "mtime")
+
+Job = collections.namedtuple(
+    "Job", "path name size mtime slicer duration filament height "
+    "layer_height layer_count tools objects parsed")
+Job.__doc__ = """Indexed G-code file, the duration is in seconds, lengths in
+millimeters and the modification time in seconds since the epoch, None
+when unknown"""
+
+def is_gcode(filename):
+    return filename.lower().endswith(GCODE_EXTENSIONS)
+
+class JobIndex:
+    """Index of G-code files stored in the SQLite database `path`, which
+    can be shared by several threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        with self._lock, self._db:
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self._db.execute("DROP TABLE IF EXISTS jobs")
+                self._db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "path TEXT PRIMARY KEY, directory TEXT, name TEXT, "
+                "size INTEGER, mtime_ns INTEGER, slicer TEXT, "
+                "duration REAL, filament REAL, height REAL, "
+                "layer_height REAL, layer_count INTEGER, tools INTEGER, "
+                "objects TEXT, parsed INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_directory "
+                             "ON jobs (directory)")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _stored(self, directory):
+        with self._lock:
+            rows = self._db.execute("SELECT path, size, mtime_ns FROM jobs "
+                                    "WHERE directory = ?", (directory,))
+            return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def scan(self, directory):
+        """Index the new and changed G-code files of `directory` and forget
+        the removed ones.
+
+        Returns
+        -------
+        tuple
+            The numbers of files indexed and removed.
+        """
+        directory = os.path.abspath(directory)
+        stored = self._stored(directory)
+        indexed = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not is_gcode(entry.name) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                stored_stat = stored.pop(entry.path, None)
+                if stored_stat == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                if self.update(entry.path, stat):
+                    indexed += 1
+        if stored:
+            with self._lock, self._db:
+                self._db.executemany("DELETE FROM jobs WHERE path = ?",
+                                     [(path,) for path in stored])
+        return indexed, len(stored)
+
+    def update(self, filename, stat = None):
+        """Index the G-code file `filename` from its slicer comments.
+
+        Returns
+        -------
+        bool
+            True if it was indexed, False if it could not be read.
+        """
+        filename = os.path.abspath(filename)
+        try:
+            if stat is None:
+                stat = os.stat(filename)
+            info = fileinfo.probe(filename)
+        except (OSError, ValueError) as e:
+            logging.debug("Could not index %s: %s", filename, e)
+            return False
+        duration = info.duration.total_seconds() \
+            if info.duration is not None else None
+        tools = len([length for length in info.filament_lengths if length]) \
+            or None
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (filename, os.path.dirname(filename),
+                 os.path.basename(filename), stat.st_size, stat.st_mtime_ns,
+                 info.slicer, duration, info.filament_length, info.height,
+                 info.layer_height, info.layer_count, tools,
+                 json.dumps(info.objects)))
+        return True
+
+    def unparsed(self, directory):
+        """Return the paths of the files of `directory` not parsed yet"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path FROM jobs WHERE directory = ? AND parsed = 0 "
+                "ORDER BY name", (os.path.abspath(directory),))
+            return [path for path, in rows]
+
+    def parse(self, filename):
+        """Parse the indexed G-code file `filename` and fill what its slicer
+        doesn't tell.
+
+        Returns
+        -------
+        bool
+            True if it was parsed.
+        """
+        filename = os.path.abspath(filename)
+        try:
+            stat = os.stat(filename)
+            with compressed.open_gcode(filename) as f:
+                gcode = gcoder.LightGCode(f)
+        except Exception as e:
+            # Whatever gcoder fails on
+            logging.debug("Could not parse %s: %s", filename, e)
+            # Don't try again until the file changes
+            with self._lock, self._db:
+                self._db.execute("UPDATE jobs SET parsed = 1 WHERE path = ?",
+                                 (filename,))
+            return False
+        duration = gcode.duration.total_seconds() \
+            if gcode.duration is not None else None
+        # Tools extruding
+        tools = set()
+        tool = "T0"
+        for line in gcode:
+            words = tokenizer.strip_comments(line.raw).upper().split()
+            if not words:
+                continue
+            if words[0][0] == "T":
+                tool = words[0]
+            elif words[0] in MOVES and any(word[0] == "E" for word in words):
+                tools.add(tool)
+        with self._lock, self._db:
+            # Unless the file changed while parsing it
+            self._db.execute(
+                "UPDATE jobs SET parsed = 1, "
+                "duration = COALESCE(duration, ?), "
+                "filament = COALESCE(filament, ?), "
+                "height = COALESCE(height, ?), "
+                "layer_count = COALESCE(layer_count, ?), "
+                "tools = COALESCE(tools, ?) "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (duration, gcode.filament_length, gcode.zmax,
+                 gcode.layers_count, max(len(tools), 1), filename,
+                 stat.st_size, stat.st_mtime_ns))
+        return True
+
+    def get(self, filename):
+        """Return the Job of `filename`, None if it is not indexed"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT path, name, size, mtime_ns, slicer, duration, "
+                "filament, height, layer_height, layer_count, tools, "
+                "objects, parsed FROM jobs WHERE path = ?",
+                (os.path.abspath(filename),)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def jobs(self, directory, sort = "name", reverse = False):
+        """Return the Jobs of `directory` sorted by the SORT_KEYS `sort`,
+        the jobs where it is unknown last"""
+        if sort not in SORT_KEYS:
+            raise ValueError("unknown sort key %r" % sort)
+        column = "mtime_ns" if sort == "mtime" else sort
+        order = "DESC" if reverse else "ASC"
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path, name, size, mtime_ns, slicer, duration, "
+                "filament, height, layer_height, layer_count, tools, "
+                "objects, parsed FROM jobs WHERE directory = ? "
+                "ORDER BY %s IS NULL, %s %s, name"
+                % (column, column, order),
+                (os.path.abspath(directory),)).fetchall()
+        return [self._job(row) for row in rows]
+
+    @staticmethod
+    def _job(row):
+        row = list(row)
+        # Modification time in seconds, objects as a list
+        row[3] = row[3] / 1e9
+        row[11] = json.loads(row[11]) if row[11] else []
+        row[12] = bool(row[12])
+        return Job(*row)
+
+class JobIndexer(threading.Thread):
+    """Thread keeping the index of `directory` in `index` up to date,
+    polling the directory every `interval` seconds. With `full_parse`,
+    the files are also parsed, waiting `parse_pause` seconds between
+    two files."""
+
+    def __init__(self, index, directory, interval = 5.0, full_parse = False,
+                 parse_pause = 1.0):
+        super().__init__(name = "JobIndexer", daemon = True)
+        self.index = index
+        self.directory = directory
+        self.interval = interval
+        self.full_parse = full_parse
+        self.parse_pause = parse_pause
+        self._stop_event = threading.Event()
+        # Set after each scan of the directory
+        self.scanned = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def _lower_priority(self):
+        # Linux schedules threads as processes of their own
+        if sys.platform.startswith("linux"):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except OSError:
+                pass
+
+    def run(self):
+        self._lower_priority()
+        while not self._stop_event.is_set():
+            try:
+                self.index.scan(self.directory)
+            except (OSError, sqlite3.Error) as e:
+                logging.warning(_("Could not index %s: %s")
+                                % (self.directory, e))
+            self.scanned.set()
+            wait = self.interval
+            if self.full_parse:
+                pending = self.index.unparsed(self.directory)
+                if pending:
+                    self.index.parse(pending[0])
+                    wait = self.parse_pause
+            self._stop_event.wait(wait)
+
+def format_job(job):
+    """Return a one line description of the Job `job`"""
+    parts = [job.name]
+    if job.duration is not None:
+        parts.append(str(datetime.timedelta(seconds = int(job.duration))))
+    if job.filament is not None:
+        parts.append("%.1f mm" % job.filament)
+    if job.height is not None:
+        parts.append("Z %.2f" % job.height)
+    if job.tools is not None and job.tools > 1:
+        parts.append("%d tools" % job.tools)
+    return "  ".join(parts)
@@ -0,0 +1,298 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""G-code object keeping its raw lines on disk.
+
+`MappedGCode` memory-maps the G-code file and only keeps the byte offset of
+each line and the layer index arrays. Line objects are created when they
+are accessed, e.g. by `printcore._sendnext` through
+`all_layers[layer][line]`, so memory use does not grow with the size of the
+file beyond those packed indexes.
+
+With a `gcodecache.GCodeCache` the indexes are stored in the cache and then
+mapped from there too, which makes reloading an unchanged file immediate.
+
+Compressed files are read through a `compressed.SeekableReader` instead of
+being mapped, the line offsets then being offsets in the decompressed data.
+
+Editing a layer (`prepend_to_layer`, `rewrite_layer`) replaces only that
+layer with an in-memory `gcoder.Layer` overlaid on the mapped ones; the
+print order indexes are then built from the layers as in `gcoder.GCode`.
+"""
+
+import mmap
+import os
+from array import array
+
+from . import compressed
+from . import gcoder
+from .gcodecache import iter_lines
+
+class MappedLayer:
+    """Layer of a `MappedGCode`, creating its lines on access"""
+
+    __slots__ = ("gcode", "start", "end", "z", "duration")
+
+    def __init__(self, gcode, start, end, z = None, duration = 0):
+        self.gcode = gcode
+        self.start = start
+        self.end = end
+        self.z = z
+        self.duration = duration
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("layer line index out of range")
+        return self.gcode.line(self.start + i)
+
+    def __iter__(self):
+        for i in range(self.start, self.end):
+            yield self.gcode.line(i)
+
+class MappedLines:
+    """Sequence of all the lines of a `MappedGCode`"""
+
+    __slots__ = ("gcode",)
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+
+    def __len__(self):
+        return len(self.gcode)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("line index out of range")
+        mapped = len(self.gcode.line_starts)
+        if i < mapped:
+            return self.gcode.line(i)
+        return self.gcode.append_layer[i - mapped]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class MappedGCode(gcoder.GCode):
+    """`gcoder.GCode` variant reading its lines from the mapped file.
+
+    `prepare` takes the file name (or a file object opened on it) rather
+    than the lines. The parse results (positions, layers, filament lengths,
+    bounding box, duration) are the same as with `gcoder.LightGCode`.
+    Lines can be appended and layers edited, edited layers being kept in
+    memory.
+    """
+
+    line_class = gcoder.LightLine
+    # prepare takes lines or a file, not the bytes of the file
+    buffer_input = False
+
+    cache = None
+    filename = None
+    line_starts = None
+    line_lengths = None
+    # Whether a layer was edited: the lines are then read from the layers
+    edited = False
+
+    def __init__(self, data = None, home_pos = None,
+                 layer_callback = None, deferred = False,
+                 cutting_as_extrusion = False, cache = None):
+        self.cache = cache
+        self._file = None
+        self._data = None
+        self._entry = None
+        super().__init__(data, home_pos, layer_callback, deferred,
+                         cutting_as_extrusion)
+
+    def prepare(self, data = None, home_pos = None, layer_callback = None):
+        self.close()
+        self.edited = False
+        if not data:
+            super().prepare(None, home_pos, layer_callback)
+            self.line_starts = array('Q')
+            self.line_lengths = array('I')
+            self.lines = MappedLines(self)
+            return
+        if isinstance(data, (str, bytes, os.PathLike)):
+            self.filename = data
+        else:
+            self.filename = data.name
+        self.home_pos = home_pos
+        self._file = compressed.open_binary(self.filename)
+        if compressed.compression(self.filename):
+            self._data = compressed.SeekableReader(self.filename)
+        elif os.fstat(self._file.fileno()).st_size:
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access = mmap.ACCESS_READ)
+        else:
+            self._data = b""
+        self.lines = MappedLines(self)
+        if self.cache is not None:
+            self._entry = self.cache.lookup(self.filename, home_pos,
+                                            self.cutting_as_extrusion,
+                                            copy = False)
+        if self._entry is None:
+            self._parse(layer_callback)
+            if self.cache is not None \
+                    and self.cache.store(self.filename, self,
+                                         (self.line_starts,
+                                          self.line_lengths)):
+                # Swap the in-memory indexes for the mapped ones
+                self._entry = self.cache.lookup(self.filename, home_pos,
+                                                self.cutting_as_extrusion,
+                                                copy = False)
+                if self._entry is not None:
+                    self._use_entry(self._entry)
+        else:
+            self._entry.restore(
+                self,
+                lambda start, end, z: MappedLayer(self, start, end, z),
+                layer_callback)
+            self._use_entry(self._entry)
+
+    def _parse(self, layer_callback):
+        """Run the `GCode` preprocessing over the file, keeping only the
+        line offsets and the size of each layer"""
+        starts = array('Q')
+        lengths = array('I')
+        line_class = self.line_class
+        layer_sizes = []
+
+        def on_layer(gcode, layer_idx):
+            # Finished layers no longer receive lines, drop their objects
+            layer = self.all_layers[layer_idx]
+            layer_sizes.append(len(layer))
+            del layer[:]
+            if layer_callback:
+                layer_callback(gcode, layer_idx)
+
+        if self._file.seekable():
+            self._file.seek(0)
+        lines = (line_class(line.decode("utf-8"))
+                 for line in iter_lines(self._file, starts, lengths))
+        self._preprocess(lines, build_layers = True,
+                         layer_callback = on_layer)
+        if len(layer_sizes) < len(self.all_layers) - 1:
+            # The last layer was not reported finished
+            layer = self.all_layers[-2]
+            layer_sizes.append(len(layer))
+            del layer[:]
+        self.line_starts = starts
+        self.line_lengths = lengths
+        start = 0
+        for i, size in enumerate(layer_sizes):
+            layer = self.all_layers[i]
+            mapped = MappedLayer(self, start, start + size, layer.z,
+                                 layer.duration)
+            self.all_layers[i] = mapped
+            start += size
+
+    def _use_entry(self, entry):
+        """Use the arrays of a mapped cache entry as indexes"""
+        self.line_starts = entry.line_starts
+        self.line_lengths = entry.line_lengths
+        self.layer_idxs = entry.layer_idxs
+        self.line_idxs = entry.line_idxs
+        self.elapsed = entry.elapsed
+
+    def line(self, i):
+        """Create the line object of the `i`-th line of the file"""
+        start = self.line_starts[i]
+        raw = self._data[start:start + self.line_lengths[i]]
+        return self.line_class(raw.decode("utf-8"))
+
+    def close(self):
+        """Unmap the file and the cache entry, after which the object can
+        only be prepared again"""
+        if self._entry is not None:
+            self.line_starts = self.line_lengths = array('Q')
+            self.layer_idxs = self.line_idxs = array('I')
+            self.elapsed = array('d')
+            self._entry.close()
+            self._entry = None
+        if isinstance(self._data, (mmap.mmap, compressed.SeekableReader)):
+            self._data.close()
+        self._data = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        if self.edited:
+            return super().__len__()
+        return len(self.line_starts) + len(self.append_layer)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def idxs(self, i):
+        if self.edited:
+            return super().idxs(i)
+        if i < len(self.line_starts):
+            return self.layer_idxs[i], self.line_idxs[i]
+        return self.append_layer_id, i - len(self.line_starts)
+
+    def append(self, command, store = True):
+        if self.edited:
+            return super().append(command, store)
+        command = command.strip()
+        if not command:
+            return
+        gline = gcoder.Line(command)
+        self._preprocess([gline])
+        if store:
+            self.append_layer.append(gline)
+            if self.elapsed is not None:
+                if not isinstance(self.elapsed, array):
+                    # The mapped cache arrays are read-only
+                    self.elapsed = array('d', self.elapsed)
+                self.elapsed.append(self.elapsed_time(len(self.elapsed)))
+        return gline
+
+    def _edit_layer(self, layer_idx):
+        """Replace the mapped layer `layer_idx` with an in-memory layer of
+        its lines, and switch from the mapped indexes to the ones built
+        from the layers"""
+        layer = self.all_layers[layer_idx]
+        if isinstance(layer, MappedLayer):
+            edited = gcoder.Layer(list(layer), layer.z)
+            edited.duration = layer.duration
+            self.all_layers[layer_idx] = edited
+        if not self.edited:
+            self.edited = True
+            self.lines = gcoder.LayeredLines(self)
+            # Offsets cached before lines were appended are stale
+            self._layers_edited()
+            # The mapped cache arrays are read-only
+            if self.elapsed is not None:
+                self.elapsed = array('d', self.elapsed)
+
+    def prepend_to_layer(self, commands, layer_idx):
+        self._edit_layer(layer_idx)
+        return super().prepend_to_layer(commands, layer_idx)
+
+    def rewrite_layer(self, commands, layer_idx):
+        self._edit_layer(layer_idx)
+        return super().rewrite_layer(commands, layer_idx)
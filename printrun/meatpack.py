@@ -0,0 +1,224 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""MeatPack packing of the G-code sent over serial links.
+
+Marlin and Prusa firmwares built with MeatPack support accept the 15 most
+common characters of G-code (digits, ".", " ", "\\n", "G" and "X") packed
+two per byte, the first one in the low nibble. A character outside the
+table gets the nibble 0b1111 and follows the packed byte as is. When the
+first character of a byte is the newline, the second one is ignored,
+which pads the lines of odd length.
+
+Packing is switched on and off by commands made of two 0xFF signal bytes
+followed by a command byte. The firmware answers the query command with
+a line such as "[MP] PV01 ON ESP" reporting whether packing is active
+and whether "E" replaces " " in the table ("NSP", no spaces mode).
+"""
+
+import re
+
+SIGNAL = 0xFF
+ENABLE_PACKING = 0xFB
+DISABLE_PACKING = 0xFA
+RESET_ALL = 0xF9
+QUERY_CONFIG = 0xF8
+ENABLE_NO_SPACES = 0xF7
+DISABLE_NO_SPACES = 0xF6
+
+PROTOCOL_VERSION = "PV01"
+TABLE = b"0123456789. \nGX"
+NO_SPACES_TABLE = b"0123456789.E\nGX"
+LITERAL = 0b1111
+
+report_exp = re.compile(r"\[MP\]\s+(?:PV\d+\s+)?(ON|OFF)(?:\s+(NSP|ESP))?")
+
+def command(code):
+    """Return the bytes of the MeatPack command `code`"""
+    return bytes((SIGNAL, SIGNAL, code))
+
+def parse_report(line):
+    """Return (active, no_spaces) from the "[MP] ..." report `line`, None if
+    `line` is not a report"""
+    match = report_exp.match(line.strip())
+    if not match:
+        return None
+    return match.group(1) == "ON", match.group(2) == "NSP"
+
+def report(active, no_spaces):
+    """Return the report line of a firmware in the given state"""
+    return "[MP] %s %s %s\n" % (PROTOCOL_VERSION, "ON" if active else "OFF",
+                                "NSP" if no_spaces else "ESP")
+
+def _pairs(table):
+    """Return the characters of each packed byte without literals"""
+    pairs = []
+    for byte in range(256):
+        first = table[byte & 0xF] if byte & 0xF != LITERAL else 0
+        second = table[byte >> 4] if byte >> 4 != LITERAL else 0
+        pairs.append(bytes((first,)) if first == 10
+                     else bytes((first, second)))
+    return pairs
+
+PAIRS = {False: _pairs(TABLE), True: _pairs(NO_SPACES_TABLE)}
+# Runs of packed bytes without literal nibbles, decoded at once
+packed_exp = re.compile(rb"[^\x0f\x1f\x2f\x3f\x4f\x5f\x6f\x7f\x8f\x9f"
+                        rb"\xaf\xbf\xcf\xdf\xef\xf0-\xff]+")
+
+def _nibbles(table):
+    nibbles = [LITERAL] * 256
+    for i, char in enumerate(table):
+        nibbles[char] = i
+    return nibbles
+
+class Encoder:
+    """Pack the lines written to a firmware with MeatPack active"""
+
+    def __init__(self, no_spaces = False):
+        self.no_spaces = no_spaces
+        # Bytes of an incomplete line, packed with the rest of the line
+        self.pending = b""
+
+    @property
+    def no_spaces(self):
+        return self._no_spaces
+
+    @no_spaces.setter
+    def no_spaces(self, value):
+        self._no_spaces = value
+        self._nibbles = _nibbles(NO_SPACES_TABLE if value else TABLE)
+        self._pairs = {}
+
+    def encode(self, data):
+        """Return the packed bytes of the lines of `data`. A trailing
+        incomplete line is kept until its end is given."""
+        lines = (self.pending + bytes(data)).split(b"\n")
+        self.pending = lines.pop()
+        pairs = self._pairs
+        out = []
+        for line in lines:
+            # Each line starts a byte, the padding after the newline is
+            # ignored by the firmware
+            line += b"\n" if len(line) & 1 else b"\n0"
+            for i in range(0, len(line), 2):
+                pair = line[i:i + 2]
+                packed = pairs.get(pair)
+                if packed is None:
+                    packed = pairs[pair] = self._pack(pair)
+                out.append(packed)
+        return b"".join(out)
+
+    def _pack(self, pair):
+        first = self._nibbles[pair[0]]
+        second = self._nibbles[pair[1]]
+        packed = bytes((first | second << 4,))
+        if first == LITERAL:
+            packed += pair[:1]
+        if second == LITERAL:
+            packed += pair[1:]
+        return packed
+
+class Decoder:
+    """Unpack the bytes received by a firmware with MeatPack support, as
+    Marlin does (used to test the encoder and to simulate printers)"""
+
+    def __init__(self):
+        self.active = False
+        self.no_spaces = False
+        self.signals = 0
+        self.command_next = False
+        self.literals = 0
+        self.second = None
+        # Replies of the firmware to the query command
+        self.reports = []
+
+    def _table(self):
+        return NO_SPACES_TABLE if self.no_spaces else TABLE
+
+    def decode(self, data):
+        """Return the characters sent in the bytes `data`"""
+        out = bytearray()
+        size = len(data)
+        pos = 0
+        while pos < size:
+            if self.active and not (self.literals or self.signals
+                                    or self.command_next):
+                match = packed_exp.match(data, pos)
+                if match:
+                    out += b"".join(map(PAIRS[self.no_spaces].__getitem__,
+                                        match.group()))
+                    pos = match.end()
+                    continue
+            self._step(data[pos], out)
+            pos += 1
+        return bytes(out)
+
+    def _step(self, byte, out):
+        if byte == SIGNAL:
+            if self.signals:
+                self.command_next = True
+                self.signals = 0
+            else:
+                self.signals = 1
+            return
+        if self.command_next:
+            self.command_next = False
+            self._command(byte)
+            return
+        if self.signals:
+            self.signals = 0
+            self._decode_byte(SIGNAL, out)
+        self._decode_byte(byte, out)
+
+    def _command(self, code):
+        if code == ENABLE_PACKING:
+            self.active = True
+        elif code == DISABLE_PACKING:
+            self.active = False
+        elif code == RESET_ALL:
+            self.active = self.no_spaces = False
+        elif code == ENABLE_NO_SPACES:
+            self.no_spaces = True
+        elif code == DISABLE_NO_SPACES:
+            self.no_spaces = False
+        elif code == QUERY_CONFIG:
+            self.reports.append(report(self.active, self.no_spaces))
+
+    def _decode_byte(self, byte, out):
+        if not self.active:
+            out.append(byte)
+        elif self.literals:
+            out.append(byte)
+            if self.second is not None:
+                out.append(self.second)
+                self.second = None
+            self.literals -= 1
+        else:
+            table = self._table()
+            first = byte & 0xF
+            second = byte >> 4
+            if first == LITERAL:
+                self.literals = 1
+                if second == LITERAL:
+                    self.literals = 2
+                else:
+                    self.second = table[second]
+            else:
+                out.append(table[first])
+                if table[first] != 10:
+                    if second == LITERAL:
+                        self.literals = 1
+                    else:
+                        out.append(table[second])
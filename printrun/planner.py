@@ -0,0 +1,589 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Print time estimation with a model of the firmware motion planner.
+
+`MotionPlanner` replays a parsed G-code file the way a Marlin or Klipper
+style planner executes it:
+
+- every move is a block with a trapezoidal velocity profile, its cruise
+  speed and acceleration limited per axis (M203, M201) and by the print,
+  retract and travel accelerations (M204);
+- the speed at the junction of two blocks is limited by the classic jerk
+  (M205 X Y Z E) or by the junction deviation (M205 J, Klipper's square
+  corner velocity);
+- lookahead only sees a buffer of `buffer_size` blocks, the last of which
+  must be able to stop;
+- G4 dwells, M109/M190 heater waits, homing, M400 and tool changes empty
+  the buffer, the heater waits last until a simple heating model reaches
+  the target temperature.
+
+The moves are collected in one pass over the lines, the block limits and
+trapezoids are computed with NumPy over all blocks at once, and only the
+forward and backward lookahead passes are sequential. The result fills
+`Layer.duration`, `GCode.duration` and the per-line `GCode.elapsed` times,
+so that `estimate_duration()` and `utils.RemainingTimeEstimator` use it.
+
+Machine limits start from the firmware defaults, can be changed from
+printer reports (M503) or settings with `MachineLimits.update_from_text`,
+and are also updated by the limit commands found in the file itself.
+
+NumPy is only imported when a file is planned, so that the module can be
+imported without it; `MotionPlanner.apply` raises ImportError then.
+"""
+
+import datetime
+import math
+import re
+import sys
+from array import array
+
+from . import tokenizer
+
+AXES = "xyze"
+# Words read from the lines: N is dropped, the others are commands
+# and parameters
+WORDS = "ngmtxyzefijrsp"
+# Lowest speed (mm/s) planned at a stop, as MINIMUM_PLANNER_SPEED in Marlin
+MINIMUM_PLANNER_SPEED = 0.05
+# Feedrate (mm/s) of moves before the first F word, as in Marlin
+DEFAULT_FEEDRATE = 25.0
+
+echo_exp = re.compile(r"^\s*echo:\s*", re.MULTILINE)
+klipper_exp = re.compile(r"(\w+)\s*=\s*([-+]?[0-9]*\.?[0-9]+)")
+# Limit commands in printer responses, such as the output of M503
+report_exp = re.compile(r"^(?:echo:)?\s*M20[1345]\s")
+
+class MachineLimits:
+    """Motion limits of the printer, in mm and seconds.
+
+    `junction_deviation` is None when the firmware uses the classic jerk
+    limits. The defaults are the ones of Marlin's example configuration.
+    """
+
+    def __init__(self):
+        self.max_feedrate = [300., 300., 5., 25.]
+        self.max_acceleration = [3000., 3000., 100., 10000.]
+        self.acceleration = 3000.
+        self.retract_acceleration = 3000.
+        self.travel_acceleration = 3000.
+        self.jerk = [10., 10., 0.3, 5.]
+        self.junction_deviation = 0.013
+        self.min_feedrate = 0.
+        self.min_travel_feedrate = 0.
+
+    def copy(self):
+        limits = MachineLimits()
+        limits.__dict__.update(self.__dict__)
+        limits.max_feedrate = list(self.max_feedrate)
+        limits.max_acceleration = list(self.max_acceleration)
+        limits.jerk = list(self.jerk)
+        return limits
+
+    def __eq__(self, other):
+        return isinstance(other, MachineLimits) \
+            and self.__dict__ == other.__dict__
+
+    def __str__(self):
+        def axes(values):
+            return " ".join("%s%g" % (axis.upper(), value)
+                            for axis, value in zip(AXES, values))
+        m205 = "M205 S%g T%g %s" % (self.min_feedrate,
+                                    self.min_travel_feedrate, axes(self.jerk))
+        if self.junction_deviation is not None:
+            m205 += " J%g" % self.junction_deviation
+        return "\n".join(["M203 " + axes(self.max_feedrate),
+                          "M201 " + axes(self.max_acceleration),
+                          "M204 P%g R%g T%g" % (self.acceleration,
+                                                self.retract_acceleration,
+                                                self.travel_acceleration),
+                          m205])
+
+    def update(self, command, words):
+        """Apply a limit command, given as its name ("M203") and its
+        (letter, value) words. Return True if it was a limit command."""
+        values = {}
+        for letter, value in words:
+            if value:
+                try:
+                    values[letter] = float(value)
+                except ValueError:
+                    pass
+        if command == "M203" or command == "M201":
+            target = self.max_feedrate if command == "M203" \
+                else self.max_acceleration
+            for i, axis in enumerate(AXES):
+                if axis in values:
+                    target[i] = values[axis]
+        elif command == "M204":
+            if "s" in values:
+                self.acceleration = self.travel_acceleration = values["s"]
+            self.acceleration = values.get("p", self.acceleration)
+            self.retract_acceleration = values.get("r", self.retract_acceleration)
+            self.travel_acceleration = values.get("t", self.travel_acceleration)
+        elif command == "M205":
+            for i, axis in enumerate(AXES):
+                if axis in values:
+                    self.jerk[i] = values[axis]
+            if "j" in values:
+                self.junction_deviation = values["j"]
+            elif "x" in values or "y" in values:
+                # Jerk limits without junction deviation: classic jerk
+                self.junction_deviation = None
+            self.min_feedrate = values.get("s", self.min_feedrate)
+            self.min_travel_feedrate = values.get("t", self.min_travel_feedrate)
+        else:
+            return False
+        return True
+
+    def update_klipper(self, line):
+        """Apply a Klipper SET_VELOCITY_LIMIT command"""
+        values = {key.upper(): float(value)
+                  for key, value in klipper_exp.findall(line)}
+        if "VELOCITY" in values:
+            self.max_feedrate[0] = self.max_feedrate[1] = values["VELOCITY"]
+        if "ACCEL" in values:
+            accel = values["ACCEL"]
+            self.acceleration = self.travel_acceleration = accel
+            self.retract_acceleration = accel
+            self.max_acceleration[0] = self.max_acceleration[1] = accel
+        if "SQUARE_CORNER_VELOCITY" in values:
+            self.junction_deviation = values["SQUARE_CORNER_VELOCITY"] ** 2 \
+                * (math.sqrt(2) - 1) / max(self.acceleration, 1e-9)
+
+    def update_from_text(self, text):
+        """Apply the limit commands of `text`, such as a M503 response or
+        the machine_limits setting. Several commands may share a line."""
+        command = None
+        words = []
+        for line in echo_exp.sub("", text).splitlines() + ["M0"]:
+            for letter, value in tokenizer.split(line, "gmxyzejpstr"):
+                if letter in ("g", "m"):
+                    if command:
+                        self.update(command, words)
+                    command = letter.upper() + value
+                    words = []
+                else:
+                    words.append((letter, value))
+        return self
+
+class Moves:
+    """Moves and timed events collected from the lines of a file"""
+
+    def __init__(self):
+        self.line = []
+        self.dx = []
+        self.dy = []
+        self.dz = []
+        self.de = []
+        self.feedrate = []
+        self.limits = []
+        self.stop = []
+        # (line index, command, heater, S value, P or R value) of dwells
+        # and temperature commands
+        self.events = []
+        self.limit_sets = []
+
+class MotionPlanner:
+    """Estimate the duration of every line of a G-code file.
+
+    `limits` are the machine limits at the start of the file, `buffer_size`
+    the number of blocks the firmware plans ahead (BLOCK_BUFFER_SIZE in
+    Marlin).
+    """
+
+    # Heating model (degrees per second), starting from ambient temperature
+    ambient_temperature = 25.
+    hotend_heating_rate = 2.
+    hotend_cooling_rate = 1.
+    bed_heating_rate = 0.5
+    bed_cooling_rate = 0.1
+
+    def __init__(self, limits = None, buffer_size = 16):
+        self.limits = limits.copy() if limits is not None else MachineLimits()
+        self.buffer_size = max(1, int(buffer_size))
+
+    def collect(self, lines, home_pos = None):
+        """Collect the moves of the raw `lines`"""
+        moves = Moves()
+        limits = self.limits.copy()
+        moves.limit_sets.append(limits)
+        home = list(home_pos or (0, 0, 0)) + [0]
+        pos = [0., 0., 0., 0.]
+        relative = relative_e = False
+        unit = 1.
+        feedrate = DEFAULT_FEEDRATE
+        speed_factor = 1.
+        tool = 0
+        stop = True
+        split = tokenizer.split
+        append_line = moves.line.append
+        append_dx = moves.dx.append
+        append_dy = moves.dy.append
+        append_dz = moves.dz.append
+        append_de = moves.de.append
+        append_feedrate = moves.feedrate.append
+        append_limits = moves.limits.append
+        append_stop = moves.stop.append
+        events = moves.events
+        limit_set = 0
+        for index, raw in enumerate(lines):
+            words = split(raw, WORDS)
+            if words and words[0][0] == "n":
+                del words[0]
+            if not words:
+                continue
+            letter, number = words[0]
+            if letter == "g" and number in ("0", "1", "2", "3", "00", "01",
+                                            "02", "03"):
+                x = y = z = e = i = j = r = None
+                for code, value in words:
+                    if not value:
+                        continue
+                    if code == "x": x = float(value) * unit
+                    elif code == "y": y = float(value) * unit
+                    elif code == "z": z = float(value) * unit
+                    elif code == "e": e = float(value) * unit
+                    elif code == "f": feedrate = float(value) * unit / 60.
+                    elif code == "i": i = float(value) * unit
+                    elif code == "j": j = float(value) * unit
+                    elif code == "r": r = float(value) * unit
+                if relative:
+                    dx = x or 0.
+                    dy = y or 0.
+                    dz = z or 0.
+                else:
+                    dx = x - pos[0] if x is not None else 0.
+                    dy = y - pos[1] if y is not None else 0.
+                    dz = z - pos[2] if z is not None else 0.
+                if relative_e:
+                    de = e or 0.
+                else:
+                    de = e - pos[3] if e is not None else 0.
+                pos[0] += dx
+                pos[1] += dy
+                pos[2] += dz
+                pos[3] += de
+                if number[-1] in "23":
+                    dx, dy = arc_delta(dx, dy, i, j, r, number[-1] == "2")
+                if dx or dy or dz or de:
+                    append_line(index)
+                    append_dx(dx)
+                    append_dy(dy)
+                    append_dz(dz)
+                    append_de(de)
+                    append_feedrate(feedrate * speed_factor)
+                    append_limits(limit_set)
+                    append_stop(stop)
+                    stop = False
+                continue
+            command = letter.upper() + number
+            if letter == "g":
+                if command in ("G90", "G91"):
+                    relative = relative_e = command == "G91"
+                elif command in ("G20", "G21"):
+                    unit = 25.4 if command == "G20" else 1.
+                elif command == "G92":
+                    for code, value in words[1:]:
+                        if value and code and code in AXES:
+                            pos[AXES.index(code)] = float(value) * unit
+                elif command == "G28":
+                    axes = [AXES.index(code) for code, _ in words[1:]
+                            if code and code in "xyz"] or [0, 1, 2]
+                    for axis in axes:
+                        pos[axis] = home[axis]
+                    stop = True
+                elif command == "G4":
+                    events.append((index, command, None,
+                                   find_value(words, "s"),
+                                   find_value(words, "p")))
+                    stop = True
+            elif letter == "m":
+                if command in ("M82", "M83"):
+                    relative_e = command == "M83"
+                elif command in ("M104", "M109", "M140", "M190"):
+                    heater = None
+                    if command in ("M104", "M109"):
+                        heater = find_value(words, "t")
+                        heater = tool if heater is None else int(heater)
+                    events.append((index, command, heater,
+                                   find_value(words, "s"),
+                                   find_value(words, "r")))
+                    if command in ("M109", "M190"):
+                        stop = True
+                elif command in ("M400", "M0", "M1"):
+                    stop = True
+                elif command == "M220":
+                    factor = find_value(words, "s")
+                    if factor is not None:
+                        speed_factor = factor / 100.
+                elif command in ("M201", "M203", "M204", "M205"):
+                    limits = limits.copy()
+                    limits.update(command, words[1:])
+                    moves.limit_sets.append(limits)
+                    limit_set += 1
+            elif letter == "t":
+                try:
+                    tool = int(number)
+                except ValueError:
+                    pass
+                stop = True
+            elif raw[:18].upper() == "SET_VELOCITY_LIMIT":
+                limits = limits.copy()
+                limits.update_klipper(raw)
+                moves.limit_sets.append(limits)
+                limit_set += 1
+        return moves
+
+    def plan(self, moves):
+        """Return the duration of each move of `moves`"""
+        import numpy
+        n = len(moves.line)
+        if not n:
+            return numpy.zeros(0)
+        delta = numpy.array([moves.dx, moves.dy, moves.dz, moves.de])
+        xyz_length = numpy.sqrt((delta[:3] ** 2).sum(axis = 0))
+        e_only = xyz_length == 0
+        length = numpy.where(e_only, numpy.abs(delta[3]), xyz_length)
+        # Axis speeds for a unit speed along the move
+        direction = delta / length
+        ratio = numpy.abs(direction)
+
+        sets = moves.limit_sets
+        set_index = numpy.array(moves.limits, dtype = numpy.intp)
+        def per_block(values):
+            return numpy.array(values, dtype = float)[set_index]
+        def axis_bound(limits):
+            """Min over axes of the per-axis limits scaled to the move"""
+            table = per_block([limit for limit in limits]).T
+            with numpy.errstate(divide = "ignore"):
+                return numpy.where(ratio > 0, table / ratio, numpy.inf).min(axis = 0)
+
+        extruding = delta[3] != 0
+        feedrate = numpy.array(moves.feedrate)
+        feedrate = numpy.maximum(feedrate, numpy.where(
+            extruding, per_block([s.min_feedrate for s in sets]),
+            per_block([s.min_travel_feedrate for s in sets])))
+        nominal = numpy.minimum(feedrate,
+                                axis_bound([s.max_feedrate for s in sets]))
+        nominal = numpy.maximum(nominal, MINIMUM_PLANNER_SPEED)
+        accel = numpy.where(
+            e_only, per_block([s.retract_acceleration for s in sets]),
+            numpy.where(extruding, per_block([s.acceleration for s in sets]),
+                        per_block([s.travel_acceleration for s in sets])))
+        accel = numpy.minimum(accel,
+                              axis_bound([s.max_acceleration for s in sets]))
+        accel = numpy.maximum(accel, 1e-3)
+
+        # Junction speeds
+        jerk = per_block([s.jerk for s in sets]).T
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            safe = numpy.where(ratio > 0, jerk / ratio, numpy.inf).min(axis = 0)
+            previous = numpy.roll(direction, 1, axis = 1)
+            jerk_junction = numpy.where(
+                numpy.abs(previous - direction) > 0,
+                jerk / numpy.abs(previous - direction), numpy.inf).min(axis = 0) ** 2
+            unit = delta / numpy.sqrt((delta ** 2).sum(axis = 0))
+            cos_theta = -(numpy.roll(unit, 1, axis = 1) * unit).sum(axis = 0)
+            sin_theta_d2 = numpy.sqrt(numpy.clip(0.5 * (1 - cos_theta), 0, 1))
+            deviation = per_block([s.junction_deviation or 0. for s in sets])
+            deviation_junction = numpy.where(
+                cos_theta > 0.999999, MINIMUM_PLANNER_SPEED ** 2,
+                numpy.where(cos_theta < -0.999999, numpy.inf,
+                            accel * deviation * sin_theta_d2 / (1 - sin_theta_d2)))
+        classic = numpy.array([s.junction_deviation is None for s in sets])[set_index]
+        junction = numpy.where(classic, jerk_junction, deviation_junction)
+        safe = numpy.where(classic, numpy.minimum(safe, nominal),
+                           MINIMUM_PLANNER_SPEED)
+        safe = numpy.maximum(safe, MINIMUM_PLANNER_SPEED)
+        previous_nominal = numpy.roll(nominal, 1)
+        max_entry = numpy.minimum(junction, numpy.minimum(nominal, previous_nominal) ** 2)
+        stop = numpy.array(moves.stop)
+        stop[0] = True
+        max_entry = numpy.where(stop, safe ** 2, max_entry)
+
+        # A block must be able to stop within the blocks after it in the
+        # buffer
+        speedup = 2 * accel * length
+        reach = numpy.concatenate(([0.], numpy.cumsum(speedup)))
+        ahead = numpy.minimum(numpy.arange(n) + self.buffer_size, n)
+        max_exit = reach[ahead] - reach[1:]
+        next_stop = numpy.append(stop[1:], True)
+        max_exit = numpy.where(next_stop, numpy.minimum(max_exit, safe ** 2),
+                               max_exit)
+
+        # Lookahead: backward pass on deceleration, forward pass on
+        # acceleration, on squared speeds
+        entry = max_entry.tolist()
+        exit = max_exit.tolist()
+        linked = (~next_stop).tolist()
+        gain = speedup.tolist()
+        following = 0.
+        for i in range(n - 1, -1, -1):
+            speed = exit[i]
+            if linked[i] and following < speed:
+                speed = following
+            exit[i] = speed
+            speed += gain[i]
+            if speed < entry[i]:
+                entry[i] = speed
+            following = entry[i]
+        for i in range(n):
+            if i and linked[i - 1] and entry[i] > exit[i - 1]:
+                entry[i] = exit[i - 1]
+            speed = entry[i] + gain[i]
+            if speed < exit[i]:
+                exit[i] = speed
+        return trapezoid_time(length, numpy.sqrt(entry), numpy.sqrt(exit),
+                              nominal, accel)
+
+    def line_durations(self, gcode, lines = None):
+        """Return the duration (s) of every line of `gcode` as an array"""
+        import numpy
+        if lines is None:
+            lines = [line.raw for line in gcode]
+        moves = self.collect(lines, gcode.home_pos)
+        durations = numpy.zeros(len(lines))
+        durations += numpy.bincount(numpy.array(moves.line, dtype = numpy.intp),
+                                    weights = self.plan(moves),
+                                    minlength = len(lines))
+        self.add_waits(moves, durations)
+        return durations
+
+    def heater_rates(self, command):
+        if command in ("M140", "M190"):
+            return self.bed_heating_rate, self.bed_cooling_rate
+        return self.hotend_heating_rate, self.hotend_cooling_rate
+
+    def add_waits(self, moves, durations):
+        """Add the dwells and heater waits of `moves` to `durations`"""
+        if not moves.events:
+            return
+        import numpy
+        elapsed = numpy.cumsum(durations)
+        waited = 0.
+        heaters = {}
+        for index, command, heater, s, r in moves.events:
+            now = elapsed[index] + waited
+            if command == "G4":
+                wait = (s or 0.) + (r or 0.) / 1000.
+            else:
+                heating, cooling = self.heater_rates(command)
+                key = ("bed",) if command in ("M140", "M190") else heater
+                temperature, target, since = heaters.get(
+                    key, (self.ambient_temperature, self.ambient_temperature, 0.))
+                if temperature < target:
+                    temperature = min(target, temperature + heating * (now - since))
+                else:
+                    temperature = max(target, temperature - cooling * (now - since))
+                target = s if s is not None else r
+                if target is None:
+                    continue
+                wait = 0.
+                if command in ("M109", "M190"):
+                    if target > temperature:
+                        wait = (target - temperature) / heating
+                    elif r is not None and target < temperature:
+                        wait = (temperature - target) / cooling
+                    if wait:
+                        temperature = target
+                heaters[key] = (temperature, target, now + wait)
+            durations[index] += wait
+            waited += wait
+
+    def apply(self, gcode, lines = None):
+        """Set the layer durations, duration and elapsed times of `gcode`
+        from the planner and return the duration of each line"""
+        import numpy
+        durations = self.line_durations(gcode, lines)
+        elapsed = numpy.cumsum(durations)
+        # Layer durations are differences of the elapsed times at the
+        # layer boundaries
+        offsets = numpy.minimum(numpy.asarray(gcode.layer_offsets,
+                                              dtype = numpy.intp),
+                                len(durations))
+        boundaries = numpy.concatenate(([0.], elapsed))[offsets]
+        totals = boundaries[1:] - boundaries[:-1]
+        for layer, total in zip(gcode.all_layers, totals.tolist()):
+            layer.duration = total
+        gcode.duration = datetime.timedelta(seconds = int(durations.sum()))
+        gcode.elapsed = array('d', elapsed.tobytes())
+        return durations
+
+def find_value(words, letter):
+    """Value of the first `letter` word of `words[1:]`, or None"""
+    for code, value in words[1:]:
+        if code == letter and value:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+def arc_delta(dx, dy, i, j, r, clockwise):
+    """Return the XY move of an arc to (dx, dy), with the length of the arc
+    along the direction of the chord"""
+    chord = math.hypot(dx, dy)
+    if r is not None:
+        if not chord:
+            return dx, dy
+        angle = 2 * math.asin(min(1., chord / (2 * abs(r))))
+        if r < 0:
+            angle = 2 * math.pi - angle
+        radius = abs(r)
+    else:
+        i = i or 0.
+        j = j or 0.
+        radius = math.hypot(i, j)
+        start = math.atan2(-j, -i)
+        end = math.atan2(dy - j, dx - i)
+        angle = start - end if clockwise else end - start
+        angle %= 2 * math.pi
+        if angle == 0:
+            angle = 2 * math.pi
+    length = radius * angle
+    if not chord:
+        return length, 0.
+    return dx * length / chord, dy * length / chord
+
+def trapezoid_time(length, entry, exit, cruise, accel):
+    """Duration of trapezoidal profiles from the entry to the exit speed
+    through the cruise speed, or a triangle when the block is too short"""
+    import numpy
+    accelerate = (cruise ** 2 - entry ** 2) / (2 * accel)
+    decelerate = (cruise ** 2 - exit ** 2) / (2 * accel)
+    plateau = length - accelerate - decelerate
+    peak = numpy.sqrt(numpy.maximum(accel * length + (entry ** 2 + exit ** 2) / 2,
+                                    0))
+    peak = numpy.where(plateau >= 0, cruise, numpy.minimum(peak, cruise))
+    return (peak - entry) / accel + (peak - exit) / accel \
+        + numpy.maximum(plateau, 0) / cruise
+
+def main():
+    from . import gcoder
+    if len(sys.argv) < 2:
+        print("usage: %s filename.gcode [limits]" % sys.argv[0])
+        return
+    with open(sys.argv[1], "r", encoding = "utf-8") as f:
+        gcode = gcoder.LightGCode(f)
+    limits = MachineLimits()
+    if len(sys.argv) > 2:
+        limits.update_from_text(" ".join(sys.argv[2:]))
+    print("Simple estimate: %d layers, %s" % gcode.estimate_duration())
+    MotionPlanner(limits).apply(gcode)
+    print("Planner estimate: %d layers, %s" % gcode.estimate_duration())
+
+if __name__ == '__main__':
+    main()
@@ -25,10 +25,16 @@ from queue import Queue, Empty as QueueEmpty
 import time
 import logging
 import traceback
-from functools import wraps, reduce
+from functools import wraps
 from collections import deque
+import re
 from printrun import gcoder
+from printrun import tokenizer
 from printrun import device
+from printrun import meatpack
+from printrun import grbl
+from printrun import hostprotocol
+from printrun import transcoder
 from .utils import set_utf8_locale, install_locale, decode_utf8
 try:
     set_utf8_locale()
@@ -37,6 +43,14 @@ except:
 install_locale('pronterface')
 from printrun.plugins import PRINTCORE_HANDLER
 
+# Marlin ADVANCED_OK: line number, free planner blocks and free command
+# buffer slots
+advanced_ok_exp = re.compile(r"ok\s+N(\d+)\s+P(\d+)\s+B(\d+)")
+# Most lines kept in flight when learning the window
+MAX_SEND_WINDOW = 32
+# Seconds between two checks of the state by the threads waiting to send
+WAIT_TIMEOUT = 0.1
+
 def locked(f):
     @wraps(f)
     def inner(*args, **kw):
@@ -80,6 +94,13 @@ class printcore():
         Collection of event-handling objects. The relevant method of each
         handler on this list will be triggered at the relevant process
         stage. See `printrun.eventhandler.PrinterEventHandler`.
+    grbl : bool
+        True to stream to a Grbl CNC or laser controller: lines are sent as
+        long as they fit in its serial buffer, without line numbers, and
+        its realtime commands can be sent with `send_realtime`.
+    grbl_status : grbl.Status
+        Last status report of the Grbl controller, see
+        `printrun.grbl.parse_status`.
     mainqueue : GCode
         The main command queue. A `printrun.gcoder.GCode` object containing an
         array of G-code commands. A call to `startprint` will populate this
@@ -97,6 +118,13 @@ class printcore():
         The priority command queue. Commands in this queue will be gradually
         sent to the printer. If there are commands in the `mainqueue` the ones
         in `priqueue` will be sent ahead of them. See `queue.Queue`.
+    send_latencies : deque of float
+        Seconds from the reception of an `ok` to the write of the next line,
+        for the last 10000 lines printed.
+    send_window : int
+        Number of lines sent ahead without waiting for their `ok`. 1 (the
+        default) waits for the `ok` of each line, 0 learns the size of the
+        command buffer of the firmware from its ADVANCED_OK replies.
 
     """
 
@@ -104,13 +132,36 @@ class printcore():
         self.baud = None
         self.dtr = None
         self.port = None
+        self.grbl = False
+        self.grbl_status = None
         self.analyzer = gcoder.GCode()
         # Serial instance connected to the printer, should be None when
         # disconnected
         self.printer = None
+        # Notified when the printer gets clear to send and when printing
+        # stops, also guards the lines sent to Grbl
+        self._clear_condition = threading.Condition()
         # clear to send, enabled after responses
-        # FIXME: should probably be changed to a sliding window approach
         self.clear = 0
+        # Lines sent without waiting for their ok, 0 to learn it
+        self.send_window = 1
+        # Free planner blocks and command buffer slots of the last
+        # ADVANCED_OK reply
+        self.planner_free = None
+        self.buffer_free = None
+        self._learned_window = 1
+        # Numbers of the lines sent whose ok wasn't received yet when
+        # sending ahead, None for unnumbered lines
+        self._in_flight = deque()
+        # Last line the printer asked to resend
+        self._resend_line = None
+        self._window_lock = threading.Lock()
+        # Lines sent to Grbl not answered yet
+        self._grbl_buffer = grbl.CharacterCounter()
+        # Seconds from the last ok to the next line sent while printing
+        self.send_latencies = deque(maxlen = 10000)
+        self._read_time = None
+        self._ok_time = None
         # The printer has responded to the initial command and is active
         self.online = False
         # is a print currently running, true if printing, false if paused
@@ -121,6 +172,9 @@ class printcore():
         self.lineno = 0
         self.resendfrom = -1
         self.paused = False
+        # The printer state may differ from the one the precomputed wire
+        # lines of the main queue rely on
+        self._wire_resync = False
         self.sentlines = {}
         self.log = deque(maxlen = 10000)
         self.sent = []
@@ -135,8 +189,12 @@ class printcore():
         self.startcb = None  # impl ()
         self.endcb = None  # impl ()
         self.onlinecb = None  # impl ()
+        self.statuscb = None  # impl (grbl.Status)
         self.loud = False  # emit sent and received lines to terminal
         self.tcp_streaming_mode = False
+        # Pack the sent lines with MeatPack if the firmware supports it
+        self.meatpack = False
+        self._meatpack_enabling = False
         self.greetings = ['start', 'Grbl ']
         self.wait = 0  # default wait period for send(), send_now()
         self.read_thread = None
@@ -173,6 +231,31 @@ class printcore():
         else:
             logging.error(error)
 
+    @property
+    def clear(self):
+        """The printer is clear to receive the next line"""
+        return self._clear
+
+    @clear.setter
+    def clear(self, value):
+        with self._clear_condition:
+            self._clear = value
+            if value:
+                self._clear_condition.notify_all()
+
+    def _wait_clear(self):
+        """Block until the printer is clear to send or printing stops"""
+        with self._clear_condition:
+            while not self._clear and self.printer and self.printing:
+                # Hosts may stop printing without waking the waiting threads
+                self._clear_condition.wait(WAIT_TIMEOUT)
+
+    def _wake_senders(self):
+        """Wake the threads waiting to send, to check the queues and the
+        print state again"""
+        with self._clear_condition:
+            self._clear_condition.notify_all()
+
     @locked
     def disconnect(self):
         """Disconnects from printer and pauses the print
@@ -185,6 +268,7 @@ class printcore():
                 self.read_thread = None
             if self.print_thread:
                 self.printing = False
+                self._wake_senders()
                 self.print_thread.join()
             self._stop_sender()
             try:
@@ -200,7 +284,7 @@ class printcore():
         self.printing = False
 
     @locked
-    def connect(self, port = None, baud = None, dtr=None):
+    def connect(self, port = None, baud = None, dtr=None, grbl=None):
         """Set port and baudrate if given, then connect to printer
         """
         if self.printer:
@@ -211,8 +295,11 @@ class printcore():
             self.baud = baud
         if dtr is not None:
             self.dtr = dtr
+        if grbl is not None:
+            self.grbl = grbl
         if self.port is not None and self.baud is not None:
             self.writefailures = 0
+            self.grbl_status = None
             self.printer = device.Device()
             self.printer.force_dtr = self.dtr
             try:
@@ -244,6 +331,7 @@ class printcore():
     def _readline(self):
         try:
             line_bytes = self.printer.readline()
+            self._read_time = time.perf_counter()
             if line_bytes is device.READ_EOF:
                 self.logError("Can't read from printer (disconnected?)." +
                               " line_bytes is None")
@@ -279,7 +367,11 @@ class printcore():
 
     def _listen_until_online(self):
         while not self.online and self._listen_can_continue():
-            self._send("M105")
+            if self.grbl:
+                # Grbl answers M105 with an error
+                self.send_realtime(grbl.STATUS_REPORT)
+            else:
+                self._send("M105")
             if self.writefailures >= 4:
                 logging.error(_("Aborting connection attempt after 4 failed writes."))
                 return
@@ -301,8 +393,13 @@ class printcore():
                     if empty_lines == 15: break
                 else: empty_lines = 0
                 if line.startswith(tuple(self.greetings)) \
-                   or line.startswith('ok') or "T:" in line:
+                   or line.startswith('ok') or "T:" in line \
+                   or (self.grbl and line.startswith('<')):
+                    # Before starting a print can send lines
+                    self._reset_window()
                     self.online = True
+                    if self.meatpack:
+                        self._query_meatpack()
                     for handler in self.event_handler:
                         try: handler.on_online()
                         except: logging.error(traceback.format_exc())
@@ -324,8 +421,15 @@ class printcore():
                 break
             if line.startswith('DEBUG_'):
                 continue
+            if self.grbl:
+                self._grbl_reply(line)
+                continue
             if line.startswith(tuple(self.greetings)) or line.startswith('ok'):
-                self.clear = True
+                self._ok_time = self._read_time
+                if self.send_window != 1:
+                    self._acknowledge(line)
+                else:
+                    self.clear = True
             if line.startswith('ok') and "T:" in line:
                 for handler in self.event_handler:
                     try: handler.on_temp(line)
@@ -336,23 +440,152 @@ class printcore():
                     except: self.logError(traceback.format_exc())
             elif line.startswith('Error'):
                 self.logError(line)
-            # Teststrings for resend parsing       # Firmware     exp. result
-            # line="rs N2 Expected checksum 67"    # Teacup       2
-            if line.lower().startswith("resend") or line.startswith("rs"):
-                for haystack in ["N:", "N", ":"]:
-                    line = line.replace(haystack, " ")
-                linewords = line.split()
-                while len(linewords) != 0:
-                    try:
-                        toresend = int(linewords.pop(0))
+            elif line.startswith('[MP]'):
+                self._meatpack_report(line)
+            if hostprotocol.is_resend(line):
+                toresend = hostprotocol.resend_number(line)
+                if toresend is not None:
+                    if self.send_window != 1:
+                        self._request_resend(toresend)
+                    else:
                         self.resendfrom = toresend
-                        break
-                    except:
-                        pass
-                self.clear = True
+                if self.send_window == 1:
+                    self.clear = True
         self.clear = True
         logging.debug('Exiting read thread')
 
+    def _window_size(self):
+        if self.send_window > 0:
+            return self.send_window
+        return self._learned_window
+
+    def _reset_window(self):
+        with self._window_lock:
+            self._in_flight.clear()
+            self._learned_window = 1
+            self._resend_line = None
+        with self._clear_condition:
+            self._grbl_buffer.clear()
+
+    def _grbl_reply(self, line):
+        """Act on the `line` received from Grbl"""
+        if grbl.is_reply(line):
+            self._ok_time = self._read_time
+            with self._clear_condition:
+                command = self._grbl_buffer.answered()
+                self.clear = True
+            if line.startswith('error'):
+                error = grbl.describe(line)
+                if command is not None:
+                    error += ": " + command
+                self.logError(error)
+        elif line.startswith('<'):
+            previous = self.grbl_status
+            status = grbl.parse_status(
+                line, previous.wco if previous is not None else None)
+            if status is not None:
+                self.grbl_status = status
+                if self.statuscb:
+                    try: self.statuscb(status)
+                    except: self.logError(traceback.format_exc())
+        elif line.startswith('ALARM') or line.startswith(tuple(self.greetings)):
+            # Grbl flushed its buffers, without answering the lines sent
+            with self._clear_condition:
+                self._grbl_buffer.clear()
+                self.clear = True
+            if line.startswith('ALARM'):
+                self.logError(grbl.describe(line))
+            if self.printing:
+                # Don't go on from the state Grbl was left in
+                self.pause()
+
+    def _grbl_wait_room(self, command, printing = False):
+        """Wait until the line `command` fits in the serial buffer of Grbl.
+
+        Returns
+        -------
+        bool
+            False if disconnected first, or if the print stopped first when
+            `printing`.
+        """
+        with self._clear_condition:
+            while not self._grbl_buffer.fits(command):
+                if not self._listen_can_continue() \
+                        or (printing and not self.printing):
+                    return False
+                self._clear_condition.wait(WAIT_TIMEOUT)
+            return True
+
+    def _acknowledge(self, line):
+        """Count the ok (or greeting) `line` out of the lines in flight"""
+        match = advanced_ok_exp.match(line)
+        with self._window_lock:
+            in_flight = self._in_flight
+            if not line.startswith('ok'):
+                # The firmware restarted and forgot the lines sent
+                in_flight.clear()
+                self._resend_line = None
+            elif match and int(match.group(1)) in in_flight:
+                # Acknowledges the lines up to the one it numbers, including
+                # those the firmware dropped after a bad line
+                lineno = int(match.group(1))
+                while in_flight.popleft() != lineno:
+                    pass
+            elif in_flight:
+                in_flight.popleft()
+            if match:
+                self.planner_free = int(match.group(2))
+                self.buffer_free = int(match.group(3))
+                # The free slots are reported once the acknowledged command
+                # is done, the buffer holds one more
+                self._learned_window = min(
+                    max(self._learned_window, self.buffer_free + 1),
+                    MAX_SEND_WINDOW)
+            self.clear = len(in_flight) < self._window_size()
+
+    def _request_resend(self, lineno):
+        """Resend the lines from `lineno`, unless it was already asked by
+        the lines sent ahead of the line first asking for it"""
+        with self._window_lock:
+            # The lines in flight after a bad line are rejected, each asking
+            # for the same line. The reply to the resent copy comes when it
+            # is the oldest line in flight.
+            if lineno == self._resend_line and self._in_flight \
+                    and self._in_flight[0] != lineno:
+                return
+            self._resend_line = lineno
+            self.resendfrom = lineno
+
+    def _query_meatpack(self):
+        """Ask the firmware whether it supports MeatPack, the packing is
+        enabled when it reports its state"""
+        self._meatpack_enabling = False
+        try:
+            # Reset a firmware left packing by a previous connection
+            self.printer.meatpack_command(meatpack.RESET_ALL)
+            self.printer.meatpack_command(meatpack.QUERY_CONFIG)
+            # Firmwares without MeatPack get the commands as a line of
+            # their own
+            self.printer.write(b"\n")
+        except device.DeviceError as e:
+            self.logError("Can't write to printer (disconnected?)"
+                          "{0}".format(e))
+
+    def _meatpack_report(self, line):
+        state = meatpack.parse_report(line)
+        if state is None or not self.meatpack:
+            return
+        active, no_spaces = state
+        if active:
+            logging.info(_("MeatPack packing enabled"))
+        elif not self._meatpack_enabling:
+            self._meatpack_enabling = True
+            try:
+                self.printer.meatpack_command(meatpack.ENABLE_PACKING)
+            except device.DeviceError as e:
+                self.logError("Can't write to printer (disconnected?)"
+                              "{0}".format(e))
+
     def _start_sender(self):
         self.stop_send_thread = False
         self.send_thread = threading.Thread(target = self._sender,
@@ -362,25 +595,28 @@ class printcore():
     def _stop_sender(self):
         if self.send_thread:
             self.stop_send_thread = True
+            self._wake_senders()
             self.send_thread.join()
             self.send_thread = None
 
     def _sender(self):
         while not self.stop_send_thread:
+            with self._clear_condition:
+                if self.priqueue.empty():
+                    # Woken by send_now
+                    self._clear_condition.wait(WAIT_TIMEOUT)
             try:
-                command = self.priqueue.get(True, 0.1)
+                command = self.priqueue.get_nowait()
             except QueueEmpty:
                 continue
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            self._wait_clear()
             self._send(command)
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            self._wait_clear()
 
     def _checksum(self, command):
-        return reduce(lambda x, y: x ^ y, map(ord, command))
+        return transcoder.checksum(command)
 
-    def startprint(self, gcode, startindex = 0):
+    def startprint(self, gcode, startindex = 0, startcommands = None):
         """Start a print.
 
         The `mainqueue` is populated and then commands are gradually sent to
@@ -393,10 +629,14 @@ class printcore():
         gcode : GCode
             A `printrun.gcoder.GCode` object containing the array of G-code
             commands. The print queue `mainqueue` will be replaced with the
-            contents of `gcode`.
+            contents of `gcode`, which may still be growing (see
+            `printrun.gcoder.StreamingGCode`).
         startindex : int, default: 0
             The index from the `gcode` array from which the printing will be
             started.
+        startcommands : list of str, optional
+            Commands sent before the first line of `gcode`, e.g. to restore
+            the printer state when starting from `startindex`.
 
         Returns
         -------
@@ -412,11 +652,21 @@ class printcore():
         self.printing = True
         self.lineno = 0
         self.resendfrom = -1
-        if not gcode or not gcode.lines:
+        self._wire_resync = startindex != 0
+        with self._window_lock:
+            self._in_flight.clear()
+            self._resend_line = None
+        if not gcode:
+            # A StreamingGCode still parsing its first line is true, the
+            # print thread waits for its lines
             return True
 
-        self.clear = False
-        self._send("M110 N-1")
+        if not self.grbl:
+            self.clear = False
+            self._send("M110 N-1")
+        # Sent from the priority queue before the main queue
+        for command in startcommands or ():
+            self.priqueue.put_nowait(command)
 
         resuming = (startindex != 0)
         self.print_thread = threading.Thread(target = self._print,
@@ -459,6 +709,7 @@ class printcore():
         if not self.printing: return False
         self.paused = True
         self.printing = False
+        self._wake_senders()
 
         # ';@pause' in the gcode file calls pause from the print thread
         if not threading.current_thread() is self.print_thread:
@@ -470,13 +721,7 @@ class printcore():
         self.print_thread = None
 
         # saves the status
-        self.pauseX = self.analyzer.abs_x
-        self.pauseY = self.analyzer.abs_y
-        self.pauseZ = self.analyzer.abs_z
-        self.pauseE = self.analyzer.abs_e
-        self.pauseF = self.analyzer.current_f
-        self.pauseRelative = self.analyzer.relative
-        self.pauseRelativeE = self.analyzer.relative_e
+        hostprotocol.save_pause(self)
 
     def resume(self):
         """Resumes a paused print.
@@ -493,25 +738,12 @@ class printcore():
         """
         if not self.paused: return False
         # restores the status
-        self.send_now("G90")  # go to absolute coordinates
-
-        xyFeed = '' if self.xy_feedrate is None else ' F' + str(self.xy_feedrate)
-        zFeed = '' if self.z_feedrate is None else ' F' + str(self.z_feedrate)
-
-        self.send_now("G1 X%s Y%s%s" % (self.pauseX, self.pauseY, xyFeed))
-        self.send_now("G1 Z" + str(self.pauseZ) + zFeed)
-        self.send_now("G92 E" + str(self.pauseE))
-
-        # go back to relative if needed
-        if self.pauseRelative:
-            self.send_now("G91")
-        if self.pauseRelativeE:
-            self.send_now('M83')
-        # reset old feed rate
-        self.send_now("G1 F" + str(self.pauseF))
+        for command in hostprotocol.resume_commands(self):
+            self.send_now(command)
 
         self.paused = False
         self.printing = True
+        self._wire_resync = True
         self.print_thread = threading.Thread(target = self._print,
                                              name = 'print thread',
                                              kwargs = {"resuming": True})
@@ -534,10 +766,13 @@ class printcore():
 
         """
         if self.online:
-            if self.printing:
+            if self.grbl and command.strip() in grbl.TYPED_REALTIME:
+                self.send_realtime(grbl.TYPED_REALTIME[command.strip()])
+            elif self.printing:
                 self.mainqueue.append(command)
             else:
                 self.priqueue.put_nowait(command)
+                self._wake_senders()
         else:
             self.logError(_("Not connected to printer."))
 
@@ -556,10 +791,42 @@ class printcore():
 
         """
         if self.online:
-            self.priqueue.put_nowait(command)
+            if self.grbl and command.strip() in grbl.TYPED_REALTIME:
+                self.send_realtime(grbl.TYPED_REALTIME[command.strip()])
+            else:
+                self.priqueue.put_nowait(command)
+                self._wake_senders()
         else:
             self.logError(_("Not connected to printer."))
 
+    def send_realtime(self, command):
+        """Send a realtime command to Grbl right away.
+
+        Realtime commands bypass the queues and the serial buffer of Grbl,
+        which acts on them as soon as they arrive, even while it is busy.
+
+        Parameters
+        ----------
+        command : bytes
+            One of the realtime commands of `printrun.grbl`, e.g.
+            `grbl.FEED_HOLD`.
+
+        """
+        if command not in grbl.REALTIME:
+            raise ValueError("not a Grbl realtime command: %r" % command)
+        if not self.printer:
+            self.logError(_("Not connected to printer."))
+            return
+        if self.loud:
+            logging.info("SENT: %r" % command)
+        try:
+            self.printer.write(command)
+            self.writefailures = 0
+        except device.DeviceError as e:
+            self.logError("Can't write to printer (disconnected?)"
+                          "{0}".format(e))
+            self.writefailures += 1
+
     def _print(self, resuming = False):
         self._stop_sender()
         try:
@@ -599,11 +866,24 @@ class printcore():
         if command.startswith(";@pause"):
             self.pause()
 
+    def _wait_index(self, i):
+        """Whether the main queue has an `i`-th line, waiting for a
+        StreamingGCode to parse it while the print goes on"""
+        queue = self.mainqueue
+        if not isinstance(queue, gcoder.StreamingGCode):
+            return queue.has_index(i)
+        # Wait in steps so that pause and cancel don't wait for the parser
+        while not queue.has_index(i, WAIT_TIMEOUT):
+            if not self.printing:
+                return False
+            if not queue.parsing:
+                return queue.has_index(i, 0)
+        return True
+
     def _sendnext(self):
         if not self.printer:
             return
-        while self.printer and self.printing and not self.clear:
-            time.sleep(0.001)
+        self._wait_clear()
         # Only wait for oks when using serial connections or when not using tcp
         # in streaming mode
         if not self.printer.has_flow_control or not self.tcp_streaming_mode:
@@ -611,16 +891,26 @@ class printcore():
         if not (self.printing and self.printer and self.online):
             self.clear = True
             return
-        if self.resendfrom < self.lineno and self.resendfrom > -1:
-            self._send(self.sentlines[self.resendfrom], self.resendfrom, False)
-            self.resendfrom += 1
+        with self._window_lock:
+            # The printer may ask for a resend while resending
+            resendfrom = self.resendfrom
+            if -1 < resendfrom < self.lineno:
+                self.resendfrom += 1
+            else:
+                self.resendfrom = -1
+        if resendfrom > -1 and resendfrom < self.lineno:
+            self._send(self.sentlines[resendfrom], resendfrom, False)
             return
-        self.resendfrom = -1
         if not self.priqueue.empty():
-            self._send(self.priqueue.get_nowait())
+            command = self.priqueue.get_nowait()
+            if not transcoder.keeps_state(command):
+                # The next shortened lines may rely on a position or
+                # feedrate the command changed
+                self._wire_resync = True
+            self._send(command)
             self.priqueue.task_done()
             return
-        if self.printing and self.mainqueue.has_index(self.queueindex):
+        if self.printing and self._wait_index(self.queueindex):
             (layer, line) = self.mainqueue.idxs(self.queueindex)
             gline = self.mainqueue.all_layers[layer][line]
             if self.queueindex > 0:
@@ -634,31 +924,54 @@ class printcore():
                 if prev_layer != layer:
                     try: self.layerchangecb(layer)
                     except: self.logError(traceback.format_exc())
+            exclusion = self.mainqueue.exclusion
+            if exclusion is not None and self.queueindex < len(exclusion.mask) \
+                    and exclusion.mask[self.queueindex]:
+                # Move of an excluded object, the fixups restore the state
+                # the next lines expect
+                for command in exclusion.fixups.get(self.queueindex, ()):
+                    self.priqueue.put_nowait(command)
+                self._wire_resync = True
+                self.queueindex += 1
+                self.clear = True
+                return
             for handler in self.event_handler:
                 try: handler.on_preprintsend(gline, self.queueindex, self.mainqueue)
                 except: logging.error(traceback.format_exc())
+            original = gline
             if self.preprintsendcb:
-                if self.mainqueue.has_index(self.queueindex + 1):
+                if self._wait_index(self.queueindex + 1):
                     (next_layer, next_line) = self.mainqueue.idxs(self.queueindex + 1)
                     next_gline = self.mainqueue.all_layers[next_layer][next_line]
                 else:
                     next_gline = None
                 gline = self.preprintsendcb(gline, next_gline)
+            if gline is not original:
+                self._wire_resync = True
             if gline is None:
                 self.queueindex += 1
                 self.clear = True
                 return
             tline = gline.raw
-            if tline.lstrip().startswith(";@"):  # check for host command
+            if hostprotocol.is_host_command(tline):
                 self.process_host_command(tline)
                 self.queueindex += 1
                 self.clear = True
                 return
 
-            # Strip comments
-            tline = gcoder.gcode_strip_comment_exp.sub("", tline).strip()
+            if gline is original:
+                tline, checksum, self._wire_resync = hostprotocol.wire_line(
+                    self.mainqueue, self.queueindex, tline, self._wire_resync)
+            else:
+                # Strip comments
+                tline = tokenizer.strip_comments(tline).strip()
+                checksum = None
             if tline:
-                self._send(tline, self.lineno, True)
+                if self.grbl and not self._grbl_wait_room(tline, True):
+                    # Paused while Grbl was busy, sent again on resume
+                    self.clear = True
+                    return
+                self._send(tline, self.lineno, True, checksum)
                 self.lineno += 1
                 for handler in self.event_handler:
                     try: handler.on_printsend(gline)
@@ -675,17 +988,33 @@ class printcore():
             if not self.paused:
                 self.queueindex = 0
                 self.lineno = 0
-                self._send("M110 N-1")
+                if not self.grbl:
+                    self._send("M110 N-1")
 
-    def _send(self, command, lineno = 0, calcchecksum = False):
+    def _send(self, command, lineno = 0, calcchecksum = False,
+              checksum = None):
         # Only add checksums if over serial (tcp does the flow control itself)
-        if calcchecksum and not self.printer.has_flow_control:
-            prefix = "N" + str(lineno) + " " + command
-            command = prefix + "*" + str(self._checksum(prefix))
+        # and never to Grbl
+        if calcchecksum and not self.printer.has_flow_control \
+                and not self.grbl:
+            command = hostprotocol.numbered(command, lineno, checksum)
             if "M110" not in command:
                 self.sentlines[lineno] = command
         if self.printer:
+            if self.grbl:
+                if not self._grbl_wait_room(command):
+                    return
+                with self._clear_condition:
+                    self._grbl_buffer.sent(command)
+                    self.clear = True
             self.sent.append(command)
+            if self.send_window != 1 and not self.grbl \
+                    and not (self.printer.has_flow_control
+                             and self.tcp_streaming_mode):
+                with self._window_lock:
+                    self._in_flight.append(
+                        lineno if command.startswith("N") else None)
+                    self.clear = len(self._in_flight) < self._window_size()
             # run the command through the analyzer
             gline = None
             try:
@@ -702,8 +1031,12 @@ class printcore():
             if self.sendcb:
                 try: self.sendcb(command, gline)
                 except: self.logError(traceback.format_exc())
+            ok_time = self._ok_time
+            if ok_time is not None and self.printing:
+                self._ok_time = None
+                self.send_latencies.append(time.perf_counter() - ok_time)
             try:
-                self.printer.write((command + "\n").encode('ascii'))
+                self.printer.write((command + "\n").encode('ascii', 'replace'))
                 self.writefailures = 0
             except device.DeviceError as e:
                 self.logError("Can't write to printer (disconnected?)"
@@ -28,19 +28,31 @@ import locale
 import logging
 import traceback
 import re
+import itertools
+import shlex
 
 from platformdirs import user_cache_dir, user_config_dir, user_data_dir
 from serial import SerialException
 
 from . import printcore
 from .utils import install_locale, run_command, get_command_output, \
-    format_time, format_duration, RemainingTimeEstimator, \
+    format_time, format_duration, parse_duration, RemainingTimeEstimator, \
     get_home_pos, parse_build_dimensions, parse_temperature_report, \
     setup_logging
 install_locale('pronterface')
 from .settings import Settings, BuildDimensionsSetting
 from .power import powerset_print_start, powerset_print_stop
+from printrun import arcfit
+from printrun import compressed
+from printrun import fileinfo
 from printrun import gcoder
+from printrun import grbl
+from printrun import jobindex
+from printrun import planner
+from printrun import tokenizer
+from printrun import transcoder
+from printrun.gcodecache import GCodeCache
+from printrun.mappedgcode import MappedGCode
 from .rpc import ProntRPC
 from printrun.spoolmanager import spoolmanager
 
@@ -103,37 +115,12 @@ class Status:
     def extruder_enabled(self):
         return self.extruder_temp != 0
 
-class RGSGCoder():
-    """Bare alternative to gcoder.LightGCode which does not preload all lines in memory,
-but still allows run_gcode_script (hence the RGS) to be processed by do_print (checksum,threading,ok waiting)"""
+class RGSGCoder(gcoder.LightStreamingGCode):
+    """G-code read from the output of a script while it is printed, which allows run_gcode_script
+(hence the RGS) to be processed by do_print (checksum,threading,ok waiting)"""
     def __init__(self, line):
-        self.lines = True
-        self.filament_length = 0.
-        self.filament_length_multi = [0]
         self.proc = run_command(line, {"$s": 'str(self.filename)'}, stdout = subprocess.PIPE, universal_newlines = True)
-        lr = gcoder.Layer([])
-        lr.duration = 0.
-        self.all_layers = [lr]
-        self.read() #empty layer causes division by zero during progress calculation
-    def read(self):
-        ln = self.proc.stdout.readline()
-        if not ln:
-            self.proc.stdout.close()
-            return None
-        ln = ln.strip()
-        if not ln:
-            return None
-        pyLn = gcoder.PyLightLine(ln)
-        self.all_layers[0].append(pyLn)
-        return pyLn
-    def has_index(self, i):
-        while i >= len(self.all_layers[0]) and not self.proc.stdout.closed:
-            self.read()
-        return i < len(self.all_layers[0])
-    def __len__(self):
-        return len(self.all_layers[0])
-    def idxs(self, i):
-        return 0, i #layer, line
+        super().__init__(self.proc.stdout, split_layers = False)
 
 class pronsole(cmd.Cmd):
     def __init__(self):
@@ -155,10 +142,18 @@ class pronsole(cmd.Cmd):
         self.recvlisteners = []
         self.in_macro = False
         self.p.onlinecb = self.online
+        # Last M201/M203/M204/M205 line reported by the printer, by command
+        self.reported_limits = {}
         self.p.errorcb = self.logError
         self.fgcode = None
         self.filename = None
+        # Thread loading a file in the background with print_while_loading
+        self.load_thread = None
+        # Passes over a file printed while it loaded, run after the print
+        self.deferred_load = None
         self.rpc_server = None
+        self.job_index = None
+        self.job_indexer = None
         self.curlayer = 0
         self.sdlisting = 0
         self.sdlisting_echo = 0
@@ -183,6 +178,8 @@ class pronsole(cmd.Cmd):
         self.settings._port_list = self.scanserial
         self.update_build_dimensions(None, self.settings.build_dimensions)
         self.update_tcp_streaming_mode(None, self.settings.tcp_streaming_mode)
+        self.update_meatpack(None, self.settings.meatpack)
+        self.update_send_window(None, self.settings.send_window)
         self.monitoring = 0
         self.starttime = 0
         self.extra_print_time = 0
@@ -350,6 +347,12 @@ class pronsole(cmd.Cmd):
             self.status_thread = None
         if self.rpc_server is not None:
             self.rpc_server.shutdown()
+        if self.job_indexer is not None:
+            self.job_indexer.stop()
+            self.job_indexer = None
+        if self.job_index is not None:
+            self.job_index.close()
+            self.job_index = None
 
     def write_prompt(self):
         sys.stdout.write(self.promptf())
@@ -727,6 +730,12 @@ Disables all heaters upon exit."))
     def update_tcp_streaming_mode(self, param, value):
         self.p.tcp_streaming_mode = self.settings.tcp_streaming_mode
 
+    def update_meatpack(self, param, value):
+        self.p.meatpack = self.settings.meatpack
+
+    def update_send_window(self, param, value):
+        self.p.send_window = int(self.settings.send_window)
+
     def update_rpc_server(self, param, value):
         if value:
             if self.rpc_server is None:
@@ -736,6 +745,26 @@ Disables all heaters upon exit."))
                 self.rpc_server.shutdown()
                 self.rpc_server = None
 
+    def update_job_index(self, param, value):
+        """Index the job directory in the background, or stop indexing it"""
+        if self.job_indexer is not None:
+            self.job_indexer.stop()
+            self.job_indexer = None
+        directory = self.settings.job_directory
+        if not directory:
+            return
+        if not os.path.isdir(directory):
+            self.logError(_("Job directory %s not found") % directory)
+            return
+        if self.job_index is None:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            self.job_index = jobindex.JobIndex(
+                os.path.join(self.cache_dir, "jobs.sqlite"))
+        self.job_indexer = jobindex.JobIndexer(
+            self.job_index, directory,
+            full_parse = self.settings.job_index_parse)
+        self.job_indexer.start()
+
     #  --------------------------------------------------------------
     #  Command line options handling
     #  --------------------------------------------------------------
@@ -784,7 +813,7 @@ Disables all heaters upon exit."))
 
     def connect_to_printer(self, port, baud, dtr):
         try:
-            self.p.connect(port, baud, dtr)
+            self.p.connect(port, baud, dtr, self.settings.grbl)
         except SerialException as e:
             # Currently, there is no errno, but it should be there in the future
             if e.errno == 2:
@@ -904,7 +933,9 @@ Disables all heaters upon exit."))
                 self.status_thread = None
                 self.p.disconnect()
                 return
-            if do_monitoring:
+            if do_monitoring and self.p.grbl:
+                self.p.send_realtime(grbl.STATUS_REPORT)
+            elif do_monitoring:
                 if self.sdprinting and not self.paused:
                     self.p.send_now("M27")
                 if self.m105_waitcycles % 10 == 0:
@@ -934,7 +965,26 @@ Disables all heaters upon exit."))
     #  --------------------------------------------------------------
 
     def do_load(self, filename):
-        self._do_load(filename)
+        if self.load_thread is not None and self.load_thread.is_alive():
+            self.logError(_("Already loading a file."))
+            return
+        if not self.settings.print_while_loading \
+                or self.settings.mapped_gcode:
+            self._do_load(filename)
+            return
+        # The print command can start the print while the file loads
+        self.load_thread = threading.Thread(target = self._load_thread,
+                                            args = (filename,),
+                                            name = 'load thread',
+                                            daemon = True)
+        self.load_thread.start()
+
+    def _load_thread(self, filename):
+        try:
+            self._do_load(filename)
+        except Exception:
+            self.logError(_("Failed to load %s:") % filename + "\n"
+                          + traceback.format_exc())
 
     def _do_load(self, filename):
         if not filename:
@@ -944,20 +994,156 @@ Disables all heaters upon exit."))
         if not os.path.exists(filename):
             self.logError(_("File not found!"))
             return
+        self.log_file_info(filename)
         self.load_gcode(filename)
         self.log(_("Loaded %s, %d lines.") % (filename, len(self.fgcode)))
         self.log(_("Estimated duration: %d layers, %s") % self.fgcode.estimate_duration())
 
+    def file_info(self, filename):
+        """Return a one line description of the G-code file `filename` from
+        the comments of its slicer, None if they tell nothing"""
+        try:
+            info = fileinfo.probe(filename)
+        except (OSError, ValueError):
+            return None
+        parts = []
+        if info.duration is not None:
+            parts.append(format_duration(info.duration.total_seconds()))
+        if info.filament_lengths:
+            parts.append(_("%s mm of filament") % " + ".join(
+                "%.1f" % length for length in info.filament_lengths))
+        if info.layer_count is not None:
+            parts.append(_("%d layers") % info.layer_count)
+        if info.layer_height is not None:
+            parts.append(_("%.2f mm layer height") % info.layer_height)
+        if info.objects:
+            parts.append(_("%d objects") % len(info.objects))
+        if not parts:
+            return None
+        if info.slicer:
+            return _("%s estimate: %s") % (info.slicer, ", ".join(parts))
+        return _("Slicer estimate: %s") % ", ".join(parts)
+
+    def log_file_info(self, filename):
+        info = self.file_info(filename)
+        if info is not None:
+            self.log(info)
+
     def load_gcode(self, filename, layer_callback = None, gcode = None):
         if gcode is None:
-            self.fgcode = gcoder.LightGCode(deferred = True)
-        else:
-            self.fgcode = gcode
-        self.fgcode.prepare(open(filename, "r", encoding="utf-8"),
-                            get_home_pos(self.build_dimensions_list),
-                            layer_callback = layer_callback)
-        self.fgcode.estimate_duration()
+            gcode = self.new_light_gcode()
+        self.fgcode = gcode
         self.filename = filename
+        self.deferred_load = None
+        store = False
+        home_pos = get_home_pos(self.build_dimensions_list)
+        cache = self.gcode_cache()
+        if isinstance(self.fgcode, MappedGCode):
+            self.fgcode.cache = cache
+            self.fgcode.prepare(filename, home_pos,
+                                layer_callback = layer_callback)
+        elif cache is None or not cache.restorable(self.fgcode) \
+                or not cache.load(filename, self.fgcode, home_pos,
+                                  layer_callback = layer_callback):
+            if self.fgcode.buffer_input \
+                    and compressed.compression(filename) is None:
+                # The lines point into the bytes of the file, decoded only
+                # when read. Compressed files are streamed below instead,
+                # so that no decompressed copy of the whole file is kept.
+                with open(filename, "rb") as f:
+                    data = f.read()
+                self.fgcode.prepare(data, home_pos,
+                                    layer_callback = layer_callback)
+            else:
+                with compressed.open_gcode(filename) as f:
+                    self.fgcode.prepare(f, home_pos,
+                                        layer_callback = layer_callback)
+                    if isinstance(self.fgcode, gcoder.StreamingGCode):
+                        self.gcode_streaming()
+                        self.fgcode.wait()
+            store = cache is not None and cache.restorable(self.fgcode)
+        if self.p.printing and self.p.mainqueue is self.fgcode:
+            # Started while loading, the print would see the estimates and
+            # sent lines change and compete with these passes for the GIL
+            self.deferred_load = (self.fgcode, filename,
+                                  cache if store else None)
+            return
+        self.finish_load(filename, cache if store else None)
+
+    def finish_load(self, filename, cache = None):
+        """Store the loaded file in `cache` if given, then estimate its
+        print time and shorten its lines"""
+        if cache is not None:
+            cache.store(filename, self.fgcode)
+        self.plan_gcode()
+        self.transcode_gcode()
+        self.fgcode.estimate_duration()
+
+    def finish_deferred_load(self):
+        """Run the passes over the loaded file skipped because it was
+        printed while loading, once it is no longer printed"""
+        if self.deferred_load is None or self.p.printing:
+            return
+        gcode, filename, cache = self.deferred_load
+        self.deferred_load = None
+        if gcode is self.fgcode:
+            self.finish_load(filename, cache)
+
+    def gcode_streaming(self):
+        """Called while loading when the lines of the G-code file can be
+        printed before the end of the parsing"""
+        pass
+
+    def machine_limits(self):
+        """Return the motion limits of the printer: the machine_limits
+        setting overridden by the limits reported by the printer"""
+        limits = planner.MachineLimits()
+        limits.update_from_text(self.settings.machine_limits)
+        limits.update_from_text("\n".join(self.reported_limits.values()))
+        return limits
+
+    def plan_gcode(self):
+        """Replace the simple duration estimate of the loaded file with the
+        one of the motion planner"""
+        if not self.settings.motion_planner or not len(self.fgcode):
+            return
+        try:
+            planner.MotionPlanner(self.machine_limits(),
+                                  self.settings.planner_buffer).apply(self.fgcode)
+        except ImportError:
+            self.logError(_("Planning print time estimates requires NumPy, "
+                            "using the simple estimate."))
+        except Exception:
+            self.logError(_("Failed to plan print time estimate:") + "\n"
+                          + traceback.format_exc())
+
+    def transcode_gcode(self):
+        """Precompute the shortened lines sent when printing the loaded
+        file"""
+        if not self.settings.transcode_gcode or not len(self.fgcode):
+            return
+        decimals = int(self.settings.transcode_decimals)
+        try:
+            self.fgcode.wire_lines = transcoder.Transcoder(
+                decimals, max(decimals, 5)).transcode(self.fgcode)
+        except Exception:
+            self.logError(_("Failed to shorten the sent G-code:") + "\n"
+                          + traceback.format_exc())
+
+    def new_light_gcode(self):
+        """Return an empty G-code object for printing without a viewer"""
+        if self.settings.mapped_gcode:
+            return MappedGCode(deferred = True)
+        if self.settings.print_while_loading:
+            return gcoder.LightStreamingGCode(deferred = True)
+        return gcoder.LightGCode(deferred = True)
+
+    def gcode_cache(self):
+        """Return the cache of parsed G-code files, or None if disabled"""
+        if self.settings.gcode_cache_size <= 0:
+            return None
+        return GCodeCache(os.path.join(self.cache_dir, "gcode"),
+                          int(self.settings.gcode_cache_size) * 1024 * 1024)
 
     def complete_load(self, text, line, begidx, endidx):
         s = line.split()
@@ -971,6 +1157,144 @@ Disables all heaters upon exit."))
 
     def help_load(self):
         self.log(_("Loads a gcode file (with tab-completion)"))
+        self.log(_("With print_while_loading set, the file loads in the background and can be printed before the end"))
+
+    def do_jobs(self, l):
+        if self.job_indexer is None:
+            self.logError(_("No job directory. Use set job_directory first."))
+            return
+        args = l.split()
+        reverse = "-r" in args
+        args = [arg for arg in args if arg != "-r"]
+        sort = args[0] if args else "name"
+        if sort not in jobindex.SORT_KEYS:
+            self.logError(_("Unknown sort key %s, use one of: %s")
+                          % (sort, ", ".join(jobindex.SORT_KEYS)))
+            return
+        if not self.job_indexer.scanned.wait(10):
+            self.log(_("Still indexing, the list is incomplete."))
+        jobs = self.job_index.jobs(self.job_indexer.directory, sort, reverse)
+        if not jobs:
+            self.log(_("No G-code files in %s") % self.job_indexer.directory)
+        for job in jobs:
+            self.log(jobindex.format_job(job))
+
+    def complete_jobs(self, text, line, begidx, endidx):
+        return [key for key in jobindex.SORT_KEYS + ("-r",)
+                if key.startswith(text)]
+
+    def help_jobs(self):
+        self.log(_("Lists the G-code files of the job directory with their "
+                   "estimated duration, filament and height, indexed in the "
+                   "background"))
+        self.log(_("jobs [%s] [-r] - sorts by name by default, -r reverses "
+                   "the order") % "|".join(jobindex.SORT_KEYS))
+
+    def do_arcfit(self, l):
+        if not self.fgcode:
+            self.logError(_("No file loaded. Please use load first."))
+            return
+        if self.p.printing or self.paused:
+            self.logError(_("Cannot fit arcs while printing."))
+            return
+        tolerance = self.settings.arc_tolerance
+        if l.strip():
+            try:
+                tolerance = float(l)
+            except ValueError:
+                self.help_arcfit()
+                return
+        self.fgcode, report = arcfit.ArcFitter(tolerance).fit(self.fgcode)
+        self.plan_gcode()
+        self.transcode_gcode()
+        self.fgcode.estimate_duration()
+        self.log(str(report))
+        self.gcode_replaced()
+
+    def help_arcfit(self):
+        self.log(_("Replaces the runs of short moves of the loaded file with arcs (G2/G3)"))
+        self.log(_("arcfit - fit within the arc_tolerance setting"))
+        self.log(_("arcfit 0.02 - fit within 0.02 mm"))
+
+    def excluded_objects(self):
+        """Return the names of the excluded objects of the loaded file"""
+        if not self.fgcode or self.fgcode.exclusion is None:
+            return frozenset()
+        return self.fgcode.exclusion.names
+
+    def exclude_objects(self, names):
+        """Skip the moves of the labelled objects `names` of the loaded file,
+        from the next line printed when printing"""
+        start = self.p.queueindex if self.p.printing or self.paused else 0
+        self.fgcode.exclude_objects(names, start)
+
+    def do_objects(self, l):
+        if not self.fgcode:
+            self.logError(_("No file loaded. Please use load first."))
+            return
+        names = self.fgcode.object_index.names
+        if not names:
+            self.log(_("The loaded file labels no objects."))
+            return
+        excluded = self.excluded_objects()
+        for number, name in enumerate(names, 1):
+            if name in excluded:
+                self.log(_("%d: %s (excluded)") % (number, name))
+            else:
+                self.log("%d: %s" % (number, name))
+
+    def help_objects(self):
+        self.log(_("Lists the objects labelled by the slicer in the loaded file"))
+
+    def do_exclude(self, l):
+        if not self.fgcode:
+            self.logError(_("No file loaded. Please use load first."))
+            return
+        try:
+            args = shlex.split(l)
+        except ValueError as e:
+            self.logError(str(e))
+            return
+        if not args:
+            excluded = self.excluded_objects()
+            if excluded:
+                self.log(_("Excluded objects: %s") % ", ".join(sorted(excluded)))
+            else:
+                self.log(_("No excluded objects."))
+            return
+        if args == ["-c"]:
+            self.exclude_objects([])
+            self.log(_("Objects no longer excluded."))
+            return
+        names = self.fgcode.object_index.names
+        excluded = set(self.excluded_objects())
+        for arg in args:
+            if arg in names:
+                excluded.add(arg)
+            elif arg.isdigit() and 1 <= int(arg) <= len(names):
+                excluded.add(names[int(arg) - 1])
+            else:
+                self.logError(_("Unknown object: %s") % arg)
+                return
+        self.exclude_objects(excluded)
+        self.log(_("Excluded objects: %s") % ", ".join(sorted(excluded)))
+
+    def complete_exclude(self, text, line, begidx, endidx):
+        if not self.fgcode:
+            return []
+        return [name for name in self.fgcode.object_index.names
+                if name.startswith(text)]
+
+    def help_exclude(self):
+        self.log(_("Skips the moves of objects labelled by the slicer (M486, EXCLUDE_OBJECT or object comments), also while printing"))
+        self.log(_("exclude 2 \"Cube id:0 copy 1\" - excludes the objects numbered as by objects or named"))
+        self.log(_("exclude - lists the excluded objects"))
+        self.log(_("exclude -c - prints all objects again"))
+
+    def gcode_replaced(self):
+        """Called when the loaded G-code was replaced by a transformed
+        copy"""
+        pass
 
     def do_slice(self, l):
         l = l.split()
@@ -1084,6 +1408,39 @@ Disables all heaters upon exit."))
             self.log(_("Send a loaded gcode file to the printer. Load a file with the load command first."))
         else:
             self.log(_("Send a loaded gcode file to the printer. You have %s loaded right now.") % self.filename)
+        self.log(_("print --from-time 2h10m - starts at the line the print is estimated to reach after 2 h 10 min"))
+        self.log(_("print --from-z 12.4 - starts at the first layer at or above Z 12.4 mm"))
+        self.log(_("When starting from a later point, temperatures, fan, modes, position and extrusion are restored first: home the printer before."))
+
+    def print_start_index(self, l):
+        """Return the line to start printing from given the --from-time or
+        --from-z arguments of print, or None on error"""
+        args = l.split()
+        if len(args) != 2 or args[0] not in ("--from-time", "--from-z"):
+            self.logError(_("Unknown print arguments: %s") % l)
+            self.help_print()
+            return None
+        option, value = args
+        try:
+            if option == "--from-time":
+                index = self.fgcode.index_at_time(parse_duration(value))
+            else:
+                index = self.fgcode.index_at_z(float(value))
+        except ValueError:
+            self.logError(_("Invalid value for %s: %s") % (option, value))
+            return None
+        if index >= len(self.fgcode):
+            self.logError(_("The print ends before %s") % value)
+            return None
+        if index:
+            layer = self.fgcode.idxs(index)[0]
+            z = self.fgcode.all_layers[layer].z
+            elapsed = self.fgcode.elapsed_time(index)
+            remaining = self.fgcode.elapsed_time(len(self.fgcode)) - elapsed
+            self.log(_("Starting at line %d (layer %d, Z %s), estimated %s into the print, %s left")
+                     % (index + 1, layer, "-" if z is None else "%.2f" % z,
+                        format_duration(elapsed), format_duration(remaining)))
+        return index
 
     def do_print(self, l):
         if not self.fgcode:
@@ -1092,10 +1449,33 @@ Disables all heaters upon exit."))
         if not self.p.online:
             self.logError(_("Not connected to printer."))
             return
+        startindex = 0
+        if l and l.strip():
+            if isinstance(self.fgcode, gcoder.StreamingGCode) \
+                    and self.fgcode.parsing:
+                self.logError(_("Wait for the file to load to start from "
+                                "a later line."))
+                return
+            startindex = self.print_start_index(l)
+            if startindex is None:
+                return
         self.log(_("Printing %s") % self.filename)
         self.log(_("You can monitor the print with the monitor command."))
         self.sdprinting = False
-        self.p.startprint(self.fgcode)
+        self.finish_deferred_load()
+        if not startindex:
+            self.p.startprint(self.fgcode)
+            return
+        # Restore the state left by the skipped lines before starting
+        startcommands = gcoder.resume_commands(
+            (line.raw for line in itertools.islice(self.fgcode.lines, startindex)),
+            self.settings.xy_feedrate, self.settings.z_feedrate)
+        self.log(_("Restoring printer state: %s") % "; ".join(startcommands))
+        # Starting from a later line is reported as resuming by printcore,
+        # which keeps the current ETA estimator
+        self.compute_eta = RemainingTimeEstimator(self.fgcode, startindex)
+        self.extra_print_time = 0
+        self.p.startprint(self.fgcode, startindex, startcommands)
 
     def do_pause(self, l):
         if self.sdprinting:
@@ -1273,6 +1653,7 @@ Disables all heaters upon exit."))
                             self.spool_manager.editLength(
                                 -self.fgcode.filament_length, extruder = 0)
 
+            self.finish_deferred_load()
             if not self.settings.final_command:
                 return
             output = get_command_output(self.settings.final_command,
@@ -1285,12 +1666,15 @@ Disables all heaters upon exit."))
     def recvcb_report(self, l):
         isreport = REPORT_NONE
         if "ok C:" in l or " Count " in l \
-           or ("X:" in l and len(gcoder.m114_exp.findall(l)) == 6):
+           or ("X:" in l and len(tokenizer.report_words(l, "XYZ")) == 6):
             self.posreport = l
             isreport = REPORT_POS
             if self.userm114 > 0:
                 self.userm114 -= 1
                 isreport |= REPORT_MANUAL
+        if planner.report_exp.match(l):
+            command = l.split("M", 1)[1].split(None, 1)[0]
+            self.reported_limits["M" + command] = l
         if "ok T:" in l or tempreading_exp.findall(l):
             self.tempreadings = l
             isreport = REPORT_TEMP
@@ -1407,6 +1791,29 @@ Disables all heaters upon exit."))
         if "T:" in l:
             self.log(l.strip().replace("T", "Hotend").replace("B", "Bed").replace("ok ", ""))
 
+    def do_limits(self, l):
+        l = l.strip()
+        if l == "read":
+            if not self.p.online:
+                self.logError(_("Printer is not online. Unable to read limits."))
+                return
+            self.p.send_now("M503")
+            time.sleep(1)
+        elif l == "clear":
+            self.reported_limits = {}
+        elif l:
+            self.help_limits()
+            return
+        self.log(_("Machine limits (reported by the printer: %s):")
+                 % (", ".join(sorted(self.reported_limits)) or _("none")))
+        self.log(str(self.machine_limits()))
+
+    def help_limits(self):
+        self.log(_("Show the motion limits used to estimate print times"))
+        self.log(_("limits read - ask the printer for its limits (M503)"))
+        self.log(_("limits clear - forget the limits reported by the printer"))
+        self.log(_("The limits apply to the files loaded afterwards."))
+
     def do_gettemp(self, l):
         if "dynamic" in l:
             self.dynamic_temp = True
@@ -66,6 +66,8 @@ from .gui import MainWindow
 from .settings import wxSetting, HiddenSetting, StringSetting, SpinSetting, \
     FloatSpinSetting, BooleanSetting, StaticTextSetting, ColorSetting, ComboSetting
 from printrun import gcoder
+from printrun import tokenizer
+from printrun.gcoder_columnar import ParallelGCode
 from .pronsole import REPORT_NONE, REPORT_POS, REPORT_TEMP, REPORT_MANUAL
 
 def format_length(mm, fractional=2):
@@ -818,7 +820,7 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         self.Bind(wx.EVT_MENU, self.savefile, self.savebtn)
 
         self.filehistory = wx.FileHistory(maxFiles = 8, idBase = wx.ID_FILE1)
-        recent = wx.Menu()
+        recent = self.recentmenu = wx.Menu()
         self.filehistory.UseMenu(recent)
         self.Bind(wx.EVT_MENU_RANGE, self.load_recent_file,
                   id = wx.ID_FILE1, id2 = wx.ID_FILE9)
@@ -833,6 +835,7 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         self.Bind(wx.EVT_MENU, self.plate, m.Append(-1, _("Plater"), _(" Compose 3D models into a single plate")))
         self.Bind(wx.EVT_MENU, self.plate_gcode, m.Append(-1, _("G-Code Plater"), _(" Compose G-Codes into a single plate")))
         self.Bind(wx.EVT_MENU, self.exclude, m.Append(-1, _("Excluder"), _(" Exclude parts of the bed from being printed")))
+        self.Bind(wx.EVT_MENU, self.exclude_labelled_objects, m.Append(-1, _("Exclude Objects..."), _(" Exclude objects labelled by the slicer from being printed")))
         self.Bind(wx.EVT_MENU, self.project, m.Append(-1, _("Projector"), _(" Project slices")))
         self.Bind(wx.EVT_MENU,
                   self.show_spool_manager,
@@ -909,6 +912,28 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         self.excluder.pop_window(self.fgcode, bgcolor = self.bgcolor,
                                  build_dimensions = self.build_dimensions_list)
 
+    def exclude_labelled_objects(self, event):
+        """Pick the objects labelled by the slicer to exclude"""
+        if not self.fgcode:
+            wx.CallAfter(self.statusbar.SetStatusText, _("No file loaded. Please use load first."))
+            return
+        names = self.fgcode.object_index.names
+        if not names:
+            self.statusbar.SetStatusText(_("The loaded file labels no objects."))
+            return
+        dlg = wx.MultiChoiceDialog(self, _("Select the objects not to print"),
+                                   _("Exclude Objects"), names)
+        excluded = self.excluded_objects()
+        dlg.SetSelections([i for i, name in enumerate(names) if name in excluded])
+        if dlg.ShowModal() == wx.ID_OK:
+            selected = [names[i] for i in dlg.GetSelections()]
+            self.exclude_objects(selected)
+            if selected:
+                self.log(_("Excluded objects: %s") % ", ".join(selected))
+            else:
+                self.log(_("No excluded objects."))
+        dlg.Destroy()
+
     def show_spool_manager(self, event):
         """Show Spool Manager Window"""
         spoolmanager_gui.SpoolManagerMainWindow(self, self.spool_manager).Show()
@@ -1176,6 +1201,12 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         recent_files.reverse()
         for f in recent_files:
             self.filehistory.AddFileToHistory(f)
+        # Describe the files in the status bar from their slicer comments
+        for i in range(self.filehistory.GetCount()):
+            item = self.recentmenu.FindItemById(wx.ID_FILE1 + i)
+            if item is not None:
+                item.SetHelp(self.file_info(self.filehistory.GetHistoryFile(i))
+                             or "")
 
     def update_gviz_params(self, param, value):
         params_map = {"preview_extrusion_width": "extrusion_width",
@@ -1440,6 +1471,7 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
             wx.CallAfter(self.statusbar.SetStatusText, _("Not connected to printer."))
             return
         self.sdprinting = False
+        self.finish_deferred_load()
         self.on_startprint()
         self.p.startprint(self.fgcode)
 
@@ -1629,7 +1661,7 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         dlg = None
         if filename is None:
             dlg = wx.FileDialog(self, _("Open file to print"), basedir, style = wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
-            dlg.SetWildcard(_("OBJ, STL, and GCODE files (*.gcode;*.gco;*.g;*.stl;*.STL;*.obj;*.OBJ)|*.gcode;*.gco;*.g;*.stl;*.STL;*.obj;*.OBJ|GCODE files (*.gcode;*.gco;*.g)|*.gcode;*.gco;*.g|OBJ, STL files (*.stl;*.STL;*.obj;*.OBJ)|*.stl;*.STL;*.obj;*.OBJ|All Files (*.*)|*.*"))
+            dlg.SetWildcard(_("OBJ, STL, and GCODE files (*.gcode;*.gco;*.g;*.stl;*.STL;*.obj;*.OBJ)|*.gcode;*.gco;*.g;*.gcode.gz;*.gcode.xz;*.gcode.zst;*.bgcode;*.stl;*.STL;*.obj;*.OBJ|GCODE files (*.gcode;*.gco;*.g;*.gcode.gz;*.gcode.xz;*.gcode.zst;*.bgcode)|*.gcode;*.gco;*.g;*.gcode.gz;*.gcode.xz;*.gcode.zst;*.bgcode|OBJ, STL files (*.stl;*.STL;*.obj;*.OBJ)|*.stl;*.STL;*.obj;*.OBJ|All Files (*.*)|*.*"))
             try:
                 dlg.SetFilterIndex(self.settings.last_file_filter)
             except:
@@ -1667,6 +1699,7 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
             if name.lower().endswith(".stl") or name.lower().endswith(".obj"):
                 self.slice(name)
             else:
+                self.log_file_info(name)
                 self.load_gcode_async(name)
         else:
             dlg.Destroy()
@@ -1710,7 +1743,16 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         self.loading_gcode = True
         self.loading_gcode_message = _("Loading %s...") % self.filename
         if self.settings.mainviz == "None":
-            gcode = gcoder.LightGCode(deferred = True)
+            gcode = self.new_light_gcode()
+        elif self.settings.print_while_loading:
+            # Printing while loading needs the lines in file order, which
+            # the parallel parser only gives at the end
+            if self.settings.parse_workers > 1:
+                self.log(_("Printing while loading: parsing with one worker."))
+            gcode = gcoder.StreamingGCode(deferred = True, cutting_as_extrusion = self.settings.cutting_as_extrusion)
+        elif self.settings.parse_workers > 1:
+            gcode = ParallelGCode(deferred = True, cutting_as_extrusion = self.settings.cutting_as_extrusion,
+                                  workers = int(self.settings.parse_workers))
         else:
             gcode = gcoder.GCode(deferred = True, cutting_as_extrusion = self.settings.cutting_as_extrusion)
         self.viz_last_yield = 0
@@ -1718,6 +1760,15 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         self.start_viz_thread(gcode)
         return gcode
 
+    def gcode_streaming(self):
+        if self.p.online:
+            wx.CallAfter(self.printbtn.Enable)
+
+    def gcode_replaced(self):
+        self.viz_last_layer = None
+        self.start_viz_thread(self.fgcode)
+        self.output_gcode_stats()
+
     def post_gcode_load(self, print_stats = True, failed=False):
         # Must be called in wx.CallAfter for safety
         self.loading_gcode = False
@@ -1728,12 +1779,14 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
             self.statusbar.SetStatusText(message)
             self.savebtn.Enable(True)
         self.loadbtn.SetLabel(_("Load File"))
-        self.printbtn.SetLabel(_("&Print"))
-        self.pausebtn.SetLabel(_("&Pause"))
-        self.pausebtn.Disable()
-        self.recoverbtn.Disable()
-        if not failed and self.p.online:
-            self.printbtn.Enable()
+        # The print may have been started while loading
+        if not self.p.printing:
+            self.printbtn.SetLabel(_("&Print"))
+            self.pausebtn.SetLabel(_("&Pause"))
+            self.pausebtn.Disable()
+            self.recoverbtn.Disable()
+            if not failed and self.p.online:
+                self.printbtn.Enable()
         self.toolbarsizer.Layout()
         self.viz_last_layer = None
         if print_stats:
@@ -2028,7 +2081,7 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
             self.logError(traceback.format_exc())
 
     def update_pos(self):
-        bits = gcoder.m114_exp.findall(self.posreport)
+        bits = tokenizer.report_words(self.posreport, "XYZ")
         x = None
         y = None
         z = None
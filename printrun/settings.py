@@ -385,7 +385,10 @@ class Settings:
         self._add(BooleanSetting("tcp_streaming_mode", False, _("TCP Streaming Mode:"),
                                  _("When using a TCP connection to the printer, the streaming mode will not wait for acks from the printer to send new commands."
                                    "This will break things such as ETA prediction, but can result in smoother prints.")), root.update_tcp_streaming_mode)
+        self._add(BooleanSetting("meatpack", False, _("MeatPack Compression:"), _("Pack the lines sent to printers whose firmware supports MeatPack (Marlin, Prusa) to send up to twice as many lines per second over serial links. Takes effect on the next connection"), "Printer"), root.update_meatpack)
+        self._add(SpinSetting("send_window", 1, 0, 32, _("Send Window:"), _("Number of lines sent ahead of the ok of the printer, to keep its planner fed with short moves. 1 waits for the ok of each line, 0 learns the size of the command buffer from Marlin ADVANCED_OK replies. Other values must not exceed the command buffer (BUFSIZE) of the firmware"), "Printer"), root.update_send_window)
         self._add(BooleanSetting("rpc_server", True, _("RPC Server:"), _("Enable RPC server to allow remotely querying print status")), root.update_rpc_server)
+        self._add(BooleanSetting("grbl", False, _("Grbl Streaming:"), _("Stream to Grbl CNC and laser controllers, sending lines as long as they fit in their 127 bytes serial buffer instead of waiting for the ok of each line. Takes effect on the next connection"), "Printer"))
         self._add(BooleanSetting("dtr", True, _("DTR:"), _("Disabling DTR would prevent Arduino (RAMPS) from resetting upon connection"), "Printer"))
         if sys.platform != "win32":
             self._add(StringSetting("devicepath", "", _("Device Name Pattern:"), _("Custom device pattern: for example /dev/3DP_* "), "Printer"))
@@ -396,6 +399,12 @@ class Settings:
         self._add(SpinSetting("xy_feedrate", 3000, 0, 50000, _("X && Y Manual Feedrate:"), _("Feedrate for Control Panel Moves in X and Y (mm/min)"), "Printer"))
         self._add(SpinSetting("z_feedrate", 100, 0, 50000, _("Z Manual Feedrate:"), _("Feedrate for Control Panel Moves in Z (mm/min)"), "Printer"))
         self._add(SpinSetting("e_feedrate", 100, 0, 1000, _("E Manual Feedrate:"), _("Feedrate for Control Panel Moves in Extrusions (mm/min)"), "Printer"))
+        self._add(BooleanSetting("motion_planner", False, _("Plan Print Time Estimates:"), _("Estimate print times by simulating the acceleration, jerk and lookahead of the firmware planner instead of the simple estimate"), "Printer"))
+        self._add(StringSetting("machine_limits", "", _("Machine Limits:"), _("Firmware motion limits used by the print time estimates, as M203/M201/M204/M205 commands, e.g. M203 X500 Y500 M204 P1500. Limits reported by the printer (M503) take precedence, unset limits use the Marlin defaults"), "Printer"))
+        self._add(SpinSetting("planner_buffer", 16, 1, 1024, _("Planner Buffer Size:"), _("Number of moves the firmware plans ahead (BLOCK_BUFFER_SIZE in Marlin), used by the print time estimates"), "Printer"))
+        self._add(FloatSpinSetting("arc_tolerance", 0.01, 0.001, 1, _("Arc Fitting Tolerance:"), _("Largest distance (mm) between the arcs written by the arcfit command and the moves they replace"), "Printer", increment = 0.005))
+        self._add(BooleanSetting("transcode_gcode", False, _("Shorten Sent G-code:"), _("Send the moves of printed files with trimmed numbers and without the coordinates and feedrates repeating the current ones, to send more moves per second over slow serial links"), "Printer"))
+        self._add(SpinSetting("transcode_decimals", 3, 0, 6, _("Sent Coordinate Decimals:"), _("Decimals kept in the coordinates and feedrates of moves in absolute positioning when shortening sent G-code (E keeps at least 5)"), "Printer"))
         defaultslicerpath = ""
         if getattr(sys, 'frozen', False):
             if sys.platform == "darwin":
@@ -410,6 +419,12 @@ class Settings:
         self._add(StringSetting("final_command", "", _("Final Command:"), _("Executable to run when the print is finished"), "External"))
         self._add(StringSetting("error_command", "", _("Error Command:"), _("Executable to run when an error occurs"), "External"))
         self._add(DirSetting("log_path", str(Path.home()), _("Log Path:"), _("Path to the log file. An empty path will log to the console."), "UI"))
+        self._add(BooleanSetting("mapped_gcode", False, _("Keep G-code on Disk:"), _("Read the lines of loaded G-code files from disk when printing instead of keeping them in memory. Saves memory on large files, requires no viewer in Pronterface"), "UI"))
+        self._add(BooleanSetting("print_while_loading", False, _("Print While Loading:"), _("Allow starting a print while the G-code file is still being parsed, pronsole then loads files in the background. Lines are sent as soon as their layer is parsed, print time estimates are only complete once the file is loaded and the motion planner and line shortening of a file printed while loading run after the print"), "UI"))
+        self._add(SpinSetting("parse_workers", 1, 1, 64, _("G-code Parser Processes:"), _("Number of processes used to parse G-code files for the viewers, 1 parses them in a single thread. Files are parsed in a single thread when printing while loading"), "UI"))
+        self._add(SpinSetting("gcode_cache_size", 256, 0, 100000, _("G-code Cache Size:"), _("Disk space (MB) used to cache parsed G-code files so that reloading them is faster, 0 disables the cache"), "UI"))
+        self._add(DirSetting("job_directory", "", _("Job Directory:"), _("Directory of queued G-code files, indexed in the background from their slicer comments and listed by the jobs command. Empty disables the index"), "UI"), root.update_job_index)
+        self._add(BooleanSetting("job_index_parse", False, _("Parse Indexed Jobs:"), _("Also parse the files of the job directory, one at a time at low priority, to fill in what their slicer comments don't tell"), "UI"), root.update_job_index)
 
         self._add(HiddenSetting("project_offset_x", 0.0))
         self._add(HiddenSetting("project_offset_y", 0.0))
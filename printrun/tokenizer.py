@@ -0,0 +1,113 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Single-pass tokenizer for G-code lines and printer reports.
+
+A line is scanned once from left to right into tokens:
+
+- a word is a letter, optional blanks and a number made of an optional
+  sign, digits, an optional dot and digits (any part may be missing);
+- ``(...)`` (without nested parentheses) and ``;...`` are comments;
+- ``*`` followed by digits is the checksum;
+- any other character is skipped.
+
+The functions below are implemented by the compiled `gcoder_tokenizer`
+extension when it is built, and by the pure-Python code of this module
+otherwise. Both give the same results.
+"""
+
+import logging
+import re
+
+# Word letters are returned lowercase, comments and checksum are tagged
+# with their delimiter
+COMMENT_PAREN = "("
+COMMENT_SEMICOLON = ";"
+CHECKSUM = "*"
+
+token_exp = re.compile(r"\(([^\(\)]*)\)|;(.*)|\*([0-9]+)|"
+                       r"([a-zA-Z])\s*([-+]?[0-9]*\.?[0-9]*)")
+comment_exp = re.compile(r"\([^\(\)]*\)|;.*")
+_split_exps = {}
+_code_exps = {}
+_report_exps = {}
+
+def py_tokenize(line):
+    """Split `line` in (code, value) tokens.
+
+    Words give their lowercase letter and number, comments give "(" or ";"
+    and their text, and the checksum gives "*" and its digits.
+    """
+    tokens = []
+    for match in token_exp.finditer(line):
+        kind = match.lastindex
+        if kind >= 4:
+            tokens.append((match.group(4).lower(), match.group(5)))
+        elif kind == 1:
+            tokens.append((COMMENT_PAREN, match.group(1)))
+        elif kind == 2:
+            tokens.append((COMMENT_SEMICOLON, match.group(2)))
+        else:
+            tokens.append((CHECKSUM, match.group(3)))
+    return tokens
+
+def py_split(line, letters):
+    """Return the (letter, number) words of `line` whose lowercase letter is
+    in `letters`, with an empty ("", "") pair in place of each comment"""
+    exp = _split_exps.get(letters)
+    if exp is None:
+        exp = _split_exps[letters] = re.compile(
+            r"\([^\(\)]*\)|;.*|([%s])\s*([-+]?[0-9]*\.?[0-9]*)"
+            % re.escape(letters))
+    return exp.findall(line.lower())
+
+def py_find_code(line, letter):
+    """Return the number of the first word of `line` with `letter` (in any
+    case) outside comments, or None"""
+    exp = _code_exps.get(letter)
+    if exp is None:
+        exp = _code_exps[letter] = re.compile(
+            r"\([^\(\)]*\)|;.*|[%s]\s*([-+]?[0-9]*\.?[0-9]*)"
+            % re.escape(letter.lower() + letter.upper()))
+    for match in exp.finditer(line):
+        if match.lastindex:
+            return match.group(1)
+    return None
+
+def py_report_words(line, letters):
+    """Return the (letter, number) pairs of a printer report such as
+    "X:10.00 Y:20.00 Z:0.30", for the uppercase `letters` followed by an
+    optional colon"""
+    exp = _report_exps.get(letters)
+    if exp is None:
+        exp = _report_exps[letters] = re.compile(
+            r"\([^\(\)]*\)|([%s]):?([-+]?[0-9]*\.?[0-9]*)"
+            % re.escape(letters))
+    return [bit for bit in exp.findall(line) if bit[0]]
+
+def py_strip_comments(line):
+    """Remove the comments of `line`"""
+    return comment_exp.sub("", line)
+
+try:
+    from .gcoder_tokenizer import tokenize, split, find_code, report_words, \
+        strip_comments
+except ImportError as e:
+    logging.debug("Compiled G-code tokenizer unavailable: %s", e)
+    tokenize = py_tokenize
+    split = py_split
+    find_code = py_find_code
+    report_words = py_report_words
+    strip_comments = py_strip_comments
@@ -0,0 +1,253 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Shortest equivalent of the G-code lines sent to the printer.
+
+printcore sends each line without its comments, prefixed with its line
+number and followed by its checksum. `Transcoder.transcode` precomputes,
+in one pass over a parsed file, the line to send for each line of the
+file:
+
+- the numbers of G0-G3 moves lose their trailing zeros, their leading
+  zero ("0.50" is sent as ".5") and, in absolute millimeters, the
+  decimals beyond `decimals` (`e_decimals` for E); relative moves are
+  not rounded, as their rounding errors would add up;
+- F words repeating the feedrate of G1-G3 moves are dropped, and so are
+  the X, Y and Z words of G0/G1 moves repeating the position in absolute
+  positioning; the position and feedrate are forgotten after any command
+  that could change them behind our back (homing, tool change, ...);
+- lines left without effect, such as a G1 F to the current feedrate, are
+  not sent;
+- with `compact`, the spaces between words are removed, which not every
+  firmware accepts.
+
+Command words are always kept: most firmwares don't support implicit
+motion commands. The XOR checksum of each line is computed in the same
+pass, printcore only combines it with the one of the line number.
+
+When a print doesn't start from the first line, a line is replaced or a
+command that may move the head is sent while printing, the printer state
+may differ from the one of the file:
+printcore then sends trimmed lines, with all their words, up to the next
+line after which the transcoder knows nothing of the previous lines.
+"""
+
+import itertools
+import operator
+import re
+from array import array
+from functools import reduce
+
+from . import tokenizer
+
+# Lines made only of words, which can be rewritten word by word, and
+# their words; the moves written by slicers have one space between words
+# and none inside them
+number = r"[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)"
+word_exp = re.compile(r"([A-Z])\s*(%s)?\s*" % number)
+words_exp = re.compile(r"(?:[A-Z]\s*(?:%s)?\s*)+" % number)
+spaced_words_exp = re.compile(r"[A-Z](?:%s)?(?: [A-Z](?:%s)?)*"
+                              % (number, number))
+# Commands that change neither the position nor the feedrate
+KEEP_STATE = frozenset(("G4", "G90", "G91", "M82", "M83", "M104", "M105",
+                        "M106", "M107", "M109", "M140", "M190", "M141",
+                        "M191", "M117", "M73", "M201", "M203", "M204",
+                        "M205", "M220", "M221", "M300", "M400"))
+MOVES = {"G0": "G0", "G00": "G0", "G1": "G1", "G01": "G1",
+         "G2": "G2", "G02": "G2", "G3": "G3", "G03": "G3"}
+# Words rounded in absolute millimeters
+ROUNDED = ("X", "Y", "Z", "E", "F")
+
+def checksum(line):
+    """XOR checksum of the bytes sent for `line`. printcore sends the lines
+    in ASCII, other characters being replaced by "?", and computes the
+    checksums of all the lines sent with this function."""
+    return reduce(operator.xor, line.encode("ascii", "replace"), 0)
+
+def keeps_state(line):
+    """Whether the command `line`, sent between the lines of a file, leaves
+    the position and feedrate the transcoded lines rely on unchanged"""
+    words = tokenizer.strip_comments(line).split(None, 1)
+    return not words or words[0].upper() in KEEP_STATE
+
+def trim_number(value):
+    """Remove the sign, zeros and dot that don't change the number
+    `value`, without rounding it"""
+    if value[-1] not in "0." and value[0] not in "0+-":
+        return value
+    negative = value[0] == "-"
+    if negative or value[0] == "+":
+        value = value[1:]
+    if "." in value:
+        value = value.rstrip("0").rstrip(".")
+    value = value.lstrip("0")
+    if not value:
+        return "0"
+    return "-" + value if negative else value
+
+def format_number(value, decimals):
+    """Format the number `value` with at most `decimals` decimals"""
+    dot = value.find(".")
+    if dot < 0 or len(value) - dot - 1 <= decimals:
+        return trim_number(value)
+    return trim_number("%.*f" % (decimals, float(value)))
+
+class WireLines:
+    """The lines to send for each line of a G-code file, packed in one
+    buffer, with their checksums"""
+
+    def __init__(self, transcoder, lines, syncs):
+        self.transcoder = transcoder
+        self.data = "".join(lines).encode("ascii", "replace")
+        self.offsets = array('Q', itertools.accumulate(
+            map(len, lines), initial = 0))
+        self.checksums = array('B', map(checksum, lines))
+        # 1 for the lines from which nothing before them is relied on
+        self.syncs = syncs
+        # Size of the lines sent without and with transcoding, newlines
+        # included, excluding line numbers and checksums
+        self.bytes_before = 0
+        self.bytes_after = sum(len(line) + 1 for line in lines if line)
+
+    def __len__(self):
+        return len(self.checksums)
+
+    def __getitem__(self, i):
+        """Return the line to send for the line `i` of the file, "" if it
+        is not sent, and its checksum"""
+        return (self.data[self.offsets[i]:self.offsets[i + 1]].decode(),
+                self.checksums[i])
+
+    def trimmed(self, raw):
+        """Return the line to send for the raw line `raw` without relying on
+        the printer state, and its checksum"""
+        line = self.transcoder.encode(raw)
+        return line, checksum(line)
+
+class Transcoder:
+    """Precompute the lines to send for G-code files"""
+
+    def __init__(self, decimals = 3, e_decimals = 5, compact = False,
+                 drop_modal = True):
+        self.decimals = decimals
+        self.e_decimals = e_decimals
+        self.compact = compact
+        self.drop_modal = drop_modal
+
+    def encode(self, raw):
+        """Return the line to send for `raw`, only trimming its numbers"""
+        line = tokenizer.strip_comments(raw).strip()
+        words = self._words(line)
+        if words is None:
+            return line
+        return self._join([word[0] + trim_number(word[1:])
+                           if len(word) > 1 else word for word in words])
+
+    def _words(self, line):
+        """Return the uppercase words (letter and number) of the move
+        `line` with its command first, None if it is not a move made only
+        of words"""
+        if not line or line[0] not in "Gg":
+            return None
+        line = line.upper()
+        if line.count("G") > 1 or "N" in line:
+            return None
+        if spaced_words_exp.fullmatch(line):
+            words = line.split(" ")
+        elif words_exp.fullmatch(line):
+            words = [letter + value
+                     for letter, value in word_exp.findall(line)]
+        else:
+            return None
+        command = MOVES.get(words[0])
+        if command is None:
+            return None
+        words[0] = command
+        return words
+
+    def _join(self, words):
+        return ("" if self.compact else " ").join(words)
+
+    def transcode(self, gcode):
+        """Return the WireLines of the parsed `gcode`"""
+        lines = []
+        syncs = bytearray()
+        bytes_before = 0
+        decimals = self.decimals
+        e_decimals = self.e_decimals
+        drop_modal = self.drop_modal
+        relative = relative_e = imperial = False
+        # Position and feedrate last sent, None while unknown
+        position = {"X": None, "Y": None, "Z": None}
+        feed = None
+        strip_comments = tokenizer.strip_comments
+        for gline in gcode.lines:
+            stripped = strip_comments(gline.raw).strip()
+            if stripped:
+                bytes_before += len(stripped) + 1
+            syncs.append(feed is None and position["X"] is None
+                         and position["Y"] is None
+                         and position["Z"] is None)
+            words = self._words(stripped)
+            if words is None:
+                lines.append(stripped)
+                command = stripped.split(None, 1)[0].upper() \
+                    if stripped else ""
+                if command in ("G90", "G91"):
+                    relative = relative_e = command == "G91"
+                elif command in ("M82", "M83"):
+                    relative_e = command == "M83"
+                elif command in ("G20", "G21"):
+                    imperial = command == "G20"
+                if command and command not in KEEP_STATE:
+                    position = {"X": None, "Y": None, "Z": None}
+                    feed = None
+                continue
+            command = words[0]
+            linear = command in ("G0", "G1")
+            out = [command]
+            for word in words[1:]:
+                letter = word[0]
+                value = word[1:]
+                if not value:
+                    out.append(letter)
+                    continue
+                if imperial or letter not in ROUNDED \
+                        or (relative_e if letter == "E"
+                            else relative and letter != "F"):
+                    value = trim_number(value)
+                else:
+                    value = format_number(value, e_decimals if letter == "E"
+                                          else decimals)
+                if letter == "F":
+                    if command == "G0":
+                        # G0 may have its own feedrate
+                        feed = None
+                    elif drop_modal and value == feed:
+                        continue
+                    else:
+                        feed = value
+                elif letter in position and linear and not relative:
+                    if drop_modal and value == position[letter]:
+                        continue
+                    position[letter] = value
+                out.append(letter + value)
+            if not linear or relative:
+                # Only the end points of absolute linear moves are known
+                position = {"X": None, "Y": None, "Z": None}
+            lines.append(self._join(out) if len(out) > 1 else "")
+        wire = WireLines(self, lines, syncs)
+        wire.bytes_before = bytes_before
+        return wire
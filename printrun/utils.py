@@ -201,6 +201,27 @@ def format_time(timestamp):
 def format_duration(delta):
     return str(datetime.timedelta(seconds = int(delta)))
 
+duration_exp = re.compile(r"(?:([0-9.]+)h)?(?:([0-9.]+)m(?:in)?)?(?:([0-9.]+)s?)?$")
+
+def parse_duration(text):
+    """Return the number of seconds of a duration such as "2h10m", "90m",
+    "45s", "1:30:00" or "5400"""
+    text = text.strip().lower().replace(" ", "")
+    try:
+        if ":" in text:
+            seconds = 0.
+            for part in text.split(":"):
+                seconds = seconds * 60 + float(part)
+            return seconds
+        match = duration_exp.match(text)
+        if text and match:
+            hours, minutes, seconds = (float(value or 0)
+                                       for value in match.groups())
+            return hours * 3600 + minutes * 60 + seconds
+    except ValueError:
+        pass
+    raise ValueError("invalid duration: %r" % text)
+
 def prepare_command(command, replaces = None):
     command = shlex.split(command.replace("\\", "\\\\"))
     if replaces:
@@ -228,11 +249,19 @@ def dosify(name):
     return os.path.split(name)[1].split(".")[0][:8] + ".g"
 
 class RemainingTimeEstimator:
+    """Estimate the remaining print time at a given line.
+
+    When the G-code carries per-line estimated times (`GCode.elapsed`) the
+    estimate is the time left after the line, otherwise it is interpolated
+    within the current layer by line count. In both cases the estimate is
+    scaled by the drift between the measured and estimated print times of
+    the finished layers. `start` is the index the print started from.
+    """
 
     drift = None
     gcode = None
 
-    def __init__(self, gcode):
+    def __init__(self, gcode, start = 0):
         self.drift = 1
         self.previous_layers_estimate = 0
         self.current_layer_estimate = 0
@@ -240,13 +269,26 @@ class RemainingTimeEstimator:
         self.gcode = gcode
         self.last_idx = -1
         self.last_estimate = None
-        self.remaining_layers_estimate = sum(layer.duration for layer in gcode.all_layers)
+        elapsed = gcode.elapsed
+        self.timed = elapsed is not None and len(elapsed) > 0
+        if self.timed:
+            self.start_time = gcode.elapsed_time(start)
+            self.total_time = gcode.elapsed_time(len(gcode))
+        start_layer = gcode.idxs(start)[0] if start < len(gcode) else 0
+        self.remaining_layers_estimate = sum(
+            layer.duration for layer in gcode.all_layers[start_layer:])
         if len(gcode) > 0:
-            self.update_layer(0, 0)
+            self.update_layer(start_layer, 0)
 
     def update_layer(self, layer, printtime):
         self.previous_layers_estimate += self.current_layer_estimate
-        if self.previous_layers_estimate > 1. and printtime > 1.:
+        if self.timed:
+            # Time estimated from the start up to the start of the layer
+            estimated = self.gcode.elapsed_time(
+                self.gcode.layer_start(layer)) - self.start_time
+            if estimated > 1. and printtime > 1.:
+                self.drift = printtime / estimated
+        elif self.previous_layers_estimate > 1. and printtime > 1.:
             self.drift = printtime / self.previous_layers_estimate
         self.current_layer_estimate = self.gcode.all_layers[layer].duration
         self.current_layer_lines = len(self.gcode.all_layers[layer])
@@ -259,11 +301,14 @@ class RemainingTimeEstimator:
             return (0, 0)
         if idx == self.last_idx:
             return self.last_estimate
-        if idx >= len(self.gcode.layer_idxs):
+        if idx >= len(self.gcode):
             return self.last_estimate
-        layer, line = self.gcode.idxs(idx)
-        layer_progress = (1 - (float(line + 1) / self.current_layer_lines))
-        remaining = layer_progress * self.current_layer_estimate + self.remaining_layers_estimate
+        if self.timed:
+            remaining = self.total_time - self.gcode.elapsed_time(idx + 1)
+        else:
+            layer, line = self.gcode.idxs(idx)
+            layer_progress = (1 - (float(line + 1) / self.current_layer_lines))
+            remaining = layer_progress * self.current_layer_estimate + self.remaining_layers_estimate
         estimate = self.drift * remaining
         total = estimate + printtime
         self.last_idx = idx
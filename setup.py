@@ -58,7 +58,11 @@ def get_data_files():
 def get_extensions():
     extensions = [
         Extension(name="printrun.gcoder_line",
-                  sources=["printrun/gcoder_line.pyx"])
+                  sources=["printrun/gcoder_line.pyx"]),
+        Extension(name="printrun.gcoder_tokenizer",
+                  sources=["printrun/gcoder_tokenizer.pyx"]),
+        Extension(name="printrun.gcoder_preprocess",
+                  sources=["printrun/gcoder_preprocess.pyx"])
     ]
     return extensions
 
@@ -67,7 +71,8 @@ setup(
     version=get_version(),
     data_files=get_data_files(),
     packages=find_packages(),
-    scripts=["pronsole.py", "pronterface.py", "plater.py", "printcore.py"],
+    scripts=["pronsole.py", "pronterface.py", "plater.py", "printcore.py",
+             "printfarm.py"],
     ext_modules=get_extensions(),
     install_requires=get_install_requires(),
     zip_safe=False,
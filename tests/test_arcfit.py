@@ -0,0 +1,128 @@
+"""Test suite for `printrun/arcfit.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import math
+import unittest
+
+# Custom libraries:
+from printrun import arcfit
+from printrun import gcoder
+
+
+def arc_lines(segments=36, radius=10., sweep=math.pi, clockwise=False,
+              relative_e=False, e_per_mm=0.05):
+    """Return the G-code of an arc of `segments` extruding moves around
+    (50, 50), starting at (50 + radius, 50)"""
+    lines = ["G21", "G90", "M83" if relative_e else "M82", "G92 E0",
+             "G1 Z0.2 F600", "G1 X%.3f Y50 F3000" % (50 + radius)]
+    e = 0.
+    chord = 2 * radius * math.sin(sweep / segments / 2)
+    for k in range(1, segments + 1):
+        angle = sweep * k / segments * (-1 if clockwise else 1)
+        de = chord * e_per_mm
+        e += de
+        lines.append("G1 X%.3f Y%.3f E%.5f%s"
+                     % (50 + radius * math.cos(angle),
+                        50 + radius * math.sin(angle),
+                        de if relative_e else e,
+                        " F1800" if k == 1 else ""))
+    lines.append("G1 X0 Y0 F3000")
+    return lines
+
+
+class TestArcFitter(unittest.TestCase):
+    """Test the fitting of G1 moves to arcs"""
+
+    def assertSameResult(self, lines, fitted):
+        expected = gcoder.GCode(lines)
+        actual = gcoder.GCode(fitted)
+        self.assertAlmostEqual(expected.filament_length,
+                               actual.filament_length, places=4)
+        self.assertEqual(expected.current_pos, actual.current_pos)
+        self.assertEqual(len(expected.all_layers), len(actual.all_layers))
+
+    def test_arc(self):
+        """A polyline on a circle becomes one arc to the same end point"""
+        for clockwise in (False, True):
+            for relative_e in (False, True):
+                with self.subTest(clockwise=clockwise,
+                                  relative_e=relative_e):
+                    lines = arc_lines(clockwise=clockwise,
+                                      relative_e=relative_e)
+                    fitted, report = arcfit.ArcFitter().fit_lines(lines)
+                    arc = fitted[6]
+                    self.assertTrue(arc.startswith("G2 " if clockwise
+                                                   else "G3 "))
+                    self.assertIn(lines[-2].split()[1], arc)
+                    self.assertIn("I-10 J0", arc)
+                    self.assertTrue(arc.endswith("F1800"))
+                    self.assertEqual(fitted[7:], lines[-1:])
+                    self.assertEqual(report.arcs, 1)
+                    self.assertEqual(report.segments, 36)
+                    self.assertEqual(report.lines_saved, 35)
+                    self.assertGreater(report.bytes_saved, 0)
+                    self.assertSameResult(lines, fitted)
+
+    def test_tolerance(self):
+        """Points off the circle by more than the tolerance are kept"""
+        lines = arc_lines()
+        x = lines[20].split()[1]
+        lines[20] = lines[20].replace(x, "X%.3f" % (float(x[1:]) + 0.05))
+        fitted, report = arcfit.ArcFitter(tolerance=0.01).fit_lines(lines)
+        self.assertIn(lines[20], fitted)
+        self.assertEqual(report.arcs, 2)
+        self.assertSameResult(lines, fitted)
+        # The moved point also makes the extrusion of its moves uneven
+        fitted, report = arcfit.ArcFitter(
+            tolerance=0.1, extrusion_tolerance=0.2).fit_lines(lines)
+        self.assertEqual(report.arcs, 1)
+
+    def test_full_circle(self):
+        """A full circle, which G2/G3 can't express with the start point
+        as end point, is not replaced by a single arc"""
+        lines = arc_lines(segments=72, sweep=2 * math.pi)
+        fitted, report = arcfit.ArcFitter().fit_lines(lines)
+        self.assertEqual(report.arcs, 1)
+        self.assertEqual(report.segments, 71)
+        self.assertEqual(fitted[7], lines[-2])
+        self.assertSameResult(lines, fitted)
+
+    def test_kept_moves(self):
+        """Straight lines, uneven extrusion, travel and feedrate changes are
+        not fitted"""
+        straight = ["G90", "G92 E0", "G1 X0 Y0"] + \
+            ["G1 X%d Y0 E%d" % (k, k) for k in range(1, 10)]
+        uneven = arc_lines()
+        uneven[20] = uneven[20].replace(" E", " E1")
+        travel = [line.split(" E")[0] for line in arc_lines()]
+        feed = arc_lines()
+        feed[20] += " F1200"
+        for name, lines, arcs in (("straight", straight, 0),
+                                  ("uneven", uneven, 2),
+                                  ("travel", travel, 0),
+                                  ("feed", feed, 2)):
+            with self.subTest(name):
+                fitted, report = arcfit.ArcFitter().fit_lines(lines)
+                self.assertEqual(report.arcs, arcs)
+                if not arcs:
+                    self.assertEqual(fitted, lines)
+
+    def test_fit_gcode(self):
+        """fit() returns a parsed GCode of the same class"""
+        lines = arc_lines()
+        for cls in (gcoder.GCode, gcoder.LightGCode):
+            with self.subTest(cls=cls.__name__):
+                fitted, report = arcfit.ArcFitter().fit(cls(lines))
+                self.assertIs(type(fitted), cls)
+                self.assertEqual(len(fitted), len(lines) - 35)
+                self.assertEqual(report.lines_saved, 35)
+                for i, line in enumerate(fitted.lines):
+                    layer, index = fitted.idxs(i)
+                    self.assertEqual(fitted.all_layers[layer][index].raw,
+                                     line.raw)
+
+
+if __name__ == "__main__":
+    unittest.main()
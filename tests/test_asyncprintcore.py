@@ -0,0 +1,313 @@
+"""Test suite for `printrun/asyncprintcore.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import asyncio
+import os
+import threading
+import unittest
+from unittest import mock
+
+# Custom libraries:
+from printrun import asyncprintcore
+from printrun import device
+from printrun import eventhandler
+from printrun import gcoder
+from printrun import hostprotocol
+from printrun import transcoder
+
+
+class FakeFirmware:
+    """Printer answering each line with "ok", asking once to resend the
+    numbered lines of `corrupt`"""
+
+    def __init__(self, corrupt=(), silent=False):
+        self.corrupt = set(corrupt)
+        self.silent = silent
+        self.received = []
+        self.server = None
+        self.writers = []
+        self.tasks = []
+
+    def reply(self, line):
+        self.received.append(line)
+        if self.silent:
+            return ""
+        if line.startswith("N") and "*" in line:
+            number = int(line[1:].split()[0])
+            if number in self.corrupt:
+                self.corrupt.discard(number)
+                return f"Error:checksum mismatch\nResend: {number}\nok\n"
+        if "M105" in line:
+            return "ok T:210.0 /210.0 B:60.0 /60.0\n"
+        return "ok\n"
+
+    async def serve(self, reader, writer):
+        self.writers.append(writer)
+        self.tasks.append(asyncio.current_task())
+        while True:
+            data = await reader.readline()
+            if not data:
+                break
+            writer.write(self.reply(data.decode().strip()).encode())
+        writer.close()
+
+    async def start_server(self):
+        """Listen on a local TCP port and return its URL"""
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"127.0.0.1:{port}"
+
+    def open_pty(self, test):
+        """Answer on a pseudo-terminal and return its device name"""
+        master, slave = os.openpty()
+        loop = asyncio.get_running_loop()
+        buffer = b""
+
+        def readable():
+            nonlocal buffer
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                loop.remove_reader(master)
+                return
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                os.write(master, self.reply(line.decode().strip()).encode())
+
+        loop.add_reader(master, readable)
+        test.addCleanup(os.close, slave)
+        test.addCleanup(os.close, master)
+        test.addCleanup(loop.remove_reader, master)
+        return os.ttyname(slave)
+
+    async def close(self):
+        for writer in self.writers:
+            writer.close()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+def print_lines(count):
+    return gcoder.GCode([f"G1 X{i} Y{i % 7}" for i in range(count)])
+
+
+class TestAsyncPrintcore(unittest.IsolatedAsyncioTestCase):
+    """Drive printers from the event loop"""
+
+    async def asyncSetUp(self):
+        self.firmware = FakeFirmware()
+        self.addAsyncCleanup(self.firmware.close)
+        self.core = asyncprintcore.AsyncPrintcore()
+        self.addAsyncCleanup(self.core.disconnect)
+        self.handler = mock.create_autospec(
+            spec=eventhandler.PrinterEventHandler)
+        self.core.addEventHandler(self.handler)
+
+    async def connect(self, firmware=None):
+        firmware = firmware or self.firmware
+        await self.core.connect(await firmware.start_server(), timeout=5)
+
+    async def test_connect(self):
+        await self.connect()
+        self.assertTrue(self.core.online)
+        self.handler.on_connect.assert_called_once()
+        self.handler.on_online.assert_called_once()
+        self.assertEqual(self.firmware.received, ["M105"])
+
+    async def test_send_now_reply(self):
+        await self.connect()
+        temperatures = self.core.temperatures()
+        reply = await self.core.send_now("M105")
+        self.assertEqual(reply, "ok T:210.0 /210.0 B:60.0 /60.0")
+        report = await asyncio.wait_for(temperatures.__anext__(), 5)
+        self.assertEqual(report["T"], ("210.0", "210.0"))
+        self.handler.on_temp.assert_called()
+        await temperatures.aclose()
+
+    async def test_send_not_connected(self):
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNone(await self.core.send("G28"))
+        self.handler.on_error.assert_called_once()
+
+    async def test_lines(self):
+        await self.connect()
+        received = []
+
+        async def collect():
+            async for line in self.core.lines():
+                received.append(line)
+
+        collector = asyncio.ensure_future(collect())
+        await self.core.send("G28")
+        await self.core.disconnect()
+        await asyncio.wait_for(collector, 5)
+        self.assertEqual(received, ["ok"])
+        self.handler.on_disconnect.assert_called_once()
+
+    async def test_print(self):
+        await self.connect()
+        self.assertTrue(await self.core.startprint(print_lines(20)))
+        self.assertFalse(await self.core.startprint(print_lines(20)))
+        await asyncio.wait_for(self.core.wait_print(), 5)
+        self.assertFalse(self.core.printing)
+        # No checksums over TCP
+        self.assertEqual(self.firmware.received[1:3],
+                         ["M110 N-1", "G1 X0 Y0"])
+        self.assertEqual(self.firmware.received[-1], "M110 N-1")
+        self.assertEqual(len(self.firmware.received), 23)
+        self.handler.on_start.assert_called_once_with(False)
+        self.handler.on_end.assert_called_once()
+        self.assertEqual(self.handler.on_printsend.call_count, 20)
+
+    async def test_send_while_printing(self):
+        await self.connect()
+        await self.core.startprint(print_lines(5))
+        self.assertIsNone(await self.core.send("M400"))
+        await asyncio.wait_for(self.core.wait_print(), 5)
+        self.assertEqual(self.firmware.received[-2:], ["M400", "M110 N-1"])
+
+    async def test_pause_resume(self):
+        await self.connect()
+        self.firmware.silent = True
+        await self.core.startprint(print_lines(10))
+        await asyncio.sleep(0.1)
+        self.assertTrue(await self.core.pause())
+        self.assertFalse(self.core.printing)
+        self.assertTrue(self.core.paused)
+        self.handler.on_end.assert_called_once()
+        # Only the first line was sent, without its ok
+        self.assertEqual(self.firmware.received[1:], ["M110 N-1"])
+        self.firmware.silent = False
+        self.assertTrue(await self.core.resume())
+        self.assertFalse(await self.core.resume())
+        # The ok of M110 lets the restore commands and the print go
+        self.firmware.writers[0].write(b"ok\n")
+        await asyncio.wait_for(self.core.wait_print(), 5)
+        self.assertIn("G90", self.firmware.received)
+        self.assertEqual(self.firmware.received[-2:],
+                         ["G1 X9 Y2", "M110 N-1"])
+        self.handler.on_start.assert_called_with(True)
+
+    async def test_host_pause(self):
+        await self.connect()
+        gcode = gcoder.GCode(["G1 X1", ";@pause", "G1 X2"])
+        await self.core.startprint(gcode)
+        await asyncio.wait_for(self.core.wait_print(), 5)
+        self.assertTrue(self.core.paused)
+        self.assertEqual(self.firmware.received[-1], "G1 X1")
+
+    async def test_cancel(self):
+        await self.connect()
+        await self.core.startprint(print_lines(10))
+        await self.core.cancelprint()
+        self.assertFalse(self.core.paused)
+        self.assertIsNone(self.core.mainqueue)
+        self.assertEqual(await self.core.send_now("M114"), "ok")
+
+    async def test_disconnect_pending(self):
+        await self.connect()
+        self.firmware.silent = True
+        pending = asyncio.ensure_future(self.core.send_now("G28"))
+        await asyncio.sleep(0.1)
+        await self.core.disconnect()
+        with self.assertRaises(device.DeviceError):
+            await pending
+        self.assertFalse(self.core.online)
+
+    async def test_printer_closes(self):
+        await self.connect()
+        lines = self.core.lines()
+        with self.assertLogs(level="ERROR"):
+            await self.firmware.close()
+            with self.assertRaises(StopAsyncIteration):
+                await asyncio.wait_for(lines.__anext__(), 5)
+        self.assertFalse(self.core.online)
+        self.handler.on_disconnect.assert_called_once()
+
+    async def test_timeout(self):
+        self.firmware.silent = True
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.core.connect(await self.firmware.start_server(),
+                                    timeout=0.2)
+        self.assertFalse(self.core.online)
+
+    async def test_refused(self):
+        server = await asyncio.start_server(lambda *args: None,
+                                            "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+        with self.assertRaises(device.DeviceError):
+            await self.core.connect(f"127.0.0.1:{port}")
+
+    async def test_many_printers(self):
+        """One event loop drives many printers without threads"""
+        threads = threading.active_count()
+        firmwares = [FakeFirmware() for _ in range(20)]
+        cores = [asyncprintcore.AsyncPrintcore() for _ in firmwares]
+        for firmware, core in zip(firmwares, cores):
+            self.addAsyncCleanup(firmware.close)
+            self.addAsyncCleanup(core.disconnect)
+        ports = [await firmware.start_server() for firmware in firmwares]
+        await asyncio.gather(*(core.connect(port, timeout=5)
+                               for port, core in zip(ports, cores)))
+        for core in cores:
+            await core.startprint(print_lines(50))
+        self.assertEqual(threading.active_count(), threads)
+        await asyncio.wait_for(
+            asyncio.gather(*(core.wait_print() for core in cores)), 10)
+        for firmware in firmwares:
+            self.assertEqual(len(firmware.received), 53)
+
+
+@unittest.skipUnless(hasattr(os, "openpty"), "needs pseudo-terminals")
+class TestSerial(unittest.IsolatedAsyncioTestCase):
+    """Print over a serial port read from the event loop"""
+
+    async def test_resend(self):
+        self.enterContext(
+            mock.patch("printrun.device.Device._disable_ttyhup"))
+        firmware = FakeFirmware(corrupt=[3])
+        core = asyncprintcore.AsyncPrintcore()
+        self.addAsyncCleanup(core.disconnect)
+        await core.connect(firmware.open_pty(self), 115200, timeout=5)
+        await core.startprint(print_lines(6))
+        with self.assertLogs(level="ERROR"):
+            await asyncio.wait_for(core.wait_print(), 5)
+        numbered = [line for line in firmware.received
+                    if line.startswith("N")]
+        self.assertEqual([int(line[1:].split()[0]) for line in numbered],
+                         [0, 1, 2, 3, 3, 4, 5])
+        self.assertEqual(numbered[0], "N0 G1 X0 Y0*41")
+        await core.disconnect()
+        self.assertFalse(core.online)
+
+    async def test_wire_lines(self):
+        """Shortened lines are sent with their precomputed checksums and
+        resent as they were sent"""
+        self.enterContext(
+            mock.patch("printrun.device.Device._disable_ttyhup"))
+        firmware = FakeFirmware(corrupt=[2])
+        core = asyncprintcore.AsyncPrintcore()
+        self.addAsyncCleanup(core.disconnect)
+        await core.connect(firmware.open_pty(self), 115200, timeout=5)
+        gcode = gcoder.GCode(["G1 X1.000 Y1.000 F1800", "G1 X2.000 Y1.000",
+                              "G1 X3.000 Y1.000"])
+        gcode.wire_lines = transcoder.Transcoder().transcode(gcode)
+        await core.startprint(gcode)
+        with self.assertLogs(level="ERROR"):
+            await asyncio.wait_for(core.wait_print(), 5)
+        numbered = [line for line in firmware.received
+                    if line.startswith("N")]
+        self.assertEqual(numbered[1:], [
+            hostprotocol.numbered("G1 X2", 1),
+            hostprotocol.numbered("G1 X3", 2),
+            hostprotocol.numbered("G1 X3", 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+"""Test suite for `printrun/bgcode.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import datetime
+import io
+import json
+import os
+import random
+import tempfile
+import unittest
+
+# Custom libraries:
+from printrun import bgcode
+from printrun import compressed
+from printrun import gcoder
+
+
+LINES = ["; generated by test", "G21", "G90", "M82", "M104 S200",
+         "G28 X Y", "G1 Z0.2 F3000", "G1 X10.5 Y20 E0.12345 F1800",
+         "G1 X20 Y20 E1.5 ; perimeter", "G2 X25 Y25 I5 J0 E2",
+         "M117 Hello world", "G1X30Y30E3", "G92 E0", "G1 Z0.4",
+         "G1 X10 Y10 E1"]
+
+
+def write(filename, lines, **kwargs):
+    """Write `lines` to the binary G-code file `filename`"""
+    with bgcode.Writer(filename, **kwargs) as writer:
+        for line in lines:
+            writer.write(line + "\n")
+
+
+class TestHeatshrink(unittest.TestCase):
+    """Test the pure Python heatshrink codec"""
+
+    def test_round_trip(self):
+        rng = random.Random(1)
+        samples = [b"", b"G", b"G1 X1\n" * 100, bytes(300),
+                   bytes(rng.randrange(256) for _ in range(5000)),
+                   "\n".join(LINES * 50).encode()]
+        for window, lookahead in bgcode.HEATSHRINK_PARAMETERS.values():
+            for data in samples:
+                with self.subTest(window=window, size=len(data)):
+                    packed = bgcode.heatshrink_compress(data, window,
+                                                        lookahead)
+                    self.assertEqual(bgcode.heatshrink_decompress(
+                        packed, window, lookahead), data)
+        self.assertLess(len(bgcode.heatshrink_compress(samples[2], 12, 4)),
+                        len(samples[2]) // 4)
+
+    def test_backrefs(self):
+        """Overlapping backrefs repeat the output, backrefs before its start
+        read zeros"""
+        # Literal "a", then 4 bytes from 1 byte back, then 2 bytes from 8
+        # bytes back in the zero filled window
+        bits = "1" + "01100001" + "0" + format(0, "012b") + format(3, "04b") \
+            + "0" + format(7, "012b") + format(1, "04b")
+        bits += "0" * (-len(bits) % 8)
+        data = int(bits, 2).to_bytes(len(bits) // 8, "big")
+        self.assertEqual(bgcode.heatshrink_decompress(data, 12, 4),
+                         b"aaaaa" + bytes(2))
+
+
+class TestSpaces(unittest.TestCase):
+    """Test the spaces left out by MeatPack"""
+
+    def test_insert_spaces(self):
+        self.assertEqual(bgcode.insert_spaces(b"G1X1Y2E.5F1800\nM117 AXE\n"
+                                              b"G28XY;comment X\n"),
+                         b"G1 X1 Y2 E.5 F1800\nM117 AXE\nG28 X Y;comment X\n")
+
+    def test_remove_spaces(self):
+        text = b"G1 X1 Y2 E.5\nM117 A X\nG1 X1 ; a comment Y\nG4  P1\n"
+        self.assertEqual(bgcode.remove_spaces(text),
+                         b"G1X1Y2E.5\nM117 A X\nG1X1 ; a comment Y\nG4  P1\n")
+        self.assertEqual(bgcode.insert_spaces(bgcode.remove_spaces(text)),
+                         text)
+
+
+class TestFiles(unittest.TestCase):
+    """Test writing and reading binary G-code files"""
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".bgcode")
+        os.close(handle)
+        self.addCleanup(os.remove, self.filename)
+
+    def read_text(self):
+        with compressed.open_gcode(self.filename) as f:
+            return f.read()
+
+    def test_round_trip(self):
+        """The text is read back as written with every encoding and
+        compression, across several G-code blocks"""
+        lines = LINES * 2000
+        expected = "".join(line + "\n" for line in lines)
+        for compression in (bgcode.COMPRESSION_NONE, bgcode.DEFLATE,
+                            bgcode.HEATSHRINK_11_4, bgcode.HEATSHRINK_12_4):
+            for encoding in (bgcode.ENCODING_NONE, bgcode.MEATPACK_COMMENTS):
+                with self.subTest(compression=compression, encoding=encoding):
+                    write(self.filename, lines, compression=compression,
+                          encoding=encoding)
+                    self.assertEqual(compressed.compression(self.filename),
+                                     "bgcode")
+                    text = self.read_text()
+                    if encoding == bgcode.ENCODING_NONE:
+                        self.assertEqual(text, expected)
+                    else:
+                        # Spaces are put back in lines written without them
+                        self.assertEqual(text, expected.replace(
+                            "G1X30Y30E3", "G1 X30 Y30 E3"))
+
+    def test_meatpack_without_comments(self):
+        write(self.filename, LINES, encoding=bgcode.MEATPACK)
+        self.assertEqual(self.read_text().splitlines()[:3],
+                         ["G21", "G90", "M82"])
+        self.assertIn("G1 X20 Y20 E1.5\n", self.read_text())
+
+    def test_last_line(self):
+        """A last line without newline is read, MeatPack ends it"""
+        for encoding, text in ((bgcode.ENCODING_NONE, "G1 X1\nG1X2"),
+                               (bgcode.MEATPACK_COMMENTS, "G1 X1\nG1 X2\n")):
+            with bgcode.Writer(self.filename, encoding=encoding) as writer:
+                writer.write("G1 X1\nG1X2")
+            self.assertEqual(self.read_text(), text)
+
+    def test_parse(self):
+        write(self.filename, LINES)
+        with compressed.open_gcode(self.filename) as f:
+            gcode = gcoder.GCode(f)
+        self.assertEqual(len(gcode), len(LINES))
+        self.assertEqual(gcode.xmax, 30)
+
+    def test_seekable_reader(self):
+        write(self.filename, LINES * 100)
+        reader = compressed.SeekableReader(self.filename,
+                                           checkpoint_interval=100)
+        self.addCleanup(reader.close)
+        text = self.read_text().encode()
+        size = len(text) // 100
+        self.assertEqual(reader[size:size + 4], b"; ge")
+        self.assertEqual(reader[len(text) - 7:len(text) + 10], b"Y10 E1\n")
+        self.assertEqual(reader[0:3], b"; g")
+
+    def test_checksum(self):
+        """Corrupted blocks are detected"""
+        write(self.filename, LINES)
+        with open(self.filename, "r+b") as f:
+            f.seek(-10, io.SEEK_END)
+            byte = f.read(1)
+            f.seek(-10, io.SEEK_END)
+            f.write(bytes((byte[0] ^ 0xFF,)))
+        with self.assertRaises(ValueError):
+            self.read_text()
+
+    def test_bad_header(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"GCDE" + bytes((2, 0, 0, 0, 1, 0)))
+        with self.assertRaises(ValueError):
+            self.read_text()
+        with self.assertRaises(ValueError):
+            bgcode.read_metadata(self.filename)
+
+    def test_truncated(self):
+        write(self.filename, LINES)
+        with open(self.filename, "r+b") as f:
+            f.truncate(os.path.getsize(self.filename) - 3)
+        with self.assertRaises(ValueError):
+            self.read_text()
+
+
+class TestMetadata(unittest.TestCase):
+    """Test the metadata read without parsing the G-code"""
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".bgcode")
+        os.close(handle)
+        self.addCleanup(os.remove, self.filename)
+
+    def test_durations(self):
+        self.assertEqual(bgcode.parse_duration("1d 2h 3m 4s"),
+                         datetime.timedelta(days=1, hours=2, minutes=3,
+                                            seconds=4))
+        self.assertEqual(bgcode.parse_duration("45s"),
+                         datetime.timedelta(seconds=45))
+        self.assertIsNone(bgcode.parse_duration("unknown"))
+        for seconds in (0, 45, 3600, 93784):
+            duration = datetime.timedelta(seconds=seconds)
+            self.assertEqual(bgcode.parse_duration(
+                bgcode.format_duration(duration)), duration)
+
+    def test_read_metadata(self):
+        """Slicer metadata fills the filament length, duration and
+        dimensions"""
+        objects = {"objects": [{"name": "a", "polygon": [[10, 20], [30, 20],
+                                                         [30, 45]]},
+                               {"name": "b", "polygon": [[50, 5], [60, 7]]}]}
+        printer = {"printer_model": "MK4", "max_layer_z": "12.40",
+                   "objects_info": json.dumps(objects)}
+        print_ = {"filament used [mm]": "1000.50, 200.25",
+                  "estimated printing time (normal mode)": "1h 2m 3s"}
+        thumbnail = bgcode.Thumbnail(bgcode.PNG, 16, 16, b"\x89PNG...")
+        write(self.filename, LINES, thumbnails=[thumbnail],
+              metadata={bgcode.PRINTER_METADATA: printer,
+                        bgcode.PRINT_METADATA: print_})
+        metadata = bgcode.read_metadata(self.filename)
+        self.assertEqual(metadata.printer["printer_model"], "MK4")
+        self.assertEqual(metadata.file["Producer"], "Printrun")
+        self.assertEqual(metadata.thumbnails, [thumbnail])
+        self.assertEqual(metadata.filament_lengths, [1000.5, 200.25])
+        self.assertEqual(metadata.bounds, (10, 60, 5, 45, 0, 12.4))
+        gcode = gcoder.GCode()
+        metadata.apply(gcode)
+        self.assertEqual(gcode.filament_length, 1200.75)
+        self.assertEqual(gcode.duration, datetime.timedelta(seconds=3723))
+        self.assertEqual((gcode.width, gcode.depth, gcode.height),
+                         (50, 40, 12.4))
+
+    def test_export(self):
+        """Exported files carry the metadata of the parsed G-code"""
+        gcode = gcoder.GCode(LINES)
+        bgcode.export(gcode, self.filename)
+        metadata = bgcode.read_metadata(self.filename)
+        self.assertAlmostEqual(metadata.filament_length,
+                               gcode.filament_length, places=2)
+        self.assertEqual(metadata.duration, gcode.duration)
+        self.assertAlmostEqual(metadata.bounds[5], gcode.zmax, places=2)
+        with compressed.open_gcode(self.filename) as f:
+            self.assertEqual(f.read().splitlines()[1:3], ["G21", "G90"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Test suite for `printrun/compressed.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import gzip
+import lzma
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Custom libraries:
+from printrun import compressed
+from printrun import gcoder
+
+TESTFILES = sorted(
+    (pathlib.Path(__file__).parent.parent / "testfiles").glob("*.gcode"))
+
+COMPRESS = {
+    "gzip": gzip.compress,
+    "xz": lzma.compress,
+}
+
+
+class TestCompressed(unittest.TestCase):
+    """Read compressed G-code files"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.data = TESTFILES[0].read_bytes()
+
+    def write(self, name, data):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
+    def test_detect(self):
+        """Formats are recognized by their first bytes"""
+        for name, compress in COMPRESS.items():
+            with self.subTest(format=name):
+                filename = self.write("file.gcode", compress(self.data))
+                self.assertEqual(compressed.compression(filename), name)
+        self.assertIsNone(compressed.compression(TESTFILES[0]))
+
+    def test_open_gcode(self):
+        """Compressed files read as the plain file"""
+        with open(TESTFILES[0], encoding="utf-8") as f:
+            expected = f.readlines()
+        for name, compress in COMPRESS.items():
+            with self.subTest(format=name):
+                filename = self.write("file.gcode.gz", compress(self.data))
+                with compressed.open_gcode(filename) as f:
+                    self.assertEqual(f.readlines(), expected)
+        with compressed.open_gcode(TESTFILES[0]) as f:
+            self.assertEqual(f.readlines(), expected)
+
+    def test_concatenated(self):
+        """Concatenated members are read one after the other"""
+        half = len(self.data) // 2
+        for name, compress in COMPRESS.items():
+            with self.subTest(format=name):
+                filename = self.write(
+                    "file.gcode",
+                    compress(self.data[:half]) + compress(self.data[half:]))
+                with compressed.open_binary(filename) as f:
+                    self.assertEqual(f.read(), self.data)
+
+    def test_parse(self):
+        """Parsing a compressed file gives the same lines and layers"""
+        with open(TESTFILES[0], encoding="utf-8") as f:
+            expected = gcoder.LightGCode(f)
+        filename = self.write("file.gcode.gz", gzip.compress(self.data))
+        with compressed.open_gcode(filename) as f:
+            actual = gcoder.LightGCode(f)
+        self.assertEqual([line.raw for line in actual],
+                         [line.raw for line in expected])
+        self.assertEqual(actual.layer_offsets, expected.layer_offsets)
+
+    def test_seekable_reader(self):
+        """Random reads give the decompressed bytes"""
+        data = self.data * 20
+        # Take checkpoints even in small files
+        patcher = mock.patch.object(compressed, "CHUNK_SIZE", 256)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name, compress in COMPRESS.items():
+            with self.subTest(format=name):
+                filename = self.write("file.gcode", compress(data))
+                reader = compressed.SeekableReader(filename,
+                                                   checkpoint_interval=4096)
+                self.addCleanup(reader.close)
+                size = len(data)
+                for start in (size // 2, 10, size - 20, size // 3, 0,
+                              size - 5):
+                    self.assertEqual(reader[start:start + 100],
+                                     data[start:start + 100])
+                if name == "gzip":
+                    self.assertGreater(len(reader._checkpoints), 1)
+
+    def test_not_compressed(self):
+        """The seekable reader only reads compressed files"""
+        with self.assertRaises(ValueError):
+            compressed.SeekableReader(TESTFILES[0])
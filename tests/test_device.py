@@ -13,6 +13,7 @@ import serial
 # Custom libraries:
 # pylint: disable-next=no-name-in-module
 from printrun import device
+from printrun import meatpack
 
 
 def mock_sttyhup(cls):
@@ -359,6 +360,25 @@ class TestWriteSerial(unittest.TestCase):
         dev.write("test")
         mocked_serial.return_value.write.assert_called_once_with("test")
 
+    def test_meatpack(self):
+        """Lines are packed between MeatPack enable and disable commands"""
+        dev, mocked_serial = self._setup_serial_write()
+        write = mocked_serial.return_value.write
+        dev.meatpack_command(meatpack.ENABLE_PACKING)
+        dev.write(b"G1 X0\n")
+        dev.meatpack_command(meatpack.DISABLE_PACKING)
+        dev.write(b"G1 X0\n")
+        self.assertEqual(
+            write.mock_calls,
+            [mock.call(meatpack.command(meatpack.ENABLE_PACKING)),
+             mock.call(bytes((0x1d, 0xeb, 0xc0))),
+             mock.call(meatpack.command(meatpack.DISABLE_PACKING)),
+             mock.call(b"G1 X0\n")])
+        # Packing stops on reconnection
+        dev.meatpack_command(meatpack.ENABLE_PACKING)
+        dev.connect()
+        self.assertIsNone(dev.meatpack)
+
     def test_write_serial_error(self):
         """DeviceError is raised on serial error during writing"""
         dev, _ = self._setup_serial_write(serial.SerialException)
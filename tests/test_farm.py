@@ -0,0 +1,261 @@
+"""Test suite for `printrun/farm.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import asyncio
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+# Custom libraries:
+from printrun import eventhandler
+from printrun import farm
+
+
+class Firmware:
+    """Printer answering each line with "ok" over a local TCP port"""
+
+    def __init__(self):
+        self.received = []
+        self.server = None
+        self.tasks = []
+        self.writers = []
+
+    async def serve(self, reader, writer):
+        self.tasks.append(asyncio.current_task())
+        self.writers.append(writer)
+        while True:
+            data = await reader.readline()
+            if not data:
+                break
+            line = data.decode().strip()
+            self.received.append(line)
+            if "M105" in line:
+                writer.write(b"ok T:200.0 /210.0 B:60.0 /60.0\n")
+            else:
+                writer.write(b"ok\n")
+        writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        return "127.0.0.1:%d" % self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+
+def write_gcode(test, count):
+    """Write a G-code file of `count` moves and return its name"""
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    filename = os.path.join(directory.name, "part.gcode")
+    with open(filename, "w") as f:
+        f.write("".join("G1 X%d Y%d\n" % (i, i % 7) for i in range(count)))
+    return filename
+
+
+class TestCallQueue(unittest.TestCase):
+    """Run the hooks of each printer in order on a bounded pool"""
+
+    def test_order_and_bound(self):
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        queues = [farm.CallQueue(executor) for _ in range(4)]
+        calls = [[] for _ in queues]
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def call(printer, index):
+            with lock:
+                running.append(printer)
+                most.append(len(running))
+            time.sleep(0.0001)
+            calls[printer].append(index)
+            with lock:
+                running.remove(printer)
+
+        for index in range(300):
+            for printer, queue in enumerate(queues):
+                queue.submit(call, printer, index)
+        executor.shutdown(wait=True)
+        for printer_calls in calls:
+            self.assertEqual(printer_calls, list(range(300)))
+        self.assertLessEqual(max(most), 2)
+
+    def test_handler_errors(self):
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        queue = farm.CallQueue(executor)
+        results = []
+        with self.assertLogs(level="ERROR"):
+            queue.submit(lambda: 1 / 0)
+            queue.submit(results.append, 1)
+            executor.shutdown(wait=True)
+        self.assertEqual(results, [1])
+
+
+class TestFarm(unittest.IsolatedAsyncioTestCase):
+    """Drive several printers from one event loop"""
+
+    async def asyncSetUp(self):
+        self.farm = farm.Farm(workers=2, poll_interval=0, connect_timeout=5)
+        self.firmwares = {}
+        for name in ("left", "right"):
+            firmware = Firmware()
+            self.addAsyncCleanup(firmware.close)
+            self.farm.add(name, await firmware.start())
+            self.firmwares[name] = firmware
+        self.addAsyncCleanup(self.farm.close)
+        self.printers = self.farm.select(["all"])
+        await asyncio.gather(*(self.farm.connect(printer)
+                               for printer in self.printers))
+
+    async def wait_prints(self):
+        await asyncio.wait_for(asyncio.gather(
+            *(printer.core.wait_print() for printer in self.printers)), 5)
+
+    async def test_shared_gcode(self):
+        filename = write_gcode(self, 30)
+        with mock.patch.object(self.farm, "_parse",
+                               wraps=self.farm._parse) as parse:
+            started = await asyncio.gather(
+                *(self.farm.startprint(printer, filename)
+                  for printer in self.printers))
+        self.assertEqual(started, [True, True])
+        parse.assert_called_once()
+        left, right = self.printers
+        self.assertIs(left.core.mainqueue, right.core.mainqueue)
+        await self.wait_prints()
+        for firmware in self.firmwares.values():
+            self.assertEqual(len(firmware.received), 33)
+            self.assertEqual(firmware.received[2], "G1 X0 Y0")
+
+    async def test_changed_file(self):
+        filename = write_gcode(self, 3)
+        gcode = await self.farm.load(filename)
+        self.assertIs(await self.farm.load(filename), gcode)
+        with open(filename, "a") as f:
+            f.write("G1 X100\n")
+        self.assertEqual(len(await self.farm.load(filename)), 4)
+
+    async def test_pooled_handler(self):
+        threads = []
+        handler = mock.create_autospec(
+            spec=eventhandler.PrinterEventHandler)
+        handler.on_recv.side_effect = \
+            lambda line: threads.append(threading.current_thread().name)
+        self.farm.addEventHandler("left", handler)
+        left = self.printers[0]
+        for i in range(5):
+            await self.farm.send(left, "M400")
+        self.farm.executor.shutdown(wait=True)
+        self.assertEqual(handler.on_send.call_count, 5)
+        self.assertEqual(handler.on_recv.call_count, 5)
+        self.assertTrue(all(name.startswith("farm worker")
+                            for name in threads))
+
+    async def test_poll(self):
+        self.farm.poll_interval = 0.01
+        left = self.printers[0]
+        await self.farm.disconnect(left)
+        await self.farm.connect(left)
+        for i in range(200):
+            if left.temperatures:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(left.temperatures["T"], ("200.0", "210.0"))
+
+    async def test_names(self):
+        with self.assertRaises(ValueError):
+            self.farm.add("left", "127.0.0.1:1")
+        with self.assertRaises(ValueError):
+            self.farm.add("all", "127.0.0.1:1")
+        with self.assertRaises(KeyError):
+            self.farm.select(["left", "middle"])
+        await self.farm.remove("right")
+        self.assertEqual(list(self.farm.printers), ["left"])
+        self.assertFalse(self.printers[1].core.online)
+
+
+class TestFarmShell(unittest.TestCase):
+    """Control the farm with commands addressed by printer name"""
+
+    def setUp(self):
+        self.shell = farm.FarmShell(farm.Farm(workers=2, poll_interval=0))
+        self.addCleanup(self.shell.close)
+        self.firmwares = []
+        for name in ("left", "right"):
+            firmware = Firmware()
+            self.addCleanup(self.close_firmware, firmware)
+            self.firmwares.append(firmware)
+            port = self.shell.call(firmware.start)
+            self.shell.onecmd("add %s %s" % (name, port))
+        self.addCleanup(self.close_farm)
+
+    def close_farm(self):
+        if not self.shell.loop.is_closed():
+            self.shell.call(self.shell.farm.close)
+
+    def close_firmware(self, firmware):
+        if not self.shell.loop.is_closed():
+            self.shell.call(firmware.close)
+
+    def command(self, line):
+        with self.assertLogs() as logs:
+            self.shell.onecmd(line)
+        return [record.getMessage() for record in logs.records]
+
+    def test_print(self):
+        messages = self.command("connect all")
+        self.assertIn("[left] Printer is now online.", messages)
+        filename = write_gcode(self, 20)
+        messages = self.command("print left,right " + filename)
+        self.assertIn("[right] Printing " + filename, messages)
+        for printer in self.shell.farm.printers.values():
+            asyncio.run_coroutine_threadsafe(printer.core.wait_print(),
+                                             self.shell.loop).result(5)
+        self.assertEqual(len(self.firmwares[0].received), 23)
+        self.assertEqual(len(self.firmwares[1].received), 23)
+        self.assertEqual(self.command("status"),
+                         ["left %s online" % self.shell.farm.printers[
+                             "left"].core.port,
+                          "right %s online" % self.shell.farm.printers[
+                              "right"].core.port])
+
+    def test_send(self):
+        self.command("connect left")
+        self.assertEqual(self.command("send left M105"),
+                         ["[left] ok T:200.0 /210.0 B:60.0 /60.0"])
+        self.assertIn("T:200.0/210.0", self.command("status")[0])
+        self.assertEqual(self.firmwares[1].received, [])
+
+    def test_errors(self):
+        self.assertEqual(self.command("pause middle"),
+                         ["Unknown printer: middle"])
+        self.assertEqual(self.command("pause left"),
+                         ["[left] Not printing, cannot pause."])
+        self.assertEqual(self.command("print left"),
+                         ["No file name given."])
+        self.assertEqual(self.command("add left 127.0.0.1:1"),
+                         ["Printer left already exists"])
+
+    def test_exit(self):
+        self.command("connect all")
+        self.shell.onecmd("disconnect all")
+        for firmware in self.firmwares:
+            self.close_firmware(firmware)
+        self.assertTrue(self.shell.onecmd("exit"))
+        self.assertTrue(self.shell.loop.is_closed())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""Test suite for `printrun/fileinfo.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import base64
+import datetime
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+# Custom libraries:
+from printrun import bgcode
+from printrun import fileinfo
+from printrun import gcoder
+
+
+MOVES = "".join("G1 X%d Y%d E%d\n" % (i % 100, i % 50, i)
+                for i in range(20000))
+
+PRUSASLICER = """; generated by PrusaSlicer 2.6.1+linux-x64-GTK3 on 2023-10-01 at 10:00:00 UTC
+
+;
+; thumbnail begin 16x16 %(length)d
+%(thumbnail)s
+; thumbnail end
+;
+
+M486 S0 ACube
+; printing object Cube id:0 copy 0
+%(moves)s; stop printing object Cube id:0 copy 0
+EXCLUDE_OBJECT_DEFINE NAME=Cylinder_id_1 CENTER=10,10
+; filament used [mm] = 1234.56, 78.90
+; filament used [g] = 3.70
+; estimated printing time (normal mode) = 1h 2m 3s
+; total layers count = 120
+
+; prusaslicer_config = begin
+; layer_height = 0.15
+; prusaslicer_config = end
+"""
+
+CURA = """;FLAVOR:Marlin
+;TIME:5025
+;Filament used: 2.5m, 0.5m
+;Layer height: 0.2
+;MINX:10
+;MAXZ:24.2
+;Generated with Cura_SteamEngine 5.4.0
+;LAYER_COUNT:121
+;MESH:bunny.stl
+%(moves)s;MESH:NONMESH
+;MESH:cube.stl
+;TIME_ELAPSED:5025.0
+"""
+
+SIMPLIFY3D = """; G-Code generated by Simplify3D(R) Version 4.1.2
+;   layerHeight,0.25
+%(moves)s; Build Summary
+;   Build time: 2 hours 5 minutes
+;   Filament length: 4567.8 mm (4.57 m)
+"""
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+
+
+def thumbnail_comments(data):
+    """Return the comment lines of the thumbnail `data` and their size"""
+    text = base64.b64encode(data).decode()
+    lines = ["; " + text[i:i + 78] for i in range(0, len(text), 78)]
+    return "\n".join(lines), len(text)
+
+
+class TestProbe(unittest.TestCase):
+    """Test reading what slicers tell of their files"""
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".gcode")
+        os.close(handle)
+        self.addCleanup(os.remove, self.filename)
+
+    def write(self, text, opener=open):
+        with opener(self.filename, "wt") as f:
+            f.write(text)
+
+    def test_prusaslicer(self):
+        comments, length = thumbnail_comments(PNG)
+        self.write(PRUSASLICER % {"moves": MOVES, "thumbnail": comments,
+                                  "length": length})
+        self.assertGreater(os.path.getsize(self.filename),
+                           2 * fileinfo.PROBE_SIZE)
+        info = fileinfo.probe(self.filename)
+        self.assertEqual(info.slicer, "PrusaSlicer 2.6.1+linux-x64-GTK3")
+        self.assertEqual(info.duration, datetime.timedelta(seconds=3723))
+        self.assertEqual(info.filament_lengths, [1234.56, 78.9])
+        self.assertAlmostEqual(info.filament_length, 1313.46)
+        self.assertEqual(info.layer_count, 120)
+        self.assertEqual(info.layer_height, 0.15)
+        self.assertEqual(info.objects, ["Cube", "Cylinder_id_1"])
+        self.assertEqual(info.thumbnails,
+                         [bgcode.Thumbnail(bgcode.PNG, 16, 16, PNG)])
+
+    def test_cura(self):
+        self.write(CURA % {"moves": MOVES})
+        info = fileinfo.probe(self.filename)
+        self.assertEqual(info.slicer, "Cura_SteamEngine 5.4.0")
+        self.assertEqual(info.duration, datetime.timedelta(seconds=5025))
+        self.assertEqual(info.filament_lengths, [2500, 500])
+        self.assertEqual((info.layer_height, info.layer_count, info.height),
+                         (0.2, 121, 24.2))
+        self.assertEqual(info.objects, ["bunny.stl", "cube.stl"])
+
+    def test_simplify3d(self):
+        self.write(SIMPLIFY3D % {"moves": MOVES})
+        info = fileinfo.probe(self.filename)
+        self.assertEqual(info.slicer, "Simplify3D(R) Version 4.1.2")
+        self.assertEqual(info.duration, datetime.timedelta(hours=2,
+                                                           minutes=5))
+        self.assertEqual(info.filament_lengths, [4567.8])
+        self.assertEqual(info.layer_height, 0.25)
+
+    def test_large_thumbnail(self):
+        """Thumbnails going past the first bytes read are read whole"""
+        data = os.urandom(3 * fileinfo.PROBE_SIZE)
+        comments, length = thumbnail_comments(data)
+        self.write(PRUSASLICER % {"moves": MOVES, "thumbnail": comments,
+                                  "length": length})
+        self.assertEqual(fileinfo.probe(self.filename).thumbnails[0].data,
+                         data)
+
+    def test_small_file(self):
+        self.write("; generated by Slic3r 1.3.0 on 2020-01-01\nG1 X1\n"
+                   "; filament used = 12.5mm (0.1cm3)\n"
+                   "; filament used [mm] = 12.5\n")
+        info = fileinfo.probe(self.filename)
+        self.assertEqual(info.slicer, "Slic3r 1.3.0")
+        self.assertEqual(info.filament_lengths, [12.5])
+        self.assertIsNone(info.duration)
+
+    def test_unknown(self):
+        self.write(MOVES)
+        info = fileinfo.probe(self.filename)
+        self.assertIsNone(info.slicer)
+        self.assertIsNone(info.filament_length)
+        self.assertEqual((info.objects, info.thumbnails), ([], []))
+
+    def test_compressed(self):
+        """Only the start of compressed files is read"""
+        self.write(CURA % {"moves": MOVES}, gzip.open)
+        info = fileinfo.probe(self.filename)
+        self.assertEqual(info.duration, datetime.timedelta(seconds=5025))
+        self.assertEqual(info.objects, ["bunny.stl"])
+
+    def test_bgcode(self):
+        objects = {"objects": [{"name": "Cube", "polygon": [[0, 0], [1, 1]]}]}
+        metadata = {"filament used [mm]": "100.5",
+                    "estimated printing time (normal mode)": "10m 5s",
+                    "layer_height": "0.2", "max_layer_z": "5.00",
+                    "objects_info": json.dumps(objects)}
+        bgcode.export(gcoder.GCode(["G1 X1 E1"]), self.filename,
+                      metadata={bgcode.PRINTER_METADATA: metadata})
+        info = fileinfo.probe(self.filename)
+        self.assertEqual(info.slicer, "Printrun")
+        self.assertEqual(info.duration, datetime.timedelta(seconds=605))
+        self.assertEqual(info.filament_lengths, [100.5])
+        self.assertEqual((info.layer_height, info.height), (0.2, 5.0))
+        self.assertEqual(info.objects, ["Cube"])
+
+    def test_apply(self):
+        self.write(CURA % {"moves": MOVES})
+        gcode = gcoder.GCode()
+        fileinfo.probe(self.filename).apply(gcode)
+        self.assertEqual(gcode.filament_length, 3000)
+        self.assertEqual(gcode.duration, datetime.timedelta(seconds=5025))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Test suite for `printrun/gcodecache.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import lzma
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Custom libraries:
+from printrun import compressed
+from printrun import gcoder
+from printrun.gcodecache import GCodeCache
+from printrun.mappedgcode import MappedGCode
+
+TESTFILES = sorted(
+    (pathlib.Path(__file__).parent.parent / "testfiles").glob("*.gcode"))
+
+GCODE_ATTRIBUTES = ("filament_length", "filament_length_multi", "xmin",
+                    "xmax", "ymin", "ymax", "zmin", "zmax", "width", "depth",
+                    "height", "duration", "current_x", "current_y",
+                    "current_z", "current_e", "total_e", "max_e",
+                    "current_tool", "relative", "relative_e", "imperial",
+                    "all_zs", "layer_idxs", "line_idxs", "elapsed")
+
+
+def parse(filename, home_pos=None):
+    """Parse `filename` as pronsole does"""
+    gcode = gcoder.LightGCode(deferred=True)
+    with open(filename, encoding="utf-8") as f:
+        gcode.prepare(f, home_pos)
+    return gcode
+
+
+class TestGCodeCache(unittest.TestCase):
+    """Store parsed files and restore them from the cache"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cache = GCodeCache(os.path.join(self.tmp_dir, "cache"))
+
+    def copy_testfile(self, path):
+        copy = os.path.join(self.tmp_dir, path.name)
+        shutil.copy(path, copy)
+        return copy
+
+    def assertSameGCode(self, expected, actual):
+        for attr in GCODE_ATTRIBUTES:
+            self.assertEqual(getattr(expected, attr), getattr(actual, attr),
+                             attr)
+        self.assertEqual([line.raw for line in expected],
+                         [line.raw for line in actual])
+        self.assertEqual(
+            [(len(layer), layer.z, layer.duration)
+             for layer in expected.all_layers],
+            [(len(layer), layer.z, layer.duration)
+             for layer in actual.all_layers])
+
+    def test_roundtrip(self):
+        """A restored file is identical to a freshly parsed one"""
+        for path in TESTFILES:
+            with self.subTest(file=path.name):
+                expected = parse(path)
+                self.cache.store(path, expected)
+                actual = gcoder.LightGCode(deferred=True)
+                self.assertTrue(self.cache.load(path, actual))
+                self.assertSameGCode(expected, actual)
+
+    def test_compressed(self):
+        """Compressed files are restored from the decompressed offsets"""
+        path = TESTFILES[0]
+        filename = os.path.join(self.tmp_dir, path.name + ".xz")
+        with open(filename, "wb") as f:
+            f.write(lzma.compress(path.read_bytes()))
+        expected = parse(path)
+        gcode = gcoder.LightGCode(deferred=True)
+        with compressed.open_gcode(filename) as f:
+            gcode.prepare(f)
+        self.assertTrue(self.cache.store(filename, gcode))
+        actual = gcoder.LightGCode(deferred=True)
+        self.assertTrue(self.cache.load(filename, actual))
+        self.assertSameGCode(expected, actual)
+
+    def test_append_after_restore(self):
+        """Commands can be appended to a restored file"""
+        expected = parse(TESTFILES[0])
+        self.cache.store(TESTFILES[0], expected)
+        actual = gcoder.LightGCode(deferred=True)
+        self.assertTrue(self.cache.load(TESTFILES[0], actual))
+        for command in ("G91", "G1 X10 E1", "G90"):
+            expected.append(command)
+            actual.append(command)
+        self.assertSameGCode(expected, actual)
+
+    def test_layer_callback(self):
+        """The layer callback is called for each restored layer"""
+        self.cache.store(TESTFILES[0], parse(TESTFILES[0]))
+        layers = []
+        gcode = gcoder.LightGCode(deferred=True)
+        self.cache.load(TESTFILES[0], gcode,
+                        layer_callback=lambda g, layer: layers.append(layer))
+        self.assertEqual(layers, list(range(len(gcode.all_layers) - 1)))
+
+    def test_modified_file(self):
+        """A modified file is parsed again"""
+        filename = self.copy_testfile(TESTFILES[0])
+        self.cache.store(filename, parse(filename))
+        with open(filename, "a", encoding="utf-8") as f:
+            f.write("G1 X1 Y1\n")
+        self.assertFalse(self.cache.load(filename,
+                                         gcoder.LightGCode(deferred=True)))
+
+    def test_touched_file(self):
+        """A file with a new modification time is parsed again"""
+        filename = self.copy_testfile(TESTFILES[0])
+        self.cache.store(filename, parse(filename))
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertFalse(self.cache.load(filename,
+                                         gcoder.LightGCode(deferred=True)))
+
+    def test_home_position(self):
+        """Entries are only used for the home position they were parsed
+        with"""
+        self.cache.store(TESTFILES[0], parse(TESTFILES[0], (0, 0, 0)))
+        self.assertFalse(self.cache.load(TESTFILES[0],
+                                         gcoder.LightGCode(deferred=True),
+                                         (10, 10, 0)))
+
+    def test_corrupted_entry(self):
+        """A corrupted entry is ignored"""
+        self.cache.store(TESTFILES[0], parse(TESTFILES[0]))
+        with open(self.cache.entry_path(TESTFILES[0]), "r+b") as f:
+            f.truncate(100)
+        self.assertFalse(self.cache.load(TESTFILES[0],
+                                         gcoder.LightGCode(deferred=True)))
+
+    def test_streaming(self):
+        """Streaming objects storing light lines are restored"""
+        expected = parse(TESTFILES[0])
+        self.cache.store(TESTFILES[0], expected)
+        actual = gcoder.LightStreamingGCode(deferred=True)
+        self.assertTrue(self.cache.load(TESTFILES[0], actual))
+        self.assertSameGCode(expected, actual)
+        self.assertTrue(actual.has_index(0))
+
+    def test_unsupported(self):
+        """Objects storing fully parsed lines can not be restored"""
+        self.cache.store(TESTFILES[0], parse(TESTFILES[0]))
+        for gcode in (gcoder.GCode(deferred=True),
+                      MappedGCode(deferred=True)):
+            with self.subTest(type(gcode).__name__):
+                self.assertFalse(self.cache.restorable(gcode))
+                with self.assertRaises(TypeError):
+                    self.cache.load(TESTFILES[0], gcode)
+
+    def test_python_lines(self):
+        """Lines without the compiled module are restored too"""
+        expected = parse(TESTFILES[0])
+        self.cache.store(TESTFILES[0], expected)
+        with mock.patch.object(gcoder, "gcoder_line", None):
+            actual = gcoder.LightGCode(deferred=True)
+            self.assertTrue(self.cache.load(TESTFILES[0], actual))
+        self.assertSameGCode(expected, actual)
+
+    def test_eviction(self):
+        """Least recently used entries are evicted over the size cap"""
+        files = [self.copy_testfile(path) for path in TESTFILES[:3]]
+        for i, filename in enumerate(files):
+            self.cache.store(filename, parse(filename))
+            os.utime(self.cache.entry_path(filename), (i, i))
+        sizes = [os.path.getsize(self.cache.entry_path(filename))
+                 for filename in files]
+        self.cache.max_size = sizes[1] + sizes[2]
+        self.cache.evict()
+        self.assertFalse(os.path.exists(self.cache.entry_path(files[0])))
+        self.assertTrue(os.path.exists(self.cache.entry_path(files[1])))
+        self.assertTrue(os.path.exists(self.cache.entry_path(files[2])))
@@ -0,0 +1,695 @@
+"""Test suite for `printrun/gcoder.py` and its alternative parse engines"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import functools
+import math
+import mmap
+import pathlib
+import queue
+import unittest
+from unittest import mock
+
+# Custom libraries:
+from printrun import gcoder
+
+try:
+    import numpy  # noqa: F401 pylint: disable=unused-import
+    from printrun import gcoder_columnar
+except ImportError:
+    gcoder_columnar = None
+
+TESTFILES = sorted(
+    (pathlib.Path(__file__).parent.parent / "testfiles").glob("*.gcode"))
+
+GCODE_ATTRIBUTES = ("filament_length", "xmin", "xmax", "ymin", "ymax",
+                    "zmin", "zmax", "current_x", "current_y", "current_z",
+                    "offset_x", "offset_y", "offset_z", "current_e",
+                    "offset_e", "total_e", "max_e", "current_tool",
+                    "relative", "relative_e", "imperial", "cutting")
+
+LINE_ATTRIBUTES = ("raw", "command", "is_move", "x", "y", "z", "e", "f",
+                   "current_x", "current_y", "current_z", "relative",
+                   "relative_e", "current_tool", "extruding")
+
+
+def read_lines(path):
+    """Read a test file as a list of lines"""
+    with open(path, encoding="utf-8") as f:
+        return f.readlines()
+
+
+def parse(cls, lines, **kwargs):
+    """Parse `lines` with `cls`, isolating the class-level multi-tool lists
+    that `gcoder.GCode` shares between instances"""
+    multi = ("current_e_multi", "offset_e_multi", "total_e_multi",
+             "max_e_multi", "filament_length_multi")
+    for attr in multi:
+        setattr(gcoder.GCode, attr, [0])
+    gcode = cls(lines, **kwargs)
+    for attr in multi:
+        setattr(gcode, attr, list(getattr(gcode, attr)))
+    for attr in multi:
+        setattr(gcoder.GCode, attr, [0])
+    return gcode
+
+
+class GCodeParityMixin:
+    """Check that an alternative parser gives the same results as
+    `gcoder.GCode` on every file of `testfiles/`"""
+
+    parser = None
+
+    def assertValueEqual(self, first, second, msg=None):
+        if first is None or second is None:
+            # Unset flags read as False on GLine and as None on PyLine
+            first = None if first is False else first
+            second = None if second is False else second
+        if isinstance(first, float) or isinstance(second, float):
+            self.assertTrue(math.isclose(first, second,
+                                         rel_tol=1e-5, abs_tol=1e-4),
+                            f"{first} != {second}: {msg}")
+        else:
+            self.assertEqual(first, second, msg)
+
+    def assertSameGCode(self, expected, actual):
+        for attr in GCODE_ATTRIBUTES:
+            self.assertValueEqual(getattr(expected, attr),
+                                  getattr(actual, attr), attr)
+        self.assertEqual(len(expected.filament_length_multi),
+                         len(actual.filament_length_multi))
+        for first, second in zip(expected.filament_length_multi,
+                                 actual.filament_length_multi):
+            self.assertValueEqual(first, second, "filament_length_multi")
+        self.assertAlmostEqual(expected.duration.total_seconds(),
+                               actual.duration.total_seconds(), places=2)
+        self.assertEqual(list(expected.layer_idxs), list(actual.layer_idxs))
+        self.assertEqual(list(expected.line_idxs), list(actual.line_idxs))
+        self.assertEqual(len(expected.elapsed), len(actual.elapsed))
+        for first, second in zip(expected.elapsed, actual.elapsed):
+            self.assertAlmostEqual(first, second, places=4)
+        self.assertEqual(len(expected.all_layers), len(actual.all_layers))
+        for first, second in zip(expected.all_layers, actual.all_layers):
+            self.assertEqual(len(first), len(second))
+            self.assertValueEqual(first.z, second.z, "layer z")
+            self.assertAlmostEqual(first.duration, second.duration, places=4)
+        self.assertEqual(len(expected.lines), len(actual.lines))
+        for i, (first, second) in enumerate(zip(expected.lines,
+                                                actual.lines)):
+            for attr in LINE_ATTRIBUTES:
+                self.assertValueEqual(getattr(first, attr),
+                                      getattr(second, attr),
+                                      f"line {i} ({first.raw}): {attr}")
+
+    def test_testfiles(self):
+        """Parsing each test file gives the same result as GCode"""
+        for path in TESTFILES:
+            for cutting_as_extrusion in (False, True):
+                with self.subTest(file=path.name,
+                                  cutting_as_extrusion=cutting_as_extrusion):
+                    lines = read_lines(path)
+                    expected = parse(
+                        gcoder.GCode, lines,
+                        cutting_as_extrusion=cutting_as_extrusion)
+                    actual = parse(
+                        self.parser, lines,
+                        cutting_as_extrusion=cutting_as_extrusion)
+                    self.assertSameGCode(expected, actual)
+
+    def test_idxs(self):
+        """idxs() maps line numbers to the same layer and line indexes"""
+        lines = read_lines(TESTFILES[0])
+        expected = parse(gcoder.GCode, lines)
+        actual = parse(self.parser, lines)
+        for i in range(len(expected)):
+            self.assertEqual(expected.idxs(i), actual.idxs(i))
+
+    def test_append(self):
+        """Appended commands update the position and the last layer"""
+        lines = read_lines(TESTFILES[0])
+        expected = parse(gcoder.GCode, lines)
+        actual = parse(self.parser, lines)
+        for command in ("G91", "G1 X10 Y-5 E1", "G90", "G1 Z50"):
+            expected.append(command)
+            actual.append(command)
+        self.assertSameGCode(expected, actual)
+
+    def test_empty(self):
+        """An empty file gives an empty GCode"""
+        expected = parse(gcoder.GCode, [])
+        actual = parse(self.parser, [])
+        self.assertEqual(len(actual), 0)
+        self.assertEqual(expected.filament_length, actual.filament_length)
+
+
+@unittest.skipIf(gcoder_columnar is None, "numpy is not installed")
+class TestColumnarGCode(GCodeParityMixin, unittest.TestCase):
+    """Test the columnar NumPy parse engine"""
+
+    @property
+    def parser(self):
+        return gcoder_columnar.ColumnarGCode
+
+    def test_rewrite_layer(self):
+        """Rewriting a layer falls back to regular Line objects"""
+        lines = read_lines(TESTFILES[0])
+        expected = parse(gcoder.GCode, lines)
+        actual = parse(self.parser, lines)
+        layer_idx = expected.layer_idxs[-1]
+        expected.rewrite_layer(["G1 X1 Y1"], layer_idx)
+        actual.rewrite_layer(["G1 X1 Y1"], layer_idx)
+        self.assertIsNone(actual.columns)
+        self.assertEqual([line.raw for line in expected.lines],
+                         [line.raw for line in actual.lines])
+        self.assertEqual(list(expected.layer_idxs), list(actual.layer_idxs))
+
+
+@unittest.skipIf(gcoder_columnar is None, "numpy is not installed")
+class TestParallelGCode(GCodeParityMixin, unittest.TestCase):
+    """Test the parser tokenizing chunks in worker processes"""
+
+    def setUp(self):
+        # Split even the small test files between the workers
+        for attr in ("min_chunk_size", "min_chunk_lines"):
+            patcher = mock.patch.object(gcoder_columnar.ParallelGCode, attr, 1)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @property
+    def parser(self):
+        return functools.partial(gcoder_columnar.ParallelGCode, workers=3)
+
+    def test_file_chunks(self):
+        """Files are split in byte ranges starting on line starts"""
+        path = TESTFILES[0]
+        chunks = gcoder_columnar.file_chunks(path, 3)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], path.stat().st_size)
+        data = path.read_bytes()
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[start - 1:start], b"\n")
+
+    def test_open_files(self):
+        """Byte ranges of open files give the same result as GCode"""
+        for path in TESTFILES:
+            with self.subTest(file=path.name):
+                expected = parse(gcoder.GCode, read_lines(path))
+                with open(path, encoding="utf-8") as f:
+                    actual = parse(self.parser, f)
+                self.assertSameGCode(expected, actual)
+
+
+def streamed(lines, **kwargs):
+    """Parse `lines` with StreamingGCode and wait for the parser thread"""
+    gcode = gcoder.StreamingGCode(lines, **kwargs)
+    gcode.wait()
+    return gcode
+
+
+class TestStreamingGCode(GCodeParityMixin, unittest.TestCase):
+    """Test the parsing in a background thread while printing"""
+
+    parser = staticmethod(streamed)
+
+    def setUp(self):
+        self.source = queue.Queue()
+
+    def feed(self, lines):
+        for line in lines:
+            self.source.put(line)
+
+    def stream(self, **kwargs):
+        """Return a StreamingGCode reading the lines fed to the source"""
+        gcode = gcoder.StreamingGCode(iter(self.source.get, None), **kwargs)
+        self.addCleanup(gcode.wait, 5)
+        self.addCleanup(self.source.put, None)
+        return gcode
+
+    def test_layers(self):
+        """Lines are available once their layer is parsed"""
+        lines = layered_lines(4)
+        expected = parse(gcoder.GCode, lines)
+        gcode = self.stream()
+        self.assertTrue(gcode)
+        self.assertFalse(gcode.has_index(0, timeout=0.01))
+        fed = expected.layer_start(3)
+        self.feed(lines[:fed])
+        self.assertTrue(gcode.has_index(expected.layer_start(1) - 1,
+                                        timeout=5))
+        self.assertFalse(gcode.has_index(fed, timeout=0.01))
+        # Only whole layers are available
+        end = len(gcode)
+        self.assertIn(end, list(expected.layer_offsets))
+        self.assertLess(end, fed)
+        for i in range(end):
+            self.assertEqual(gcode.idxs(i), expected.idxs(i))
+            self.assertEqual(gcode.lines[i].raw, lines[i])
+        self.feed(lines[fed:] + [None])
+        self.assertFalse(gcode.has_index(len(lines)))
+        self.assertTrue(gcode.wait(5))
+        self.assertEqual(len(gcode), len(lines))
+        self.assertEqual(list(gcode.elapsed), list(expected.elapsed))
+
+    def test_layer_callback(self):
+        """Layer callbacks are called from the parser thread"""
+        lines = layered_lines()
+        expected = []
+        parse(gcoder.GCode, lines,
+              layer_callback=lambda gcode, layer: expected.append(layer))
+        called = []
+        gcode = gcoder.StreamingGCode(
+            lines, layer_callback=lambda gcode, layer: called.append(layer))
+        gcode.wait()
+        self.assertEqual(called, expected)
+
+    def test_unsplit(self):
+        """Lines are available as soon as they are read without layers"""
+        gcode = self.stream(split_layers=False)
+        self.feed(["G28", "G1 X10 F600"])
+        self.assertTrue(gcode.has_index(1, timeout=5))
+        self.assertEqual(gcode.idxs(1), (0, 1))
+        self.assertFalse(gcode.has_index(2, timeout=0.01))
+        self.feed(["G1 Y10", None])
+        self.assertTrue(gcode.wait(5))
+        self.assertEqual([line.raw for line in gcode],
+                         ["G28", "G1 X10 F600", "G1 Y10"])
+        self.assertEqual(len(gcode.all_layers), 1)
+
+    def test_append(self):
+        """Commands appended while parsing follow the parsed lines"""
+        gcode = self.stream()
+        gcode.append("M117 appended")
+        self.feed(["G28", "G1 X10 E1 F600", None])
+        self.assertTrue(gcode.wait(5))
+        self.assertEqual([line.raw for line in gcode],
+                         ["G28", "G1 X10 E1 F600", "M117 appended"])
+
+    def test_error(self):
+        """Parser errors are raised by wait()"""
+        def failing():
+            yield "G28"
+            raise OSError("read error")
+        with self.assertLogs(level="ERROR"):
+            gcode = gcoder.StreamingGCode(failing())
+            with self.assertRaises(OSError):
+                gcode.wait()
+        self.assertFalse(gcode.has_index(0))
+
+
+def from_buffer(lines, **kwargs):
+    """Parse `lines` from the UTF-8 bytes of the file"""
+    return gcoder.GCode("".join(lines).encode("utf-8"), **kwargs)
+
+
+class TestBufferGCode(GCodeParityMixin, unittest.TestCase):
+    """Test the parsing of the bytes of a file"""
+
+    parser = staticmethod(from_buffer)
+
+    def test_line_endings(self):
+        """Lines end with \\n, \\r or \\r\\n and are stripped"""
+        for cls in (gcoder.LightGCode, gcoder.GCode):
+            with self.subTest(cls=cls.__name__):
+                gcode = cls(b"G28\r\n  G1 X10 \rG1 Y5\n\n\t\r\nM84")
+                self.assertEqual([line.raw for line in gcode],
+                                 ["G28", "G1 X10", "G1 Y5", "M84"])
+                self.assertEqual(gcode.xmax, 10)
+        self.assertEqual([line.command for line in gcode],
+                         ["G28", "G1", "G1", "M84"])
+
+    def test_non_ascii(self):
+        """Non-ASCII lines are decoded, invalid UTF-8 is replaced"""
+        gcode = gcoder.GCode("M117 Température\nG1 X5 ; été\n"
+                             .encode("utf-8") + b"M117 \xff\n")
+        self.assertEqual([line.raw for line in gcode],
+                         ["M117 Température", "G1 X5 ; été",
+                          "M117 \ufffd"])
+        self.assertEqual(gcode.lines[1].x, 5)
+
+    def test_shared_commands(self):
+        """Lines share the strings of their commands"""
+        for data in (["G1 X1", "G1 X2", "M84"], b"G1 X1\nG1 X2\nM84"):
+            with self.subTest(data=data):
+                gcode = gcoder.GCode(data)
+                first, second, third = gcode.lines
+                self.assertIs(first.command, second.command)
+                self.assertEqual(third.command, "M84")
+
+    def test_mmap(self):
+        """A mapped file is parsed like its bytes"""
+        path = TESTFILES[0]
+        expected = parse(gcoder.GCode, read_lines(path))
+        with open(path, "rb") as f:
+            # The lines point into the map, which stays open with them
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.assertSameGCode(expected, parse(gcoder.GCode, data))
+
+
+class PythonGCode(gcoder.GCode):
+    """GCode running the Python implementation of _preprocess"""
+    compiled_preprocess = False
+
+
+class PythonLightGCode(gcoder.LightGCode):
+    """LightGCode running the Python implementation of _preprocess"""
+    compiled_preprocess = False
+
+
+@unittest.skipIf(gcoder.gcoder_preprocess is None,
+                 "compiled _preprocess is not built")
+class TestCompiledPreprocess(unittest.TestCase):
+    """Compare the compiled _preprocess with the Python one, which must give
+    exactly the same values"""
+
+    def assertSameGCode(self, expected, actual, line_attributes):
+        for attr in GCODE_ATTRIBUTES + ("duration", "all_zs",
+                                        "filament_length_multi"):
+            self.assertEqual(getattr(expected, attr), getattr(actual, attr),
+                             attr)
+        self.assertEqual(list(expected.layer_idxs), list(actual.layer_idxs))
+        self.assertEqual(list(expected.line_idxs), list(actual.line_idxs))
+        self.assertEqual(list(expected.elapsed), list(actual.elapsed))
+        self.assertEqual(
+            [(len(layer), layer.z, layer.duration)
+             for layer in expected.all_layers],
+            [(len(layer), layer.z, layer.duration)
+             for layer in actual.all_layers])
+        for i, (first, second) in enumerate(zip(expected.lines,
+                                                actual.lines)):
+            for attr in line_attributes:
+                self.assertEqual(getattr(first, attr), getattr(second, attr),
+                                 f"line {i} ({first.raw}): {attr}")
+
+    def test_testfiles(self):
+        """Each test file gives the same results with both implementations"""
+        for path in TESTFILES:
+            lines = read_lines(path)
+            for cutting_as_extrusion in (False, True):
+                with self.subTest(file=path.name,
+                                  cutting_as_extrusion=cutting_as_extrusion):
+                    self.assertSameGCode(
+                        parse(PythonGCode, lines,
+                              cutting_as_extrusion=cutting_as_extrusion),
+                        parse(gcoder.GCode, lines,
+                              cutting_as_extrusion=cutting_as_extrusion),
+                        LINE_ATTRIBUTES)
+            with self.subTest(file=path.name, light=True):
+                self.assertSameGCode(parse(PythonLightGCode, lines),
+                                     parse(gcoder.LightGCode, lines),
+                                     ("raw", "command", "is_move"))
+
+    def test_layer_callback(self):
+        """The layer callback is called for the same layers"""
+        lines = read_lines(TESTFILES[0])
+        calls = {}
+        for cls in (PythonGCode, gcoder.GCode):
+            calls[cls] = []
+            parse(cls, lines, layer_callback=lambda gcode, layer, cls=cls:
+                  calls[cls].append((layer, len(gcode.all_layers[layer]))))
+        self.assertTrue(calls[gcoder.GCode])
+        self.assertEqual(calls[PythonGCode], calls[gcoder.GCode])
+
+    def test_append(self):
+        """Appended commands are processed the same way"""
+        lines = read_lines(TESTFILES[0])
+        expected = parse(PythonGCode, lines)
+        actual = parse(gcoder.GCode, lines)
+        for command in ("T1", "G91", "G1 X10 Y-5 E1", "G90", "G92 E0",
+                        "G28 X", "G20", "G1 Z2 E1", "M3", "G4 P500"):
+            self.assertEqual(
+                [getattr(expected.append(command), attr)
+                 for attr in LINE_ATTRIBUTES],
+                [getattr(actual.append(command), attr)
+                 for attr in LINE_ATTRIBUTES], command)
+        self.assertSameGCode(expected, actual, LINE_ATTRIBUTES)
+
+    def test_unknown_commands(self):
+        """Lines without a G, M or T command keep the command the Python
+        implementation finds, without growing the shared opcode table"""
+        gcoder_line = gcoder.gcoder_line
+        lines = ["G1 X1", "%", "X10 Y5", "SET_VELOCITY_LIMIT ACCEL=100",
+                 "G29.1", "T0", "S100"]
+        self.assertSameGCode(parse(PythonGCode, lines),
+                             parse(gcoder.GCode, lines), ("raw", "command"))
+        size = len(gcoder_line.opcode_table())
+        parse(gcoder.GCode, [f"junk {i}" for i in range(100)]
+              + [f"X{i}.5 Y1" for i in range(100)])
+        self.assertEqual(len(gcoder_line.opcode_table()), size)
+
+
+def layered_lines(layers=6):
+    """Return the lines of a print of `layers` square layers"""
+    lines = ["G28", "G90", "M82", "G92 E0"]
+    e = 0
+    for layer in range(layers):
+        lines.append("G1 Z%.1f F600" % (0.2 * (layer + 1)))
+        for x, y, feedrate in ((0, 0, 6000), (20, 0, 1200), (20, 20, 1200),
+                               (0, 20, 3000), (0, 0, 3000)):
+            e += 1
+            lines.append("G1 X%d Y%d E%d F%d" % (x, y, e, feedrate))
+        lines.append("M117 layer %d" % layer)
+    return lines
+
+
+class TestTimeIndex(unittest.TestCase):
+    """Test the per-line elapsed times and the lookups using them"""
+
+    def setUp(self):
+        self.gcode = parse(gcoder.GCode, layered_lines())
+
+    def test_elapsed(self):
+        """Elapsed times grow line by line up to the duration"""
+        gcode = self.gcode
+        self.assertEqual(len(gcode.elapsed), len(gcode))
+        self.assertEqual(list(gcode.elapsed), sorted(gcode.elapsed))
+        self.assertEqual(int(gcode.elapsed_time(len(gcode))),
+                         gcode.duration.total_seconds())
+        self.assertEqual(gcode.elapsed_time(0), 0)
+        self.assertAlmostEqual(
+            gcode.elapsed_time(len(gcode)),
+            sum(layer.duration for layer in gcode.all_layers))
+
+    def test_index_at_time(self):
+        """The line printing at a time is found back from its times"""
+        gcode = self.gcode
+        for i in range(0, len(gcode), 97):
+            start, end = gcode.elapsed_time(i), gcode.elapsed_time(i + 1)
+            if end > start:
+                self.assertEqual(gcode.index_at_time((start + end) / 2), i)
+        self.assertEqual(gcode.index_at_time(0), 0)
+        self.assertEqual(gcode.index_at_time(gcode.elapsed[-1] + 1),
+                         len(gcode))
+
+    def test_index_at_z(self):
+        """Heights map to the first line of the layer reaching them"""
+        gcode = self.gcode
+        layer = gcode.all_layers[3]
+        index = gcode.index_at_z(layer.z)
+        self.assertEqual(gcode.idxs(index), (3, 0))
+        self.assertEqual(gcode.index_at_z(layer.z - 0.01), index)
+        self.assertEqual(gcode.index_at_z(1e6), len(gcode))
+
+    def test_edits(self):
+        """Edited layers keep one elapsed time per line"""
+        gcode = self.gcode
+        total = gcode.elapsed_time(len(gcode))
+        gcode.prepend_to_layer(["M117 a", "M117 b"], 2)
+        self.assertEqual(len(gcode.elapsed), len(gcode))
+        self.assertEqual(gcode.elapsed_time(len(gcode)), total)
+        gcode.rewrite_layer(["G1 X1 Y1"], 2)
+        self.assertEqual(len(gcode.elapsed), len(gcode))
+        self.assertEqual(gcode.elapsed_time(len(gcode)), total)
+        gcode.append("M400")
+        self.assertEqual(len(gcode.elapsed), len(gcode))
+
+
+class TestResumeCommands(unittest.TestCase):
+    """Test the commands restoring the state left by the first lines"""
+
+    def test_state(self):
+        """Temperatures, modes, position and extrusion are restored"""
+        lines = ["M140 S60", "M104 S210", "M190 S60", "M109 S210", "G21",
+                 "G28", "G90", "M83", "G92 E0", "G1 Z0.3 F600",
+                 "G1 X10 Y20 E2 F1200", "M106 S128", "G1 X15 E1.5",
+                 "G92 E10", "G1 Z0.6"]
+        self.assertEqual(
+            gcoder.resume_commands(lines, 3000, 100, 1),
+            ["M140 S60", "M104 T0 S210", "M190 S60", "M109 T0 S210", "G21",
+             "G90", "G1 Z1.6 F100", "G1 X15 Y20 F3000", "G1 Z0.6 F100",
+             "G92 E10", "M83", "M106 S128", "G1 F1200"])
+
+    def test_relative(self):
+        """Relative moves are accumulated and the mode restored"""
+        lines = ["G91", "T1", "M104 T1 S200", "G1 X1 Y1 Z1", "G1 X1 Y1",
+                 "M107"]
+        commands = gcoder.resume_commands(lines, 3000, 100, 0)
+        self.assertEqual(commands,
+                         ["M104 T1 S200", "M109 T1 S200", "G21", "T1", "G90",
+                          "G1 Z1 F100", "G1 X2 Y2 F3000", "G1 Z1 F100",
+                          "M83", "G91", "M107"])
+
+
+PRUSASLICER_OBJECTS = [
+    "M486 T2", "M486 S0 A\"Cube id:0 copy 0\"",
+    "M486 S1 A\"Cube id:0 copy 1\"", "M486 S-1",
+    "G90", "M82", "G1 Z0.2 F600",
+    "M486 S0", "; printing object Cube id:0 copy 0",
+    "G1 X10 Y10 F9000", "G1 X20 Y10 E1 F1200", "G1 X20 Y20 E2",
+    "; stop printing object Cube id:0 copy 0", "M486 S-1",
+    "M486 S1", "; printing object Cube id:0 copy 1",
+    "G1 X50 Y10 F9000", "G1 X60 Y10 E3 F1200",
+    "; stop printing object Cube id:0 copy 1", "M486 S-1",
+    "G1 Z0.4 F600",
+    "M486 S0", "G1 X10 Y10 F9000", "G1 Z0.5", "G1 X20 Y10 E4 F1200",
+    "M486 S-1",
+    "M486 S1", "G1 X50 Y10 F9000", "G1 X60 Y10 E5 F1200", "M486 S-1",
+]
+
+
+class TestObjectIndex(unittest.TestCase):
+    """Test indexing the labelled objects and excluding them"""
+
+    def test_m486(self):
+        """M486 labels take precedence over comments"""
+        gcode = gcoder.GCode(PRUSASLICER_OBJECTS)
+        index = gcode.object_index
+        self.assertEqual(index.names, ["Cube id:0 copy 0", "Cube id:0 copy 1"])
+        self.assertEqual(index.ranges["Cube id:0 copy 0"], [(8, 13), (22, 25)])
+        self.assertEqual(index.ranges["Cube id:0 copy 1"], [(15, 19), (27, 29)])
+        self.assertIs(gcode.object_index, index)
+
+    def test_labels(self):
+        for lines, names, ranges in (
+                (["EXCLUDE_OBJECT_DEFINE NAME=a CENTER=1,1",
+                  "EXCLUDE_OBJECT_DEFINE NAME=b", "EXCLUDE_OBJECT_START NAME=a",
+                  "G1 X1 E1", "EXCLUDE_OBJECT_END NAME=a"],
+                 ["a", "b"], {"a": [(3, 4)], "b": []}),
+                (["; printing object part", "G1 X1 E1",
+                  "; stop printing object part", "G1 X2"],
+                 ["part"], {"part": [(1, 2)]}),
+                ([";LAYER:0", ";MESH:a.stl", "G1 X1 E1", ";MESH:NONMESH",
+                  "G1 Z1", ";LAYER:1", ";MESH:a.stl", "G1 X2 E2", ";LAYER:2",
+                  "G1 X3"],
+                 ["a.stl"], {"a.stl": [(2, 3), (7, 8)]}),
+                (["G1 X1 E1"], [], {})):
+            with self.subTest(lines=lines[0]):
+                index = gcoder.GCode(lines).object_index
+                self.assertEqual(index.names, names)
+                self.assertEqual(index.ranges, ranges)
+
+    def test_exclusion(self):
+        """Moves of excluded objects are skipped, the extruder position, Z
+        and feedrate restored"""
+        gcode = gcoder.GCode(PRUSASLICER_OBJECTS)
+        exclusion = gcode.exclude_objects(["Cube id:0 copy 0"])
+        self.assertIs(gcode.exclusion, exclusion)
+        self.assertEqual([i for i, skip in enumerate(exclusion.mask) if skip],
+                         [9, 10, 11, 22, 23, 24])
+        self.assertEqual(exclusion.fixups,
+                         {11: ["G92 E2", "G1 F1200"],
+                          24: ["G92 E4", "G1 Z0.5", "G1 F1200"]})
+        lines = exclusion.lines(gcode)
+        self.assertNotIn("G1 X20 Y10 E1 F1200", lines)
+        self.assertEqual(lines[lines.index("G92 E2") - 1],
+                         "; printing object Cube id:0 copy 0")
+        # Excluding from the middle of the print
+        exclusion = gcode.exclude_objects(["Cube id:0 copy 0"], start=23)
+        self.assertEqual([i for i, skip in enumerate(exclusion.mask) if skip],
+                         [23, 24])
+        self.assertIsNone(gcode.exclude_objects([]))
+        with self.assertRaises(ValueError):
+            gcode.exclude_objects(["Sphere"])
+
+    def test_relative(self):
+        """Relative moves skipped are made up for in the modes in use"""
+        lines = ["M83", "G91", "; printing object a", "G1 X1 Y2 E1",
+                 "G1 Z0.2 F600", "G92 Z0", "G1 X1 E1",
+                 "; stop printing object a", "G1 X1 E1"]
+        gcode = gcoder.GCode(lines)
+        exclusion = gcode.exclude_objects(["a"])
+        self.assertEqual(exclusion.fixups, {6: ["G1 X2 Y2", "G1 F600"]})
+        gcode = gcoder.GCode(["G90", "M83", "; printing object a",
+                              "G91", "G1 Z1", "G90", "G1 Z2",
+                              "; stop printing object a"])
+        self.assertEqual(gcode.exclude_objects(["a"]).fixups,
+                         {6: ["G1 Z2"]})
+        gcode = gcoder.GCode(["G90", "; printing object a", "G1 Z2",
+                              "G91", "M82", "G1 X1",
+                              "; stop printing object a"])
+        self.assertEqual(gcode.exclude_objects(["a"]).fixups,
+                         {5: ["G90", "G1 Z2", "G91", "M82", "G1 X1"]})
+
+    def test_edits(self):
+        """The index and exclusion are dropped with the edited lines"""
+        gcode = gcoder.GCode(PRUSASLICER_OBJECTS)
+        index = gcode.object_index
+        gcode.exclude_objects(["Cube id:0 copy 1"])
+        gcode.prepend_to_layer(["M117 a"], 0)
+        self.assertIsNone(gcode.exclusion)
+        self.assertIsNot(gcode.object_index, index)
+
+
+class TestLayerEdits(unittest.TestCase):
+    """Test editing layers through the layer offsets"""
+
+    def setUp(self):
+        self.lines = layered_lines()
+        self.gcode = parse(gcoder.GCode, self.lines)
+
+    def assertConsistent(self, gcode):
+        offsets = list(gcode.layer_offsets)
+        self.assertEqual(offsets[-1], len(gcode))
+        layer_idxs = []
+        line_idxs = []
+        for layer_idx, layer in enumerate(gcode.all_layers):
+            self.assertEqual(offsets[layer_idx + 1] - offsets[layer_idx],
+                             len(layer))
+            layer_idxs += [layer_idx] * len(layer)
+            line_idxs += range(len(layer))
+        self.assertEqual(list(gcode.layer_idxs), layer_idxs)
+        self.assertEqual(list(gcode.line_idxs), line_idxs)
+        for i, line in enumerate(gcode.lines):
+            layer, line_idx = gcode.idxs(i)
+            self.assertIs(gcode.all_layers[layer][line_idx], line)
+            self.assertIs(gcode.lines[i], line)
+
+    def test_offsets(self):
+        """Offsets delimit the layers in print order"""
+        gcode = self.gcode
+        self.assertConsistent(gcode)
+        self.assertEqual([line.raw for line in gcode], self.lines)
+
+    def test_prepend(self):
+        """Commands are injected at the start of the layer"""
+        gcode = self.gcode
+        start = gcode.layer_start(3)
+        self.assertEqual(gcode.prepend_to_layer([" M117 a", "", "M400"], 3),
+                         ["M117 a", "M400"])
+        self.assertConsistent(gcode)
+        expected = self.lines[:start] + ["M117 a", "M400"] + self.lines[start:]
+        self.assertEqual([line.raw for line in gcode], expected)
+        self.assertFalse(gcode.lines[start].is_move)
+
+    def test_rewrite(self):
+        """Commands replace the lines of the layer"""
+        gcode = self.gcode
+        start, end = gcode.layer_start(2), gcode.layer_start(3)
+        self.assertEqual(gcode.rewrite_layer(["G1 X1", "G1 X2"], 2),
+                         ["G1 X1", "G1 X2"])
+        self.assertConsistent(gcode)
+        expected = self.lines[:start] + ["G1 X1", "G1 X2"] + self.lines[end:]
+        self.assertEqual([line.raw for line in gcode], expected)
+
+    def test_append(self):
+        """Appended lines extend the offsets of the last layer"""
+        gcode = self.gcode
+        gcode.layer_offsets
+        gcode.layer_idxs
+        gcode.append("G1 X5")
+        gcode.prepend_to_layer(["M117 a"], 0)
+        gcode.append("G1 X6")
+        self.assertConsistent(gcode)
+        self.assertEqual(gcode.lines[-1].raw, "G1 X6")
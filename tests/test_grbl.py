@@ -0,0 +1,98 @@
+"""Test suite for `printrun/grbl.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import unittest
+
+# Custom libraries:
+from printrun import grbl
+
+
+class TestStatus(unittest.TestCase):
+    """Test the parsing of status reports"""
+
+    def test_grbl_11(self):
+        status = grbl.parse_status(
+            "<Run|MPos:10.000,20.000,-1.500|Bf:12,90|FS:1200,8000|"
+            "WCO:5.000,5.000,0.000|Ov:100,100,100>\r\n")
+        self.assertEqual(status.state, "Run")
+        self.assertEqual(status.mpos, (10, 20, -1.5))
+        self.assertEqual(status.wpos, (5, 15, -1.5))
+        self.assertEqual((status.feed, status.spindle), (1200, 8000))
+        self.assertEqual((status.planner_free, status.rx_free), (12, 90))
+        self.assertEqual(status.fields["Ov"], "100,100,100")
+
+    def test_last_wco(self):
+        """The work position is known from the last offset reported"""
+        status = grbl.parse_status("<Hold:0|MPos:1.000,2.000,3.000|F:500>",
+                                   (1, 1, 1))
+        self.assertEqual(status.state, "Hold")
+        self.assertEqual(status.wpos, (0, 1, 2))
+        self.assertEqual(status.feed, 500)
+        self.assertIsNone(status.spindle)
+        status = grbl.parse_status("<Idle|WPos:1.000,2.000,3.000|Ln:42>")
+        self.assertIsNone(status.mpos)
+        self.assertEqual(status.line, 42)
+
+    def test_grbl_09(self):
+        status = grbl.parse_status(
+            "<Idle,MPos:1.000,2.000,3.000,WPos:0.000,1.000,2.000,"
+            "Buf:0,RX:0>")
+        self.assertEqual(status.state, "Idle")
+        self.assertEqual(status.mpos, (1, 2, 3))
+        self.assertEqual(status.wpos, (0, 1, 2))
+        self.assertEqual(status.fields["RX"], "0")
+
+    def test_not_status(self):
+        for line in ("ok", "[MSG:Reset to continue]", "<Idle"):
+            with self.subTest(line=line):
+                self.assertIsNone(grbl.parse_status(line))
+
+
+class TestReplies(unittest.TestCase):
+    """Test the replies of Grbl"""
+
+    def test_describe(self):
+        self.assertEqual(grbl.describe("error:20\r\n"),
+                         "error:20 (Unsupported command)")
+        self.assertEqual(grbl.describe("ALARM:1"), "ALARM:1 (Hard limit)")
+        self.assertEqual(grbl.describe("error:99"), "error:99")
+        self.assertEqual(grbl.describe("error: Bad number format"),
+                         "error: Bad number format")
+
+    def test_is_reply(self):
+        self.assertTrue(grbl.is_reply("ok\r\n"))
+        self.assertTrue(grbl.is_reply("error:2"))
+        self.assertFalse(grbl.is_reply("ALARM:1"))
+        self.assertFalse(grbl.is_reply("<Idle|MPos:0,0,0>"))
+
+
+class TestCharacterCounter(unittest.TestCase):
+    """Test counting the characters in the serial buffer"""
+
+    def test_counting(self):
+        counter = grbl.CharacterCounter(size=20)
+        self.assertTrue(counter.fits("G1 X1 Y1 F100"))
+        counter.sent("G1 X1 Y1 F100")
+        self.assertEqual(counter.used, 14)
+        # 14 + 6 bytes fill the buffer, one more doesn't fit
+        self.assertTrue(counter.fits("G1 X2"))
+        self.assertFalse(counter.fits("G1 X20"))
+        counter.sent("G1 X2")
+        self.assertEqual(counter.answered(), "G1 X1 Y1 F100")
+        self.assertEqual((len(counter), counter.used), (1, 6))
+        self.assertTrue(counter.fits("G1 X20"))
+        counter.clear()
+        self.assertIsNone(counter.answered())
+
+    def test_long_line(self):
+        """A line longer than the buffer is sent when it is empty"""
+        counter = grbl.CharacterCounter(size=10)
+        self.assertTrue(counter.fits("G1 X100 Y100"))
+        counter.sent("G1 X100 Y100")
+        self.assertFalse(counter.fits("G1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Test suite for `printrun/hostprotocol.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import types
+import unittest
+
+# Custom libraries:
+from printrun import gcoder
+from printrun import hostprotocol
+from printrun import transcoder
+
+
+class TestHostProtocol(unittest.TestCase):
+    """Lines sent by both printer hosts"""
+
+    def test_resend(self):
+        for line, number in (("Resend: 12", 12), ("Resend:N:3", 3),
+                             ("rs N2 Expected checksum 67", 2),
+                             ("resend", None)):
+            with self.subTest(line=line):
+                self.assertTrue(hostprotocol.is_resend(line))
+                self.assertEqual(hostprotocol.resend_number(line), number)
+        self.assertFalse(hostprotocol.is_resend("ok T:200"))
+
+    def test_numbered(self):
+        self.assertEqual(hostprotocol.numbered("G1 X0 Y0", 0),
+                         "N0 G1 X0 Y0*41")
+        precomputed = transcoder.checksum("G1 X0 Y0")
+        self.assertEqual(hostprotocol.numbered("G1 X0 Y0", 7, precomputed),
+                         hostprotocol.numbered("G1 X0 Y0", 7))
+
+    def test_host_command(self):
+        self.assertTrue(hostprotocol.is_host_command("  ;@pause"))
+        self.assertFalse(hostprotocol.is_host_command("; comment"))
+
+    def test_wire_line(self):
+        lines = ["G1 X1.000 Y1.000 F1800", "G1 X2.000 Y1.000 ; move",
+                 "G28", "G1 X1 Y1"]
+        gcode = gcoder.GCode(lines)
+        self.assertEqual(hostprotocol.wire_line(gcode, 1, lines[1], False),
+                         ("G1 X2.000 Y1.000", None, False))
+        gcode.wire_lines = transcoder.Transcoder().transcode(gcode)
+        line, checksum, resync = hostprotocol.wire_line(gcode, 1, lines[1],
+                                                        False)
+        self.assertEqual((line, resync), ("G1 X2", False))
+        self.assertEqual(checksum, transcoder.checksum(line))
+        # The Y the shortened line leaves out is sent again until the
+        # next sync point
+        self.assertEqual(hostprotocol.wire_line(gcode, 1, lines[1], True)[0],
+                         "G1 X2 Y1")
+        self.assertFalse(hostprotocol.wire_line(gcode, 3, lines[3], True)[2])
+
+    def test_pause_resume(self):
+        host = types.SimpleNamespace(analyzer=gcoder.GCode(),
+                                     xy_feedrate=3000, z_feedrate=None)
+        for line in ("G1 X10 Y20 Z0.5 E1.5 F1200", "M83"):
+            host.analyzer.append(line, store=False)
+        hostprotocol.save_pause(host)
+        self.assertEqual(hostprotocol.resume_commands(host),
+                         ["G90", "G1 X10.0 Y20.0 F3000", "G1 Z0.5",
+                          "G92 E1.5", "M83", "G1 F1200.0"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Test suite for `printrun/jobindex.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import os
+import tempfile
+import time
+import unittest
+
+# Custom libraries:
+from printrun import jobindex
+
+
+def slicer_file(minutes, filament, height, tools=1):
+    """Return the text of a file with PrusaSlicer comments"""
+    return ("; generated by PrusaSlicer 2.6.1\nG1 X1 Y1 E1\n"
+            "; filament used [mm] = %s\n"
+            "; estimated printing time (normal mode) = %dm 0s\n"
+            "; max_layer_z = %.2f\n"
+            % (", ".join(["%.1f" % filament] * tools), minutes, height))
+
+
+class TestJobIndex(unittest.TestCase):
+    """Test indexing a directory of G-code files"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = os.path.join(tmp.name, "jobs")
+        os.mkdir(self.directory)
+        self.index = jobindex.JobIndex(os.path.join(tmp.name, "jobs.sqlite"))
+        self.addCleanup(self.index.close)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_scan(self):
+        self.write("b.gcode", slicer_file(30, 1000, 10))
+        self.write("a.gcode", slicer_file(90, 500, 20, tools=2))
+        self.write("notes.txt", "not G-code")
+        self.assertEqual(self.index.scan(self.directory), (2, 0))
+        jobs = self.index.jobs(self.directory)
+        self.assertEqual([job.name for job in jobs], ["a.gcode", "b.gcode"])
+        self.assertEqual((jobs[0].duration, jobs[0].filament, jobs[0].height,
+                          jobs[0].tools, jobs[0].slicer),
+                         (5400, 1000, 20, 2, "PrusaSlicer 2.6.1"))
+        self.assertFalse(jobs[0].parsed)
+        # Unchanged files are not read again
+        self.assertEqual(self.index.scan(self.directory), (0, 0))
+
+    def test_changes(self):
+        """Changed files are indexed again, removed ones forgotten"""
+        path = self.write("a.gcode", slicer_file(30, 1000, 10))
+        self.write("b.gcode", slicer_file(30, 1000, 10))
+        self.index.scan(self.directory)
+        self.write("a.gcode", slicer_file(45, 1200, 10))
+        os.utime(path, ns=(0, 10 ** 9))
+        os.remove(os.path.join(self.directory, "b.gcode"))
+        self.assertEqual(self.index.scan(self.directory), (1, 1))
+        self.assertEqual(self.index.get(path).duration, 2700)
+        self.assertEqual(self.index.get(path).mtime, 1)
+        self.assertIsNone(self.index.get(
+            os.path.join(self.directory, "b.gcode")))
+
+    def test_sort(self):
+        self.write("a.gcode", slicer_file(30, 1000, 10))
+        self.write("b.gcode", slicer_file(90, 500, 5))
+        self.write("c.gcode", "G1 X1 E1\n")
+        self.index.scan(self.directory)
+        for key, reverse, names in (("duration", False, "abc"),
+                                    ("duration", True, "bac"),
+                                    ("filament", False, "bac"),
+                                    ("height", False, "bac"),
+                                    ("name", True, "cba")):
+            with self.subTest(key=key, reverse=reverse):
+                jobs = self.index.jobs(self.directory, key, reverse)
+                # Jobs without the key come last
+                self.assertEqual("".join(job.name[0] for job in jobs), names)
+        with self.assertRaises(ValueError):
+            self.index.jobs(self.directory, "path; DROP TABLE jobs")
+
+    def test_parse(self):
+        """Parsing fills what the slicer didn't tell"""
+        path = self.write("a.gcode", "G28\nG1 Z0.2 F600\nG1 X10 E1 F1200\n"
+                                     "T1\nG1 Z0.4\nG1 X20 E2\n")
+        self.index.scan(self.directory)
+        self.assertEqual(self.index.unparsed(self.directory), [path])
+        self.assertIsNone(self.index.get(path).duration)
+        self.assertTrue(self.index.parse(path))
+        job = self.index.get(path)
+        self.assertTrue(job.parsed)
+        self.assertGreater(job.duration, 0)
+        self.assertEqual((job.filament, job.layer_count, job.tools),
+                         (2, 2, 2))
+        self.assertAlmostEqual(job.height, 0.4)
+        self.assertEqual(self.index.unparsed(self.directory), [])
+
+    def test_indexer(self):
+        self.write("a.gcode", slicer_file(30, 1000, 10))
+        self.write("b.gcode", "G1 Z1\nG1 X10 E5 F600\n")
+        indexer = jobindex.JobIndexer(self.index, self.directory,
+                                      interval=0.01, full_parse=True,
+                                      parse_pause=0.01)
+        indexer.start()
+        self.addCleanup(indexer.stop)
+        self.assertTrue(indexer.scanned.wait(5))
+        deadline = time.monotonic() + 5
+        while self.index.unparsed(self.directory) \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+        jobs = self.index.jobs(self.directory, "filament")
+        self.assertEqual([(job.name, job.filament) for job in jobs],
+                         [("b.gcode", 5), ("a.gcode", 1000)])
+        indexer.stop()
+        self.assertFalse(indexer.is_alive())
+
+    def test_format_job(self):
+        self.write("a.gcode", slicer_file(90, 1000, 10, tools=2))
+        self.index.scan(self.directory)
+        self.assertEqual(jobindex.format_job(
+            self.index.jobs(self.directory)[0]),
+            "a.gcode  1:30:00  2000.0 mm  Z 10.00  2 tools")
+
+
+if __name__ == "__main__":
+    unittest.main()
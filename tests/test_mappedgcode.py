@@ -0,0 +1,163 @@
+"""Test suite for `printrun/mappedgcode.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import gzip
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+# Custom libraries:
+from printrun import gcoder
+from printrun.gcodecache import GCodeCache
+from printrun.mappedgcode import MappedGCode, MappedLayer
+
+TESTFILES = sorted(
+    (pathlib.Path(__file__).parent.parent / "testfiles").glob("*.gcode"))
+
+GCODE_ATTRIBUTES = ("filament_length", "filament_length_multi", "xmin",
+                    "xmax", "ymin", "ymax", "zmin", "zmax", "duration",
+                    "current_x", "current_y", "current_z", "current_e",
+                    "current_tool", "relative", "relative_e", "all_zs")
+
+
+def parse(filename):
+    """Parse `filename` with gcoder.LightGCode"""
+    with open(filename, encoding="utf-8") as f:
+        return gcoder.LightGCode(f)
+
+
+class TestMappedGCode(unittest.TestCase):
+    """Compare MappedGCode with LightGCode"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cache = GCodeCache(os.path.join(self.tmp_dir, "cache"))
+
+    def mapped(self, filename, **kwargs):
+        gcode = MappedGCode(filename, **kwargs)
+        self.addCleanup(gcode.close)
+        return gcode
+
+    def assertSameGCode(self, expected, actual):
+        for attr in GCODE_ATTRIBUTES:
+            self.assertEqual(getattr(expected, attr), getattr(actual, attr),
+                             attr)
+        self.assertEqual(len(expected), len(actual))
+        self.assertEqual(
+            [expected.elapsed_time(i) for i in range(len(expected) + 1)],
+            [actual.elapsed_time(i) for i in range(len(actual) + 1)])
+        self.assertEqual(list(expected.elapsed), list(actual.elapsed))
+        self.assertEqual(expected.estimate_duration(),
+                         actual.estimate_duration())
+        self.assertEqual(
+            [(len(layer), layer.z, layer.duration)
+             for layer in expected.all_layers],
+            [(len(layer), layer.z, layer.duration)
+             for layer in actual.all_layers])
+        i = 0
+        while expected.has_index(i):
+            self.assertTrue(actual.has_index(i))
+            self.assertEqual(expected.idxs(i), actual.idxs(i))
+            layer, line = expected.idxs(i)
+            self.assertEqual(expected.all_layers[layer][line].raw,
+                             actual.all_layers[layer][line].raw)
+            i += 1
+        self.assertFalse(actual.has_index(i))
+        self.assertEqual([line.raw for line in expected],
+                         [line.raw for line in actual])
+
+    def test_testfiles(self):
+        """Mapped files give the same results as LightGCode"""
+        for path in TESTFILES:
+            with self.subTest(file=path.name):
+                self.assertSameGCode(parse(path), self.mapped(path))
+
+    def test_cached(self):
+        """Files are mapped the same way from the cache"""
+        for path in TESTFILES:
+            with self.subTest(file=path.name):
+                expected = parse(path)
+                self.assertSameGCode(expected,
+                                     self.mapped(path, cache=self.cache))
+                self.assertIsNotNone(self.cache.lookup(path))
+                self.assertSameGCode(expected,
+                                     self.mapped(path, cache=self.cache))
+
+    def test_file_object(self):
+        """Files can be given as file objects"""
+        with open(TESTFILES[0], encoding="utf-8") as f:
+            actual = self.mapped(f)
+        self.assertSameGCode(parse(TESTFILES[0]), actual)
+
+    def test_compressed(self):
+        """Compressed files are read at the decompressed offsets"""
+        filename = os.path.join(self.tmp_dir, TESTFILES[0].name + ".gz")
+        with open(filename, "wb") as f:
+            f.write(gzip.compress(TESTFILES[0].read_bytes()))
+        expected = parse(TESTFILES[0])
+        self.assertSameGCode(expected, self.mapped(filename))
+        self.assertSameGCode(expected, self.mapped(filename, cache=self.cache))
+        self.assertSameGCode(expected, self.mapped(filename, cache=self.cache))
+
+    def test_layer_callback(self):
+        """The layer callback is called for each layer"""
+        for cache in (None, self.cache, self.cache):
+            layers = []
+            gcode = self.mapped(
+                TESTFILES[0], cache=cache,
+                layer_callback=lambda g, layer: layers.append(layer))
+            self.assertEqual(layers, list(range(len(gcode.all_layers) - 1)))
+
+    def test_append(self):
+        """Appended commands are part of the last layer"""
+        expected = parse(TESTFILES[0])
+        actual = self.mapped(TESTFILES[0], cache=self.cache)
+        for command in ("G91", "G1 X10 E1", "G90"):
+            expected.append(command)
+            actual.append(command)
+        self.assertSameGCode(expected, actual)
+
+    def test_append_elapsed(self):
+        """Appended commands have an estimated time, also when the times
+        are mapped from the cache"""
+        for cache in (None, self.cache, self.cache):
+            expected = parse(TESTFILES[4])  # quick-test.gcode: timed
+            actual = self.mapped(TESTFILES[4], cache=cache)
+            for command in ("G1 X10 F600", "G1 X20"):
+                expected.append(command)
+                actual.append(command)
+            self.assertSameGCode(expected, actual)
+            total = expected.elapsed_time(len(expected))
+            self.assertEqual(actual.index_at_time(total), len(actual))
+
+    def test_empty_file(self):
+        """Empty files give an empty object"""
+        filename = os.path.join(self.tmp_dir, "empty.gcode")
+        with open(filename, "w", encoding="utf-8"):
+            pass
+        self.assertSameGCode(parse(filename), self.mapped(filename))
+
+    def test_edit_layer(self):
+        """Edited layers give the same lines as with LightGCode"""
+        filename = TESTFILES[1]  # layer-detect.gcode: 5 layers
+        for cache in (None, self.cache, self.cache):
+            expected = parse(filename)
+            actual = self.mapped(filename, cache=cache)
+            actual.layer_offsets
+            for gcode in (expected, actual):
+                gcode.append("G1 X5")
+                gcode.prepend_to_layer(["M117 a", "M400"], 2)
+                gcode.rewrite_layer(["G1 X1 Y1"], 1)
+                gcode.append("G1 X6")
+            self.assertSameGCode(expected, actual)
+            self.assertEqual([line.raw for line in expected],
+                             [line.raw for line in actual])
+            self.assertEqual(list(expected.layer_idxs),
+                             list(actual.layer_idxs))
+            self.assertEqual(actual.lines[-1].raw, "G1 X6")
+            self.assertIsInstance(actual.all_layers[3], MappedLayer)
@@ -0,0 +1,90 @@
+"""Test suite for `printrun/meatpack.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import unittest
+
+# Custom libraries:
+from printrun import meatpack
+
+
+LINES = [b"G1 X10.5 Y20 E0.12345\n", b"G1 X1\n", b"M104 S200\n", b"\n",
+         b"N12 G28*37\n", b"M117 H\xc3\xa9llo world\n", b"G92 E0\n"]
+
+
+def packing_decoder(no_spaces=False):
+    """Return a Decoder with packing enabled"""
+    decoder = meatpack.Decoder()
+    decoder.decode(meatpack.command(meatpack.ENABLE_PACKING))
+    if no_spaces:
+        decoder.decode(meatpack.command(meatpack.ENABLE_NO_SPACES))
+    return decoder
+
+
+class TestEncoder(unittest.TestCase):
+    """Test the packing of lines"""
+
+    def test_round_trip(self):
+        """Packed lines decode to the original ones"""
+        for no_spaces in (False, True):
+            with self.subTest(no_spaces=no_spaces):
+                encoder = meatpack.Encoder(no_spaces)
+                decoder = packing_decoder(no_spaces)
+                for line in LINES:
+                    self.assertEqual(decoder.decode(encoder.encode(line)),
+                                     line)
+                data = b"".join(LINES)
+                self.assertEqual(decoder.decode(encoder.encode(data)), data)
+
+    def test_packing(self):
+        """Table characters take half a byte, others a byte and a half"""
+        encoder = meatpack.Encoder()
+        # First character in the low nibble
+        self.assertEqual(encoder.encode(b"G1 X0\n"), bytes((0x1d, 0xeb, 0xc0)))
+        # A byte ending with the newline is padded
+        self.assertEqual(encoder.encode(b"G1\n"), bytes((0x1d, 0x0c)))
+        self.assertEqual(len(encoder.encode(b"G1 X10.5 Y20\n")), 8)
+        self.assertEqual(len(meatpack.Encoder(True).encode(b"G1X1E.5\n")), 4)
+
+    def test_partial_writes(self):
+        """Incomplete lines are packed once complete"""
+        encoder = meatpack.Encoder()
+        decoder = packing_decoder()
+        data = b"".join(LINES)
+        packed = b"".join(encoder.encode(data[i:i + 5])
+                          for i in range(0, len(data), 5))
+        self.assertEqual(encoder.pending, b"")
+        # Split the packed bytes anywhere
+        self.assertEqual(decoder.decode(packed[:7]) + decoder.decode(packed[7:]),
+                         data)
+        self.assertEqual(encoder.encode(b"G1"), b"")
+        self.assertEqual(decoder.decode(encoder.encode(b" X1\n")), b"G1 X1\n")
+
+
+class TestDecoder(unittest.TestCase):
+    """Test the firmware side of the protocol"""
+
+    def test_commands(self):
+        decoder = meatpack.Decoder()
+        self.assertEqual(decoder.decode(b"G1 X1\n"), b"G1 X1\n")
+        decoder.decode(meatpack.command(meatpack.QUERY_CONFIG))
+        decoder.decode(meatpack.command(meatpack.ENABLE_PACKING)
+                       + meatpack.command(meatpack.ENABLE_NO_SPACES)
+                       + meatpack.command(meatpack.QUERY_CONFIG))
+        self.assertTrue(decoder.active)
+        self.assertEqual(decoder.reports, ["[MP] PV01 OFF ESP\n",
+                                           "[MP] PV01 ON NSP\n"])
+        decoder.decode(meatpack.command(meatpack.RESET_ALL))
+        self.assertFalse(decoder.active or decoder.no_spaces)
+
+    def test_parse_report(self):
+        self.assertEqual(meatpack.parse_report("[MP] PV01 ON ESP\n"),
+                         (True, False))
+        self.assertEqual(meatpack.parse_report(meatpack.report(False, True)),
+                         (False, True))
+        self.assertIsNone(meatpack.parse_report("ok T:20"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+"""Test suite for `printrun/planner.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import math
+import pathlib
+import unittest
+
+# Custom libraries:
+from printrun import gcoder
+from printrun import planner
+
+try:
+    import numpy  # noqa: F401 pylint: disable=unused-import
+except ImportError:
+    numpy = None
+
+TESTFILES = sorted(
+    (pathlib.Path(__file__).parent.parent / "testfiles").glob("*.gcode"))
+
+M503 = """echo:; Maximum feedrates (units/s):
+echo:  M203 X500.00 Y500.00 Z12.00 E120.00
+echo:; Maximum Acceleration (units/s2):
+echo:  M201 X9000.00 Y9000.00 Z500.00 E10000.00
+echo:; Acceleration (units/s2): P<print_accel> R<retract_accel> T<travel_accel>
+echo:  M204 P1500.00 R1500.00 T1500.00
+echo:; Advanced: B<min_segment_time_us> S<min_feedrate> T<min_travel_feedrate> J<junc_dev>
+echo:  M205 B20000.00 S0.00 T0.00 J0.02
+echo:; PID settings:
+echo:  M301 P22.20 I1.08 D114.00
+"""
+
+
+def limits(text=""):
+    """Return MachineLimits with `text` applied"""
+    return planner.MachineLimits().update_from_text(text)
+
+
+def duration(text, machine_limits=None, buffer_size=16):
+    """Return the planned duration of the G-code in `text`"""
+    lines = text.split("\n")
+    gcode = gcoder.LightGCode(lines)
+    return planner.MotionPlanner(machine_limits, buffer_size) \
+        .line_durations(gcode, [line.raw for line in gcode]).sum()
+
+
+class TestMachineLimits(unittest.TestCase):
+    """Test the parsing of limit commands"""
+
+    def test_m503(self):
+        """M503 responses set the limits"""
+        machine_limits = limits(M503)
+        self.assertEqual(machine_limits.max_feedrate, [500, 500, 12, 120])
+        self.assertEqual(machine_limits.max_acceleration,
+                         [9000, 9000, 500, 10000])
+        self.assertEqual(machine_limits.acceleration, 1500)
+        self.assertEqual(machine_limits.junction_deviation, 0.02)
+
+    def test_classic_jerk(self):
+        """Jerk limits without junction deviation select classic jerk"""
+        machine_limits = limits("M205 X8 Y8 Z0.4 E4.5")
+        self.assertIsNone(machine_limits.junction_deviation)
+        self.assertEqual(machine_limits.jerk, [8, 8, 0.4, 4.5])
+
+    def test_one_line(self):
+        """Several commands can be given on one line"""
+        machine_limits = limits("M203 X200 M204 S800")
+        self.assertEqual(machine_limits.max_feedrate[0], 200)
+        self.assertEqual(machine_limits.acceleration, 800)
+        self.assertEqual(machine_limits.travel_acceleration, 800)
+
+    def test_str(self):
+        """Limits are written back as commands"""
+        for text in (M503, "M205 X8 Y8"):
+            machine_limits = limits(text)
+            self.assertEqual(limits(str(machine_limits)), machine_limits)
+
+    def test_report(self):
+        """Limit reports of the printer are recognized"""
+        self.assertTrue(planner.report_exp.match("echo:  M201 X9000.00"))
+        self.assertTrue(planner.report_exp.match("M204 P1500 R1500 T1500"))
+        self.assertFalse(planner.report_exp.match("echo:  M301 P22.20"))
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestMotionPlanner(unittest.TestCase):
+    """Test the planned durations"""
+
+    def test_trapezoid(self):
+        """A long move accelerates, cruises and decelerates"""
+        # 5 mm to reach 100 mm/s at 1000 mm/s2, 5 mm to stop
+        self.assertAlmostEqual(
+            duration("G1 X100 F6000", limits("M204 P1000 T1000")), 1.1,
+            places=2)
+
+    def test_triangle(self):
+        """A short move does not reach its feedrate"""
+        # Accelerate over 1 mm then decelerate over 1 mm at 1000 mm/s2
+        self.assertAlmostEqual(
+            duration("G1 X2 F6000", limits("M204 P1000 T1000")),
+            2 * math.sqrt(2 * 1 / 1000), places=3)
+
+    def test_axis_limits(self):
+        """Per axis limits slow down the moves"""
+        self.assertAlmostEqual(duration("G1 Z10 F6000", limits("M203 Z5 M201 Z1000")),
+                               2 + 5 / 1000, places=3)
+
+    def test_lookahead(self):
+        """Aligned segments are planned as one move, within the buffer"""
+        single = duration("G1 X100 F6000")
+        segments = "\n".join("G1 X%d F6000" % x for x in range(1, 101))
+        self.assertAlmostEqual(duration(segments, buffer_size=128), single,
+                               places=3)
+        self.assertGreater(duration(segments, buffer_size=2), single + 0.1)
+
+    def test_jerk(self):
+        """Corners are taken at the speed allowed by jerk or junction
+        deviation"""
+        corner = "G1 X50 F6000\nG1 X50 Y50"
+        straight = "G1 X50 F6000\nG1 X100"
+        jerk = limits("M205 X10 Y10")
+        deviation = limits("M205 J0.01")
+        self.assertGreater(duration(corner, jerk), duration(straight, jerk))
+        self.assertGreater(duration(corner, deviation),
+                           duration(corner, jerk))
+
+    def test_limits_in_file(self):
+        """Limit commands of the file apply to the following moves"""
+        self.assertGreater(duration("M204 P100 T100\nG1 X100 F6000"),
+                           duration("G1 X100 F6000"))
+
+    def test_waits(self):
+        """Dwells and heater waits are added"""
+        self.assertAlmostEqual(duration("G4 P1500\nG4 S2"), 3.5)
+        self.assertAlmostEqual(duration("M109 S205"), 90)
+        # The hotend heats during the bed wait
+        self.assertAlmostEqual(duration("M104 S205\nM190 S60\nM109 S205"),
+                               70 + 20)
+        self.assertAlmostEqual(duration("M109 S25"), 0)
+
+    def test_arc(self):
+        """Arcs last as long as moves of the same length"""
+        self.assertAlmostEqual(
+            duration("G1 X10 F600\nG2 X10 Y0 I10 J0"),
+            duration("G1 X10 F600\nG1 Y%f" % (20 * math.pi)), places=2)
+
+    def test_apply(self):
+        """The durations of the layers add up to the duration"""
+        for path in TESTFILES:
+            with self.subTest(file=path.name):
+                with open(path, encoding="utf-8") as f:
+                    gcode = gcoder.LightGCode(f)
+                durations = planner.MotionPlanner().apply(gcode)
+                self.assertEqual(len(durations), len(gcode))
+                total = sum(layer.duration for layer in gcode.all_layers)
+                self.assertAlmostEqual(total, durations.sum())
+                self.assertEqual(gcode.duration.total_seconds(), int(total))
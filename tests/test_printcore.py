@@ -7,8 +7,10 @@ It also serves as a test for printrun.eventhandler.PrinterEventHandler.
 #   python3 -m unittest discover tests
 
 # Standard libraries:
+import queue
 import random
 import socket
+import threading
 import time
 import unittest
 from unittest import mock
@@ -17,7 +19,10 @@ from unittest import mock
 import serial
 from printrun import eventhandler
 from printrun import gcoder
+from printrun import grbl
+from printrun import meatpack
 from printrun import printcore
+from printrun import transcoder
 
 
 DEFAULT_ANSWER = 'ok:\n'
@@ -35,6 +40,15 @@ def wait_printer_cycles(cycles):
     time.sleep(CNC_PROCESS_TIME*cycles)
 
 
+def wait_until(condition, cycles):
+    """Wait up to `cycles` printer cycles for `condition()` to be true and
+    return its last value"""
+    deadline = time.monotonic() + CNC_PROCESS_TIME*cycles
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(CNC_PROCESS_TIME/10)
+    return condition()
+
+
 def mock_sttyhup(cls):
     """Fake stty control"""
     # Needed to avoid error:
@@ -547,9 +561,8 @@ class TestPrint(unittest.TestCase):
                      (self.mocked_handler.on_end, self.end_cb),
                      "assert_called_once")
 
-        # Resume print
+        # Resume print, the rest of it may be sent within a few cycles
         self.core.resume()
-        wait_printer_cycles(6)
 
         with self.subTest("Check `paused` is unset after resuming"):
             self.assertFalse(self.core.paused)
@@ -557,12 +570,13 @@ class TestPrint(unittest.TestCase):
         with self.subTest("Check `printing` is set after resuming"):
             self.assertTrue(self.core.printing)
 
+        wait_until(lambda: self.start_cb.call_count == 2, 6)
         subtest_mock(self, "Check `start` event/callback when resuming",
                      (self.start_cb, self.mocked_handler.on_start),
                      "assert_called_with", True)
 
         # Let the print finish
-        wait_printer_cycles(self.print_line_count*1.5)
+        wait_until(lambda: not self.core.printing, self.print_line_count*1.5)
 
         with self.subTest("Check that `resume` finishes the print"):
             self.check_finished_print()
@@ -601,6 +615,100 @@ class TestPrint(unittest.TestCase):
                      (self.mocked_handler.on_end, self.end_cb),
                      "assert_called_once")
 
+    def test_transcoded_print(self):
+        """Test that the precomputed lines of the main queue are sent, and
+        only trimmed ones after starting mid file"""
+        print_code = gcoder.GCode(["G1 X1.000 Y2.000 F1800",
+                                   "G1 X1.000 Y3.000 F1800",
+                                   "G1 X2.000 Y3.000 F1800",
+                                   "G1 X2.000 Y3.000 F1800",
+                                   "G92 E0", "G1 X2.000 Y4.000"])
+        print_code.wire_lines = transcoder.Transcoder().transcode(print_code)
+        for startindex, sent in ((0, ["G1 X1 Y2 F1800", "G1 Y3", "G1 X2",
+                                      "G92 E0", "G1 X2 Y4"]),
+                                 (2, ["G1 X2 Y3 F1800", "G1 X2 Y3 F1800",
+                                      "G92 E0", "G1 X2 Y4"])):
+            with self.subTest(startindex=startindex):
+                write = self.mocked_serial.return_value.write
+                write.reset_mock()
+                self.core.startprint(print_code, startindex=startindex)
+                wait_printer_cycles(len(sent)*3)
+                self.assertEqual(
+                    [call.args[0] for call in write.mock_calls
+                     if call.args[0].startswith(b"N")],
+                    [checksum_command(command, lineno)
+                     for lineno, command in enumerate(sent)])
+
+    def test_priority_command_resync(self):
+        """Test that a command sent while printing that may change the
+        position or feedrate makes the next lines be sent in full"""
+        print_code = gcoder.GCode(["G1 X1 Y2 F1800", "G1 X1 Y3 F1800",
+                                   "G1 X1 Y4 F1800"])
+        print_code.wire_lines = transcoder.Transcoder().transcode(print_code)
+        for command, sent in (("M105", ["G1 X1 Y2 F1800", "G1 Y3", "G1 Y4"]),
+                              ("G1 X5 F300", ["G1 X1 Y2 F1800",
+                                              "G1 X1 Y3 F1800",
+                                              "G1 X1 Y4 F1800"])):
+            with self.subTest(command=command):
+                write = self.mocked_serial.return_value.write
+                write.reset_mock()
+                self.mocked_handler.on_printsend.side_effect = \
+                    lambda gline, command=command: (
+                        self.core.send_now(command)
+                        if gline is print_code.lines[0] else None)
+                self.core.startprint(print_code)
+                wait_printer_cycles(len(sent)*4)
+                written = [call.args[0] for call in write.mock_calls]
+                self.assertIn(f"{command}\n".encode(), written)
+                self.assertEqual(
+                    [line for line in written if line.startswith(b"N")],
+                    [checksum_command(line, lineno)
+                     for lineno, line in enumerate(sent)])
+
+    def test_streaming_print(self):
+        """Test that a print starts without waiting for a streamed file to
+        be parsed, and that pausing doesn't wait for the parser"""
+        source = queue.Queue()
+        print_code = gcoder.StreamingGCode(iter(source.get, None),
+                                           split_layers=False)
+        self.addCleanup(print_code.wait, 5)
+        self.addCleanup(source.put, None)
+        started = time.monotonic()
+        self.assertTrue(self.core.startprint(print_code))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertTrue(self.core.printing)
+        started = time.monotonic()
+        self.core.pause()
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertTrue(self.core.paused)
+        self.core.resume()
+        write = self.mocked_serial.return_value.write
+        source.put("G1 X1")
+        source.put(None)
+        self.assertTrue(print_code.wait(5))
+        wait_printer_cycles(20)
+        self.assertIn(checksum_command("G1 X1", 0),
+                      [call.args[0] for call in write.mock_calls])
+
+    def test_excluded_objects(self):
+        """Test that the moves of excluded objects are skipped and the
+        fixups sent in their place"""
+        print_code = gcoder.GCode(["G1 Z0.2", "; printing object a",
+                                   "G1 X1 E1", "G1 X2 E2",
+                                   "; stop printing object a",
+                                   "; printing object b", "G1 X3 E3",
+                                   "; stop printing object b"])
+        print_code.exclude_objects(["a"])
+        write = self.mocked_serial.return_value.write
+        write.reset_mock()
+        self.core.startprint(print_code)
+        wait_printer_cycles(20)
+        self.assertEqual(
+            [call.args[0] for call in write.mock_calls
+             if not call.args[0].startswith(b"M110")],
+            [checksum_command("G1 Z0.2", 0), b"G92 E2\n",
+             checksum_command("G1 X3 E3", 1)])
+
     def test_host_command(self):
         """Test calling host-commands"""
         print_lines = []
@@ -613,6 +721,420 @@ class TestPrint(unittest.TestCase):
         self.assertTrue(self.core.paused)
 
 
+class MeatPackFirmware:
+    """Fake firmware with MeatPack support behind a mocked serial.Serial"""
+
+    def __init__(self, resend=None):
+        self.decoder = meatpack.Decoder()
+        self.buffer = b""
+        self.written = 0
+        self.received = []
+        self.replies = queue.Queue()
+        # Line number to ask to resend once
+        self.resend = resend
+
+    def write(self, data):
+        self.written += len(data)
+        self.buffer += self.decoder.decode(data)
+        for report in self.decoder.reports:
+            self.replies.put(report)
+        self.decoder.reports.clear()
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            if not line:
+                continue
+            self.received.append(line)
+            if self.resend is not None and \
+                    line.startswith(b"N%d " % self.resend):
+                self.resend = None
+                self.replies.put("Resend: %d\n" % int(line[1:].split()[0]))
+            self.replies.put("ok\n")
+
+    def readline(self, *args):
+        try:
+            return self.replies.get(timeout=0.01).encode()
+        except queue.Empty:
+            return b""
+
+
+class TestMeatPack(unittest.TestCase):
+    """Functional checks for MeatPack packing"""
+
+    @classmethod
+    def setUpClass(cls):
+        mock_sttyhup(cls)
+
+    def connect(self, firmware, enabled=True):
+        mocked_serial = mock_serial(self, firmware.readline)
+        mocked_serial.return_value.write.side_effect = firmware.write
+        core = printcore.printcore()
+        self.addCleanup(core.disconnect)
+        core.meatpack = enabled
+        core.connect("/mocked/port", 1000)
+        wait_printer_cycles(10)
+        return core
+
+    def test_negotiation(self):
+        """Packing is enabled once the firmware reports its support"""
+        firmware = MeatPackFirmware()
+        core = self.connect(firmware)
+        self.assertTrue(core.online)
+        self.assertTrue(firmware.decoder.active)
+        self.assertIsNotNone(core.printer.meatpack)
+
+    def test_disabled(self):
+        """Lines are not packed unless requested"""
+        firmware = MeatPackFirmware()
+        core = self.connect(firmware, enabled=False)
+        self.assertFalse(firmware.decoder.active)
+        self.assertIsNone(core.printer.meatpack)
+
+    def test_print(self):
+        """Packed lines keep their numbers and checksums, and resends
+        work"""
+        firmware = MeatPackFirmware(resend=3)
+        core = self.connect(firmware)
+        lines = ["G1 X%d.5 Y20.25 E%d.125" % (i, i) for i in range(10)]
+        written = firmware.written
+        core.startprint(gcoder.GCode(lines))
+        wait_printer_cycles(len(lines) * 2)
+        received = [line for line in firmware.received
+                    if line.startswith(b"N")]
+        expected = [checksum_command(line, i).rstrip()
+                    for i, line in enumerate(lines)]
+        self.assertEqual(received[:4], expected[:4])
+        # Lines are resent from the requested one
+        self.assertEqual(received[4], expected[3])
+        self.assertEqual(received[-len(lines) + 3:], expected[3:])
+        self.assertLess(firmware.written - written,
+                        sum(map(len, received)) * 0.8)
+
+
+class BufferedFirmware:
+    """Fake Marlin firmware with a command buffer of `size` lines behind a
+    mocked serial.Serial, answering with ADVANCED_OK replies"""
+
+    def __init__(self, size=4, advanced_ok=True, corrupt=(), drop=False):
+        self.size = size
+        self.advanced_ok = advanced_ok
+        # Line numbers received corrupted once
+        self.corrupt = set(corrupt)
+        # Drop the lines buffered after a bad line as Marlin flushes its
+        # input
+        self.drop = drop
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.replies = []
+        self.accepted = []
+        self.received = 0
+        self.last_lineno = -1
+        self.most_buffered = 0
+
+    def write(self, data):
+        with self.lock:
+            self.buffer += [line for line in data.decode().split("\n")
+                            if line]
+            self.most_buffered = max(self.most_buffered, len(self.buffer))
+
+    def ok(self):
+        if not self.advanced_ok:
+            return "ok\n"
+        # The acknowledged command still holds its slot
+        return "ok N%d P15 B%d\n" % (self.last_lineno,
+                                      self.size - len(self.buffer) - 1)
+
+    def process(self, line):
+        if not line.startswith("N"):
+            self.replies.append(self.ok())
+            return
+        self.received += 1
+        command = line.split("*")[0]
+        lineno = int(command[1:].split()[0])
+        if "M110" in command:
+            self.last_lineno = lineno
+        elif lineno in self.corrupt or lineno != self.last_lineno + 1:
+            self.corrupt.discard(lineno)
+            self.replies.append("Error:checksum mismatch, Last Line: %d\n"
+                                % self.last_lineno)
+            self.replies.append("Resend: %d\n" % (self.last_lineno + 1))
+            self.replies.append("ok\n")
+            if self.drop:
+                self.buffer.clear()
+            return
+        else:
+            self.last_lineno = lineno
+            self.accepted.append(command.split(" ", 1)[1])
+        self.replies.append(self.ok())
+
+    def readline(self, *args):
+        time.sleep(0.001)
+        with self.lock:
+            if not self.replies and self.buffer:
+                self.process(self.buffer.pop(0))
+            if self.replies:
+                return self.replies.pop(0).encode()
+        return b""
+
+
+class TestSendWindow(unittest.TestCase):
+    """Functional checks for sending lines ahead of their ok"""
+
+    LINES = ["G1 X%d Y%d" % (i, i % 7) for i in range(60)]
+
+    @classmethod
+    def setUpClass(cls):
+        mock_sttyhup(cls)
+
+    def print_lines(self, firmware, window):
+        mocked_serial = mock_serial(self, firmware.readline)
+        mocked_serial.return_value.write.side_effect = firmware.write
+        core = printcore.printcore()
+        self.addCleanup(core.disconnect)
+        core.send_window = window
+        self.errors = []
+        core.errorcb = self.errors.append
+        core.connect("/mocked/port", 1000)
+        deadline = time.monotonic() + 5
+        while not core.online and time.monotonic() < deadline:
+            time.sleep(0.01)
+        core.startprint(gcoder.GCode(self.LINES))
+        time.sleep(0.05)
+        deadline = time.monotonic() + 10
+        while (core.printing or firmware.buffer or firmware.replies) \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return core
+
+    def test_learned_window(self):
+        """The window is the command buffer size reported by ADVANCED_OK"""
+        firmware = BufferedFirmware(size=4)
+        core = self.print_lines(firmware, 0)
+        self.assertEqual(firmware.accepted, self.LINES)
+        self.assertEqual(core._window_size(), 4)
+        self.assertEqual(firmware.most_buffered, 4)
+        self.assertEqual(core.planner_free, 15)
+
+    def test_stop_and_wait(self):
+        firmware = BufferedFirmware(size=4)
+        self.print_lines(firmware, 1)
+        self.assertEqual(firmware.accepted, self.LINES)
+        self.assertEqual(firmware.most_buffered, 1)
+
+    def check_resend(self, **kwargs):
+        firmware = BufferedFirmware(size=4, corrupt=(5, 6, 30), **kwargs)
+        core = self.print_lines(firmware, 4)
+        self.assertEqual(firmware.accepted, self.LINES)
+        self.assertLessEqual(firmware.most_buffered, 4)
+        # At most the lines in flight are resent for each bad line
+        self.assertLessEqual(firmware.received - len(self.LINES), 3 * 4)
+        self.assertFalse(core._in_flight)
+        self.assertIn("Error:checksum mismatch, Last Line: 4\n", self.errors)
+
+    def test_resend(self):
+        """Lines rejected after a bad one are resent once, in order"""
+        self.check_resend()
+
+    def test_resend_dropped(self):
+        """Lines dropped by the firmware after a bad one are resent"""
+        self.check_resend(drop=True)
+
+    def test_resend_plain_ok(self):
+        """Resends work with an explicit window and plain oks"""
+        self.check_resend(advanced_ok=False)
+
+
+class TestWaking(unittest.TestCase):
+    """Functional checks for waking the threads waiting to send"""
+
+    @classmethod
+    def setUpClass(cls):
+        mock_sttyhup(cls)
+
+    def setUp(self):
+        # Only the wake-ups can unblock the waiting threads in time
+        self.enterContext(mock.patch.object(printcore, "WAIT_TIMEOUT", 30))
+        self.answers = ["ok\n"]
+        mocked_serial = mock_serial(self, self.readline)
+        self.write = mocked_serial.return_value.write
+        self.core = printcore.printcore()
+        self.addCleanup(self.core.disconnect)
+        self.core.connect("/mocked/port", 1000)
+        deadline = time.monotonic() + 5
+        while not self.core.online and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def readline(self, *args):
+        time.sleep(0.001)
+        return self.answers.pop(0).encode() if self.answers else b""
+
+    def wait_write(self, data):
+        deadline = time.monotonic() + 5
+        while mock.call(data) not in self.write.mock_calls \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.write.assert_any_call(data)
+
+    def test_send_now(self):
+        """The idle sender sends the commands as they are queued"""
+        self.core.send_now("M114")
+        self.wait_write(b"M114\n")
+
+    def test_ok(self):
+        """An ok wakes the print thread waiting for it"""
+        self.core.startprint(gcoder.GCode(["G1 X1", "G1 X2"]))
+        self.wait_write(b"M110 N-1\n")
+        self.answers.append("ok\n")
+        self.wait_write(checksum_command("G1 X1", 0))
+        self.assertEqual(len(self.core.send_latencies), 1)
+        self.assertLess(self.core.send_latencies[0], 5)
+
+    def test_pause(self):
+        """Pausing wakes the print thread waiting for an ok"""
+        self.core.startprint(gcoder.GCode(["G1 X1", "G1 X2"]))
+        self.wait_write(b"M110 N-1\n")
+        start = time.monotonic()
+        self.core.pause()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIsNone(self.core.print_thread)
+
+
+class GrblFirmware:
+    """Fake Grbl controller with a serial buffer of `size` bytes behind a
+    mocked serial.Serial"""
+
+    def __init__(self, size=grbl.RX_BUFFER_SIZE, alarm_after=None):
+        self.size = size
+        # Raise ALARM:1 once this many lines are accepted
+        self.alarm_after = alarm_after
+        self.lock = threading.Lock()
+        self.rx = b""
+        self.replies = ["Grbl 1.1h ['$' for help]\r\n"]
+        self.accepted = []
+        self.realtime = []
+        self.most_buffered = 0
+        self.overflowed = False
+
+    def write(self, data):
+        with self.lock:
+            for byte in (data[i:i + 1] for i in range(len(data))):
+                if byte in grbl.REALTIME:
+                    self.realtime.append(byte)
+                    if byte == grbl.STATUS_REPORT:
+                        self.replies.insert(
+                            0, "<Idle|MPos:1.000,2.000,3.000|Bf:15,%d|"
+                            "FS:0,0|WCO:1.000,1.000,1.000>\r\n"
+                            % (self.size - len(self.rx)))
+                else:
+                    self.rx += byte
+            self.overflowed |= len(self.rx) > self.size
+            self.most_buffered = max(self.most_buffered, len(self.rx))
+
+    def process(self, line):
+        if line.startswith("G99"):
+            self.replies.append("error:20\r\n")
+            return
+        self.accepted.append(line)
+        if len(self.accepted) == self.alarm_after:
+            self.rx = b""
+            self.replies.append("ALARM:1\r\n")
+            return
+        self.replies.append("ok\r\n")
+
+    def readline(self, *args):
+        time.sleep(0.001)
+        with self.lock:
+            if not self.replies and b"\n" in self.rx:
+                line, self.rx = self.rx.split(b"\n", 1)
+                self.process(line.decode())
+            if self.replies:
+                return self.replies.pop(0).encode()
+        return b""
+
+
+class TestGrbl(unittest.TestCase):
+    """Functional checks for streaming to Grbl"""
+
+    LINES = ["G1 X%d.125 Y%d.5 F%d" % (i, i % 7, 1000 + i) for i in range(80)]
+
+    @classmethod
+    def setUpClass(cls):
+        mock_sttyhup(cls)
+
+    def connect(self, firmware):
+        mocked_serial = mock_serial(self, firmware.readline)
+        mocked_serial.return_value.write.side_effect = firmware.write
+        core = printcore.printcore()
+        self.addCleanup(core.disconnect)
+        self.errors = []
+        core.errorcb = self.errors.append
+        core.connect("/mocked/port", 115200, grbl=True)
+        deadline = time.monotonic() + 5
+        while not core.online and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return core
+
+    def print_lines(self, firmware, lines):
+        core = self.connect(firmware)
+        core.startprint(gcoder.GCode(lines))
+        time.sleep(0.05)
+        deadline = time.monotonic() + 10
+        while (core.printing or firmware.rx or firmware.replies) \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return core
+
+    def test_streaming(self):
+        """Lines are sent as long as they fit in the serial buffer"""
+        firmware = GrblFirmware()
+        core = self.print_lines(firmware, self.LINES)
+        # Without line numbers, checksums nor M110
+        self.assertEqual(firmware.accepted, self.LINES)
+        self.assertFalse(firmware.overflowed)
+        self.assertGreater(firmware.most_buffered,
+                           grbl.RX_BUFFER_SIZE - len(self.LINES[-1]) - 1)
+        self.assertEqual(len(core._grbl_buffer), 0)
+        self.assertEqual(self.errors, [])
+
+    def test_error(self):
+        """Errors are logged with their line and streaming goes on"""
+        firmware = GrblFirmware()
+        self.print_lines(firmware, self.LINES[:10] + ["G99"]
+                         + self.LINES[10:])
+        self.assertEqual(firmware.accepted, self.LINES)
+        self.assertEqual(self.errors, ["error:20 (Unsupported command): G99"])
+
+    def test_alarm(self):
+        """The print is paused when Grbl raises an alarm"""
+        firmware = GrblFirmware(alarm_after=20)
+        core = self.print_lines(firmware, self.LINES)
+        self.assertTrue(core.paused)
+        self.assertIn("ALARM:1 (Hard limit)", self.errors)
+        self.assertEqual(len(core._grbl_buffer), 0)
+        self.assertLess(core.queueindex, len(self.LINES))
+
+    def test_realtime(self):
+        """Realtime commands bypass the queues, status reports are parsed"""
+        firmware = GrblFirmware()
+        core = self.connect(firmware)
+        statuses = []
+        core.statuscb = statuses.append
+        core.send_now("?")
+        core.send_realtime(grbl.FEED_HOLD)
+        core.send_realtime(grbl.FEED_OVERRIDE_PLUS_10)
+        with self.assertRaises(ValueError):
+            core.send_realtime(b"G")
+        deadline = time.monotonic() + 5
+        while not statuses and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # After the status report asked when connecting
+        self.assertEqual(firmware.realtime[-3:],
+                         [grbl.STATUS_REPORT, grbl.FEED_HOLD,
+                          grbl.FEED_OVERRIDE_PLUS_10])
+        self.assertEqual(firmware.rx, b"")
+        self.assertEqual(statuses[-1].wpos, (0, 1, 2))
+        self.assertIs(core.grbl_status, statuses[-1])
+
+
 class TestReset(unittest.TestCase):
     """Functional checks for the reset method"""
 
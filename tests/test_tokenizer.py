@@ -0,0 +1,104 @@
+"""Test suite for `printrun/tokenizer.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import pathlib
+import random
+import re
+import unittest
+
+# Custom libraries:
+from printrun import gcoder
+from printrun import tokenizer
+
+try:
+    from printrun import gcoder_tokenizer
+except ImportError:
+    gcoder_tokenizer = None
+
+TESTFILES = sorted(
+    (pathlib.Path(__file__).parent.parent / "testfiles").glob("*.gcode"))
+
+FUNCTIONS = ("tokenize", "split", "find_code", "report_words",
+             "strip_comments")
+
+
+def random_lines(count, seed=0):
+    """Return `count` random lines made of G-code characters"""
+    rng = random.Random(seed)
+    alphabet = "GMTXYZEFSPgxyz0123456789.-+ \t;()*:"
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randrange(30)))
+            for _ in range(count)]
+
+
+def calls(line):
+    """Return the tokenizer calls to check for `line`"""
+    return [("tokenize", (line,)),
+            ("split", (line, gcoder.to_parse)),
+            ("find_code", (line, "S")),
+            ("find_code", (line, "p")),
+            ("report_words", (line, "XYZ")),
+            ("strip_comments", (line,))]
+
+
+class TestTokenizer(unittest.TestCase):
+    """Test the tokenizer functions"""
+
+    def test_tokenize(self):
+        """Lines are split in words, comments and checksum"""
+        self.assertEqual(
+            tokenizer.tokenize("N3 G1 X-1.5 y .2 (move) E+3. *17 ; done"),
+            [("n", "3"), ("g", "1"), ("x", "-1.5"), ("y", ".2"),
+             ("(", "move"), ("e", "+3."), ("*", "17"), (";", " done")])
+        self.assertEqual(tokenizer.tokenize(""), [])
+
+    def test_split(self):
+        """Only the requested letters are kept"""
+        self.assertEqual(
+            tokenizer.split("G1 X10 M5 (c) Y2 ;x3", "gxy"),
+            [("g", "1"), ("x", "10"), ("", ""), ("y", "2"), ("", "")])
+
+    def test_find_code(self):
+        """Codes are found in any case, outside comments"""
+        self.assertEqual(tokenizer.find_code("M104 (S1) S210", "S"), "210")
+        self.assertEqual(tokenizer.find_code("m104 s210", "S"), "210")
+        self.assertEqual(tokenizer.find_code("M104 ; S210", "S"), None)
+        self.assertEqual(tokenizer.find_code("M104 S", "S"), "")
+
+    def test_report_words(self):
+        """Position reports are parsed with or without colons"""
+        self.assertEqual(
+            tokenizer.report_words("X:10.00 Y:20.00 Z:0.30 E:0.00", "XYZ"),
+            [("X", "10.00"), ("Y", "20.00"), ("Z", "0.30")])
+        self.assertEqual(tokenizer.report_words("X1 Y2 Z3", "XYZ"),
+                         [("X", "1"), ("Y", "2"), ("Z", "3")])
+
+    def test_strip_comments(self):
+        """Comments are removed"""
+        self.assertEqual(tokenizer.strip_comments("G1 (a) X1 ;b"), "G1  X1 ")
+        self.assertEqual(tokenizer.strip_comments("G28"), "G28")
+
+    def test_former_expressions(self):
+        """The tokenizer agrees with the expressions it replaces"""
+        gcode_exp = re.compile(r"\([^\(\)]*\)|;.*|([%s])\s*([-+]?[0-9]*\.?[0-9]*)"
+                               % gcoder.to_parse)
+        for line in random_lines(5000):
+            with self.subTest(line=line):
+                self.assertEqual(tokenizer.py_split(line, gcoder.to_parse),
+                                 gcode_exp.findall(line.lower()))
+
+    @unittest.skipIf(gcoder_tokenizer is None,
+                     "compiled tokenizer is not built")
+    def test_compiled(self):
+        """The compiled and Python tokenizers give the same results"""
+        lines = random_lines(5000)
+        for path in TESTFILES:
+            with open(path, encoding="utf-8") as f:
+                lines += f.read().splitlines()
+        for line in lines:
+            for name, args in calls(line):
+                with self.subTest(function=name, line=line):
+                    self.assertEqual(
+                        getattr(gcoder_tokenizer, name)(*args),
+                        getattr(tokenizer, "py_" + name)(*args))
@@ -0,0 +1,140 @@
+"""Test suite for `printrun/transcoder.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import unittest
+
+# Custom libraries:
+from printrun import gcoder
+from printrun import printcore
+from printrun import transcoder
+
+
+def transcode(lines, **kwargs):
+    """Return the lines sent for `lines`"""
+    wire = transcoder.Transcoder(**kwargs).transcode(gcoder.GCode(lines))
+    return [wire[i][0] for i in range(len(wire))]
+
+
+class TestNumbers(unittest.TestCase):
+    """Test the shortening of numbers"""
+
+    def test_trim_number(self):
+        for value, trimmed in (("10.000", "10"), ("0.500", ".5"),
+                               ("-0.50", "-.5"), ("+2", "2"), ("007", "7"),
+                               ("0", "0"), ("0.0", "0"), ("-0.000", "0"),
+                               ("100", "100"), ("1.", "1"), (".25", ".25")):
+            with self.subTest(value=value):
+                self.assertEqual(transcoder.trim_number(value), trimmed)
+
+    def test_format_number(self):
+        self.assertEqual(transcoder.format_number("1.23456", 3), "1.235")
+        self.assertEqual(transcoder.format_number("1.2", 3), "1.2")
+        self.assertEqual(transcoder.format_number("0.0004", 3), "0")
+        self.assertEqual(transcoder.format_number("9.9996", 3), "10")
+
+
+class TestTranscoder(unittest.TestCase):
+    """Test the lines sent for G-code files"""
+
+    def test_trim(self):
+        """Numbers are trimmed and rounded in absolute millimeters"""
+        self.assertEqual(
+            transcode(["G90", "M82", "G1 X10.000 Y0.5000 E1.234567 F1800.0",
+                       "g1 x 20 y+1 ; comment", "G01 Z0.30000"]),
+            ["G90", "M82", "G1 X10 Y.5 E1.23457 F1800", "G1 X20 Y1",
+             "G1 Z.3"])
+        self.assertEqual(transcode(["G1 X10.12345"], decimals=2),
+                         ["G1 X10.12"])
+
+    def test_relative(self):
+        """Relative moves and arc offsets are not rounded"""
+        self.assertEqual(
+            transcode(["G91", "G1 X0.12345 E0.000012", "G90", "M83",
+                       "G1 X1.23456 E0.000012", "G2 X1 Y1 I0.55555 J0"]),
+            ["G91", "G1 X.12345 E.000012", "G90", "M83",
+             "G1 X1.235 E.000012", "G2 X1 Y1 I.55555 J0"])
+
+    def test_modal(self):
+        """Repeated feedrates and coordinates are not sent"""
+        lines = ["G90", "G1 X1 Y2 Z0.2 F1800", "G1 X2 Y2 E1 F1800",
+                 "G1 X2.0001 Y2 F1800", "G1 X3 F1200", "G0 X3 Y3 F9000",
+                 "G1 X4 Y3 F1200", "G2 X5 Y3 I1 J0 F1200", "G1 X5 Y3"]
+        self.assertEqual(
+            transcode(lines),
+            ["G90", "G1 X1 Y2 Z.2 F1800", "G1 X2 E1", "", "G1 X3 F1200",
+             "G0 Y3 F9000", "G1 X4 F1200", "G2 X5 Y3 I1 J0", "G1 X5 Y3"])
+        self.assertEqual(transcode(lines, drop_modal=False)[2],
+                         "G1 X2 Y2 E1 F1800")
+        self.assertEqual(transcode(lines, compact=True)[1],
+                         "G1X1Y2Z.2F1800")
+
+    def test_state_reset(self):
+        """The position and feedrate are forgotten after commands which may
+        change them"""
+        for command in ("G28", "G92 X0", "T1", "G20", "M600"):
+            with self.subTest(command=command):
+                self.assertEqual(
+                    transcode(["G1 X1 Y1 F1800", "M104 S200", "G1 X1 Y2",
+                               command, "G1 X1 Y2 F1800"])[2:],
+                    ["G1 Y2", command, "G1 X1 Y2 F1800"])
+
+    def test_untouched(self):
+        """Lines which are not moves made only of words are only stripped
+        of their comments"""
+        lines = ["M117 Hello 0.50", "G1 X1 N2", "G1 X1 G90", "G1 X1 *12",
+                 "G92 E0.000"]
+        self.assertEqual(transcode(lines),
+                         ["M117 Hello 0.50", "G1 X1 N2", "G1 X1 G90",
+                          "G1 X1 *12", "G92 E0.000"])
+
+    def test_wire_lines(self):
+        """Checksums match printcore's and sync points are flagged"""
+        lines = ["G1 X1.000 Y1.000 F1800", "; comment", "G1 X2.000 Y1.000",
+                 "G28", "G1 X1 Y1"]
+        wire = transcoder.Transcoder().transcode(gcoder.GCode(lines))
+        core = printcore.printcore()
+        self.assertEqual(len(wire), len(lines))
+        for i in range(len(wire)):
+            line, checksum = wire[i]
+            if line:
+                # pylint: disable-next=protected-access
+                self.assertEqual(checksum, core._checksum(line))
+        self.assertEqual(wire[1], ("", 0))
+        self.assertEqual(list(wire.syncs), [1, 0, 0, 0, 1])
+        # pylint: disable-next=protected-access
+        self.assertEqual(wire.trimmed(lines[2]),
+                         ("G1 X2 Y1", core._checksum("G1 X2 Y1")))
+        self.assertEqual(wire.bytes_before,
+                         sum(len(line) + 1 for line in lines) - 10)
+        self.assertEqual(wire.bytes_after, len("G1 X1 Y1 F1800 G1 X2 "
+                                               "G28 G1 X1 Y1 "))
+
+    def test_checksum(self):
+        """Non-ASCII characters are checksummed as the "?" sent for them"""
+        core = printcore.printcore()
+        for line in ("M117 Température", "M117 Temp?rature", "G1 X1"):
+            # pylint: disable-next=protected-access
+            self.assertEqual(transcoder.checksum(line), core._checksum(line))
+        self.assertEqual(transcoder.checksum("M117 Température"),
+                         transcoder.checksum("M117 Temp?rature"))
+
+    def test_keeps_state(self):
+        """Commands that may move the head or change the feedrate are
+        told apart"""
+        for line in ("M105", "m105", "G4 P100", "M117 G1 X1", "; G28", ""):
+            self.assertTrue(transcoder.keeps_state(line), line)
+        for line in ("G1 Z10", "G28 ; home", "G1X1", "G92 E0", "T1"):
+            self.assertFalse(transcoder.keeps_state(line), line)
+
+    def test_wire_lines_dropped(self):
+        """Editing the layers drops the precomputed lines"""
+        gcode = gcoder.GCode(["G1 X1 Y1", "G1 X2 Y2"])
+        gcode.wire_lines = transcoder.Transcoder().transcode(gcode)
+        gcode.prepend_to_layer(["G28"], 0)
+        self.assertIsNone(gcode.wire_lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
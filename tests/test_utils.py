@@ -0,0 +1,92 @@
+"""Test suite for `printrun/utils.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import unittest
+
+# Custom libraries:
+from printrun import gcoder
+from printrun import utils
+
+
+def square_layers(feedrates):
+    """Return a LightGCode with one square layer per feedrate"""
+    lines = ["G28", "G92 E0"]
+    e = 0
+    for layer, feedrate in enumerate(feedrates):
+        lines.append("G1 Z%.1f F600" % (0.2 * (layer + 1)))
+        for x, y in ((0, 0), (50, 0), (50, 50), (0, 50), (0, 0)):
+            e += 1
+            lines.append("G1 X%d Y%d E%d F%d" % (x, y, e, feedrate))
+    return gcoder.LightGCode(lines)
+
+
+class TestParseDuration(unittest.TestCase):
+    """Test the parsing of durations"""
+
+    def test_units(self):
+        """Hours, minutes and seconds can be combined"""
+        self.assertEqual(utils.parse_duration("2h10m"), 7800)
+        self.assertEqual(utils.parse_duration("90m"), 5400)
+        self.assertEqual(utils.parse_duration("1h 30s"), 3630)
+        self.assertEqual(utils.parse_duration("1.5h"), 5400)
+        self.assertEqual(utils.parse_duration("45"), 45)
+
+    def test_clock(self):
+        """Clock notation is read as hours, minutes and seconds"""
+        self.assertEqual(utils.parse_duration("1:30:00"), 5400)
+        self.assertEqual(utils.parse_duration("2:30"), 150)
+
+    def test_invalid(self):
+        """Invalid durations raise ValueError"""
+        for text in ("", "h", "2x", "1:a"):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    utils.parse_duration(text)
+
+
+class TestRemainingTimeEstimator(unittest.TestCase):
+    """Test the remaining time estimates"""
+
+    def test_elapsed(self):
+        """The remaining time is the estimated time after the line"""
+        gcode = square_layers([3000, 600, 3000])
+        estimator = utils.RemainingTimeEstimator(gcode)
+        total = gcode.elapsed_time(len(gcode))
+        for i in range(len(gcode)):
+            remaining, _ = estimator(i, 0)
+            self.assertAlmostEqual(remaining,
+                                   total - gcode.elapsed_time(i + 1))
+
+    def test_drift(self):
+        """Estimates are scaled by the measured speed of the print"""
+        gcode = square_layers([3000, 600, 3000])
+        estimator = utils.RemainingTimeEstimator(gcode)
+        start = gcode.layer_start(1)
+        estimator.update_layer(1, 2 * gcode.elapsed_time(start))
+        remaining, _ = estimator(start, 0)
+        self.assertAlmostEqual(
+            remaining,
+            2 * (gcode.elapsed_time(len(gcode))
+                 - gcode.elapsed_time(start + 1)))
+
+    def test_start(self):
+        """Prints started from a later line measure the drift from there"""
+        gcode = square_layers([3000, 600, 3000])
+        start = gcode.layer_start(1)
+        estimator = utils.RemainingTimeEstimator(gcode, start)
+        end = gcode.layer_start(2)
+        estimated = gcode.elapsed_time(end) - gcode.elapsed_time(start)
+        estimator.update_layer(2, estimated)
+        self.assertAlmostEqual(estimator.drift, 1)
+
+    def test_without_elapsed(self):
+        """Without elapsed times, layers are interpolated by line count"""
+        gcode = square_layers([3000, 600])
+        gcode.elapsed = None
+        estimator = utils.RemainingTimeEstimator(gcode)
+        remaining, total = estimator(0, 10)
+        self.assertLess(remaining,
+                        sum(layer.duration for layer in gcode.all_layers))
+        self.assertEqual(total, remaining + 10)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Mock serial printer with MeatPack support, on a pseudo-terminal (Linux,
+# macOS). The transfer time of the received bytes at the given baud rate
+# is simulated, so the gain of MeatPack can be measured without hardware.
+#
+# Run the printer and connect Pronterface to the printed port:
+#   python3 testtools/meatpack-printer.py --baud 115200
+# Or print a file with printcore without and with MeatPack:
+#   python3 testtools/meatpack-printer.py --benchmark file.gcode
+
+import argparse
+import os
+import sys
+import threading
+import time
+from functools import reduce
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import meatpack
+
+class MockPrinter:
+    """Firmware answering "ok" to each line received on a pseudo-terminal,
+    checking their line numbers and checksums"""
+
+    def __init__(self, baud = 115200, latency = 0.0005):
+        self.baud = baud
+        # Processing time of each line
+        self.latency = latency
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+        self.decoder = meatpack.Decoder()
+        self.received_bytes = 0
+        self.lines = 0
+        self.errors = 0
+        self.expected_lineno = 0
+        self.stopped = False
+        self.thread = threading.Thread(target = self.run, daemon = True)
+
+    def start(self):
+        self.thread.start()
+
+    def reply(self, text):
+        os.write(self.master, text.encode())
+
+    def run(self):
+        buffer = b""
+        clock = time.perf_counter()
+        while not self.stopped:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            # 10 bits per byte on the wire
+            clock = max(clock, time.perf_counter()) + \
+                len(data) * 10 / self.baud
+            self.received_bytes += len(data)
+            buffer += self.decoder.decode(data)
+            for report in self.decoder.reports:
+                self.reply(report)
+            self.decoder.reports.clear()
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                line = line.decode("ascii", "replace").strip()
+                if line:
+                    time.sleep(max(0, clock - time.perf_counter())
+                               + self.latency)
+                    self.process(line)
+
+    def process(self, line):
+        self.lines += 1
+        if line.startswith("N") and "*" in line:
+            command, checksum = line.rsplit("*", 1)
+            lineno = int(command[1:].split()[0])
+            expected = reduce(lambda x, y: x ^ y, map(ord, command))
+            if int(checksum) != expected:
+                self.errors += 1
+                self.reply("Error:checksum mismatch, Last Line: %d\n"
+                           "Resend: %d\nok\n" % (self.expected_lineno - 1,
+                                                 self.expected_lineno))
+                return
+            if "M110" in command:
+                self.expected_lineno = lineno + 1
+            elif lineno != self.expected_lineno:
+                self.errors += 1
+                self.reply("Error:Line Number is not Last Line Number+1\n"
+                           "Resend: %d\nok\n" % self.expected_lineno)
+                return
+            else:
+                self.expected_lineno += 1
+        if line.startswith("M105"):
+            self.reply("ok T:210.0 /210.0 B:60.0 /60.0\n")
+        else:
+            self.reply("ok\n")
+
+def benchmark(filename, baud):
+    from printrun import gcoder
+    from printrun import printcore
+    gcode = gcoder.LightGCode(open(filename))
+    results = []
+    for packed in (False, True):
+        printer = MockPrinter(baud)
+        printer.start()
+        core = printcore.printcore()
+        core.meatpack = packed
+        core.connect(printer.port, baud)
+        while not core.online or (packed and core.printer.meatpack is None):
+            time.sleep(0.01)
+        start_bytes = printer.received_bytes
+        start = time.perf_counter()
+        core.startprint(gcode)
+        time.sleep(0.1)
+        while core.printing:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        core.disconnect()
+        printer.stopped = True
+        sent = printer.received_bytes - start_bytes
+        print("%-9s %8d bytes, %6.2f s, %7.1f lines/s, %d errors"
+              % ("MeatPack" if packed else "Plain", sent, elapsed,
+                 len(gcode) / elapsed, printer.errors))
+        results.append(elapsed)
+    print("Speedup: %.2fx" % (results[0] / results[1]))
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--baud", type = int, default = 115200)
+    parser.add_argument("--benchmark", metavar = "GCODE",
+                        help = "print this file without and with MeatPack")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.benchmark, args.baud)
+        return
+    printer = MockPrinter(args.baud)
+    print("Mock printer on %s" % printer.port)
+    printer.start()
+    try:
+        while True:
+            time.sleep(1)
+            print("%d lines, %d bytes received, %d errors, MeatPack %s"
+                  % (printer.lines, printer.received_bytes, printer.errors,
+                     "on" if printer.decoder.active else "off"))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
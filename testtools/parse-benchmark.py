@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the G-code parsers on the files of testfiles/ (or the given ones)
+# and check that they agree. Test files are small, use --scale to parse
+# them repeated many times:
+#   python3 testtools/parse-benchmark.py --scale 200 --workers 1 2 4
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.gcoder_columnar import ColumnarGCode, ParallelGCode
+
+ATTRIBUTES = ("filament_length", "xmin", "xmax", "ymin", "ymax",
+              "zmin", "zmax", "duration", "layers_count")
+
+def parse(factory, filename):
+    # GCode shares its per-tool lists between instances, reset them
+    for attr in ("current_e_multi", "offset_e_multi", "total_e_multi",
+                 "max_e_multi", "filament_length_multi"):
+        setattr(gcoder.GCode, attr, [0])
+    start = time.perf_counter()
+    with open(filename, "r", encoding = "utf-8") as f:
+        gcode = factory(f)
+    return gcode, time.perf_counter() - start
+
+def summary(gcode):
+    values = [getattr(gcode, attr) for attr in ATTRIBUTES]
+    return [round(v, 3) if isinstance(v, float) else v for v in values] \
+        + [list(gcode.layer_idxs), list(gcode.line_idxs)]
+
+def main():
+    parser = argparse.ArgumentParser(description = "G-code parser benchmark")
+    parser.add_argument("files", nargs = "*", help = "G-code files")
+    parser.add_argument("--scale", type = int, default = 1,
+                        help = "repeat the content of each file this many times")
+    parser.add_argument("--workers", type = int, nargs = "+",
+                        default = [2, os.cpu_count() or 1],
+                        help = "worker counts of the parallel parser")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    ParallelGCode.min_chunk_size = 0
+    ParallelGCode.min_chunk_lines = 0
+    files = args.files or sorted(glob.glob(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "testfiles", "*.gcode")))
+    parsers = [("GCode", gcoder.GCode), ("ColumnarGCode", ColumnarGCode)]
+    parsers += [("ParallelGCode(%d)" % n,
+                 lambda f, n = n: ParallelGCode(f, workers = n))
+                for n in sorted(set(args.workers))]
+    totals = dict.fromkeys([name for name, _ in parsers], 0.)
+    for filename in files:
+        with tempfile.NamedTemporaryFile("w", suffix = ".gcode",
+                                         delete = False) as tmp:
+            with open(filename, "r", encoding = "utf-8") as f:
+                content = f.read()
+            for _ in range(args.scale):
+                tmp.write(content + "\n")
+        try:
+            print(os.path.basename(filename))
+            reference = None
+            for name, factory in parsers:
+                gcode, elapsed = parse(factory, tmp.name)
+                totals[name] += elapsed
+                result = summary(gcode)
+                if reference is None:
+                    reference = result
+                status = "" if result == reference else "  MISMATCH"
+                print("  %-20s %8d lines %8.3fs%s" % (name, len(gcode), elapsed, status))
+        finally:
+            os.unlink(tmp.name)
+    print("Total")
+    for name, _ in parsers:
+        print("  %-20s %8.3fs  x%.2f" % (name, totals[name], totals["GCode"] / totals[name]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measure the time printcore takes to send the next line of a print once
+# the printer answered "ok", and the CPU time it uses meanwhile. A mock
+# printer in a process of its own, on a pseudo-terminal (Linux, macOS),
+# answers each line after --delay seconds and timestamps the oks it sends
+# and the lines it receives:
+#   python3 testtools/send-latency.py --lines 2000 --delay 0.002
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def mock_printer(conn, delay):
+    master, slave = os.openpty()
+    conn.send(os.ttyname(slave))
+    latencies = []
+    last_ok = None
+    buffer = b""
+    while True:
+        data = os.read(master, 4096)
+        arrival = time.perf_counter()
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if last_ok is not None and line.startswith(b"N"):
+                latencies.append(arrival - last_ok)
+            last_ok = None
+            if line.startswith(b"M105"):
+                os.write(master, b"ok T:20.0 /0.0 B:20.0 /0.0\n")
+                continue
+            time.sleep(delay)
+            os.write(master, b"ok\n")
+            last_ok = time.perf_counter()
+            if line.startswith(b"M110") and latencies:
+                # End of the print
+                conn.send(latencies)
+                latencies = []
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return "median %.3f ms, 99%% %.3f ms, max %.3f ms" % (
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type = int, default = 2000)
+    parser.add_argument("--delay", type = float, default = 0.002,
+                        help = "seconds the printer takes to answer a line")
+    parser.add_argument("--baud", type = int, default = 250000)
+    args = parser.parse_args()
+
+    from printrun import gcoder
+    from printrun import printcore
+    conn, child_conn = multiprocessing.Pipe()
+    printer = multiprocessing.Process(target = mock_printer,
+                                      args = (child_conn, args.delay),
+                                      daemon = True)
+    printer.start()
+    port = conn.recv()
+    core = printcore.printcore()
+    core.connect(port, args.baud)
+    while not core.online:
+        time.sleep(0.01)
+    gcode = gcoder.LightGCode(["G1 X%d Y%d" % (i % 100, i % 7)
+                               for i in range(args.lines)])
+    start = time.perf_counter()
+    cpu = time.process_time()
+    core.startprint(gcode)
+    latencies = conn.recv()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    print("%d lines in %.2f s, host CPU %.2f s (%.0f%%)"
+          % (args.lines, elapsed, cpu, 100 * cpu / elapsed))
+    print("ok to next line, at the printer: " + summary(latencies))
+    host = getattr(core, "send_latencies", None)
+    if host:
+        print("ok to next line, in printcore:   " + summary(host))
+    core.disconnect()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Lines/sec of the G-code line helpers with the former regular expressions,
+# the pure-Python tokenizer and the compiled one (if built):
+#   python3 testtools/tokenizer-benchmark.py [file.gcode ...]
+
+import glob
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun import tokenizer
+
+try:
+    from printrun import gcoder_tokenizer
+except ImportError:
+    gcoder_tokenizer = None
+
+# Expressions used before the tokenizer
+gcode_exp = re.compile(r"\([^\(\)]*\)|;.*|[/\*].*\n|([%s])\s*([-+]?[0-9]*\.?[0-9]*)" % gcoder.to_parse)
+specific_exp = r"(?:\([^\(\)]*\))|(?:;.*)|(?:[/\*].*\n)|(%s[-+]?[0-9]*\.?[0-9]*)"
+m114_exp = re.compile(r"\([^\(\)]*\)|[/\*].*\n|([XYZ]):?([-+]?[0-9]*\.?[0-9]*)")
+strip_comment_exp = re.compile(r"\([^\(\)]*\)|;.*|[/\*].*\n")
+
+def regex_find_code(line, code):
+    bits = [bit for bit in re.findall(specific_exp % code, line) if bit]
+    return bits[0][1:] if bits else None
+
+REPORTS = ["X:10.00 Y:20.00 Z:0.30 E:0.00 Count X:800 Y:1600 Z:120",
+           "ok C: X:0.00 Y:0.00 Z:0.00 E:0.00",
+           "ok T:210.0 /210.0 B:60.0 /60.0 @:64 B@:127"]
+
+def implementations():
+    yield "regex", {
+        "split": lambda l: gcode_exp.findall(l.lower()),
+        "S/P": lambda l: regex_find_code(l, "S"),
+        "strip": lambda l: strip_comment_exp.sub("", l),
+        "m114": m114_exp.findall,
+    }
+    modules = [("python", tokenizer, "py_")]
+    if gcoder_tokenizer is not None:
+        modules.append(("compiled", gcoder_tokenizer, ""))
+    for name, module, prefix in modules:
+        split = getattr(module, prefix + "split")
+        find_code = getattr(module, prefix + "find_code")
+        report_words = getattr(module, prefix + "report_words")
+        yield name, {
+            "split": lambda l, split = split: split(l, gcoder.to_parse),
+            "S/P": lambda l, find_code = find_code: find_code(l, "S"),
+            "strip": getattr(module, prefix + "strip_comments"),
+            "m114": lambda l, report_words = report_words: report_words(l, "XYZ"),
+        }
+
+def main():
+    files = sys.argv[1:] or sorted(glob.glob(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "testfiles", "*.gcode")))
+    lines = []
+    for filename in files:
+        with open(filename, "r", encoding = "utf-8") as f:
+            lines += [l2 for l2 in (l.strip() for l in f) if l2]
+    reports = REPORTS * (len(lines) // len(REPORTS) + 1)
+    if gcoder_tokenizer is None:
+        print("Compiled tokenizer not built, only timing the Python one")
+    print("%d lines" % len(lines))
+    results = {}
+    for name, functions in implementations():
+        row = []
+        for helper, function in functions.items():
+            data = reports if helper == "m114" else lines
+            repeat = max(1, 200000 // len(data))
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for line in data:
+                    function(line)
+            elapsed = time.perf_counter() - start
+            rate = repeat * len(data) / elapsed
+            results[name, helper] = rate
+            row.append("%s %9.0f/s" % (helper, rate))
+            if name != "regex":
+                row[-1] += " (x%.1f)" % (rate / results["regex", helper])
+        print("%-9s %s" % (name, "  ".join(row)))
+
+if __name__ == "__main__":
+    main()
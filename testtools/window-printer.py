@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Mock Marlin printer with a command buffer and a motion planner, on a
+# pseudo-terminal (Linux, macOS). The wire time of the received bytes, the
+# USB latency of each direction and the duration of the moves are
+# simulated, the printer answers with ADVANCED_OK replies. Lines arriving
+# while the input is full are corrupted, as an overflowing serial buffer
+# would, and random lines can be corrupted with --errors.
+#
+# Compare the stop-and-wait sender of printcore with sending ahead, on
+# short moves or the given file:
+#   python3 testtools/window-printer.py --benchmark
+#   python3 testtools/window-printer.py --benchmark file.gcode --errors 0.01
+# Or run the printer and connect Pronterface to the printed port:
+#   python3 testtools/window-printer.py
+
+import argparse
+import collections
+import heapq
+import os
+import random
+import sys
+import threading
+import time
+from functools import reduce
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+class MockPrinter:
+    """Firmware with a command buffer of `bufsize` lines and a planner of
+    `blocks` moves of `move_time` seconds, answering each line after
+    `latency` seconds"""
+
+    def __init__(self, baud = 250000, latency = 0.001, bufsize = 4,
+                 blocks = 16, move_time = 0.002, rx_lines = 2,
+                 error_rate = 0.0):
+        self.baud = baud
+        self.latency = latency
+        self.bufsize = bufsize
+        self.blocks = blocks
+        self.move_time = move_time
+        # Lines the serial input buffer holds besides the command buffer
+        self.rx_lines = rx_lines
+        self.error_rate = error_rate
+        self.random = random.Random(1)
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+        self.condition = threading.Condition()
+        # (arrival time, line, corrupted) of the lines received
+        self.received = collections.deque()
+        self.replies = []
+        self.planner = collections.deque()
+        self.last_n = 0
+        self.lines = 0
+        self.moves = 0
+        self.errors = 0
+        self.underruns = 0
+        self.idle = 0.0
+        self.stopped = False
+        self.threads = [threading.Thread(target = target, daemon = True)
+                        for target in (self.read, self.process, self.reply)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped = True
+        with self.condition:
+            self.condition.notify_all()
+
+    def read(self):
+        buffer = b""
+        clock = time.perf_counter()
+        while not self.stopped:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            with self.condition:
+                for line in lines:
+                    line = line.decode("ascii", "replace").strip()
+                    if not line:
+                        continue
+                    # 10 bits per byte on the wire
+                    clock = max(clock, time.perf_counter()) \
+                        + (len(line) + 1) * 10 / self.baud
+                    overflow = len(self.received) >= \
+                        self.bufsize + self.rx_lines
+                    corrupted = overflow or \
+                        self.random.random() < self.error_rate
+                    self.received.append((clock + self.latency, line,
+                                          corrupted))
+                self.condition.notify_all()
+
+    def send(self, text):
+        with self.condition:
+            heapq.heappush(self.replies,
+                           (time.perf_counter() + self.latency, text))
+            self.condition.notify_all()
+
+    def reply(self):
+        while not self.stopped:
+            with self.condition:
+                while not self.stopped and not self.replies:
+                    self.condition.wait()
+                if self.stopped:
+                    break
+                due, text = self.replies[0]
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.replies)
+            os.write(self.master, text.encode())
+
+    def ok(self):
+        now = time.perf_counter()
+        while self.planner and self.planner[0] <= now:
+            self.planner.popleft()
+        # The command buffer holds the lines arrived, this one included
+        arrived = sum(1 for arrival, line, corrupted in self.received
+                      if arrival <= now)
+        free = max(0, self.bufsize - arrived)
+        return "ok N%d P%d B%d\n" % (self.last_n,
+                                      self.blocks - len(self.planner), free)
+
+    def process(self):
+        while not self.stopped:
+            with self.condition:
+                while not self.stopped and not self.received:
+                    self.condition.wait()
+                if self.stopped:
+                    break
+                arrival, line, corrupted = self.received[0]
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+            self.execute(line, corrupted)
+            with self.condition:
+                self.received.popleft()
+
+    def execute(self, line, corrupted):
+        self.lines += 1
+        if line.startswith("N") and "*" in line:
+            command, checksum = line.rsplit("*", 1)
+            lineno = int(command[1:].split()[0])
+            expected = reduce(lambda x, y: x ^ y, map(ord, command))
+            if corrupted or int(checksum) != expected:
+                self.errors += 1
+                self.send("Error:checksum mismatch, Last Line: %d\n"
+                          "Resend: %d\nok\n" % (self.last_n, self.last_n + 1))
+                return
+            if "M110" in command:
+                self.last_n = lineno
+            elif lineno != self.last_n + 1:
+                self.send("Error:Line Number is not Last Line Number+1, "
+                          "Last Line: %d\nResend: %d\nok\n"
+                          % (self.last_n, self.last_n + 1))
+                return
+            else:
+                self.last_n = lineno
+            line = command.split(" ", 1)[1]
+        if line.startswith(("G0", "G1", "G2", "G3")):
+            self.plan_move()
+        if line.startswith("M105"):
+            self.send("ok T:210.0 /210.0 B:60.0 /60.0\n")
+        else:
+            self.send(self.ok())
+
+    def plan_move(self):
+        now = time.perf_counter()
+        while self.planner and self.planner[0] <= now:
+            self.planner.popleft()
+        if len(self.planner) >= self.blocks:
+            # Full planner, the next line waits for a free block
+            time.sleep(self.planner[0] - now)
+            now = self.planner.popleft()
+        if self.planner:
+            start = self.planner[-1]
+        else:
+            start = now
+            if self.moves:
+                # Starved planner
+                self.underruns += 1
+                self.idle += now - self.last_end
+        self.last_end = start + self.move_time
+        self.planner.append(self.last_end)
+        self.moves += 1
+
+def short_moves(count):
+    return ["G1 X%.3f Y%.3f E%.5f" % (100 + (i % 20) * 0.3, 100 + i % 2,
+                                      i * 0.01)
+            for i in range(count)]
+
+def benchmark(filename, args):
+    from printrun import gcoder
+    from printrun import printcore
+    if filename:
+        with open(filename) as f:
+            gcode = gcoder.LightGCode(f)
+    else:
+        gcode = gcoder.LightGCode(short_moves(args.lines))
+    results = {}
+    for name, window in (("Stop-and-wait", 1), ("Learned window", 0)):
+        printer = MockPrinter(args.baud, args.latency, args.bufsize,
+                              move_time = args.move_time,
+                              error_rate = args.errors)
+        printer.start()
+        core = printcore.printcore()
+        core.send_window = window
+        core.errorcb = lambda error: None
+        core.connect(printer.port, args.baud)
+        while not core.online:
+            time.sleep(0.01)
+        start = time.perf_counter()
+        core.startprint(gcode)
+        time.sleep(0.1)
+        while core.printing or printer.received:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        window = core._window_size()
+        core.disconnect()
+        printer.stop()
+        print("%-15s %6.2f s, %7.1f lines/s, window %2d, planner idle "
+              "%5.2f s (%d underruns), %d errors"
+              % (name, elapsed, len(gcode) / elapsed, window, printer.idle,
+                 printer.underruns, printer.errors))
+        # Lines are numbered from 0
+        if printer.last_n + 1 < len(gcode):
+            print("  only %d of %d lines printed!"
+                  % (printer.last_n + 1, len(gcode)))
+        results[name] = elapsed
+    print("Speedup: %.2fx" % (results["Stop-and-wait"]
+                              / results["Learned window"]))
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--baud", type = int, default = 250000)
+    parser.add_argument("--latency", type = float, default = 0.001,
+                        help = "USB latency of each direction in seconds")
+    parser.add_argument("--bufsize", type = int, default = 4,
+                        help = "command buffer size (Marlin BUFSIZE)")
+    parser.add_argument("--move-time", type = float, default = 0.002,
+                        help = "duration of each move in seconds")
+    parser.add_argument("--errors", type = float, default = 0.0,
+                        help = "rate of lines received corrupted")
+    parser.add_argument("--lines", type = int, default = 2000,
+                        help = "short moves printed without a file")
+    parser.add_argument("--benchmark", metavar = "GCODE", nargs = "?",
+                        const = "", default = None,
+                        help = "print this file (or short moves) "
+                        "stop-and-wait then sending ahead")
+    args = parser.parse_args()
+    if args.benchmark is not None:
+        benchmark(args.benchmark, args)
+        return
+    printer = MockPrinter(args.baud, args.latency, args.bufsize,
+                          move_time = args.move_time,
+                          error_rate = args.errors)
+    print("Mock printer on %s" % printer.port)
+    printer.start()
+    try:
+        while True:
+            time.sleep(1)
+            print("%d lines, %d moves, planner idle %.2f s, %d errors"
+                  % (printer.lines, printer.moves, printer.idle,
+                     printer.errors))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()